@@ -0,0 +1,179 @@
+"""
+AGREGADOS POR VENTANA DE LAS MEDICIONES (módulo compartido)
+
+receptor_mqtt.py escribe cada punto crudo (uno cada ~2 s) a INFLUX_BUCKET_NEW.
+Para consultas de rango largo (tableros, exportaciones) no hace falta esa
+resolución, así que con INFLUX_BUCKET_REDUCIDO configurado el receptor
+acumula en memoria, por dispositivo y ventana (1 y 15 minutos por defecto):
+- vrms mínimo, máximo y promedio
+- potencia promedio
+- fuga máxima
+- factor de potencia promedio
+- número de muestras
+y escribe cada ventana como 'energia_1m' / 'energia_15m' (tag device_id,
+timestamp = inicio de la ventana) en el bucket reducido al cerrarse.
+
+Cada ventana guarda los ts_unix que ya sumó: una muestra repetida (reenvío
+QoS 1 tras reconectar, reintento de un reenvío del búfer de gracia) no se
+cuenta dos veces.
+
+Una ventana se cierra cuando terminó hace AGREGADOS_CIERRE_S segundos y no
+ha recibido muestras en ese lapso (así un backlog que llega en orden se
+escribe completo). Las ventanas escritas se conservan AGREGADOS_RETENCION_S
+segundos: si llega una muestra tardía se vuelven a escribir ya combinadas.
+Una muestra más vieja que eso abre la ventana de nuevo y la sobrescribe solo
+con lo que llegue (el caso de una ventana vista a medias antes de que el
+dispositivo se desconectara).
+"""
+
+import os
+import time
+import threading
+from array import array
+from bisect import bisect_left
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- 1. Configuración ---
+
+INFLUX_BUCKET_REDUCIDO = os.environ.get("INFLUX_BUCKET_REDUCIDO")
+# Anchos de ventana en segundos
+AGREGADOS_VENTANAS_S = tuple(
+    int(v) for v in os.environ.get("AGREGADOS_VENTANAS_S", "60,900").split(",") if v.strip()
+)
+# Segundos sin muestras (y después del fin de la ventana) antes de escribirla
+AGREGADOS_CIERRE_S = int(os.environ.get("AGREGADOS_CIERRE_S", 30))
+# Segundos que se conserva una ventana ya escrita por si llegan datos tardíos
+AGREGADOS_RETENCION_S = int(os.environ.get("AGREGADOS_RETENCION_S", 3600))
+# Segundos entre revisiones de ventanas cerradas
+AGREGADOS_FLUSH_S = float(os.environ.get("AGREGADOS_FLUSH_S", 10))
+
+# Posiciones del acumulador de una ventana
+N, VRMS_MIN, VRMS_MAX, VRMS_SUMA, POTENCIA_SUMA, FUGA_MAX, FP_SUMA, ULTIMA_MUESTRA, SUCIA, VISTOS = range(10)
+
+
+def medicion_ventana(ancho_s):
+    """Nombre de la medición en InfluxDB para un ancho de ventana (ej. 'energia_15m')."""
+    return f"energia_{ancho_s // 60}m" if ancho_s % 60 == 0 else f"energia_{ancho_s}s"
+
+
+# --- 2. Agregador ---
+
+class AgregadorVentanas:
+    """Acumuladores por (ancho, device_id, inicio de ventana) (thread-safe)."""
+
+    def __init__(self, anchos=AGREGADOS_VENTANAS_S):
+        self.anchos = tuple(anchos)
+        self.ventanas = {}
+        self.lock = threading.Lock()
+
+    def _combinar(self, llave, n, vrms_min, vrms_max, vrms_suma, potencia_suma, fuga_max, fp_suma, ahora, vistos):
+        acumulado = self.ventanas.get(llave)
+        if acumulado is None:
+            self.ventanas[llave] = [n, vrms_min, vrms_max, vrms_suma, potencia_suma, fuga_max, fp_suma, ahora, True,
+                                    vistos]
+            return
+        acumulado[N] += n
+        acumulado[VRMS_MIN] = min(acumulado[VRMS_MIN], vrms_min)
+        acumulado[VRMS_MAX] = max(acumulado[VRMS_MAX], vrms_max)
+        acumulado[VRMS_SUMA] += vrms_suma
+        acumulado[POTENCIA_SUMA] += potencia_suma
+        acumulado[FUGA_MAX] = max(acumulado[FUGA_MAX], fuga_max)
+        acumulado[FP_SUMA] += fp_suma
+        acumulado[ULTIMA_MUESTRA] = ahora
+        acumulado[SUCIA] = True
+        acumulado[VISTOS] = vistos
+
+    def agregar(self, device_id, ts_unix, vrms, potencia, fuga, fp):
+        ts_unix = int(ts_unix)
+        ahora = time.time()
+        with self.lock:
+            for ancho in self.anchos:
+                llave = (ancho, device_id, ts_unix // ancho * ancho)
+                acumulado = self.ventanas.get(llave)
+                vistos = array('I') if acumulado is None else acumulado[VISTOS]
+                i = bisect_left(vistos, ts_unix)
+                if i < len(vistos) and vistos[i] == ts_unix:
+                    continue
+                vistos.insert(i, ts_unix)
+                self._combinar(llave, 1, vrms, vrms, vrms, potencia, fuga, fp, ahora, vistos)
+
+    def agregar_lote(self, device_id, ts_unix, vrms, potencia, fuga, fp):
+        """Igual que agregar() para arreglos numpy: agrupa por ventana con reduceat."""
+        ts_unix, unicos = np.unique(np.asarray(ts_unix, dtype=np.int64), return_index=True)
+        if len(ts_unix) == 0:
+            return
+        columnas = [np.asarray(c, dtype=np.float64)[unicos] for c in (vrms, potencia, fuga, fp)]
+        ahora = time.time()
+        with self.lock:
+            for ancho in self.anchos:
+                # ts_unix está ordenado, así que las ventanas quedan contiguas
+                ventana = ts_unix // ancho
+                inicios, cortes = np.unique(ventana, return_index=True)
+                fines = np.append(cortes[1:], len(ts_unix))
+                nuevas = np.ones(len(ts_unix), dtype=bool)
+                vistos_previos = {}
+                for inicio, corte, fin in zip(inicios.tolist(), cortes.tolist(), fines.tolist()):
+                    acumulado = self.ventanas.get((ancho, device_id, inicio * ancho))
+                    if acumulado is not None and len(acumulado[VISTOS]):
+                        previos = np.frombuffer(acumulado[VISTOS], dtype=np.uint32)
+                        nuevas[corte:fin] = ~np.isin(ts_unix[corte:fin], previos)
+                        vistos_previos[inicio] = previos
+                if not nuevas.any():
+                    continue
+                ts_nuevos = ts_unix[nuevas]
+                v, p, f, pf = (c[nuevas] for c in columnas)
+                ventana = ts_nuevos // ancho
+                inicios, cortes, conteos = np.unique(ventana, return_index=True, return_counts=True)
+                filas = zip(
+                    inicios.tolist(), cortes.tolist(), conteos.tolist(),
+                    np.minimum.reduceat(v, cortes).tolist(), np.maximum.reduceat(v, cortes).tolist(),
+                    np.add.reduceat(v, cortes).tolist(), np.add.reduceat(p, cortes).tolist(),
+                    np.maximum.reduceat(f, cortes).tolist(), np.add.reduceat(pf, cortes).tolist(),
+                )
+                for inicio, corte, conteo, *valores in filas:
+                    propios = ts_nuevos[corte:corte + conteo]
+                    previos = vistos_previos.get(inicio)
+                    if previos is not None:
+                        propios = np.union1d(previos, propios)
+                    vistos = array('I', propios.astype(np.uint32).tobytes())
+                    self._combinar((ancho, device_id, inicio * ancho), conteo, *valores, ahora, vistos)
+
+    def cerradas(self, ahora=None):
+        """
+        Ventanas listas para escribir: [(ancho, device_id, inicio_unix, campos)].
+        Quedan como escritas (reintentar() si la escritura falla) y se olvidan
+        las que pasaron AGREGADOS_RETENCION_S sin cambios.
+        """
+        ahora = time.time() if ahora is None else ahora
+        filas = []
+        with self.lock:
+            for llave, a in list(self.ventanas.items()):
+                ancho, device_id, inicio = llave
+                fin = inicio + ancho
+                if a[SUCIA]:
+                    if ahora - fin >= AGREGADOS_CIERRE_S and ahora - a[ULTIMA_MUESTRA] >= AGREGADOS_CIERRE_S:
+                        a[SUCIA] = False
+                        filas.append((ancho, device_id, inicio, {
+                            'vrms_min': a[VRMS_MIN],
+                            'vrms_max': a[VRMS_MAX],
+                            'vrms_media': a[VRMS_SUMA] / a[N],
+                            'power_media': a[POTENCIA_SUMA] / a[N],
+                            'leakage_max': a[FUGA_MAX],
+                            'power_factor_media': a[FP_SUMA] / a[N],
+                            'muestras': a[N],
+                        }))
+                elif ahora - max(fin, a[ULTIMA_MUESTRA]) >= AGREGADOS_RETENCION_S:
+                    del self.ventanas[llave]
+        return filas
+
+    def reintentar(self, filas):
+        """Vuelve a marcar como pendientes las ventanas de una escritura fallida."""
+        with self.lock:
+            for ancho, device_id, inicio, _ in filas:
+                acumulado = self.ventanas.get((ancho, device_id, inicio))
+                if acumulado is not None:
+                    acumulado[SUCIA] = True
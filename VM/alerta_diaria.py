@@ -1,5 +1,8 @@
 # -------------------------------------------------------------------
-# Script de Alertas Diarias para LETE v4.1 (Integración con Telegram)
+# Script de Alertas Diarias para LETE v5.0 (Integración con Telegram)
+# - v5.0: Planificador: clasifica a todos los clientes, precarga consumos por
+#   lote y envía con concurrencia acotada. Bitácora diaria de envíos para
+#   reanudar sin duplicar mensajes. Tiempos por fase en el resumen.
 # - Lee datos de consumo desde InfluxDB en lugar de CSV.
 # - Consultas a PostgreSQL actualizadas para la nueva estructura (clientes/dispositivos_lete).
 # - Se implementa la lógica de "Primer Periodo" para proyecciones precisas.
@@ -9,19 +12,23 @@
 
 # --- 1. Importaciones ---
 import psycopg2
+from psycopg2.extras import execute_values
 import requests
 import pandas as pd
 import certifi
 import os
 import json
-from datetime import date, datetime, timedelta
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import pytz
 from tenacity import retry, stop_after_attempt, wait_exponential
-import calendar
 
-# --- ¡NUEVA IMPORTACIÓN REQUERIDA! ---
-from influxdb_client import InfluxDBClient
+from consumo_energia import asegurar_esquema_acumulados, obtener_consumo_desde_influxdb, obtener_consumo_lote, obtener_consumo_periodo_lote
+from outbox_notificaciones import NOTIFICACIONES_OUTBOX, asegurar_esquema_outbox, encolar_notificaciones, intenciones
+from facturacion_cfe import TARIFAS_CFE, calcular_costo_estimado_vectorizado, calcular_fechas_corte, fecha_corte_anterior, precalcular_calendario
 
 # --- 2. Carga de Variables de Entorno ---
 load_dotenv()
@@ -69,31 +76,137 @@ TPL_DISPOSITIVO_OFFLINE = os.environ.get("TPL_DISPOSITIVO_OFFLINE")
 
 
 # --- Lógica de Negocio y Reglas ---
-IVA = 1.16
 ZONA_HORARIA_LOCAL = pytz.timezone('America/Mexico_City')
 MIN_DIAS_PARA_PROYECCION = 5
 
-# --- Estructura de Tarifas CFE (Refactorizada) ---
-TARIFAS_CFE = {
-    '01': [
-        {'hasta_kwh': 150, 'precio': 1.08},
-        {'hasta_kwh': 280, 'precio': 1.32},
-        {'hasta_kwh': float('inf'), 'precio': 3.85}
-    ],
-    '01A': [
-        {'hasta_kwh': 150, 'precio': 1.08},
-        {'hasta_kwh': 300, 'precio': 1.32},
-        {'hasta_kwh': float('inf'), 'precio': 3.85}
-    ],
-    'PDBT': [
-        {'hasta_kwh': float('inf'), 'precio': 5.60}
-    ],
-    'DAC': [
-        {'hasta_kwh': float('inf'), 'precio': 7.80}
-    ]
-}
+# Tarifas, costo estimado y calendario de cortes: ver facturacion_cfe.py
 
 # --- 5. Funciones de Base de Datos (MODIFICADAS) ---
+
+# Envíos completados entre cada aplicación de las actualizaciones en cola
+ALERTA_LOTE_CLIENTES = int(os.environ.get("ALERTA_LOTE_CLIENTES", 50))
+
+COLUMNAS_BANDERA = ("notificacion_corte_3dias_enviada", "notificacion_dia_corte_enviada")
+
+
+class SesionBD:
+    """
+    Una sola conexión a PostgreSQL por corrida (se reabre solo si se cae).
+    Las actualizaciones de promedios y banderas se encolan en memoria y se
+    aplican juntas, en una transacción, con aplicar_pendientes().
+    Lleva la cuenta de conexiones abiertas y sentencias ejecutadas.
+    Es segura entre hilos: los envíos concurrentes encolan y registran
+    a través de un candado.
+    """
+
+    def __init__(self):
+        self.conn = None
+        self.conexiones = 0
+        self.sentencias = 0
+        self._promedios = {}
+        self._banderas = {columna: set() for columna in COLUMNAS_BANDERA}
+        self._reseteos = set()
+        self._notificaciones = []
+        self._lock = threading.RLock()
+
+    def conectar(self):
+        if self.conn is None or self.conn.closed:
+            self.conn = psycopg2.connect(host=DB_HOST, user=DB_USER, password=DB_PASS, dbname=DB_NAME)
+            self.conexiones += 1
+        return self.conn
+
+    def consultar(self, sql, params=None):
+        with self._lock:
+            with self.conectar().cursor() as cursor:
+                cursor.execute(sql, params)
+                self.sentencias += 1
+                filas = cursor.fetchall() if cursor.description else []
+            self.conn.commit()
+            return filas
+
+    def encolar_promedio(self, device_id, promedio):
+        with self._lock:
+            self._promedios[device_id] = float(promedio)
+
+    def encolar_bandera(self, device_id, columna):
+        with self._lock:
+            self._banderas[columna].add(device_id)
+
+    def encolar_reseteo(self, device_id):
+        with self._lock:
+            self._reseteos.add(device_id)
+
+    def encolar_notificaciones(self, filas):
+        with self._lock:
+            self._notificaciones.extend(filas)
+
+    def hay_pendientes(self):
+        return bool(self._promedios or self._reseteos or self._notificaciones or any(self._banderas.values()))
+
+    def aplicar_pendientes(self):
+        """Aplica en una transacción todo lo encolado. Si falla, lo conserva para reintentar."""
+        with self._lock:
+            self._aplicar_pendientes()
+
+    def _aplicar_pendientes(self):
+        if not self.hay_pendientes():
+            return
+        conn = self.conectar()
+        try:
+            # Intenciones del outbox y banderas se confirman en la misma transacción
+            nuevas = encolar_notificaciones(conn, self._notificaciones)
+            if self._notificaciones:
+                self.sentencias += 1
+            with conn.cursor() as cursor:
+                if self._promedios:
+                    execute_values(cursor, """
+                        UPDATE clientes c
+                        SET kwh_promedio_diario = v.promedio
+                        FROM dispositivos_lete d, (VALUES %s) AS v(device_id, promedio)
+                        WHERE c.id = d.cliente_id AND d.device_id = v.device_id
+                    """, list(self._promedios.items()))
+                    self.sentencias += 1
+                # Los reseteos (inicio de ciclo) van antes que las banderas nuevas
+                if self._reseteos:
+                    cursor.execute("""
+                        UPDATE clientes c
+                        SET notificacion_corte_3dias_enviada = false,
+                            notificacion_dia_corte_enviada = false
+                        FROM dispositivos_lete d
+                        WHERE c.id = d.cliente_id AND d.device_id = ANY(%s)
+                    """, (list(self._reseteos),))
+                    self.sentencias += 1
+                for columna, dispositivos in self._banderas.items():
+                    if not dispositivos: continue
+                    cursor.execute(f"""
+                        UPDATE clientes c
+                        SET {columna} = true
+                        FROM dispositivos_lete d
+                        WHERE c.id = d.cliente_id AND d.device_id = ANY(%s)
+                    """, (list(dispositivos),))
+                    self.sentencias += 1
+            conn.commit()
+        except Exception as e:
+            print(f"❌ ERROR al aplicar actualizaciones en lote (se reintentará): {e}")
+            conn.rollback()
+            return
+        print(f"✅ Actualizaciones aplicadas: {len(self._promedios)} promedios, "
+              f"{len(self._reseteos)} reseteos, {sum(len(d) for d in self._banderas.values())} banderas, "
+              f"{nuevas} notificaciones nuevas en el outbox.")
+        self._notificaciones.clear()
+        self._promedios.clear()
+        self._reseteos.clear()
+        for dispositivos in self._banderas.values():
+            dispositivos.clear()
+
+    def cerrar(self):
+        if self.conn is not None and not self.conn.closed:
+            self.conn.close()
+
+
+sesion_bd = SesionBD()
+
+
 def obtener_clientes():
     """
     Obtiene la lista de clientes y sus datos relevantes, uniendo las tablas
@@ -101,12 +214,9 @@ def obtener_clientes():
     y el nuevo "telegram_chat_id".
     """
     try:
-        conn = psycopg2.connect(host=DB_HOST, user=DB_USER, password=DB_PASS, dbname=DB_NAME)
-        cursor = conn.cursor()
-        
         # --- ¡CONSULTA MODIFICADA CON JOIN Y NUEVO CAMPO! ---
         # Se añaden lectura_cierre_periodo_anterior y lectura_medidor_inicial
-        cursor.execute("""
+        lista_clientes = sesion_bd.consultar("""
             SELECT 
                 d.device_id, 
                 c.telefono_whatsapp, 
@@ -129,9 +239,6 @@ def obtener_clientes():
         """)
         # El orden de las columnas debe ser consistente.
         
-        lista_clientes = cursor.fetchall()
-        cursor.close()
-        conn.close()
         print(f"✅ Se encontraron {len(lista_clientes)} clientes activos en la base de datos.")
         return lista_clientes
     except Exception as e:
@@ -139,116 +246,52 @@ def obtener_clientes():
         return []
 
 def actualizar_promedio_cliente(device_id, nuevo_promedio):
-    """Actualiza el kwh_promedio_diario para un cliente en Supabase (vía device_id)."""
-    print(f"ACTUALIZANDO promedio para {device_id} a {nuevo_promedio:.2f} kWh/día...")
-    try:
-        conn = psycopg2.connect(host=DB_HOST, user=DB_USER, password=DB_PASS, dbname=DB_NAME)
-        cursor = conn.cursor()
-        
-        # --- ¡CONSULTA MODIFICADA CON UPDATE...FROM...WHERE! ---
-        sql_update_query = """
-            UPDATE clientes c
-            SET kwh_promedio_diario = %s
-            FROM dispositivos_lete d
-            WHERE c.id = d.cliente_id AND d.device_id = %s
-        """
-        cursor.execute(sql_update_query, (float(nuevo_promedio), device_id))
-        conn.commit()
-        print(f"✅ Promedio para {device_id} actualizado exitosamente.")
-    except Exception as e:
-        print(f"❌ ERROR al actualizar el promedio para {device_id}: {e}")
-    finally:
-        if 'cursor' in locals() and not cursor.closed: cursor.close()
-        if 'conn' in locals() and not conn.closed: conn.close()
+    """Encola la actualización del kwh_promedio_diario de un cliente (vía device_id)."""
+    print(f"ACTUALIZANDO promedio para {device_id} a {nuevo_promedio:.2f} kWh/día (en cola)...")
+    sesion_bd.encolar_promedio(device_id, nuevo_promedio)
 
 def marcar_notificacion_enviada(device_id, tipo_notificacion):
-    """Marca una notificación de corte como enviada para no repetirla."""
+    """Encola la bandera de notificación de corte enviada para no repetirla."""
     columna_a_actualizar = f"{tipo_notificacion}_enviada"
-    print(f"Marcando bandera '{columna_a_actualizar}' para {device_id}...")
-    try:
-        conn = psycopg2.connect(host=DB_HOST, user=DB_USER, password=DB_PASS, dbname=DB_NAME)
-        cursor = conn.cursor()
-        if columna_a_actualizar not in ["notificacion_corte_3dias_enviada", "notificacion_dia_corte_enviada"]:
-            print(f"⚠️  Intento de actualizar columna no permitida: {columna_a_actualizar}")
-            return
-            
-        # --- ¡CONSULTA MODIFICADA CON UPDATE...FROM...WHERE! ---
-        sql_update_query = f"""
-            UPDATE clientes c
-            SET {columna_a_actualizar} = true
-            FROM dispositivos_lete d
-            WHERE c.id = d.cliente_id AND d.device_id = %s
-        """
-        cursor.execute(sql_update_query, (device_id,))
-        conn.commit()
-    except Exception as e:
-        print(f"❌ ERROR al actualizar bandera de notificación para {device_id}: {e}")
-    finally:
-        if 'cursor' in locals() and not cursor.closed: cursor.close()
-        if 'conn' in locals() and not conn.closed: conn.close()
+    if columna_a_actualizar not in COLUMNAS_BANDERA:
+        print(f"⚠️  Intento de actualizar columna no permitida: {columna_a_actualizar}")
+        return
+    print(f"Marcando bandera '{columna_a_actualizar}' para {device_id} (en cola)...")
+    sesion_bd.encolar_bandera(device_id, columna_a_actualizar)
 
 def resetear_banderas_notificacion(device_id):
-    """Resetea las banderas al inicio de un nuevo ciclo."""
-    print(f"Reseteando banderas de notificación para {device_id}...")
-    try:
-        conn = psycopg2.connect(host=DB_HOST, user=DB_USER, password=DB_PASS, dbname=DB_NAME)
-        cursor = conn.cursor()
-        
-        # --- ¡CONSULTA MODIFICADA CON UPDATE...FROM...WHERE! ---
-        sql_update_query = """
-            UPDATE clientes c
-            SET notificacion_corte_3dias_enviada = false, 
-                notificacion_dia_corte_enviada = false
-            FROM dispositivos_lete d
-            WHERE c.id = d.cliente_id AND d.device_id = %s
-        """
-        cursor.execute(sql_update_query, (device_id,))
-        conn.commit()
-    except Exception as e:
-        print(f"❌ ERROR al resetear banderas para {device_id}: {e}")
-    finally:
-        if 'cursor' in locals() and not cursor.closed: cursor.close()
-        if 'conn' in locals() and not conn.closed: conn.close()
+    """Encola el reseteo de las banderas al inicio de un nuevo ciclo."""
+    print(f"Reseteando banderas de notificación para {device_id} (en cola)...")
+    sesion_bd.encolar_reseteo(device_id)
 
 # --- 6. Funciones de Consulta de Datos y APIs Externas ---
 
-# --- ¡FUNCIÓN REEMPLAZADA! ---
-def obtener_consumo_desde_influxdb(device_id, fecha_inicio_aware, fecha_fin_aware):
-    """
-    Obtiene el consumo total de un dispositivo (en kWh) desde InfluxDB 
-    para un rango de tiempo específico.
-    """
-    
-    # Preparamos las fechas en formato ISO 8601 UTC, requerido por Flux
-    start_time = fecha_inicio_aware.isoformat()
-    stop_time = fecha_fin_aware.isoformat()
-
-    flux_query = f"""
-    from(bucket: "{INFLUX_BUCKET}")
-      |> range(start: {start_time}, stop: {stop_time})
-      |> filter(fn: (r) => r._measurement == "energia")
-      |> filter(fn: (r) => r._field == "power")
-      |> filter(fn: (r) => r.device_id == "{device_id}")
-      |> integral(unit: 1s)
-      |> map(fn: (r) => ({{ _value: r._value / 3600000.0 }}))
-      |> sum()
-    """
-    
-    try:
-        with InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG, timeout=10_000) as client:
-            query_api = client.query_api()
-            tables = query_api.query(query=flux_query)
-            
-            if tables and tables[0].records:
-                total_kwh = tables[0].records[0].get_value()
-                return total_kwh, None
-            else:
-                # No se encontraron datos en InfluxDB para ese rango
-                return None, None
+# (obtener_consumo_desde_influxdb vive en consumo_energia.py: usa los acumulados horarios)
 
-    except Exception as e:
-        print(f"❌ ERROR al consultar InfluxDB para {device_id}: {e}")
-        return None, None
+# Consumos de la corrida consultados por lote: {(device_id, inicio, fin): kwh}
+consumos_precargados = {}
+
+def _ventana_dia(fecha_inicio, fecha_fin):
+    """Ventana [medianoche de fecha_inicio, medianoche de fecha_fin) en hora local."""
+    return (ZONA_HORARIA_LOCAL.localize(datetime.combine(fecha_inicio, datetime.min.time())),
+            ZONA_HORARIA_LOCAL.localize(datetime.combine(fecha_fin, datetime.min.time())))
+
+def obtener_consumo(device_id, inicio_aware, fin_aware):
+    """Consumo (kwh, None) de la precarga por lote, o consulta individual si no estaba."""
+    llave = (device_id, inicio_aware, fin_aware)
+    if llave in consumos_precargados:
+        return consumos_precargados[llave], None
+    return obtener_consumo_desde_influxdb(device_id, inicio_aware, fin_aware)
+
+# Costos de la corrida calculados en una sola llamada vectorizada: {(device_id, clase): costo}
+costos_precargados = {}
+
+def obtener_costo(device_id, clase, kwh, tipo_tarifa):
+    """Costo precalculado del cliente, o cálculo individual si no estaba."""
+    costo = costos_precargados.get((device_id, clase))
+    if costo is None:
+        costo = float(calcular_costo_estimado_vectorizado([kwh], [tipo_tarifa])[0])
+    return costo
 
 @retry(wait=wait_exponential(multiplier=1, min=4, max=10), stop=stop_after_attempt(3))
 def enviar_alerta_whatsapp(telefono_destino, content_sid, content_variables):
@@ -357,10 +400,12 @@ def formatear_mensaje_telegram(template_sid, variables):
         return f"Alerta del sistema (SID: {template_sid}). Variables: {json.dumps(variables)}"
 
 # --- ¡NUEVA FUNCIÓN DE DECISIÓN! ---
-def enviar_alerta_dual(cliente_info, template_sid, variables):
+def enviar_alerta_dual(cliente_info, template_sid, variables, periodo=None):
     """
     Decide si enviar la alerta por WhatsApp o Telegram basándose en la
     preferencia del cliente.
+    Con NOTIFICACIONES_OUTBOX no envía: encola la intención (idempotente por
+    dispositivo/plantilla/periodo) para aplicarla junto con las banderas.
     """
     # Desempaquetamos solo los campos que necesitamos para esta decisión
     telefono_whatsapp = cliente_info.get('telefono')
@@ -369,65 +414,35 @@ def enviar_alerta_dual(cliente_info, template_sid, variables):
     
     if prefiere_telegram and telegram_chat_id:
         # --- Canal 1: Preferencia es TELEGRAM ---
-        print(f"INFO: Cliente prefiere Telegram. Enviando a {telegram_chat_id}...")
         mensaje_telegram = formatear_mensaje_telegram(template_sid, variables)
+        if NOTIFICACIONES_OUTBOX:
+            sesion_bd.encolar_notificaciones(intenciones(
+                cliente_info.get('device_id'), template_sid, variables, periodo,
+                telegram_chat_id=telegram_chat_id, texto_telegram=mensaje_telegram
+            ))
+            return True
+        print(f"INFO: Cliente prefiere Telegram. Enviando a {telegram_chat_id}...")
         enviar_alerta_telegram(telegram_chat_id, mensaje_telegram)
+        return True
         
     elif telefono_whatsapp:
         # --- Canal 2: Preferencia es WHATSAPP (o no ha configurado Telegram) ---
+        if NOTIFICACIONES_OUTBOX:
+            sesion_bd.encolar_notificaciones(intenciones(
+                cliente_info.get('device_id'), template_sid, variables, periodo, telefono=telefono_whatsapp
+            ))
+            return True
         print(f"INFO: Cliente prefiere WhatsApp (o es default). Enviando a {telefono_whatsapp}...")
         enviar_alerta_whatsapp(telefono_whatsapp, template_sid, variables)
+        return True
         
     else:
         # --- Fallback: No tiene canal de contacto ---
         print(f"⚠️ ADVERTENCIA: Cliente sin 'telefono_whatsapp' ni 'telegram_chat_id' configurado. No se envió alerta.")
+        return False
 
 # --- 7. Funciones de Lógica de Negocio ---
-def calcular_costo_estimado(kwh_consumidos, tipo_tarifa):
-    """Calcula el costo aproximado del recibo de CFE usando la estructura de tarifas."""
-    if tipo_tarifa not in TARIFAS_CFE:
-        print(f"⚠️  Advertencia: Tarifa '{tipo_tarifa}' no reconocida. No se puede calcular el costo.")
-        return 0.0
-    costo_sin_iva = 0.0
-    kwh_restantes = kwh_consumidos
-    limite_anterior = 0
-    for escalon in TARIFAS_CFE[tipo_tarifa]:
-        limite_actual = escalon['hasta_kwh']
-        kwh_en_este_escalon = min(kwh_restantes, limite_actual - limite_anterior)
-        costo_sin_iva += kwh_en_este_escalon * escalon['precio']
-        kwh_restantes -= kwh_en_este_escalon
-        if kwh_restantes <= 0: break
-        limite_anterior = limite_actual
-    return costo_sin_iva * IVA
-
-def calcular_fechas_corte(hoy_aware, dia_de_corte, ciclo_bimestral):
-    """Calcula la fecha de corte más reciente y la próxima (versión simplificada y corregida)."""
-    hoy = hoy_aware.date()
-    candidatos_pasados = []
-    for i in range(12):
-        mes_candidato = hoy.month - i
-        ano_candidato = hoy.year
-        if mes_candidato <= 0:
-            mes_candidato += 12
-            ano_candidato -= 1
-        es_mes_par = (mes_candidato % 2 == 0)
-        if (ciclo_bimestral == 'par' and es_mes_par) or (ciclo_bimestral == 'impar' and not es_mes_par):
-            try:
-                dia = min(dia_de_corte, calendar.monthrange(ano_candidato, mes_candidato)[1])
-                fecha_candidata = date(ano_candidato, mes_candidato, dia)
-                if fecha_candidata <= hoy:
-                    candidatos_pasados.append(fecha_candidata)
-            except ValueError: continue
-    if not candidatos_pasados: return None, None
-    ultima_fecha_de_corte = max(candidatos_pasados)
-    mes_proximo = ultima_fecha_de_corte.month + 2
-    ano_proximo = ultima_fecha_de_corte.year
-    if mes_proximo > 12:
-        mes_proximo -= 12
-        ano_proximo += 1
-    dia_proximo = min(dia_de_corte, calendar.monthrange(ano_proximo, mes_proximo)[1])
-    proxima_fecha_de_corte = date(ano_proximo, mes_proximo, dia_proximo)
-    return ultima_fecha_de_corte, proxima_fecha_de_corte
+# (calcular_costo_estimado_vectorizado y calcular_fechas_corte viven en facturacion_cfe.py)
 
 # --- 8. Lógica de Procesamiento de Clientes (MODIFICADA) ---
 def _enviar_alerta_3_dias(cliente, proxima_fecha_de_corte):
@@ -440,15 +455,17 @@ def _enviar_alerta_3_dias(cliente, proxima_fecha_de_corte):
     
     # Creamos un dict con la info del cliente para la función dual
     cliente_info = {
+        "device_id": device_id,
         "telefono": telefono,
         "telegram_chat_id": telegram_chat_id,
         "prefiere_telegram": prefiere_telegram
     }
     
     # ¡Llamamos a la nueva función!
-    enviar_alerta_dual(cliente_info, CONTENT_SID_AVISO_CORTE_3DIAS, variables)
+    enviado = enviar_alerta_dual(cliente_info, CONTENT_SID_AVISO_CORTE_3DIAS, variables, proxima_fecha_de_corte.isoformat())
     
     marcar_notificacion_enviada(device_id, 'notificacion_corte_3dias')
+    return enviado
 
 def _enviar_alerta_dia_de_corte(cliente, ultima_corte, proxima_corte):
     # Desempaquetado (15 campos)
@@ -460,29 +477,30 @@ def _enviar_alerta_dia_de_corte(cliente, ultima_corte, proxima_corte):
     inicio_periodo = ZONA_HORARIA_LOCAL.localize(datetime.combine(ultima_corte, datetime.min.time()))
     fin_periodo = ZONA_HORARIA_LOCAL.localize(datetime.combine(proxima_corte, datetime.min.time()))
     
-    consumo_final, _ = obtener_consumo_desde_influxdb(device_id, inicio_periodo, fin_periodo)
+    consumo_final, _ = obtener_consumo(device_id, inicio_periodo, fin_periodo)
     if consumo_final is None: consumo_final = 0.0
     
-    costo_final = calcular_costo_estimado(consumo_final, tipo_tarifa)
+    costo_final = obtener_costo(device_id, CLASE_DIA_DE_CORTE, consumo_final, tipo_tarifa)
     variables = {"1": nombre, "2": f"{consumo_final:.2f}", "3": f"{costo_final:.2f}"}
     
     cliente_info = {
+        "device_id": device_id,
         "telefono": telefono,
         "telegram_chat_id": telegram_chat_id,
         "prefiere_telegram": prefiere_telegram
     }
     
     # ¡Llamamos a la nueva función!
-    enviar_alerta_dual(cliente_info, CONTENT_SID_DIA_DE_CORTE, variables)
+    enviado = enviar_alerta_dual(cliente_info, CONTENT_SID_DIA_DE_CORTE, variables, proxima_corte.isoformat())
     
     marcar_notificacion_enviada(device_id, 'notificacion_dia_corte')
+    return enviado
 
 def _generar_reporte_diario(cliente, hoy_aware, fechas_corte):
     # --- ¡DESEMPAQUETADO MODIFICADO! ---
     # Ahora recibimos 15 campos del tuple de cliente
     (device_id, telefono, telegram_chat_id, prefiere_telegram, kwh_promedio, nombre, _, tipo_tarifa, 
-     fecha_inicio_servicio, _, _, _, 
-     lectura_cierre, lectura_inicial, _) = cliente
+     _, _, _, _, _, _, _) = cliente
      
     ultima_fecha_de_corte, proxima_fecha_de_corte = fechas_corte
     
@@ -491,92 +509,40 @@ def _generar_reporte_diario(cliente, hoy_aware, fechas_corte):
     fin_ayer = ZONA_HORARIA_LOCAL.localize(datetime.combine(hoy_aware.date(), datetime.min.time()))
     
     # --- ¡CAMBIO DE FUNCIÓN! ---
-    kwh_ayer, _ = obtener_consumo_desde_influxdb(device_id, inicio_ayer, fin_ayer)
+    kwh_ayer, _ = obtener_consumo(device_id, inicio_ayer, fin_ayer)
     
     if kwh_ayer is None: 
         print(f"INFO: No se encontraron datos de consumo de ayer para {nombre}. No se enviará reporte.")
         return
 
     # --- LÓGICA DE "PRIMER PERIODO" APLICADA AQUÍ ---
-    
-    # 1. Determinar desde cuándo medir en InfluxDB
-    fecha_inicio_servicio_date = fecha_inicio_servicio.date() if isinstance(fecha_inicio_servicio, datetime) else fecha_inicio_servicio
-    fecha_inicio_periodo_influx = ultima_fecha_de_corte
-    
-    if fecha_inicio_servicio_date and fecha_inicio_servicio_date > ultima_fecha_de_corte:
-        fecha_inicio_periodo_influx = fecha_inicio_servicio_date
-        print(f"   -> {nombre}: Cliente en primer periodo (instaló el {fecha_inicio_servicio_date}).")
-
-    inicio_periodo_influx_aware = ZONA_HORARIA_LOCAL.localize(datetime.combine(fecha_inicio_periodo_influx, datetime.min.time()))
-    
-    # 2. Consultar el consumo medido por InfluxDB
     # (Se consulta desde el inicio del periodo EN INFLUX hasta el fin de ayer)
-    kwh_medidos_influx, _ = obtener_consumo_desde_influxdb(device_id, inicio_periodo_influx_aware, fin_ayer)
+    # (Precargado desde el acumulado incremental del periodo, compartido con el vigilante)
+    inicio_periodo_influx_aware, _ = _ventana_dia(_inicio_medicion_periodo(cliente, ultima_fecha_de_corte), hoy_aware.date())
+    kwh_medidos_influx, _ = obtener_consumo(device_id, inicio_periodo_influx_aware, fin_ayer)
     if kwh_medidos_influx is None: kwh_medidos_influx = 0.0
 
-    # 3. Calcular el consumo "acarreado" (si aplica)
-    kwh_acarreados = 0.0
-    if (fecha_inicio_servicio_date and 
-        fecha_inicio_servicio_date > ultima_fecha_de_corte and 
-        lectura_inicial and 
-        lectura_cierre):
-        
-        # El cliente está en su primer periodo Y se instaló después del corte.
-        kwh_acarreados = float(lectura_inicial) - float(lectura_cierre)
+    kwh_acarreados, dias_transcurridos_ciclo, proyeccion_kwh = _proyeccion_periodo(
+        cliente, hoy_aware.date(), fechas_corte, kwh_medidos_influx)
+    if kwh_acarreados:
         print(f"   -> {nombre}: Lógica de Primer Periodo. Acarreados: {kwh_acarreados:.2f} kWh")
 
-    # 4. El consumo total del periodo es la suma de ambos
+    # El consumo total del periodo es la suma de ambos
     kwh_periodo_actual = kwh_acarreados + kwh_medidos_influx
     print(f"   -> {nombre}: Consumo medido Influx: {kwh_medidos_influx:.2f} kWh. Total periodo: {kwh_periodo_actual:.2f} kWh")
     # --- FIN DE LÓGICA "PRIMER PERIODO" ---
         
     promedio_float = float(kwh_promedio) if kwh_promedio is not None else 0.0
     
-    # Calculamos los días REALES transcurridos en el periodo del ciclo
-    dias_transcurridos_ciclo = (ayer_date - ultima_fecha_de_corte).days + 1
-    if dias_transcurridos_ciclo <= 0: 
-        dias_transcurridos_ciclo = 1
-    
     # --- LÓGICA DE SELECCIÓN DE PLANTILLA (CORREGIDA) ---
-    if dias_transcurridos_ciclo < MIN_DIAS_PARA_PROYECCION:
+    if proyeccion_kwh is None:
         # PERIODO INICIAL: Sin proyección
         print(f"   -> {nombre}: Aún en periodo inicial (sin proyección). Días del ciclo: {dias_transcurridos_ciclo}")
         variables = {"1": nombre, "2": f"{kwh_ayer:.2f}", "3": f"{kwh_periodo_actual:.2f}"}
         template_sid = CONTENT_SID_REPORTE_INICIAL
         
     else:
-        # CON PROYECCIÓN: Solo proyectamos el consumo medido, NO los acarreados
-        dias_del_ciclo = (proxima_fecha_de_corte - ultima_fecha_de_corte).days
-        if dias_del_ciclo <= 0: 
-            dias_del_ciclo = 60  # Fallback
-        
-        # --- CORRECCIÓN CLAVE ---
-        # Si el cliente instaló después del inicio del ciclo, ajustamos la proyección
-        if fecha_inicio_servicio_date and fecha_inicio_servicio_date > ultima_fecha_de_corte:
-            # Cliente en primer periodo: Proyectamos SOLO el consumo medido
-            dias_con_medicion = (ayer_date - fecha_inicio_servicio_date).days + 1
-            if dias_con_medicion <= 0: 
-                dias_con_medicion = 1
-            
-            # Promedio REAL del cliente (sin acarreados)
-            promedio_diario_real = kwh_medidos_influx / dias_con_medicion
-            
-            # Días restantes del ciclo (desde hoy hasta el corte)
-            dias_restantes = (proxima_fecha_de_corte - hoy_aware.date()).days
-            
-            # Proyección = Acarreados + Consumo ya medido + Estimación de días restantes
-            proyeccion_kwh = kwh_acarreados + kwh_medidos_influx + (promedio_diario_real * dias_restantes)
-            
-            print(f"   -> {nombre}: Primer Periodo. Promedio real: {promedio_diario_real:.2f} kWh/día")
-            print(f"      Acarreados: {kwh_acarreados:.2f}, Medidos: {kwh_medidos_influx:.2f}, Proyección días restantes: {promedio_diario_real * dias_restantes:.2f}")
-        else:
-            # Cliente regular: Proyección simple proporcional
-            promedio_diario = kwh_periodo_actual / dias_transcurridos_ciclo
-            proyeccion_kwh = promedio_diario * dias_del_ciclo
-            
-            print(f"   -> {nombre}: Cliente regular. Promedio: {promedio_diario:.2f} kWh/día")
-        
-        costo_estimado = calcular_costo_estimado(proyeccion_kwh, tipo_tarifa)
+        costo_estimado = obtener_costo(device_id, CLASE_REPORTE_DIARIO, proyeccion_kwh, tipo_tarifa)
         
         print(f"      Proyección total: {proyeccion_kwh:.2f} kWh -> ${costo_estimado:.2f}")
         
@@ -594,13 +560,14 @@ def _generar_reporte_diario(cliente, hoy_aware, fechas_corte):
         # --- ¡NUEVA LÓGICA DE ENVÍO! ---
     # (Toda la lógica 'if/else' de arriba solo decide el 'template_sid' y las 'variables')
     cliente_info = {
+        "device_id": device_id,
         "telefono": telefono,
         "telegram_chat_id": telegram_chat_id,
         "prefiere_telegram": prefiere_telegram
     }    
 
     # ¡Llamamos a la nueva función!
-    enviar_alerta_dual(cliente_info, template_sid, variables)
+    return enviar_alerta_dual(cliente_info, template_sid, variables, hoy_aware.date().isoformat())
 
 def _realizar_cierre_de_ciclo(cliente, fechas_corte):
     # Desempaquetado (AHORA 15 campos)
@@ -612,7 +579,7 @@ def _realizar_cierre_de_ciclo(cliente, fechas_corte):
     fin_bimestre = ZONA_HORARIA_LOCAL.localize(datetime.combine(proxima_fecha_de_corte, datetime.min.time()))
     
     # --- ¡CAMBIO DE FUNCIÓN! ---
-    consumo_total_bimestre, _ = obtener_consumo_desde_influxdb(device_id, inicio_bimestre, fin_bimestre)
+    consumo_total_bimestre, _ = obtener_consumo(device_id, inicio_bimestre, fin_bimestre)
     
     if consumo_total_bimestre is not None and consumo_total_bimestre > 0:
         dias_del_bimestre = (proxima_fecha_de_corte - ultima_fecha_de_corte).days
@@ -621,106 +588,338 @@ def _realizar_cierre_de_ciclo(cliente, fechas_corte):
             actualizar_promedio_cliente(device_id, nuevo_promedio)
     resetear_banderas_notificacion(device_id)
 
-def procesar_un_cliente(cliente_data, hoy_aware):
-    """Orquesta el procesamiento completo para un único cliente."""
-    # --- ¡DESEMPAQUETADO MODIFICADO! ---
-    # Leemos 15 campos
-    (device_id, telefono, telegram_chat_id, prefiere_telegram, _, nombre, dia_de_corte, _, 
-     fecha_inicio_servicio, ciclo_bimestral, notif_3dias_enviada, notif_corte_enviada, _, _, 
-     primera_medicion_recibida) = cliente_data
-     
-    print(f"\n--- Procesando cliente: {nombre} ({device_id}) ---")
-
-    # --- REGLA 0: AÚN NO HA CONECTADO EL DISPOSITIVO ---
-    if not primera_medicion_recibida:
-        # Verificamos que ha pasado al menos 1 día para no ser insistentes
-        fecha_inicio_servicio_date = fecha_inicio_servicio.date() if isinstance(fecha_inicio_servicio, datetime) else fecha_inicio_servicio
-        dias_desde_activacion = (hoy_aware.date() - fecha_inicio_servicio_date).days
-
-        if dias_desde_activacion >= 1:
-            print(f"INFO: {nombre} (activado hace {dias_desde_activacion} días) aún no conecta. Enviando recordatorio DIARIO.")
-
-            # (Asegúrate de tener esta variable en .env)
-            # CONTENT_SID_RECORDATORIO_CONEXION ya se cargó arriba
-            variables = {"1": nombre}
-            
-            # Enviar usando la lógica dual
-            cliente_info = {
-                "telefono": telefono,
-                "telegram_chat_id": telegram_chat_id,
-                "prefiere_telegram": prefiere_telegram
-            }
-            enviar_alerta_dual(cliente_info, CONTENT_SID_RECORDATORIO_CONEXION, variables)
-            
-        # No marcamos ninguna bandera, se enviará de nuevo mañana
-
-        # Como no hay mediciones, no podemos procesar nada más.
-        print(f"INFO: {nombre} no tiene mediciones. Omitiendo reportes diarios.")
-        return # Salir de la función para este cliente.
-    # --- FIN DE REGLA 0 ---
-    
-    ultima_corte, proxima_corte = calcular_fechas_corte(hoy_aware, dia_de_corte, ciclo_bimestral)
-    if not ultima_corte or not proxima_corte:
-        print(f"⚠️ No se pudo determinar el periodo de corte para {nombre}. Omitiendo.")
-        return
+def _enviar_recordatorio_conexion(cliente, hoy_aware):
+    # Desempaquetado (15 campos)
+    (device_id, telefono, telegram_chat_id, prefiere_telegram, _, nombre, _, _, 
+     fecha_inicio_servicio, _, _, _, _, _, _) = cliente
+
+    fecha_inicio_servicio_date = fecha_inicio_servicio.date() if isinstance(fecha_inicio_servicio, datetime) else fecha_inicio_servicio
+    dias_desde_activacion = (hoy_aware.date() - fecha_inicio_servicio_date).days
+    print(f"INFO: {nombre} (activado hace {dias_desde_activacion} días) aún no conecta. Enviando recordatorio DIARIO.")
+
+    # (Asegúrate de tener esta variable en .env)
+    # CONTENT_SID_RECORDATORIO_CONEXION ya se cargó arriba
+    variables = {"1": nombre}
     
+    # Enviar usando la lógica dual
+    cliente_info = {
+        "device_id": device_id,
+        "telefono": telefono,
+        "telegram_chat_id": telegram_chat_id,
+        "prefiere_telegram": prefiere_telegram
+    }
+    # No marcamos ninguna bandera, se enviará de nuevo mañana
+    return enviar_alerta_dual(cliente_info, CONTENT_SID_RECORDATORIO_CONEXION, variables, hoy_aware.date().isoformat())
+
+# --- 9. Planificador de la Corrida ---
+
+# Envíos simultáneos a Twilio/Telegram
+ALERTA_MAX_CONCURRENCIA = int(os.environ.get("ALERTA_MAX_CONCURRENCIA", 8))
+
+CLASE_SIN_CONEXION = 'sin_conexion'
+CLASE_DIA_DE_CORTE = 'dia_de_corte'
+CLASE_CIERRE_CICLO = 'cierre_ciclo'
+CLASE_AVISO_3_DIAS = 'aviso_3_dias'
+CLASE_REPORTE_DIARIO = 'reporte_diario'
+
+def planificar_corrida(clientes, hoy_aware):
+    """
+    Clasifica a todos los clientes según las reglas de negocio del día.
+    Devuelve {clase: [(cliente, fechas), ...]}; un cliente puede aparecer en
+    'cierre_ciclo' y además en 'aviso_3_dias' o 'reporte_diario'.
+    """
+    plan = {clase: [] for clase in (CLASE_SIN_CONEXION, CLASE_DIA_DE_CORTE, CLASE_CIERRE_CICLO,
+                                    CLASE_AVISO_3_DIAS, CLASE_REPORTE_DIARIO)}
     hoy = hoy_aware.date()
-    dias_restantes = (proxima_corte - hoy).days
+    for cliente_data in clientes:
+        # Leemos 15 campos
+        (device_id, _, _, _, _, nombre, dia_de_corte, _, 
+         fecha_inicio_servicio, ciclo_bimestral, notif_3dias_enviada, notif_corte_enviada, _, _, 
+         primera_medicion_recibida) = cliente_data
+
+        # --- REGLA 0: AÚN NO HA CONECTADO EL DISPOSITIVO ---
+        if not primera_medicion_recibida:
+            # Verificamos que ha pasado al menos 1 día para no ser insistentes
+            fecha_inicio_servicio_date = fecha_inicio_servicio.date() if isinstance(fecha_inicio_servicio, datetime) else fecha_inicio_servicio
+            if (hoy - fecha_inicio_servicio_date).days >= 1:
+                plan[CLASE_SIN_CONEXION].append((cliente_data, None))
+            # Como no hay mediciones, no podemos procesar nada más.
+            continue
+        
+        ultima_corte, proxima_corte = calcular_fechas_corte(hoy_aware, dia_de_corte, ciclo_bimestral)
+        if not ultima_corte or not proxima_corte:
+            print(f"⚠️ No se pudo determinar el periodo de corte para {nombre}. Omitiendo.")
+            continue
+        dias_restantes = (proxima_corte - hoy).days
+
+        # REGLA 1: Hoy es el día de corte (máxima prioridad). No se hace nada más hoy.
+        if dias_restantes == 0 and not notif_corte_enviada:
+            plan[CLASE_DIA_DE_CORTE].append((cliente_data, (ultima_corte, proxima_corte)))
+            continue
+
+        # REGLA 2: Hoy es el día DESPUÉS del corte.
+        # El "cierre" calcula el bimestre que acaba de terminar: el 'ultima_corte'
+        # de hoy fue el 'proxima_corte' de ayer, así que necesitamos el anterior.
+        if hoy == ultima_corte + timedelta(days=1):
+            inicio_periodo_cerrado = fecha_corte_anterior(ultima_corte, dia_de_corte)
+            plan[CLASE_CIERRE_CICLO].append((cliente_data, (inicio_periodo_cerrado, ultima_corte)))
+
+        # REGLA 3: Faltan 3 días para el corte. No se envía reporte diario hoy.
+        if dias_restantes == 3 and not notif_3dias_enviada:
+            plan[CLASE_AVISO_3_DIAS].append((cliente_data, proxima_corte))
+            continue
+        
+        # REGLA 4: Si no se cumplió ninguna regla anterior, se envía el reporte diario.
+        plan[CLASE_REPORTE_DIARIO].append((cliente_data, (ultima_corte, proxima_corte)))
+    return plan
 
-    # --- FLUJO LÓGICO BASADO EN REGLAS DE NEGOCIO ---
-    
-    # REGLA 1: Hoy es el día de corte (máxima prioridad).
-    if dias_restantes == 0 and not notif_corte_enviada:
-        _enviar_alerta_dia_de_corte(cliente_data, ultima_corte, proxima_corte)
-        return # No se hace nada más hoy.
-
-    # REGLA 2: Hoy es el día DESPUÉS del corte.
-    if hoy == ultima_corte + timedelta(days=1):
-         # Corrección: El "cierre" debe calcular el bimestre que acaba de terminar.
-         # El 'ultima_corte' de hoy fue el 'proxima_corte' de ayer.
-         # Necesitamos el 'ultima_corte' anterior.
-         mes_anterior = ultima_corte.month - 2
-         ano_anterior = ultima_corte.year
-         if mes_anterior <= 0:
-             mes_anterior += 12
-             ano_anterior -= 1
-         dia_anterior = min(dia_de_corte, calendar.monthrange(ano_anterior, mes_anterior)[1])
-         inicio_periodo_cerrado = date(ano_anterior, mes_anterior, dia_anterior)
-         
-         _realizar_cierre_de_ciclo(cliente_data, (inicio_periodo_cerrado, ultima_corte))
-
-    # REGLA 3: Faltan 3 días para el corte.
-    if dias_restantes == 3 and not notif_3dias_enviada:
-        _enviar_alerta_3_dias(cliente_data, proxima_corte)
-        return # No se envía reporte diario hoy.
-    
-    # REGLA 4: Si no se cumplió ninguna regla anterior, se envía el reporte diario.
-    # (Se pasa el cliente_data completo, que incluye los 14 campos)
-    _generar_reporte_diario(cliente_data, hoy_aware, (ultima_corte, proxima_corte))
+def _inicio_medicion_periodo(cliente, ultima_corte):
+    """Inicio del periodo en Influx: último corte o la instalación si fue después."""
+    fecha_inicio_servicio = cliente[8]
+    fecha_inicio_servicio_date = fecha_inicio_servicio.date() if isinstance(fecha_inicio_servicio, datetime) else fecha_inicio_servicio
+    if fecha_inicio_servicio_date and fecha_inicio_servicio_date > ultima_corte:
+        return fecha_inicio_servicio_date
+    return ultima_corte
+
+def _proyeccion_periodo(cliente, hoy, fechas_corte, kwh_medidos_influx):
+    """
+    (kwh_acarreados, dias_transcurridos_ciclo, proyeccion_kwh) del reporte diario.
+    'proyeccion_kwh' es None mientras el ciclo lleve menos de MIN_DIAS_PARA_PROYECCION días.
+    """
+    fecha_inicio_servicio, lectura_cierre, lectura_inicial = cliente[8], cliente[12], cliente[13]
+    ultima_fecha_de_corte, proxima_fecha_de_corte = fechas_corte
+    ayer_date = hoy - timedelta(days=1)
+    fecha_inicio_servicio_date = fecha_inicio_servicio.date() if isinstance(fecha_inicio_servicio, datetime) else fecha_inicio_servicio
+    primer_periodo = bool(fecha_inicio_servicio_date and fecha_inicio_servicio_date > ultima_fecha_de_corte)
+
+    # El cliente está en su primer periodo Y se instaló después del corte.
+    kwh_acarreados = 0.0
+    if primer_periodo and lectura_inicial and lectura_cierre:
+        kwh_acarreados = float(lectura_inicial) - float(lectura_cierre)
+
+    # Días REALES transcurridos en el periodo del ciclo
+    dias_transcurridos_ciclo = (ayer_date - ultima_fecha_de_corte).days + 1
+    if dias_transcurridos_ciclo <= 0:
+        dias_transcurridos_ciclo = 1
+    if dias_transcurridos_ciclo < MIN_DIAS_PARA_PROYECCION:
+        return kwh_acarreados, dias_transcurridos_ciclo, None
+
+    dias_del_ciclo = (proxima_fecha_de_corte - ultima_fecha_de_corte).days
+    if dias_del_ciclo <= 0:
+        dias_del_ciclo = 60  # Fallback
+
+    if primer_periodo:
+        # Solo se proyecta el consumo medido (promedio REAL, sin acarreados)
+        dias_con_medicion = (ayer_date - fecha_inicio_servicio_date).days + 1
+        if dias_con_medicion <= 0:
+            dias_con_medicion = 1
+        promedio_diario_real = kwh_medidos_influx / dias_con_medicion
+        dias_restantes = (proxima_fecha_de_corte - hoy).days
+        proyeccion_kwh = kwh_acarreados + kwh_medidos_influx + promedio_diario_real * dias_restantes
+    else:
+        # Cliente regular: proyección simple proporcional
+        proyeccion_kwh = (kwh_acarreados + kwh_medidos_influx) / dias_transcurridos_ciclo * dias_del_ciclo
+    return kwh_acarreados, dias_transcurridos_ciclo, proyeccion_kwh
+
+def precargar_consumos(plan, hoy_aware):
+    """
+    Consulta por lote los consumos que necesitará cada clase del plan:
+    una consulta Flux por ventana compartida en lugar de una por cliente.
+    El consumo del periodo del reporte diario sale del acumulado incremental,
+    también por lote (un SELECT/UPSERT para todos; aquí, en el hilo principal,
+    porque usa la conexión de la sesión).
+    """
+    hoy = hoy_aware.date()
+    ventanas_por_clase = {
+        CLASE_DIA_DE_CORTE: [(c[0], *_ventana_dia(*fechas)) for c, fechas in plan[CLASE_DIA_DE_CORTE]],
+        CLASE_CIERRE_CICLO: [(c[0], *_ventana_dia(*fechas)) for c, fechas in plan[CLASE_CIERRE_CICLO]],
+        CLASE_REPORTE_DIARIO: [(c[0], *_ventana_dia(hoy - timedelta(days=1), hoy)) for c, _ in plan[CLASE_REPORTE_DIARIO]],
+    }
+    consumos_precargados.clear()
+    for clase, ventanas in ventanas_por_clase.items():
+        if ventanas:
+            consumos_precargados.update(obtener_consumo_lote(ventanas))
+
+    ventanas_periodo = [(c[0], *_ventana_dia(_inicio_medicion_periodo(c, ultima_corte), hoy))
+                        for c, (ultima_corte, _) in plan[CLASE_REPORTE_DIARIO]]
+    consumos_precargados.update(obtener_consumo_periodo_lote(sesion_bd.conectar(), ventanas_periodo))
+    print(f"✅ {len(consumos_precargados)} consumos precargados.")
+
+def precalcular_costos(plan, hoy_aware):
+    """
+    Costo del día de corte y de la proyección del reporte diario de todos los
+    clientes del plan en una sola llamada a calcular_costo_estimado_vectorizado().
+    Los consumos que faltaban en la precarga se consultan aquí y se guardan en
+    'consumos_precargados' para que el envío use exactamente el mismo valor.
+    """
+    hoy = hoy_aware.date()
 
-# --- 9. Ejecución Principal ---
+    def consumo(device_id, inicio, fin):
+        llave = (device_id, inicio, fin)
+        if llave not in consumos_precargados:
+            consumos_precargados[llave] = obtener_consumo(device_id, inicio, fin)[0]
+        return consumos_precargados[llave]
+
+    llaves, kwh, tarifas = [], [], []
+    for cliente, fechas in plan[CLASE_DIA_DE_CORTE]:
+        llaves.append((cliente[0], CLASE_DIA_DE_CORTE))
+        kwh.append(consumo(cliente[0], *_ventana_dia(*fechas)) or 0.0)
+        tarifas.append(cliente[7])
+    for cliente, fechas in plan[CLASE_REPORTE_DIARIO]:
+        inicio, fin = _ventana_dia(_inicio_medicion_periodo(cliente, fechas[0]), hoy)
+        _, _, proyeccion_kwh = _proyeccion_periodo(cliente, hoy, fechas, consumo(cliente[0], inicio, fin) or 0.0)
+        if proyeccion_kwh is not None:
+            llaves.append((cliente[0], CLASE_REPORTE_DIARIO))
+            kwh.append(proyeccion_kwh)
+            tarifas.append(cliente[7])
+
+    costos_precargados.clear()
+    if not llaves:
+        return
+    for tarifa in sorted(set(tarifas) - set(TARIFAS_CFE), key=str):
+        print(f"⚠️  Advertencia: Tarifa '{tarifa}' no reconocida. No se puede calcular el costo.")
+    costos_precargados.update(zip(llaves, calcular_costo_estimado_vectorizado(kwh, tarifas).tolist()))
+    print(f"✅ {len(costos_precargados)} costos calculados.")
+
+# --- Bitácora de envíos (para reanudar sin duplicar mensajes) ---
+
+def asegurar_bitacora_envios():
+    sesion_bd.consultar("""
+        CREATE TABLE IF NOT EXISTS alerta_diaria_envios (
+            fecha DATE NOT NULL,
+            device_id VARCHAR(20) NOT NULL,
+            clase VARCHAR(20) NOT NULL,
+            enviado_en TIMESTAMPTZ DEFAULT NOW(),
+            PRIMARY KEY (fecha, device_id, clase)
+        )
+    """)
+
+def obtener_envios_del_dia(fecha):
+    filas = sesion_bd.consultar("SELECT device_id, clase FROM alerta_diaria_envios WHERE fecha = %s", (fecha,))
+    return set(filas)
+
+def registrar_envio(fecha, device_id, clase):
+    """Se registra en cuanto el mensaje sale (no espera al lote de banderas)."""
+    sesion_bd.consultar("""
+        INSERT INTO alerta_diaria_envios (fecha, device_id, clase) VALUES (%s, %s, %s)
+        ON CONFLICT DO NOTHING
+    """, (fecha, device_id, clase))
+
+def _ejecutar_envio(clase, cliente, fechas, hoy_aware):
+    device_id, nombre = cliente[0], cliente[5]
+    print(f"\n--- [{clase}] {nombre} ({device_id}) ---")
+    if clase == CLASE_SIN_CONEXION:
+        enviado = _enviar_recordatorio_conexion(cliente, hoy_aware)
+    elif clase == CLASE_DIA_DE_CORTE:
+        enviado = _enviar_alerta_dia_de_corte(cliente, *fechas)
+    elif clase == CLASE_AVISO_3_DIAS:
+        enviado = _enviar_alerta_3_dias(cliente, fechas)
+    else:
+        enviado = _generar_reporte_diario(cliente, hoy_aware, fechas)
+    # Con outbox, la idempotencia la da la clave de cada intención
+    if enviado and not NOTIFICACIONES_OUTBOX:
+        registrar_envio(hoy_aware.date(), device_id, clase)
+    return enviado
+
+def ejecutar_envios(plan, hoy_aware):
+    """
+    Envía los mensajes del plan con concurrencia acotada (ALERTA_MAX_CONCURRENCIA).
+    Omite lo que la bitácora del día ya registra como enviado (reanudación).
+    Devuelve (enviados, omitidos, errores).
+    """
+    ya_enviados = obtener_envios_del_dia(hoy_aware.date())
+    tareas = [
+        (clase, cliente, fechas)
+        for clase in (CLASE_DIA_DE_CORTE, CLASE_AVISO_3_DIAS, CLASE_REPORTE_DIARIO, CLASE_SIN_CONEXION)
+        for cliente, fechas in plan[clase]
+    ]
+    pendientes = [t for t in tareas if (t[1][0], t[0]) not in ya_enviados]
+    omitidos = len(tareas) - len(pendientes)
+    if omitidos:
+        print(f"INFO: {omitidos} mensajes ya enviados hoy según la bitácora. Se omiten.")
+
+        # Si la corrida anterior cayó antes de aplicar las banderas, se aplican ahora
+        for clase, cliente, _ in tareas:
+            if (cliente[0], clase) in ya_enviados:
+                if clase == CLASE_DIA_DE_CORTE: marcar_notificacion_enviada(cliente[0], 'notificacion_dia_corte')
+                elif clase == CLASE_AVISO_3_DIAS: marcar_notificacion_enviada(cliente[0], 'notificacion_corte_3dias')
+
+    enviados = errores = 0
+    with ThreadPoolExecutor(max_workers=ALERTA_MAX_CONCURRENCIA) as ejecutor:
+        futuros = {ejecutor.submit(_ejecutar_envio, clase, cliente, fechas, hoy_aware): cliente
+                   for clase, cliente, fechas in pendientes}
+        for i, (futuro, cliente) in enumerate(futuros.items(), start=1):
+            try:
+                if futuro.result():
+                    enviados += 1
+            except Exception as e:
+                errores += 1
+                print(f"❌ ERROR INESPERADO al procesar '{cliente[5]}'. Saltando. Error: {e}")
+            if i % ALERTA_LOTE_CLIENTES == 0:
+                sesion_bd.aplicar_pendientes()
+    return enviados, omitidos, errores
+
+# --- 10. Ejecución Principal ---
 def main():
     print("=" * 50)
-    print(f"--- Iniciando Script de Reporte Diario v4.1 (con Telegram - CORREGIDO) ---")
-    
+    print(f"--- Iniciando Script de Reporte Diario v5.0 (planificador concurrente) ---")
+    tiempos = {}
+
+    t0 = time.perf_counter()
     clientes = obtener_clientes()
     if not clientes:
         print("No hay clientes para procesar. Terminando script.")
+        sesion_bd.cerrar()
         return
 
     ahora_aware = datetime.now(ZONA_HORARIA_LOCAL)
     print(f"Ejecutando a las {ahora_aware.strftime('%Y-%m-%d %H:%M:%S %Z')}")
+    precalcular_calendario(ahora_aware)
+    try:
+        asegurar_esquema_acumulados(sesion_bd.conectar())
+        asegurar_bitacora_envios()
+        if NOTIFICACIONES_OUTBOX:
+            asegurar_esquema_outbox(sesion_bd.conectar())
+            sesion_bd.conn.commit()
+    except Exception as e:
+        if sesion_bd.conn and not sesion_bd.conn.closed: sesion_bd.conn.rollback()
+        print(f"❌ ERROR al verificar el esquema (acumulados/bitácora). Abortando. Detalles: {e}")
+        sesion_bd.cerrar()
+        return
 
-    for cliente in clientes:
-        try:
-            procesar_un_cliente(cliente, ahora_aware)
-        except Exception as e:
-            # cliente[4] es 'nombre' en el nuevo tuple
-            nombre_cliente = cliente[4] if len(cliente) > 4 else "ID Desconocido"
-            print(f"❌ ERROR INESPERADO al procesar '{nombre_cliente}'. Saltando. Error: {e}")
+    plan = planificar_corrida(clientes, ahora_aware)
+    tiempos['clasificacion'] = time.perf_counter() - t0
+    print("Plan: " + ", ".join(f"{clase}={len(tareas)}" for clase, tareas in plan.items()))
 
-    print("\n--- Script de Reporte Diario v4.1 (CORREGIDO) completado. ---")
+    try:
+        t0 = time.perf_counter()
+        precargar_consumos(plan, ahora_aware)
+        precalcular_costos(plan, ahora_aware)
+        tiempos['precarga'] = time.perf_counter() - t0
+
+        # Los cierres solo actualizan la BD (promedio y banderas en cola)
+        t0 = time.perf_counter()
+        for cliente, fechas in plan[CLASE_CIERRE_CICLO]:
+            try:
+                _realizar_cierre_de_ciclo(cliente, fechas)
+            except Exception as e:
+                print(f"❌ ERROR INESPERADO en el cierre de '{cliente[5]}'. Saltando. Error: {e}")
+        tiempos['cierres'] = time.perf_counter() - t0
+
+        t0 = time.perf_counter()
+        enviados, omitidos, errores = ejecutar_envios(plan, ahora_aware)
+        tiempos['envios'] = time.perf_counter() - t0
+        print(f"\n✅ Mensajes: {enviados} enviados, {omitidos} omitidos (ya enviados), {errores} con error.")
+    finally:
+        t0 = time.perf_counter()
+        sesion_bd.aplicar_pendientes()
+        sesion_bd.cerrar()
+        tiempos['actualizaciones'] = time.perf_counter() - t0
+
+    print("⏱️  Tiempos por fase: " + ", ".join(f"{fase} {segundos:.2f}s" for fase, segundos in tiempos.items()))
+    print(f"📊 Base de datos: {sesion_bd.conexiones} conexión(es), {sesion_bd.sentencias} sentencia(s).")
+    print("\n--- Script de Reporte Diario v5.0 completado. ---")
     print("=" * 50)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -1,8 +1,14 @@
+import os
+import heapq
+import argparse
+
 import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
 import numpy as np
 
+from cargador_consumo import cargar_consumo, iterar_bloques, MOTOR_AUTO, MOTOR_C, MOTOR_PYARROW
+from perfil_carga import PerfilCarga
+from eventos_consumo import DetectorEventos, DESCRIPCIONES, clasificar, detectar_eventos, resumir_eventos
+
 # --- 1. CONFIGURACIÓN ---
 NOMBRE_ARCHIVO_CSV = 'influxdata_2025-11-08T09_29_08Z.csv'
 
@@ -13,105 +19,272 @@ PRECIO_KWH_MXN = 2.5
 # Umbral (en Watts) para detectar un "pico" de electrodoméstico.
 # Ajusta esto si ves demasiados eventos pequeños.
 UMBRAL_PICO_W = 300
+
+NOMBRE_GRAFICA = 'analisis_consumo_7dias.png'
+
+NS_POR_HORA = 3_600_000_000_000
 # -------------------------
 
 
 def clasificar_pico(watts):
     """Estima qué tipo de aparato podría ser basado en la potencia."""
-    watts = round(watts)
-    if watts > 2500:
-        return f"{watts} W: Podría ser una regadera eléctrica, o varios aparatos potentes al mismo tiempo."
-    elif watts > 1500:
-        return f"{watts} W: Típico de un horno eléctrico, parrilla de inducción o aire acondicionado grande."
-    elif watts > 800:
-        return f"{watts} W: Común en microondas, cafeteras, tostadores, planchas o secadoras de pelo."
-    elif watts > 300:
-        return f"{watts} W: Sugiere un motor grande (lavadora, bomba de agua, licuadora)."
-    elif watts > 100:
-        return f"{watts} W: Probablemente el compresor del refrigerador o un ventilador."
-    else:
-        return f"{watts} W: Carga pequeña (TV, computadora)."
+    return f"{round(watts)} W: {DESCRIPCIONES[clasificar(watts)]}"
 
-def analizar_consumo():
-    try:
-        print(f"Cargando {NOMBRE_ARCHIVO_CSV}...")
-        df = pd.read_csv(NOMBRE_ARCHIVO_CSV, comment='#')
-    except FileNotFoundError:
-        print(f"--- ERROR ---")
-        print(f"No se encontró el archivo '{NOMBRE_ARCHIVO_CSV}'.")
-        print("Asegúrate de que el script y el CSV estén en la misma carpeta.")
-        return
-    except Exception as e:
-        print(f"Ocurrió un error al leer el archivo: {e}")
-        return
 
-    print("Procesando datos (puede tardar unos segundos)...")
-    
-    # --- 2. LIMPIEZA Y PREPARACIÓN DE DATOS ---
-    # Convertir columnas a numérico, manejando errores
-    df['power'] = pd.to_numeric(df['power'], errors='coerce')
-    df['power_factor'] = pd.to_numeric(df['power_factor'], errors='coerce')
-    
-    # Convertir tiempo y establecer como índice
-    df['time'] = pd.to_datetime(df['time'], errors='coerce')
-    df = df.dropna(subset=['time', 'power', 'power_factor'])
-    df = df.set_index('time')
-    
-    if df.empty:
-        print("No se encontraron datos válidos después de la limpieza. Revisa el archivo.")
-        return
+def _metricas_eventos(eventos):
+    """Top 5 encendidos (por escalón) y resumen por categoría de la tabla de eventos_consumo."""
+    top = eventos.sort_values('escalon_w', ascending=False, kind='stable').head(5)
+    return {
+        'eventos_encendido': [
+            {'fecha': fila.inicio, 'escalon_w': fila.escalon_w, 'categoria': int(fila.categoria),
+             'duracion_s': fila.duracion_s, 'energia_kwh': fila.energia_kwh}
+            for fila in top.itertuples(index=False)
+        ],
+        'total_encendidos': len(eventos),
+        'resumen_eventos': resumir_eventos(eventos),
+    }
 
-    # --- 3. CÁLCULO DE MÉTRICAS ---
-    
-    # --- A. Patrones Generales y Consumo ---
-    consumo_promedio_w = df['power'].mean()
-    consumo_maximo_w = df['power'].max()
-    fecha_consumo_maximo = df['power'].idxmax()
-    
-    # Agrupar por hora del día (0-23) para encontrar patrones
-    df_por_hora_dia = df.groupby(df.index.hour)['power'].mean()
-    hora_pico_promedio = df_por_hora_dia.idxmax()
-    hora_valle_promedio = df_por_hora_dia.idxmin()
-
-    # --- B. Malos Hábitos (Consumo Base y Factor de Potencia) ---
-    
-    # B1. Consumo Base (Fantasma) - Promedio de la madrugada (2 AM - 4 AM)
-    df_noche = df.between_time('02:00', '04:00')
-    consumo_base_w = 0.0
-    if not df_noche.empty:
-        consumo_base_w = df_noche['power'].mean()
-        costo_fantasma_mes = (consumo_base_w * 24 * 30.5 / 1000) * PRECIO_KWH_MXN
-    else:
+
+def _metricas_perfil(perfil, potencias_respaldo):
+    """
+    Horas pico/valle, consumo base y factor de potencia a partir de un
+    PerfilCarga. 'potencias_respaldo' (función) da las potencias para el
+    cuantil 5% cuando el perfil no tiene datos de madrugada.
+    """
+    promedio_por_hora = perfil.promedio_por_hora_del_dia()
+
+    # B1. Consumo Base (Fantasma) - Promedio de la madrugada (2 AM - 4 AM, ambos
+    # incluidos; el perfil guardado solo tiene horas cerradas: 2 AM a 3:59)
+    consumo_base_w = perfil.consumo_base_w()
+    if consumo_base_w is None:
         # Si no hay datos de 2-4am, usamos el 5% más bajo
-        consumo_base_w = df['power'].quantile(0.05)
-        costo_fantasma_mes = (consumo_base_w * 24 * 30.5 / 1000) * PRECIO_KWH_MXN
+        consumo_base_w = np.quantile(potencias_respaldo(), 0.05)
+
+    return {
+        'hora_pico_promedio': int(np.nanargmax(promedio_por_hora)),
+        'hora_valle_promedio': int(np.nanargmin(promedio_por_hora)),
+        'consumo_base_w': consumo_base_w,
+        'costo_fantasma_mes': (consumo_base_w * 24 * 30.5 / 1000) * PRECIO_KWH_MXN,
+        # B2. Factor de Potencia (solo de lecturas con consumo real)
+        'factor_potencia_promedio': perfil.factor_potencia_promedio(),
+    }
+
+
+def calcular_metricas(df, perfil=None):
+    """
+    Calcula todas las métricas del reporte a partir del DataFrame limpio
+    (índice 'time', columnas 'power' y 'power_factor'). Trabaja sobre los
+    arreglos de numpy en lugar de columnas intermedias del DataFrame.
+    Con 'perfil' (PerfilCarga guardado) el perfil horario, el consumo base
+    y el factor de potencia salen de él sin recorrer las muestras.
+    """
+    potencia = df['power'].to_numpy(dtype=np.float64)
+    factor_potencia = df['power_factor'].to_numpy()
+    ns = df.index.as_unit('ns').asi8
+
+    # --- A. Patrones Generales y Consumo ---
+    consumo_promedio_w = potencia.mean()
+    posicion_maximo = int(potencia.argmax())
+    consumo_maximo_w = potencia[posicion_maximo]
+    fecha_consumo_maximo = df.index[posicion_maximo]
+
+    # Perfil por hora del día, consumo base y factor de potencia (perfil_carga.py)
+    if perfil is None:
+        perfil = PerfilCarga().agregar_muestras(ns, potencia, factor_potencia)
+    metricas_perfil = _metricas_perfil(perfil, lambda: potencia)
+
+    # --- C. Detección de Electrodomésticos (Encendidos) ---
+    # Escalones sostenidos (las rampas de varias muestras cuentan una vez)
+    eventos = detectar_eventos(df.index, potencia, UMBRAL_PICO_W)
+
+    return {
+        'muestras': len(potencia),
+        'consumo_promedio_w': consumo_promedio_w,
+        'consumo_maximo_w': consumo_maximo_w,
+        'fecha_consumo_maximo': fecha_consumo_maximo,
+        **metricas_perfil,
+        **_metricas_eventos(eventos),
+        # Para la gráfica: promedio por hora y los 5 picos MÁS ALTOS (no los 'diff' más altos)
+        'serie_horaria': df['power'].resample('h').mean(),
+        'top_picos_absolutos': df['power'].nlargest(5),
+    }
+
+
+class AgregadosConsumo:
+    """
+    Agregados parciales y combinables de las métricas del reporte, para
+    procesar exportaciones que no caben en memoria bloque por bloque.
+    Los bloques deben llegar en orden (como vienen en el CSV); el detector de
+    eventos arrastra la cola no resuelta de cada bloque al siguiente.
+    resultado() devuelve el mismo diccionario que calcular_metricas().
+    """
+
+    TOP_K = 5
+
+    def __init__(self):
+        self.muestras = 0
+        self.suma_potencia = 0.0
+        # Perfil por hora de la semana, consumo base y factor de potencia
+        self.perfil = PerfilCarga()
+        # Mientras no haya muestras de madrugada se guardan las potencias para
+        # el cuantil 5% (solo pasa en exportaciones de menos de un día)
+        self.potencias_sin_madrugada = []
+        # Serie para la gráfica: {hora (ns // NS_POR_HORA): [suma, muestras]}
+        self.horas_calendario = {}
+        # Montículo de (valor, -posición, timestamp) con las TOP_K potencias mayores
+        self.top_potencia = []
+        self.detector = DetectorEventos(UMBRAL_PICO_W)
+
+    def _empujar(self, monticulo, valor, posicion, timestamp):
+        # A igual valor gana la muestra más antigua (como nlargest / un orden estable)
+        elemento = (valor, -posicion, timestamp)
+        if len(monticulo) < self.TOP_K:
+            heapq.heappush(monticulo, elemento)
+        elif elemento[:2] > monticulo[0][:2]:
+            heapq.heapreplace(monticulo, elemento)
+
+    def _empujar_mayores(self, monticulo, valores, posiciones, indice):
+        """Solo empuja los candidatos del bloque que pueden entrar al top."""
+        if len(posiciones) > self.TOP_K:
+            corte = np.partition(valores[posiciones], -self.TOP_K)[-self.TOP_K]
+            posiciones = posiciones[valores[posiciones] >= corte]
+        for i in posiciones.tolist():
+            self._empujar(monticulo, valores[i], self.muestras + i, indice[i])
+
+    def agregar(self, bloque):
+        if bloque.empty:
+            return self
+        potencia = bloque['power'].to_numpy(dtype=np.float64)
+        factor_potencia = bloque['power_factor'].to_numpy()
+        ns = bloque.index.as_unit('ns').asi8
+
+        self.suma_potencia += potencia.sum()
+        self.perfil.agregar_muestras(ns, potencia, factor_potencia)
+        if self.perfil.consumo_base_w() is None:
+            self.potencias_sin_madrugada.append(potencia.copy())
+        else:
+            self.potencias_sin_madrugada = []
+
+        horas, inversa = np.unique(ns // NS_POR_HORA, return_inverse=True)
+        sumas = np.bincount(inversa, weights=potencia)
+        cuentas = np.bincount(inversa)
+        for hora, suma, cuenta in zip(horas.tolist(), sumas.tolist(), cuentas.tolist()):
+            acumulado = self.horas_calendario.setdefault(hora, [0.0, 0])
+            acumulado[0] += suma
+            acumulado[1] += cuenta
 
-    # B2. Factor de Potencia (solo de lecturas con consumo real)
-    factor_potencia_promedio = df[df['power'] > 20]['power_factor'].mean() # Ignorar PF cuando la potencia es casi 0
+        self.detector.agregar(ns, potencia)
+        self._empujar_mayores(self.top_potencia, potencia, np.arange(len(potencia)), bloque.index)
+        self.muestras += len(potencia)
+        return self
 
-    # --- C. Detección de Electrodomésticos (Picos) ---
-    # Usamos 'diff()' para ver los "brincos" de consumo (aparatos encendiéndose)
-    df['power_diff'] = df['power'].diff()
-    
-    # Filtramos picos por encima del umbral
-    eventos_encendido = df[df['power_diff'] > UMBRAL_PICO_W].sort_values(by='power_diff', ascending=False)
+    def combinar(self, siguiente):
+        """
+        Incorpora los agregados del tramo que sigue inmediatamente a este.
+        Todo es exacto salvo los eventos: el detector de este tramo se cierra
+        (sus encendidos abiertos quedan sin emparejar y una rampa que cruce la
+        frontera se pierde) y se continúa con el del tramo siguiente.
+        """
+        if siguiente.muestras == 0:
+            return self
+        if self.muestras == 0:
+            self.__dict__.update(siguiente.__dict__)
+            return self
 
+        for valor, menos_posicion, timestamp in siguiente.top_potencia:
+            self._empujar(self.top_potencia, valor, self.muestras - menos_posicion, timestamp)
 
-    # --- 4. IMPRESIÓN DEL REPORTE EN TERMINAL ---
-    
+        anteriores = self.detector.finalizar().eventos
+        for abierto in siguiente.detector.abiertos:
+            abierto[0] += len(anteriores)
+        siguiente.detector.eventos = anteriores + siguiente.detector.eventos
+        self.detector = siguiente.detector
+
+        self.suma_potencia += siguiente.suma_potencia
+        self.perfil.combinar(siguiente.perfil)
+        if self.perfil.consumo_base_w() is None:
+            self.potencias_sin_madrugada += siguiente.potencias_sin_madrugada
+        else:
+            self.potencias_sin_madrugada = []
+        for hora, (suma, cuenta) in siguiente.horas_calendario.items():
+            acumulado = self.horas_calendario.setdefault(hora, [0.0, 0])
+            acumulado[0] += suma
+            acumulado[1] += cuenta
+
+        self.muestras += siguiente.muestras
+        return self
+
+    def resultado(self, perfil=None):
+        """
+        Métricas del reporte, o None si no se agregó ninguna muestra. Con
+        'perfil' (PerfilCarga guardado) se usa en lugar del acumulado.
+        """
+        if self.muestras == 0:
+            return None
+        metricas_perfil = _metricas_perfil(perfil or self.perfil,
+                                           lambda: np.concatenate(self.potencias_sin_madrugada))
+
+        picos = sorted(self.top_potencia, key=lambda e: (-e[0], -e[1]))
+
+        horas = np.array(sorted(self.horas_calendario), dtype=np.int64)
+        promedios = [self.horas_calendario[h][0] / self.horas_calendario[h][1] for h in horas.tolist()]
+        serie_horaria = pd.Series(promedios, index=pd.to_datetime(horas * NS_POR_HORA, utc=True), name='power')
+        serie_horaria = serie_horaria.reindex(
+            pd.date_range(serie_horaria.index[0], serie_horaria.index[-1], freq='h', name='time'))
+
+        return {
+            'muestras': self.muestras,
+            'consumo_promedio_w': self.suma_potencia / self.muestras,
+            'consumo_maximo_w': picos[0][0],
+            'fecha_consumo_maximo': picos[0][2],
+            **metricas_perfil,
+            **_metricas_eventos(self.detector.finalizar().tabla()),
+            'serie_horaria': serie_horaria,
+            'top_picos_absolutos': pd.Series(
+                [valor for valor, _, _ in picos],
+                index=pd.DatetimeIndex([timestamp for _, _, timestamp in picos], name='time'),
+                name='power'),
+        }
+
+
+def calcular_metricas_por_bloques(bloques, perfil=None):
+    """Métricas del reporte en una sola pasada sobre un iterador de bloques (memoria constante)."""
+    agregados = AgregadosConsumo()
+    for bloque in bloques:
+        agregados.agregar(bloque)
+    return agregados.resultado(perfil)
+
+
+def cargar_perfil_bd(device_id):
+    """PerfilCarga guardado por rollup_energia.py (DB_* del .env), o None si no existe."""
+    import psycopg2
+    from perfil_carga import cargar_perfiles
+
+    conn = psycopg2.connect(host=os.environ.get("DB_HOST"), port=os.environ.get("DB_PORT", "5432"),
+                            user=os.environ.get("DB_USER"), password=os.environ.get("DB_PASS"),
+                            dbname=os.environ.get("DB_NAME"))
+    try:
+        perfil = cargar_perfiles(conn, [device_id]).get(device_id)
+    finally:
+        conn.close()
+    return perfil if perfil is not None and not perfil.vacio else None
+
+
+def imprimir_reporte(m):
     print("\n" + "="*50)
     print("      REPORTE DE ANÁLISIS ENERGÉTICO (7 Días)")
     print("="*50 + "\n")
 
     print("--- 💡 1. RESUMEN GENERAL DEL HOGAR ---")
-    print(f"  · Consumo Promedio:     {consumo_promedio_w:.2f} W")
-    print(f"  · Pico Máximo de Consumo: {consumo_maximo_w:.2f} W (Registrado el {fecha_consumo_maximo})")
+    print(f"  · Consumo Promedio:     {m['consumo_promedio_w']:.2f} W")
+    print(f"  · Pico Máximo de Consumo: {m['consumo_maximo_w']:.2f} W (Registrado el {m['fecha_consumo_maximo']})")
 
     print("\n--- 🚫 2. ANÁLISIS DE MALOS HÁBITOS Y AHORRO ---")
-    print(f"  · Consumo Base (Fantasma): {consumo_base_w:.2f} W")
+    print(f"  · Consumo Base (Fantasma): {m['consumo_base_w']:.2f} W")
     print(f"    ↳ Esto es lo que tu casa consume 'sin usar nada' (standby, módems, etc.)")
-    print(f"    ↳ Costo mensual estimado de esta carga fantasma: ${costo_fantasma_mes:.2f} MXN\n")
-    
+    print(f"    ↳ Costo mensual estimado de esta carga fantasma: ${m['costo_fantasma_mes']:.2f} MXN\n")
+
+    factor_potencia_promedio = m['factor_potencia_promedio']
     print(f"  · Factor de Potencia Promedio: {factor_potencia_promedio:.2f}")
     if factor_potencia_promedio < 0.8:
         print("    ↳ ¡ALERTA! Este valor es muy bajo (Ideal > 0.9).")
@@ -121,62 +294,105 @@ def analizar_consumo():
 
 
     print("\n--- 📈 3. PATRONES DE CONSUMO DIARIO ---")
-    print(f"  · Hora 'Pico' Promedio: {hora_pico_promedio}:00 hrs")
+    print(f"  · Hora 'Pico' Promedio: {m['hora_pico_promedio']}:00 hrs")
     print(f"    ↳ Es la hora del día en la que, en promedio, más energía consumes.")
-    print(f"  · Hora 'Valle' Promedio: {hora_valle_promedio}:00 hrs")
+    print(f"  · Hora 'Valle' Promedio: {m['hora_valle_promedio']}:00 hrs")
     print(f"    ↳ Es la hora del día con menor consumo (usualmente la madrugada).")
 
-    print("\n--- 🔌 4. DETECCIÓN DE ELECTRODOMÉSTICOS (Top 5 Picos) ---")
-    print(f"   (Basado en aumentos repentinos de más de {UMBRAL_PICO_W} W)\n")
-    
-    if eventos_encendido.empty:
+    print("\n--- 🔌 4. DETECCIÓN DE ELECTRODOMÉSTICOS (Top 5 Encendidos) ---")
+    print(f"   (Escalones sostenidos de más de {UMBRAL_PICO_W} W; una subida en varias muestras cuenta una vez)\n")
+
+    if not m['eventos_encendido']:
         print("  No se detectaron picos grandes. Posiblemente tu consumo es muy estable o el umbral es muy alto.")
     else:
-        for i, (timestamp, row) in enumerate(eventos_encendido.head(5).iterrows()):
-            pico_watts = row['power_diff']
-            clasificacion = clasificar_pico(pico_watts)
-            print(f"  {i+1}. {timestamp.strftime('%Y-%m-%d %H:%M:%S')}")
-            print(f"     ↳ Se detectó un encendido de +{pico_watts:.0f} W.")
-            print(f"     ↳ Clasificación: {clasificacion}\n")
-
-
-    # --- 5. GENERACIÓN DE GRÁFICA ---
-    print("Generando gráfica (analisis_consumo_7dias.png)...")
-    
-    # Agrupamos por hora para la gráfica principal
-    df_grafica = df['power'].resample('H').mean()
-    
-    plt.figure(figsize=(15, 8))
-    
-    # Graficar el consumo por hora
-    df_grafica.plot(color='blue', label='Consumo Promedio por Hora (W)', zorder=2)
-    
-    # Añadir una línea horizontal para el Consumo Base
-    plt.axhline(y=consumo_base_w, color='red', linestyle='--', 
-                label=f'Consumo Base (Fantasma): {consumo_base_w:.0f} W', zorder=3)
-    
-    # Añadir marcadores para los picos máximos detectados
-    # Tomamos los 5 picos MÁS ALTOS (no los 'diff' más altos)
-    top_picos_absolutos = df['power'].nlargest(5)
-    plt.scatter(top_picos_absolutos.index, top_picos_absolutos.values, 
-                color='orange', s=100, zorder=4, label='Picos Máximos Absolutos')
-    
-    # --- Estilo de la Gráfica ---
-    plt.title('Análisis de Consumo Eléctrico - 7 Días', fontsize=16)
-    plt.ylabel('Potencia (Watts)', fontsize=12)
-    plt.xlabel('Fecha y Hora', fontsize=12)
-    plt.grid(True, linestyle='--', alpha=0.6)
-    plt.legend(loc='upper left')
-    plt.tight_layout()
-    ax = plt.gca()
-    ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d %H:%M'))
-    plt.xticks(rotation=30)
-    
-    # Guardar y Mostrar
-    plt.savefig('analisis_consumo_7dias.png', dpi=150)
+        for i, evento in enumerate(m['eventos_encendido']):
+            clasificacion = clasificar_pico(evento['escalon_w'])
+            print(f"  {i+1}. {evento['fecha'].strftime('%Y-%m-%d %H:%M:%S')}")
+            print(f"     ↳ Se detectó un encendido de +{evento['escalon_w']:.0f} W.")
+            print(f"     ↳ Clasificación: {clasificacion}")
+            if not np.isnan(evento['duracion_s']):
+                horas, minutos = divmod(round(evento['duracion_s'] / 60), 60)
+                duracion = f"{horas}h {minutos:02d}m" if evento['duracion_s'] >= 60 else f"{evento['duracion_s']:.0f}s"
+                print(f"     ↳ Encendido durante ~{duracion} ({evento['energia_kwh']:.2f} kWh).")
+            print()
+        print(f"  Encendidos detectados en el periodo: {m['total_encendidos']}")
+
+
+def generar_grafica(m, ruta_png=NOMBRE_GRAFICA, interactiva=False):
+    """
+    Guarda la gráfica (png, svg o webp según la extensión). matplotlib se
+    importa hasta aquí; sin 'interactiva' se reutiliza la figura del proceso.
+    """
+    import grafica_consumo
+
+    print(f"Generando gráfica ({ruta_png})...")
+    if interactiva:
+        grafica_consumo.PlantillaGrafica(interactiva=True).dibujar(
+            m['serie_horaria'], m['consumo_base_w'], m['top_picos_absolutos'], ruta_png)
+    else:
+        grafica_consumo.dibujar_grafica(m, ruta_png)
+
+
+def analizar_consumo(ruta_csv=NOMBRE_ARCHIVO_CSV, usar_cache=True, motor=MOTOR_AUTO,
+                     por_bloques=False, tamano_bloque=None, perfil=None):
+    """
+    Genera el reporte y la gráfica de una exportación. Con 'por_bloques' el
+    CSV se procesa en una sola pasada sin cargarlo completo (exportaciones
+    más grandes que la RAM); el reporte es el mismo. Con 'perfil' (PerfilCarga)
+    las secciones 2 y 3 salen del perfil guardado.
+    """
+    df = None
+    metricas = None
+    try:
+        print(f"Cargando {ruta_csv}...")
+        if por_bloques:
+            print("Procesando datos por bloques...")
+            metricas = calcular_metricas_por_bloques(iterar_bloques(ruta_csv, tamano_bloque), perfil)
+        else:
+            df = cargar_consumo(ruta_csv, usar_cache=usar_cache, motor=motor)
+    except FileNotFoundError:
+        print(f"--- ERROR ---")
+        print(f"No se encontró el archivo '{ruta_csv}'.")
+        print("Asegúrate de que el script y el CSV estén en la misma carpeta.")
+        return
+    except Exception as e:
+        print(f"Ocurrió un error al leer el archivo: {e}")
+        return
+
+    if df is not None and not df.empty:
+        print("Procesando datos...")
+        metricas = calcular_metricas(df, perfil)
+
+    if metricas is None:
+        print("No se encontraron datos válidos después de la limpieza. Revisa el archivo.")
+        return
+
+    imprimir_reporte(metricas)
+    generar_grafica(metricas, NOMBRE_GRAFICA, interactiva=True)
     print("\n¡Análisis completo! Gráfica guardada y reporte impreso.")
+    import matplotlib.pyplot as plt
     plt.show()
+    return metricas
 
 # --- Ejecutar el análisis ---
 if __name__ == "__main__":
-    analizar_consumo()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Reporte de consumo a partir de una exportación CSV de InfluxDB.")
+    parser.add_argument('csv', nargs='?', default=NOMBRE_ARCHIVO_CSV)
+    parser.add_argument('--sin-cache', action='store_true', help="No usar ni guardar la caché Feather/Parquet.")
+    parser.add_argument('--motor', choices=[MOTOR_AUTO, MOTOR_PYARROW, MOTOR_C], default=MOTOR_AUTO)
+    parser.add_argument('--por-bloques', action='store_true',
+                        help="Una sola pasada con memoria constante (exportaciones más grandes que la RAM).")
+    parser.add_argument('--tamano-bloque', type=int, default=None, help="Filas por bloque en --por-bloques.")
+    parser.add_argument('--perfil-bd', metavar='DEVICE_ID', default=None,
+                        help="Perfil horario, consumo base y factor de potencia del perfil guardado en la BD.")
+    args = parser.parse_args()
+    perfil = None
+    if args.perfil_bd:
+        try:
+            perfil = cargar_perfil_bd(args.perfil_bd)
+            if perfil is None:
+                print(f"ADVERTENCIA: No hay perfil de carga para '{args.perfil_bd}'. Se calcula del CSV.")
+        except Exception as e:
+            print(f"ADVERTENCIA: No se pudo leer el perfil de carga ({e}). Se calcula del CSV.")
+    analizar_consumo(args.csv, usar_cache=not args.sin_cache, motor=args.motor,
+                     por_bloques=args.por_bloques, tamano_bloque=args.tamano_bloque, perfil=perfil)
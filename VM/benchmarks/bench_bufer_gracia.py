@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Benchmark del búfer del periodo de gracia: tabla anterior (una fila JSON por
+medición, BIGSERIAL + índices por device_id y ts_unix) vs chunks binarios en
+tabla particionada por día (bufer_gracia.py).
+
+Requiere PostgreSQL (DB_* del .env). Crea tablas propias con prefijo
+'bench_', simula --dias días de recepción de --dispositivos equipos en
+gracia (una medición cada 2 s) y mide:
+- Inserción (execute_values, un commit por día simulado).
+- Reenvío de un dispositivo: lectura + decodificación a registros.
+- Purga de un dispositivo.
+- Expiración del día más viejo: DELETE por fecha vs DROP de la partición.
+Al final reporta el tamaño en disco de cada esquema y borra las tablas.
+
+Uso: python benchmarks/bench_bufer_gracia.py [--dispositivos 100] [--dias 3] [--muestras-dia 43200]
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+from datetime import date, timedelta
+
+import numpy as np
+import psycopg2
+from psycopg2.extras import execute_values
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import bufer_gracia as bg
+from lote_mediciones import DTYPE_MEDICION, a_payloads_json, registros_desde_json
+
+TABLA_JSON = "bench_mediciones_pendientes"
+TABLA_CHUNKS = "bench_mediciones_gracia"
+DIA_BASE = date(2026, 1, 1)
+
+
+def conectar():
+    return psycopg2.connect(
+        host=os.environ.get("DB_HOST"), port=os.environ.get("DB_PORT", 5432),
+        dbname=os.environ.get("DB_NAME"), user=os.environ.get("DB_USER"),
+        password=os.environ.get("DB_PASS"), connect_timeout=10
+    )
+
+
+def registros_dia(dia, n):
+    ts0 = int(time.mktime((DIA_BASE + timedelta(days=dia)).timetuple()))
+    registros = np.zeros(n, dtype=DTYPE_MEDICION)
+    registros['ts_unix'] = ts0 + 2 * np.arange(n)
+    registros['vrms'] = 127.1
+    registros['pwr'] = 290.5 + np.arange(n) % 50
+    registros['pf'] = 0.91
+    registros['leak'] = 0.01
+    return registros
+
+
+def crear(conn, args):
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {TABLA_JSON}, {TABLA_CHUNKS}")
+        cursor.execute(f"""
+            CREATE TABLE {TABLA_JSON} (
+                id BIGSERIAL PRIMARY KEY,
+                device_id VARCHAR(20) NOT NULL,
+                ts_unix BIGINT NOT NULL,
+                payload_json TEXT NOT NULL,
+                created_at TIMESTAMPTZ DEFAULT NOW()
+            )
+        """)
+        cursor.execute(f"CREATE INDEX ON {TABLA_JSON} (device_id)")
+        cursor.execute(f"CREATE INDEX ON {TABLA_JSON} (ts_unix)")
+        cursor.execute(f"""
+            CREATE TABLE {TABLA_CHUNKS} (
+                device_id VARCHAR(20) NOT NULL, dia DATE NOT NULL,
+                ts_min BIGINT NOT NULL, ts_max BIGINT NOT NULL,
+                muestras INTEGER NOT NULL, registros BYTEA NOT NULL,
+                creado TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            ) PARTITION BY RANGE (dia)
+        """)
+        cursor.execute(f"CREATE INDEX ON {TABLA_CHUNKS} (device_id, ts_min)")
+        for dia in range(args.dias):
+            inicio = DIA_BASE + timedelta(days=dia)
+            cursor.execute(f"""
+                CREATE TABLE {TABLA_CHUNKS}_{inicio:%Y%m%d} PARTITION OF {TABLA_CHUNKS}
+                FOR VALUES FROM (%s) TO (%s)
+            """, (inicio, inicio + timedelta(days=1)))
+    conn.commit()
+
+
+def cronometrar(conn, sql, params=None):
+    inicio = time.perf_counter()
+    with conn.cursor() as cursor:
+        cursor.execute(sql, params)
+        filas = cursor.rowcount
+    conn.commit()
+    return time.perf_counter() - inicio, filas
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dispositivos', type=int, default=100)
+    parser.add_argument('--dias', type=int, default=3)
+    parser.add_argument('--muestras-dia', type=int, default=43_200)
+    args = parser.parse_args()
+
+    conn = conectar()
+    crear(conn, args)
+    total = args.dispositivos * args.dias * args.muestras_dia
+    print(f"=== {args.dispositivos} dispositivos x {args.dias} días x {args.muestras_dia:,} "
+          f"= {total:,} mediciones ===")
+    dispositivos = [f"DEV{i:05d}" for i in range(args.dispositivos)]
+
+    t_json = t_chunks = 0.0
+    for dia in range(args.dias):
+        registros = registros_dia(dia, args.muestras_dia)
+        filas_json = a_payloads_json(registros)
+        inicio = time.perf_counter()
+        with conn.cursor() as cursor:
+            for device_id in dispositivos:
+                execute_values(cursor, f"INSERT INTO {TABLA_JSON} (device_id, ts_unix, payload_json) VALUES %s",
+                               [(device_id, ts, payload) for ts, payload in filas_json], page_size=5000)
+        conn.commit()
+        t_json += time.perf_counter() - inicio
+
+        inicio = time.perf_counter()
+        filas = []
+        for device_id in dispositivos:
+            for corte in range(0, len(registros), bg.GRACIA_CHUNK_MUESTRAS):
+                chunk = registros[corte:corte + bg.GRACIA_CHUNK_MUESTRAS]
+                filas.append((device_id, DIA_BASE + timedelta(days=dia), int(chunk['ts_unix'][0]),
+                              int(chunk['ts_unix'][-1]), len(chunk), chunk.tobytes()))
+        with conn.cursor() as cursor:
+            execute_values(cursor, f"INSERT INTO {TABLA_CHUNKS} (device_id, dia, ts_min, ts_max, muestras, registros) "
+                                   f"VALUES %s", filas)
+        conn.commit()
+        t_chunks += time.perf_counter() - inicio
+
+    print(f"\n  {'operación':<34} {'JSON por fila':>14} {'chunks':>14}")
+    print(f"  {'inserción (mediciones/s)':<34} {total / t_json:>14,.0f} {total / t_chunks:>14,.0f}")
+
+    device_id = dispositivos[0]
+    inicio = time.perf_counter()
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT id, payload_json FROM {TABLA_JSON} WHERE device_id = %s ORDER BY ts_unix",
+                       (device_id,))
+        a = registros_desde_json([json.loads(payload) for _, payload in cursor.fetchall()])
+    t_json = time.perf_counter() - inicio
+    inicio = time.perf_counter()
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT registros FROM {TABLA_CHUNKS} WHERE device_id = %s ORDER BY ts_min", (device_id,))
+        b = np.concatenate([np.frombuffer(bytes(blob), dtype=DTYPE_MEDICION) for blob, in cursor.fetchall()])
+    t_chunks = time.perf_counter() - inicio
+    assert len(a) == len(b)
+    print(f"  {'reenvío de 1 dispositivo (s)':<34} {t_json:>14.3f} {t_chunks:>14.3f}")
+
+    device_id = dispositivos[1]
+    t_json, _ = cronometrar(conn, f"DELETE FROM {TABLA_JSON} WHERE device_id = %s", (device_id,))
+    t_chunks, _ = cronometrar(conn, f"DELETE FROM {TABLA_CHUNKS} WHERE device_id = %s", (device_id,))
+    print(f"  {'purga de 1 dispositivo (s)':<34} {t_json:>14.3f} {t_chunks:>14.3f}")
+
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT pg_total_relation_size(%s)", (TABLA_JSON,))
+        mb_json = cursor.fetchone()[0] / 1e6
+        cursor.execute("""
+            SELECT sum(pg_total_relation_size(i.inhrelid)) FROM pg_inherits i
+            WHERE i.inhparent = %s::regclass
+        """, (TABLA_CHUNKS,))
+        mb_chunks = cursor.fetchone()[0] / 1e6
+
+    fin_dia = int(time.mktime((DIA_BASE + timedelta(days=1)).timetuple()))
+    t_json, _ = cronometrar(conn, f"DELETE FROM {TABLA_JSON} WHERE ts_unix < %s", (fin_dia,))
+    t_chunks, _ = cronometrar(conn, f"DROP TABLE {TABLA_CHUNKS}_{DIA_BASE:%Y%m%d}")
+    print(f"  {'expiración de 1 día (s)':<34} {t_json:>14.3f} {t_chunks:>14.3f}")
+    print(f"  {'tamaño en disco (MB)':<34} {mb_json:>14,.1f} {mb_chunks:>14,.1f}")
+
+    with conn.cursor() as cursor:
+        cursor.execute(f"DROP TABLE IF EXISTS {TABLA_JSON}, {TABLA_CHUNKS}")
+    conn.commit()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
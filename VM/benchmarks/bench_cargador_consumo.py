@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Benchmark del cargador de exportaciones de analizar_consumo.py.
+
+Genera un CSV anotado sintético con el formato de exportación de InfluxDB
+(muestras cada 2s durante varios meses) y mide:
+- Lector anterior: read_csv(comment='#') con tipos por defecto + to_numeric /
+  to_datetime(errors='coerce').
+- cargador_consumo con el lector C por bloques y con PyArrow (sin caché).
+- Primera corrida con caché (parsea y guarda) y segunda corrida (lee la caché).
+
+Uso: python benchmarks/bench_cargador_consumo.py [--meses 3] [--dir /tmp/bench_consumo]
+"""
+
+import os
+import sys
+import time
+import shutil
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import cargador_consumo as cc
+
+ANOTACIONES = (
+    "#group,false,false,true,true,false,false,false,true\n"
+    "#datatype,string,long,dateTime:RFC3339,dateTime:RFC3339,dateTime:RFC3339,double,double,string\n"
+    "#default,_result,,,,,,,\n"
+)
+
+
+def generar_exportacion(ruta, meses, device_id='BENCH0001'):
+    muestras = int(meses * 30 * 86400 / 2)
+    rng = np.random.default_rng(7)
+    inicio = pd.Timestamp('2025-01-01', tz='UTC')
+    tiempos = pd.date_range(inicio, periods=muestras, freq='2s')
+    hora = tiempos.hour.to_numpy()
+    base = 80 + 250 * ((hora >= 18) & (hora <= 23))
+    potencia = np.clip(base + rng.normal(0, 30, muestras) + 1500 * (rng.random(muestras) < 0.001), 0, None)
+    df = pd.DataFrame({
+        'result': '',
+        'table': 0,
+        '_start': tiempos[0].strftime('%Y-%m-%dT%H:%M:%SZ'),
+        '_stop': tiempos[-1].strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'time': tiempos.strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'power': potencia.round(2),
+        'power_factor': rng.uniform(0.7, 1.0, muestras).round(3),
+        'device_id': device_id,
+    })
+    with open(ruta, 'w') as archivo:
+        archivo.write(ANOTACIONES)
+        df.to_csv(archivo, index=False)
+    return muestras
+
+
+def cargar_anterior(ruta):
+    """El lector original de analizar_consumo.py."""
+    df = pd.read_csv(ruta, comment='#')
+    df['power'] = pd.to_numeric(df['power'], errors='coerce')
+    df['power_factor'] = pd.to_numeric(df['power_factor'], errors='coerce')
+    df['time'] = pd.to_datetime(df['time'], errors='coerce')
+    df = df.dropna(subset=['time', 'power', 'power_factor'])
+    return df.set_index('time')
+
+
+def cronometrar(nombre, funcion, *args, **kwargs):
+    inicio = time.perf_counter()
+    resultado = funcion(*args, **kwargs)
+    segundos = time.perf_counter() - inicio
+    print(f"  {nombre:<34} {segundos:9.3f} s")
+    return resultado, segundos
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--meses', type=float, default=3)
+    parser.add_argument('--dir', default='/tmp/bench_consumo')
+    args = parser.parse_args()
+
+    os.makedirs(args.dir, exist_ok=True)
+    ruta = os.path.join(args.dir, f'export_{args.meses:g}m.csv')
+    cache = os.path.join(args.dir, '.cache_consumo')
+    shutil.rmtree(cache, ignore_errors=True)
+    cc.ANALISIS_CACHE_DIR = cache
+
+    if not os.path.exists(ruta):
+        print(f"Generando {ruta}...")
+        muestras = generar_exportacion(ruta, args.meses)
+    else:
+        muestras = None
+    print(f"Archivo: {ruta} ({os.path.getsize(ruta) / 1e6:.0f} MB"
+          f"{f', {muestras:,} filas' if muestras else ''})\n")
+
+    anterior, t_anterior = cronometrar("lector anterior", cargar_anterior, ruta)
+    (nuevo_c, _), _ = cronometrar("cargador, lector C", cc.leer_csv, ruta, cc.MOTOR_C)
+    if cc.pa is not None:
+        cronometrar("cargador, PyArrow", cc.leer_csv, ruta, cc.MOTOR_PYARROW)
+    else:
+        print("  (PyArrow no instalado: se omite)")
+    _, t_fria = cronometrar("caché: primera corrida", cc.cargar_consumo, ruta)
+    cargado, t_caliente = cronometrar("caché: segunda corrida", cc.cargar_consumo, ruta)
+
+    iguales = (len(anterior) == len(nuevo_c) == len(cargado)
+               and np.allclose(anterior['power'].to_numpy(), cargado['power'].to_numpy())
+               and (anterior.index == cargado.index).all())
+    print(f"\nMismas filas y valores que el lector anterior: {'sí' if iguales else 'NO'}")
+    print(f"Memoria: anterior {anterior.memory_usage(deep=True).sum() / 1e6:.0f} MB, "
+          f"cargador {cargado.memory_usage(deep=True).sum() / 1e6:.0f} MB")
+    print(f"Aceleración: {t_anterior / t_fria:.1f}x sin caché, {t_anterior / t_caliente:.0f}x con caché")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+#!/usr/bin/env python3
+"""
+Benchmark de consumo por ventana: un cliente a la vez vs consulta por lote.
+
+Requiere el .env de producción. Para las mismas ventanas que usa
+alerta_diaria.py (ayer y el periodo desde un día de corte común) mide:
+- Ciclo por cliente: obtener_consumo_desde_influxdb() por cada ventana.
+- Lote: obtener_consumo_lote(), una consulta por ventana compartida.
+
+Uso: python benchmarks/bench_consumo_lote.py DEVICE_ID [DEVICE_ID ...] [--dias-periodo 30]
+"""
+
+import os
+import sys
+import time
+import argparse
+from datetime import datetime, timedelta
+
+import pytz
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import consumo_energia as ce
+
+ZONA_HORARIA_LOCAL = pytz.timezone('America/Mexico_City')
+
+
+def medianoche(fecha):
+    return ZONA_HORARIA_LOCAL.localize(datetime.combine(fecha, datetime.min.time()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('devices', nargs='+')
+    parser.add_argument('--dias-periodo', type=int, default=30)
+    args = parser.parse_args()
+
+    hoy = datetime.now(ZONA_HORARIA_LOCAL).date()
+    ayer = (medianoche(hoy - timedelta(days=1)), medianoche(hoy))
+    periodo = (medianoche(hoy - timedelta(days=args.dias_periodo)), medianoche(hoy))
+    ventanas = [(device_id, *ventana) for device_id in args.devices for ventana in (ayer, periodo)]
+    print(f"{len(args.devices)} dispositivos, {len(ventanas)} ventanas "
+          f"(ayer + periodo de {args.dias_periodo} días)")
+    print(f"Watermark de rollup: {ce.obtener_watermark_rollup()}\n")
+
+    inicio = time.perf_counter()
+    por_cliente = {v: ce.obtener_consumo_desde_influxdb(*v)[0] for v in ventanas}
+    t_por_cliente = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    por_lote = ce.obtener_consumo_lote(ventanas)
+    t_lote = time.perf_counter() - inicio
+
+    diferencias = [
+        v for v in ventanas
+        if abs((por_cliente[v] or 0.0) - (por_lote.get(v) or 0.0)) > 1e-6
+    ]
+    print(f"Por cliente: {t_por_cliente:.3f}s")
+    print(f"Por lote:    {t_lote:.3f}s ({t_por_cliente / t_lote:.1f}x más rápido)")
+    print(f"Ventanas con kWh distintos: {len(diferencias)}")
+    for device_id, inicio_v, fin_v in diferencias[:10]:
+        v = (device_id, inicio_v, fin_v)
+        print(f"  {device_id} {inicio_v.date()} -> {fin_v.date()}: {por_cliente[v]} vs {por_lote.get(v)}")
+    ce.cerrar_cliente_influx()
+
+
+if __name__ == "__main__":
+    main()
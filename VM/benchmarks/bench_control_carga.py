@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+"""
+Benchmark del control de carga del receptor (control_carga.py).
+
+Sin broker ni bases de datos (estado de suscripción 'active' fijo y
+escritura a InfluxDB descartada), mide:
+- El costo por mensaje de on_message con JSON con y sin límites por
+  dispositivo (token bucket + nivel de descarte), con flota de N equipos
+  publicando cada 2 s: el camino normal no debe notar la diferencia.
+- Un dispositivo en bucle: cuántos mensajes deja pasar el bucket.
+- Una caída de InfluxDB: derrame al espool (directorio temporal) al pasar
+  RECEPTOR_MAX_PUNTOS y reescritura posterior.
+
+Uso: python benchmarks/bench_control_carga.py [--mensajes 200000] [--dispositivos 500]
+"""
+
+import os
+import sys
+import time
+import argparse
+import logging
+import tempfile
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import receptor_mqtt as rm
+import control_carga as cc
+
+
+class EscrituraNula:
+    """Sustituto de write_api: cuenta puntos; 'caida' simula InfluxDB fuera de línea."""
+
+    def __init__(self):
+        self.puntos = 0
+        self.caida = False
+
+    def write(self, bucket, org, record):
+        if self.caida:
+            raise ConnectionError("InfluxDB fuera de línea (simulado)")
+        self.puntos += len(record) if isinstance(record, list) else 1
+
+
+class Mensaje:
+    def __init__(self, topic, payload):
+        self.topic, self.payload, self.mid, self.qos = topic, payload, 0, 0
+
+
+def mensajes_flota(n, dispositivos):
+    ahora = int(time.time())
+    return [Mensaje(f"lete/mediciones/DEV{i % dispositivos:05d}",
+                    (f'{{"ts_unix":{ahora - (n - i) * 2 // dispositivos},"vrms":127.1,"irms_p":2.5,"irms_n":2.49,'
+                     f'"pwr":290.5,"va":317.7,"pf":0.91,"leak":0.010,"temp":45.2,"seq":{i}}}').encode('utf-8'))
+            for i in range(n)]
+
+
+def en_memoria():
+    return len(rm.carril_vivo.buffer) + len(rm.carril_backfill.buffer)
+
+
+def medir(nombre, mensajes):
+    cpu = time.process_time()
+    for msg in mensajes:
+        rm.on_message(None, None, msg)
+    cpu = time.process_time() - cpu
+    print(f"  {nombre:<34} {cpu / len(mensajes) * 1e6:>10.2f} µs/mensaje")
+    return cpu / len(mensajes)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mensajes', type=int, default=200_000)
+    parser.add_argument('--dispositivos', type=int, default=500)
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    escritura = EscrituraNula()
+    rm.influx_write_api = escritura
+    rm.get_device_subscription_status = lambda device_id: 'active'
+
+    print(f"=== Camino normal: {args.mensajes:,} mensajes JSON de {args.dispositivos} dispositivos ===")
+    mensajes = mensajes_flota(args.mensajes, args.dispositivos)
+    sin = cc.LimitadorDispositivos(0, 0)
+    rm.limitador_vivo = rm.limitador_backfill = sin
+    medir("sin límites (warm-up)", mensajes[:20_000])
+    base = medir("sin límites", mensajes)
+    rm.limitador_vivo = cc.LimitadorDispositivos(cc.LIMITE_VIVO_MUESTRAS_S, cc.LIMITE_VIVO_RAFAGA)
+    rm.limitador_backfill = cc.LimitadorDispositivos(cc.LIMITE_BACKFILL_MUESTRAS_S, cc.LIMITE_BACKFILL_RAFAGA)
+    con = medir("con token bucket + nivel", mensajes)
+    print(f"  Sobrecosto: {(con - base) * 1e6:+.2f} µs/mensaje ({(con / base - 1) * 100:+.1f} %); "
+          f"descartadas: {sum(sum(m.values()) for m in rm.contadores_descarte.tomar().values())}")
+
+    print("\n=== Dispositivo en bucle (5 s publicando sin pausa) ===")
+    limitador = cc.LimitadorDispositivos(cc.LIMITE_VIVO_MUESTRAS_S, cc.LIMITE_VIVO_RAFAGA)
+    inicio, permitidos, total = time.monotonic(), 0, 0
+    while time.monotonic() - inicio < 5:
+        permitidos += limitador.permitir("LOOP0001")
+        total += 1
+    print(f"  {total:,} intentos, {permitidos:,} permitidos "
+          f"(ráfaga {cc.LIMITE_VIVO_RAFAGA:g} + {cc.LIMITE_VIVO_MUESTRAS_S:g}/s)")
+
+    print(f"\n=== Caída de InfluxDB con presupuesto de {cc.RECEPTOR_MAX_PUNTOS:,} puntos ===")
+    with tempfile.TemporaryDirectory() as directorio:
+        rm.espool = cc.EspoolDisco(directorio)
+        rm.limitador_vivo = rm.limitador_backfill = sin
+        escritura.caida = True
+        # Sin flush: los puntos se quedan en memoria como con InfluxDB caído
+        rm.carril_vivo.batch_size = rm.carril_vivo.batch_timeout = 10 ** 9
+        n = int(cc.RECEPTOR_MAX_PUNTOS * 1.5)
+        for msg in mensajes_flota(n, args.dispositivos):
+            rm.on_message(None, None, msg)
+        print(f"  En memoria: {en_memoria():,} puntos, nivel {rm.shedding_level()}")
+        inicio = time.perf_counter()
+        rm.spill_to_disk()
+        print(f"  Tras derramar: {en_memoria():,} en memoria, {rm.espool.bytes / 1e6:.1f} MB en disco, "
+              f"nivel {rm.shedding_level()} ({time.perf_counter() - inicio:.2f} s)")
+        escritura.caida = False
+        escritos = escritura.puntos
+        rm.carril_backfill.siguiente_flush = 0
+        while rm.drain_spool():
+            rm.carril_backfill.siguiente_flush = 0
+        print(f"  Reescritos desde el espool: {escritura.puntos - escritos:,} puntos")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+Benchmark de la gráfica de los reportes de consumo.
+
+Compara, por gráfica y en un lote de N reportes:
+- Ruta anterior: pyplot + Series.plot() + scatter + tight_layout() + savefig()
+  con una figura nueva por reporte.
+- grafica_consumo: figura plantilla reutilizada, serie diezmada (mín/máx) y
+  márgenes fijos, en png / svg / webp.
+Cada modo corre en un proceso nuevo para medir su pico de memoria (RSS).
+
+Uso: python benchmarks/bench_grafica_consumo.py [--reportes 1000] [--dias 7] [--salida /tmp/bench_graficas]
+"""
+
+import os
+import sys
+import time
+import resource
+import argparse
+import multiprocessing
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+
+def metricas_sinteticas(semilla, dias):
+    """Solo lo que usa la gráfica: serie horaria, consumo base y picos absolutos."""
+    rng = np.random.default_rng(semilla)
+    horas = pd.date_range('2025-01-01', periods=dias * 24, freq='h', tz='UTC', name='time')
+    serie = pd.Series(100 + 200 * rng.random(len(horas)), index=horas, name='power')
+    picos = serie.nlargest(5) + 1500
+    return {'serie_horaria': serie, 'consumo_base_w': 80 + 20 * rng.random(), 'top_picos_absolutos': picos}
+
+
+def grafica_anterior(m, ruta):
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    import matplotlib.dates as mdates
+
+    plt.figure(figsize=(15, 8))
+    m['serie_horaria'].plot(color='blue', label='Consumo Promedio por Hora (W)', zorder=2)
+    plt.axhline(y=m['consumo_base_w'], color='red', linestyle='--',
+                label=f"Consumo Base (Fantasma): {m['consumo_base_w']:.0f} W", zorder=3)
+    picos = m['top_picos_absolutos']
+    plt.scatter(picos.index, picos.values, color='orange', s=100, zorder=4, label='Picos Máximos Absolutos')
+    plt.title('Análisis de Consumo Eléctrico - 7 Días', fontsize=16)
+    plt.ylabel('Potencia (Watts)', fontsize=12)
+    plt.xlabel('Fecha y Hora', fontsize=12)
+    plt.grid(True, linestyle='--', alpha=0.6)
+    plt.legend(loc='upper left')
+    plt.tight_layout()
+    plt.gca().xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d %H:%M'))
+    plt.xticks(rotation=30)
+    plt.savefig(ruta, dpi=150)
+    plt.close('all')
+
+
+def correr_modo(modo, formato, reportes, dias, salida):
+    """[PROCESO HIJO] Dibuja 'reportes' gráficas. Devuelve (segundos, pico RSS en MB)."""
+    if modo == 'anterior':
+        dibujar = grafica_anterior
+    else:
+        import grafica_consumo
+        dibujar = grafica_consumo.dibujar_grafica
+    lote = [metricas_sinteticas(i, dias) for i in range(min(reportes, 50))]
+    inicio = time.perf_counter()
+    for i in range(reportes):
+        dibujar(lote[i % len(lote)], os.path.join(salida, f"{modo}_{i % 10}.{formato}"))
+    segundos = time.perf_counter() - inicio
+    return segundos, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--reportes', type=int, default=1000)
+    parser.add_argument('--dias', type=int, default=7)
+    parser.add_argument('--salida', default='/tmp/bench_graficas')
+    args = parser.parse_args()
+    os.makedirs(args.salida, exist_ok=True)
+
+    print(f"{args.reportes} gráficas de {args.dias} días ({args.dias * 24} puntos horarios)\n")
+    print(f"{'modo':<24} {'total (s)':>10} {'ms/gráfica':>11} {'pico RSS (MB)':>14}")
+    contexto = multiprocessing.get_context('spawn')
+    base = None
+    for modo, formato in (('anterior', 'png'), ('plantilla', 'png'), ('plantilla', 'svg'), ('plantilla', 'webp')):
+        with contexto.Pool(1) as pool:
+            segundos, rss = pool.apply(correr_modo, (modo, formato, args.reportes, args.dias, args.salida))
+        base = base or segundos
+        print(f"{modo + ' ' + formato:<24} {segundos:10.2f} {segundos / args.reportes * 1000:11.1f} {rss:14.0f}"
+              f"   ({base / segundos:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Benchmark del receptor MQTT: un JSON por medición vs lotes binarios.
+
+Simula el vaciado del backlog de la tarjeta SD y mide, sin broker ni
+bases de datos, lo que hace on_message hasta dejar la línea lista para
+InfluxDB:
+- JSON: decode + json.loads + Point por mensaje (parse_payload_to_point)
+  y su serialización a line protocol al hacer flush.
+- Lote binario: decodificar_lote (numpy) + a_line_protocol por lote.
+Reporta mensajes/s, muestras/s, CPU por muestra y bytes por muestra, y
+verifica que ambos caminos generen los mismos valores.
+
+Uso: python benchmarks/bench_mqtt_lote.py [--muestras 100000] [--tamano-lote 200 500 2000]
+"""
+
+import os
+import sys
+import time
+import argparse
+import logging
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import receptor_mqtt as rm
+from lote_mediciones import DTYPE_MEDICION, codificar_lote, decodificar_lote, a_line_protocol
+
+DEVICE_ID = "BENCH0001"
+
+
+def generar_registros(n):
+    rng = np.random.default_rng(42)
+    registros = np.zeros(n, dtype=DTYPE_MEDICION)
+    registros['seq'] = np.arange(1, n + 1)
+    registros['ts_unix'] = 1_760_000_000 + 2 * np.arange(n)
+    registros['vrms'] = rng.normal(127, 3, n)
+    registros['irms_p'] = rng.gamma(2, 1.0, n)
+    registros['irms_n'] = registros['irms_p'] - rng.gamma(2, 0.01, n)
+    registros['pwr'] = registros['vrms'] * registros['irms_p'] * 0.9
+    registros['va'] = registros['vrms'] * registros['irms_p']
+    registros['pf'] = 0.9
+    registros['leak'] = np.abs(registros['irms_p'] - registros['irms_n'])
+    registros['temp'] = rng.normal(45, 2, n)
+    return registros
+
+
+def payload_json(r):
+    """Mismo snprintf que el firmware al reenviar una línea del .dat."""
+    return (f'{{"ts_unix":{r["ts_unix"]},"vrms":{r["vrms"]:.2f},"irms_p":{r["irms_p"]:.3f},'
+            f'"irms_n":{r["irms_n"]:.3f},"pwr":{r["pwr"]:.2f},"va":{r["va"]:.2f},"pf":{r["pf"]:.2f},'
+            f'"leak":{r["leak"]:.3f},"temp":{r["temp"]:.1f},"seq":{r["seq"]}}}').encode('utf-8')
+
+
+def medir(nombre, mensajes, procesar, muestras, bytes_totales):
+    pared, cpu = time.perf_counter(), time.process_time()
+    lineas = []
+    for payload in mensajes:
+        lineas.extend(procesar(payload))
+    pared, cpu = time.perf_counter() - pared, time.process_time() - cpu
+    print(f"  {nombre:<22} {len(mensajes) / pared:>12,.0f} {muestras / pared:>12,.0f} "
+          f"{cpu / muestras * 1e6:>12.2f} {bytes_totales / muestras:>10.1f}")
+    return lineas
+
+
+def _campos(linea):
+    """{campo: valor} de una línea de line protocol (para comparar caminos)."""
+    _, campos, ts = linea.rsplit(' ', 2)
+    valores = dict(par.split('=') for par in campos.split(','))
+    return {k: v.rstrip('i') for k, v in valores.items()}, int(ts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--muestras', type=int, default=100_000)
+    parser.add_argument('--tamano-lote', type=int, nargs='+', default=[200, 500, 2000])
+    args = parser.parse_args()
+    logging.disable(logging.CRITICAL)
+
+    registros = generar_registros(args.muestras)
+    n = len(registros)
+    print(f"=== Receptor MQTT: {n:,} mediciones ===")
+    print(f"  {'camino':<22} {'mensajes/s':>12} {'muestras/s':>12} {'CPU µs/muestra':>12} {'bytes/muestra':>10}")
+
+    mensajes_json = [payload_json(r) for r in registros]
+
+    def procesar_json(payload):
+        point, _ = rm.parse_payload_to_point(payload.decode('utf-8'), DEVICE_ID)
+        return [point.to_line_protocol()]
+
+    lineas_json = medir("JSON (1 por mensaje)", mensajes_json, procesar_json, n, sum(map(len, mensajes_json)))
+
+    lineas_lote = None
+    for tamano in args.tamano_lote:
+        mensajes = [codificar_lote(registros[i:i + tamano]) for i in range(0, n, tamano)]
+        lineas_lote = medir(f"binario (lote de {tamano})", mensajes,
+                            lambda payload: a_line_protocol(DEVICE_ID, decodificar_lote(payload)),
+                            n, sum(map(len, mensajes)))
+
+    # Ambos caminos deben escribir lo mismo (Point usa segundos; el lote, ns)
+    diferentes = 0
+    for linea_json, linea_lote in zip(lineas_json, lineas_lote):
+        campos_json, ts_json = _campos(linea_json)
+        campos_lote, ts_lote = _campos(linea_lote)
+        if ts_json * 1_000_000_000 != ts_lote or {k: float(v) for k, v in campos_json.items()} != \
+                {k: float(v) for k, v in campos_lote.items()}:
+            diferentes += 1
+    print(f"\nLíneas con valores distintos entre JSON y binario: {diferentes} de {n:,}")
+
+
+if __name__ == "__main__":
+    main()
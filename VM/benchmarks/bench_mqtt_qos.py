@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Benchmark de entrega MQTT: QoS 0 vs QoS 1 con ack automático vs QoS 1 con
+ack manual después de la escritura (lo que hace receptor_mqtt.py con
+MQTT_SESION_PERSISTENTE=true).
+
+Requiere un broker (MQTT_BROKER_HOST del .env). Publica N mediciones JSON
+en un topic propio del benchmark y mide, del lado del suscriptor, mensajes/s
+hasta recibirlas todas y cuántas faltaron. En el modo de ack manual los mids
+se confirman cada --lote mensajes tras simular la escritura durable
+(--latencia-escritura ms) o, como el flush periódico del receptor, cuando
+pasan --timeout segundos sin completar el lote. Si max_inflight_messages del
+broker es menor que --lote, este modo queda limitado por el timeout.
+
+Uso: python benchmarks/bench_mqtt_qos.py [--mensajes 20000] [--lote 50] [--latencia-escritura 20] [--timeout 1]
+"""
+
+import os
+import sys
+import time
+import json
+import argparse
+import threading
+
+import paho.mqtt.client as mqtt
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import receptor_mqtt as rm
+
+TOPIC = "lete/bench_qos/{}"
+MODOS = (
+    ('QoS 0', 0, False),
+    ('QoS 1 (ack automático)', 1, False),
+    ('QoS 1 (ack tras escritura)', 1, True),
+)
+
+
+def cliente(client_id, manual_ack=False):
+    c = mqtt.Client(mqtt.CallbackAPIVersion.VERSION1, client_id=client_id, manual_ack=manual_ack)
+    if rm.MQTT_USERNAME and rm.MQTT_PASSWORD:
+        c.username_pw_set(rm.MQTT_USERNAME, rm.MQTT_PASSWORD)
+    c.max_inflight_messages_set(1000)
+    c.max_queued_messages_set(0)
+    return c
+
+
+def medir(nombre, qos, manual, args):
+    topic = TOPIC.format(os.getpid())
+    recibidos = set()
+    pendientes = []
+    lock = threading.Lock()
+    listo = threading.Event()
+    suscrito = threading.Event()
+    ultimo_ack = [time.perf_counter()]
+
+    def confirmar(c):
+        time.sleep(args.latencia_escritura / 1000)
+        for mid, q in pendientes:
+            c.ack(mid, q)
+        pendientes.clear()
+        ultimo_ack[0] = time.perf_counter()
+
+    def on_message(c, userdata, msg):
+        with lock:
+            recibidos.add(json.loads(msg.payload)['seq'])
+            if manual:
+                pendientes.append((msg.mid, msg.qos))
+                if len(pendientes) >= args.lote:
+                    confirmar(c)
+            if len(recibidos) >= args.mensajes:
+                listo.set()
+
+    sub = cliente(f"bench_qos_sub_{os.getpid()}_{qos}_{int(manual)}", manual_ack=manual)
+    sub.on_message = on_message
+    sub.on_subscribe = lambda *a: suscrito.set()
+    sub.connect(rm.MQTT_BROKER_HOST, rm.MQTT_PORT, 60)
+    sub.loop_start()
+    sub.subscribe(topic, qos=qos)
+    suscrito.wait(10)
+
+    pub = cliente(f"bench_qos_pub_{os.getpid()}_{qos}_{int(manual)}")
+    pub.connect(rm.MQTT_BROKER_HOST, rm.MQTT_PORT, 60)
+    pub.loop_start()
+
+    inicio = time.perf_counter()
+    for seq in range(args.mensajes):
+        payload = json.dumps({"ts_unix": 1_760_000_000 + 2 * seq, "vrms": 127.1, "pwr": 350.25, "seq": seq})
+        pub.publish(topic, payload, qos=qos)
+    # Como el flush periódico del receptor: confirma lo pendiente si el lote no se llena
+    while not listo.wait(0.05):
+        if time.perf_counter() - inicio > args.espera_max:
+            break
+        with lock:
+            if manual and pendientes and time.perf_counter() - ultimo_ack[0] >= args.timeout:
+                confirmar(sub)
+    segundos = time.perf_counter() - inicio
+
+    for c in (pub, sub):
+        c.loop_stop()
+        c.disconnect()
+    perdidos = args.mensajes - len(recibidos)
+    print(f"  {nombre:<28} {len(recibidos) / segundos:>12,.0f} {segundos:>10.2f} {perdidos:>10,}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--mensajes', type=int, default=20_000)
+    parser.add_argument('--lote', type=int, default=rm.BATCH_SIZE)
+    parser.add_argument('--latencia-escritura', type=float, default=20, help="ms por escritura de lote")
+    parser.add_argument('--timeout', type=float, default=1.0, help="s sin llenar el lote antes de confirmar")
+    parser.add_argument('--espera-max', type=float, default=120.0)
+    args = parser.parse_args()
+
+    print(f"=== Entrega MQTT: {args.mensajes:,} mensajes vía {rm.MQTT_BROKER_HOST}:{rm.MQTT_PORT} ===")
+    print(f"  {'modo':<28} {'mensajes/s':>12} {'segundos':>10} {'perdidos':>10}")
+    for nombre, qos, manual in MODOS:
+        medir(nombre, qos, manual, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+"""
+Benchmark de escalamiento de reportes_consumo_lote.py.
+
+Genera en memoria N dispositivos sintéticos (7 días a 2s, ~302k muestras
+cada uno) y ejecuta el lote completo (métricas + .txt + .json + .png) con
+distintos números de procesos, para ver cómo escala con los workers.
+
+Uso: python benchmarks/bench_reportes_lote.py [--dispositivos 16] [--workers 1,2,4,8] [--salida /tmp/bench_reportes]
+"""
+
+import os
+import sys
+import argparse
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import reportes_consumo_lote as rl
+
+
+def dispositivo_sintetico(semilla, dias=7):
+    rng = np.random.default_rng(semilla)
+    tiempos = pd.date_range('2025-01-01', periods=dias * 43200, freq='2s', tz='UTC', name='time')
+    hora = tiempos.hour.to_numpy()
+    potencia = (60 + rng.uniform(0, 60)) + 250 * ((hora >= 18) & (hora <= 23))
+    potencia = np.clip(potencia + rng.normal(0, 30, len(tiempos)) + 1500 * (rng.random(len(tiempos)) < 0.001), 0, None)
+    return pd.DataFrame({
+        'power': potencia,
+        'power_factor': rng.uniform(0.7, 1.0, len(tiempos)).astype('float32'),
+    }, index=tiempos)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dispositivos', type=int, default=16)
+    parser.add_argument('--workers', default='1,2,4,8')
+    parser.add_argument('--salida', default='/tmp/bench_reportes')
+    args = parser.parse_args()
+
+    tareas = [(f"BENCH{i:04d}", dispositivo_sintetico(i)) for i in range(args.dispositivos)]
+    print(f"{args.dispositivos} dispositivos sintéticos de 7 días ({os.cpu_count()} CPUs)\n")
+    print(f"{'workers':>7} {'lote (s)':>9} {'s/reporte':>10} {'aceleración':>12} {'eficiencia':>11}")
+
+    base = None
+    for workers in [int(w) for w in args.workers.split(',')]:
+        resultados, segundos = rl.procesar_lote(tareas, args.salida, workers, mostrar_progreso=False)
+        errores = [r for r in resultados if r['error']]
+        if errores:
+            print(f"  {len(errores)} errores, p. ej. {errores[0]['error']}")
+        base = base or segundos
+        print(f"{workers:>7} {segundos:9.2f} {segundos / len(tareas):10.3f} "
+              f"{base / segundos:11.2f}x {base / segundos / workers:10.0%}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Benchmark del resumen horario del vigilante: muestras crudas vs agregado en InfluxDB.
+
+Requiere el .env de producción (InfluxDB con datos de la última hora). Mide:
+- Crudo: flux_datos_crudos() por dispositivo (pivot de ~1,800 filas x 3
+  campos) + resumir_dataframe() en pandas.
+- Agregado: flux_resumen_flota() una sola vez para toda la flota.
+Para cada uno reporta bytes de respuesta (CSV anotado) y tiempo, y verifica
+que el resumen sea el mismo (conteos, p25 de fuga, potencia media y última
+medición), es decir, que los chequeos tomen las mismas decisiones.
+Antes verifica el p25 de fuga sobre series sintéticas (array.from): el
+fragmento Flux de flux_cuantil_lineal() contra Series.quantile() de pandas
+con los mismos datos, incluidos tamaños donde los métodos difieren.
+
+Uso: python benchmarks/bench_resumen_vigilante.py [DEVICE_ID ...] [--minutos 60] [--max-dispositivos 50]
+"""
+
+import os
+import sys
+import math
+import time
+import random
+import argparse
+
+import pandas as pd
+from influxdb_client import InfluxDBClient
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import vigilante_calidad as vc
+
+CAMPOS_COMPARADOS = ('picos_altos', 'picos_bajos', 'fuga_p25', 'potencia_media', 'ultima_medicion')
+
+
+def bytes_respuesta(query_api, flux_query):
+    return len(query_api.query_raw(query=flux_query).data)
+
+
+def iguales(a, b):
+    if isinstance(a, float) and isinstance(b, float):
+        return (math.isnan(a) and math.isnan(b)) or math.isclose(a, b, rel_tol=1e-9, abs_tol=1e-12)
+    return a == b
+
+
+def verificar_p25(query_api, tamanos=(1, 2, 3, 10, 37, 1800)):
+    """Mismo p25 en Flux y en pandas para series sintéticas. Devuelve cuántas difieren."""
+    rng = random.Random(25)
+    series = {f"sintetico_{n}": [round(rng.uniform(0.0, 0.5), 4) for _ in range(n)] for n in tamanos}
+    filas = ", ".join(f'{{device_id: "{device_id}", _value: {valor}}}'
+                      for device_id, valores in series.items() for valor in valores)
+    flux_query = f"""
+    import "array"
+    import "math"
+    {vc.flux_cuantil_lineal("fuga_p25", f"array.from(rows: [{filas}])", 0.25)}
+    """
+    flux = {record.values.get('device_id'): float(record.get_value())
+            for table in query_api.query(query=flux_query) for record in table.records}
+    distintos = 0
+    for device_id, valores in series.items():
+        esperado = float(pd.Series(valores).quantile(0.25))
+        igual = device_id in flux and iguales(esperado, flux[device_id])
+        distintos += not igual
+        print(f"  p25 n={len(valores):<5} pandas={esperado:.6f} flux={flux.get(device_id, float('nan')):.6f}"
+              f"  {'igual' if igual else 'DISTINTO'}")
+    return distintos
+
+
+def decisiones(resumen):
+    """Lo que decide verificar_voltaje con el resumen (la fuga y el consumo comparan los valores)."""
+    return (resumen['picos_altos'] >= vc.CANTIDAD_EVENTOS_VOLTAJE_PARA_ALERTA,
+            resumen['picos_bajos'] >= vc.CANTIDAD_EVENTOS_VOLTAJE_PARA_ALERTA)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('dispositivos', nargs='*', help="Por defecto, los que tengan datos en la ventana.")
+    parser.add_argument('--minutos', type=int, default=60)
+    parser.add_argument('--max-dispositivos', type=int, default=50)
+    args = parser.parse_args()
+
+    with InfluxDBClient(url=vc.INFLUX_URL, token=vc.INFLUX_TOKEN, org=vc.INFLUX_ORG, timeout=60_000) as client:
+        query_api = client.query_api()
+
+        print("=== p25 de fuga: Flux vs pandas (series sintéticas) ===")
+        distintos_p25 = verificar_p25(query_api)
+
+        print(f"\n=== Resumen de los últimos {args.minutos} min ===")
+        inicio = time.perf_counter()
+        resumenes = vc.obtener_resumenes_influx(args.minutos)
+        tiempo_agregado = time.perf_counter() - inicio
+        if resumenes is None:
+            print("No se pudo consultar el resumen agregado.")
+            return 1
+        bytes_agregado = bytes_respuesta(query_api, vc.flux_resumen_flota(args.minutos))
+
+        dispositivos = (args.dispositivos or sorted(resumenes))[:args.max_dispositivos]
+        tiempo_crudo = 0.0
+        bytes_crudo = 0
+        distintos = 0
+        print(f"  {'device_id':<16} {'bytes crudo':>12} {'s crudo':>9}  resumen")
+        for device_id in dispositivos:
+            inicio = time.perf_counter()
+            crudo = vc.resumir_dataframe(vc.obtener_datos_influx_dataframe(device_id, args.minutos))
+            segundos = time.perf_counter() - inicio
+            tiempo_crudo += segundos
+            respuesta = bytes_respuesta(query_api, vc.flux_datos_crudos(device_id, args.minutos))
+            bytes_crudo += respuesta
+
+            agregado = resumenes.get(device_id)
+            if crudo is None or agregado is None:
+                igual = crudo is None and agregado is None
+            else:
+                igual = all(iguales(crudo[c], agregado[c]) for c in CAMPOS_COMPARADOS) \
+                    and decisiones(crudo) == decisiones(agregado)
+            distintos += not igual
+            print(f"  {device_id:<16} {respuesta:>12,} {segundos:>9.3f}  {'igual' if igual else 'DISTINTO'}")
+            if not igual:
+                print(f"      crudo:    {crudo}\n      agregado: {agregado}")
+
+    print(f"\n  Crudo ({len(dispositivos)} consultas):   {bytes_crudo:>12,} bytes  {tiempo_crudo:8.2f} s")
+    print(f"  Agregado (1 consulta, {len(resumenes)} disp.): {bytes_agregado:>12,} bytes  {tiempo_agregado:8.2f} s")
+    print(f"  Resúmenes distintos: {distintos} de {len(dispositivos)}")
+    return 1 if distintos or distintos_p25 else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""
+Benchmark de consultas de consumo por periodo: integral cruda vs acumulados horarios.
+
+Requiere el .env de producción (InfluxDB con INFLUX_BUCKET_ROLLUP ya poblado
+por rollup_energia.py). Para cada dispositivo mide el tiempo de:
+- integrar_consumo_crudo(): integral() sobre muestras de 2s de todo el periodo.
+- obtener_consumo_desde_influxdb(): suma de filas horarias + bordes crudos.
+
+Uso: python benchmarks/bench_rollup_consumo.py DEVICE_ID [DEVICE_ID ...] [--dias 60]
+"""
+
+import os
+import sys
+import time
+import argparse
+from datetime import datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import consumo_energia as ce
+
+
+def cronometrar(funcion, *args):
+    inicio = time.perf_counter()
+    resultado = funcion(*args)
+    return resultado, time.perf_counter() - inicio
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('devices', nargs='+')
+    parser.add_argument('--dias', type=int, default=60)
+    args = parser.parse_args()
+
+    fin = datetime.now(timezone.utc)
+    inicio = (fin - timedelta(days=args.dias)).replace(hour=0, minute=0, second=0, microsecond=0)
+    print(f"Periodo: {inicio.isoformat()} -> {fin.isoformat()} ({args.dias} días)")
+    print(f"Watermark de rollup: {ce.obtener_watermark_rollup()}\n")
+    print(f"{'device_id':<16} {'crudo (s)':>10} {'rollup (s)':>11} {'x':>7} {'kWh crudo':>11} {'kWh rollup':>11}")
+
+    total_crudo = total_rollup = 0.0
+    for device_id in args.devices:
+        kwh_crudo, t_crudo = cronometrar(ce.integrar_consumo_crudo, device_id, inicio, fin)
+        (kwh_rollup, _), t_rollup = cronometrar(ce.obtener_consumo_desde_influxdb, device_id, inicio, fin)
+        total_crudo += t_crudo
+        total_rollup += t_rollup
+        print(f"{device_id:<16} {t_crudo:10.3f} {t_rollup:11.3f} {t_crudo / t_rollup:7.1f} "
+              f"{kwh_crudo or 0:11.3f} {kwh_rollup or 0:11.3f}")
+
+    print(f"\nTotal: crudo {total_crudo:.2f}s, rollup {total_rollup:.2f}s "
+          f"({total_crudo / total_rollup:.1f}x más rápido)")
+    ce.cerrar_cliente_influx()
+
+
+if __name__ == "__main__":
+    main()
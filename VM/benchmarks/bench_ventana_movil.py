@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark de ventana_movil.VentanaMovil.
+
+Compara, para una ventana de 1 hora a 2s (1,800 muestras):
+- Costo de agregar() por muestra.
+- Costo de las consultas (conteos, media, varianza, min/max, cuantil).
+- Lo que hacía el chequeo horario: recalcular todo sobre un DataFrame.
+
+Uso: python benchmarks/bench_ventana_movil.py [num_muestras]
+"""
+
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from ventana_movil import VentanaMovil
+
+UMBRAL_ALTO = 139.7
+UMBRAL_BAJO = 114.3
+
+
+def medir(nombre, funcion, repeticiones):
+    inicio = time.perf_counter()
+    for _ in range(repeticiones):
+        funcion()
+    total = time.perf_counter() - inicio
+    print(f"  {nombre:<38} {total / repeticiones * 1e6:10.2f} µs/op")
+    return total
+
+
+def main():
+    num_muestras = int(sys.argv[1]) if len(sys.argv) > 1 else 200_000
+    rng = np.random.default_rng(42)
+    ts = np.arange(num_muestras, dtype=np.float64) * 2
+    vrms = rng.normal(127, 5, num_muestras)
+    fuga = rng.gamma(2, 0.05, num_muestras)
+
+    v_vrms = VentanaMovil(3600, umbrales_sobre=(UMBRAL_ALTO,), umbrales_bajo=(UMBRAL_BAJO,))
+    v_fuga = VentanaMovil(3600, rango_histograma=(0.0, 5.0), bins_histograma=500)
+
+    print(f"=== VentanaMovil: {num_muestras:,} muestras, ventana de 1h ===")
+    inicio = time.perf_counter()
+    for i in range(num_muestras):
+        v_vrms.agregar(ts[i], vrms[i])
+        v_fuga.agregar(ts[i], fuga[i])
+    total = time.perf_counter() - inicio
+    print(f"  agregar() (2 ventanas)                 {total / num_muestras * 1e6:10.2f} µs/muestra")
+    print(f"  memoria por ventana                    {v_fuga.memoria_bytes() / 1024:10.1f} KiB")
+
+    print("\n--- Consultas sobre la ventana ---")
+    medir("contar_sobre + contar_bajo", lambda: (v_vrms.contar_sobre(UMBRAL_ALTO), v_vrms.contar_bajo(UMBRAL_BAJO)), 100_000)
+    medir("media + varianza", lambda: (v_vrms.media(), v_vrms.varianza()), 100_000)
+    medir("minimo + maximo", lambda: (v_vrms.minimo(), v_vrms.maximo()), 100_000)
+    medir("cuantil(0.25) aproximado", lambda: v_fuga.cuantil(0.25), 20_000)
+    medir("cuantil(0.25) exacto", lambda: v_fuga.cuantil_exacto(0.25), 20_000)
+
+    print("\n--- Referencia: recálculo con pandas (chequeo horario) ---")
+    df = pd.DataFrame({'vrms': v_vrms.valores(), 'leakage': v_fuga.valores()})
+    medir("conteos + quantile + mean (DataFrame)", lambda: (
+        df[df['vrms'] > UMBRAL_ALTO].shape[0],
+        df[df['vrms'] < UMBRAL_BAJO].shape[0],
+        df['leakage'].quantile(0.25),
+        df['vrms'].mean()
+    ), 2_000)
+
+    error = abs(v_fuga.cuantil(0.25) - v_fuga.cuantil_exacto(0.25))
+    print(f"\nError del cuantil aproximado: {error:.4f} A (resolución del histograma: 0.01 A)")
+
+
+if __name__ == "__main__":
+    main()
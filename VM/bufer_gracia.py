@@ -0,0 +1,253 @@
+"""
+BÚFER DEL PERIODO DE GRACIA (módulo compartido)
+
+Mientras la suscripción de un cliente está en gracia, receptor_mqtt.py no
+escribe sus mediciones a InfluxDB sino a PostgreSQL, para reenviarlas si
+paga o purgarlas si expira. Antes era una fila por medición en
+'mediciones_pendientes' (payload JSON + BIGSERIAL + dos índices) y purgas y
+reenvíos fila por fila. Ahora:
+- Las mediciones de cada dispositivo se juntan en memoria (AcumuladorGracia)
+  y se guardan como un chunk: una fila con los registros empacados en el
+  formato binario de lote_mediciones.py (40 bytes por medición), su rango
+  de ts_unix y el número de muestras. Un chunk se escribe al juntar
+  GRACIA_CHUNK_MUESTRAS o a los GRACIA_FLUSH_S segundos de su primera
+  medición.
+- 'mediciones_gracia' está particionada por día UTC de recepción
+  (mediciones_gracia_AAAAMMDD). Lo recibido hace más que el periodo de gracia
+  ya no puede reenviarse, así que la expiración es un DROP de particiones.
+- Reenviar o purgar un dispositivo lee o borra sus chunks (índice por
+  device_id), no cada medición.
+La tabla anterior, si existe, se sigue leyendo y purgando hasta vaciarse.
+"""
+
+import os
+import json
+import time
+import threading
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+
+from lote_mediciones import DTYPE_MEDICION, registros_desde_json
+
+load_dotenv()
+
+# --- 1. Configuración ---
+
+# Segundos máximos que una medición de gracia espera en memoria su chunk
+GRACIA_FLUSH_S = float(os.environ.get("GRACIA_FLUSH_S", 60))
+# Muestras por chunk (se escribe antes si se llena)
+GRACIA_CHUNK_MUESTRAS = int(os.environ.get("GRACIA_CHUNK_MUESTRAS", 1000))
+
+TABLA = "mediciones_gracia"
+TABLA_ANTERIOR = "mediciones_pendientes"
+
+
+def _dia_utc(ts=None):
+    return datetime.fromtimestamp(time.time() if ts is None else ts, tz=timezone.utc).date()
+
+
+def _particion(dia):
+    return f"{TABLA}_{dia:%Y%m%d}"
+
+
+# --- 2. Esquema y particiones ---
+
+def asegurar_esquema_gracia(conn):
+    """Crea la tabla particionada, su índice y la partición de hoy. No hace commit."""
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {TABLA} (
+                device_id VARCHAR(20) NOT NULL,
+                dia DATE NOT NULL,
+                ts_min BIGINT NOT NULL,
+                ts_max BIGINT NOT NULL,
+                muestras INTEGER NOT NULL,
+                registros BYTEA NOT NULL,
+                creado TIMESTAMPTZ NOT NULL DEFAULT NOW()
+            ) PARTITION BY RANGE (dia)
+        """)
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS idx_{TABLA}_device_id ON {TABLA} (device_id, ts_min)")
+    asegurar_particion(conn, _dia_utc())
+
+
+_particiones_creadas = set()
+
+
+def asegurar_particion(conn, dia):
+    """Crea (una vez por proceso) la partición de un día. No hace commit."""
+    if dia in _particiones_creadas:
+        return
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS {_particion(dia)} PARTITION OF {TABLA}
+            FOR VALUES FROM (%s) TO (%s)
+        """, (dia, dia + timedelta(days=1)))
+    _particiones_creadas.add(dia)
+
+
+def expirar_particiones(conn, dias):
+    """
+    Borra (DROP) las particiones de días de recepción anteriores a 'dias'
+    atrás. Devuelve los nombres borrados. No hace commit.
+    """
+    limite = _dia_utc() - timedelta(days=dias)
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT c.relname FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = %s::regclass
+        """, (TABLA,))
+        nombres = [fila[0] for fila in cursor.fetchall()]
+        borradas = []
+        for nombre in sorted(nombres):
+            sufijo = nombre[len(TABLA) + 1:]
+            if not sufijo.isdigit() or datetime.strptime(sufijo, "%Y%m%d").date() >= limite:
+                continue
+            cursor.execute(f"DROP TABLE IF EXISTS {nombre}")
+            borradas.append(nombre)
+    _particiones_creadas.difference_update(d for d in list(_particiones_creadas) if d < limite)
+    return borradas
+
+
+# --- 3. Lectura y escritura de chunks ---
+
+def guardar_chunks(conn, chunks):
+    """Inserta [(device_id, registros DTYPE_MEDICION)] en la partición de hoy. No hace commit."""
+    dia = _dia_utc()
+    asegurar_particion(conn, dia)
+    filas = []
+    for device_id, registros in chunks:
+        ts = registros['ts_unix']
+        filas.append((device_id, dia, int(ts.min()), int(ts.max()), len(registros), registros.tobytes()))
+    with conn.cursor() as cursor:
+        execute_values(cursor, f"""
+            INSERT INTO {TABLA} (device_id, dia, ts_min, ts_max, muestras, registros) VALUES %s
+        """, filas)
+    return sum(len(registros) for _, registros in chunks)
+
+
+def _tabla_anterior_existe(cursor):
+    cursor.execute("SELECT to_regclass(%s)", (TABLA_ANTERIOR,))
+    return cursor.fetchone()[0] is not None
+
+
+def leer_pendientes(conn, device_id):
+    """
+    (registros DTYPE_MEDICION ordenados por ts_unix, marca) de un dispositivo,
+    incluidas las filas JSON de la tabla anterior. 'marca' delimita lo leído
+    para borrar_pendientes().
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(f"SELECT registros, creado FROM {TABLA} WHERE device_id = %s", (device_id,))
+        filas = cursor.fetchall()
+        partes = [np.frombuffer(bytes(blob), dtype=DTYPE_MEDICION) for blob, _ in filas]
+        marca = max((creado for _, creado in filas), default=None)
+        max_id_anterior = None
+        if _tabla_anterior_existe(cursor):
+            cursor.execute(f"SELECT id, payload_json FROM {TABLA_ANTERIOR} WHERE device_id = %s", (device_id,))
+            anteriores = cursor.fetchall()
+            if anteriores:
+                max_id_anterior = max(fila[0] for fila in anteriores)
+                mediciones = []
+                for _, payload in anteriores:
+                    try:
+                        datos = json.loads(payload)
+                    except ValueError:
+                        continue
+                    if datos.get('ts_unix'):
+                        mediciones.append(datos)
+                partes.append(registros_desde_json(mediciones))
+    if not partes:
+        return np.zeros(0, dtype=DTYPE_MEDICION), (marca, max_id_anterior)
+    registros = np.concatenate(partes)
+    return registros[np.argsort(registros['ts_unix'], kind='stable')], (marca, max_id_anterior)
+
+
+def borrar_pendientes(conn, device_id, marca=None):
+    """
+    Borra los chunks de un dispositivo (hasta 'marca' de leer_pendientes, o
+    todos) y sus filas en la tabla anterior. Devuelve chunks/filas borrados.
+    No hace commit.
+    """
+    hasta_creado, hasta_id = marca if marca is not None else (None, None)
+    with conn.cursor() as cursor:
+        borradas = 0
+        if marca is None:
+            cursor.execute(f"DELETE FROM {TABLA} WHERE device_id = %s", (device_id,))
+            borradas += cursor.rowcount
+        elif hasta_creado is not None:
+            cursor.execute(f"DELETE FROM {TABLA} WHERE device_id = %s AND creado <= %s", (device_id, hasta_creado))
+            borradas += cursor.rowcount
+        if _tabla_anterior_existe(cursor) and (marca is None or hasta_id is not None):
+            if marca is None:
+                cursor.execute(f"DELETE FROM {TABLA_ANTERIOR} WHERE device_id = %s", (device_id,))
+            else:
+                cursor.execute(f"DELETE FROM {TABLA_ANTERIOR} WHERE device_id = %s AND id <= %s",
+                               (device_id, hasta_id))
+            borradas += cursor.rowcount
+    return borradas
+
+
+# --- 4. Acumulador en memoria ---
+
+class AcumuladorGracia:
+    """
+    Mediciones de gracia por dispositivo en espera de su chunk (thread-safe).
+    Guarda también los acks MQTT (sesión, mid, qos) de esos mensajes, que se
+    confirman cuando el chunk queda en PostgreSQL.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # device_id -> [primera_llegada, [arreglos], muestras, [acks]]
+        self.pendientes = {}
+
+    def agregar(self, device_id, registros, delivery=None):
+        """Encola registros DTYPE_MEDICION. Devuelve True si el ack quedó pendiente."""
+        with self.lock:
+            pendiente = self.pendientes.get(device_id)
+            if pendiente is None:
+                pendiente = self.pendientes[device_id] = [time.time(), [], 0, []]
+            pendiente[1].append(registros)
+            pendiente[2] += len(registros)
+            if delivery:
+                pendiente[3].append(delivery)
+        return bool(delivery)
+
+    def listos(self, forzar=False):
+        """[(device_id, registros, acks)] de los chunks llenos o vencidos (o todos)."""
+        ahora = time.time()
+        salida = []
+        with self.lock:
+            for device_id, (llegada, partes, muestras, acks) in list(self.pendientes.items()):
+                if forzar or muestras >= GRACIA_CHUNK_MUESTRAS or ahora - llegada >= GRACIA_FLUSH_S:
+                    del self.pendientes[device_id]
+                    salida.append((device_id, np.concatenate(partes), acks))
+        return salida
+
+    def tomar(self, device_id):
+        """(registros, acks) pendientes de un dispositivo, o (None, []); los saca del acumulador."""
+        with self.lock:
+            pendiente = self.pendientes.pop(device_id, None)
+        if pendiente is None:
+            return None, []
+        return np.concatenate(pendiente[1]), pendiente[3]
+
+    def devolver(self, chunks):
+        """Re-encola chunks que no se pudieron guardar."""
+        with self.lock:
+            for device_id, registros, acks in chunks:
+                pendiente = self.pendientes.get(device_id)
+                if pendiente is None:
+                    self.pendientes[device_id] = [time.time() - GRACIA_FLUSH_S, [registros], len(registros), list(acks)]
+                else:
+                    pendiente[1].insert(0, registros)
+                    pendiente[2] += len(registros)
+                    pendiente[3][:0] = acks
+
+    def muestras(self):
+        with self.lock:
+            return sum(p[2] for p in self.pendientes.values())
@@ -0,0 +1,290 @@
+"""
+CARGADOR DE EXPORTACIONES DE CONSUMO (módulo compartido)
+
+Lee los CSV anotados que exporta InfluxDB (líneas '#group', '#datatype', ...)
+para analizar_consumo.py sin pasar por los tipos por defecto de pandas:
+- Solo lee las columnas que usa el análisis (tiempo, power, power_factor y
+  device_id si existe) con tipos explícitos.
+- Usa el lector de PyArrow (multihilo) si está instalado; si no, o si el
+  archivo trae varias tablas con anotaciones intermedias, usa el lector C de
+  pandas por bloques.
+- Guarda el resultado limpio en una caché Feather/Parquet identificada por el
+  hash del contenido del CSV: una segunda corrida sobre el mismo archivo no
+  vuelve a parsear nada.
+
+El DataFrame resultante tiene índice 'time' (UTC) y columnas 'power'
+(float64), 'power_factor' (float32) y, si venía en el CSV, 'device_id'.
+"""
+
+import os
+import json
+import mmap
+import hashlib
+
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pacsv
+except ImportError:
+    pa = None
+
+try:
+    import fastparquet  # noqa: F401  (motor alterno para Parquet)
+    HAY_FASTPARQUET = True
+except ImportError:
+    HAY_FASTPARQUET = False
+
+# --- 1. Configuración ---
+
+# Carpeta de la caché (por defecto, '.cache_consumo' junto al CSV)
+ANALISIS_CACHE_DIR = os.environ.get("ANALISIS_CACHE_DIR")
+# Filas por bloque en el lector por bloques
+ANALISIS_TAMANO_BLOQUE = int(os.environ.get("ANALISIS_TAMANO_BLOQUE", 1_000_000))
+
+# Cambiar si cambia la limpieza o los tipos (invalida las cachés anteriores)
+VERSION_CACHE = 1
+
+COLUMNAS_TIEMPO = ('time', '_time')
+TIPOS_COLUMNAS = {
+    'power': 'float64',
+    'power_factor': 'float32',
+}
+COLUMNAS_ANALISIS = set(COLUMNAS_TIEMPO) | set(TIPOS_COLUMNAS) | {'device_id'}
+
+MOTOR_AUTO = 'auto'
+MOTOR_PYARROW = 'pyarrow'
+MOTOR_C = 'c'
+
+
+# --- 2. Estructura del Archivo ---
+
+def _inspeccionar_csv(ruta):
+    """
+    Devuelve (lineas_anotacion, encabezado, anotaciones_intermedias):
+    cuántas líneas '#' hay antes del encabezado, las columnas del encabezado
+    y si hay más anotaciones después (exportación con varias tablas).
+    """
+    lineas_anotacion = 0
+    with open(ruta, 'rb') as archivo:
+        for linea in archivo:
+            if linea.startswith(b'#'):
+                lineas_anotacion += 1
+                continue
+            encabezado = linea.decode('utf-8').rstrip('\r\n').split(',')
+            inicio_datos = archivo.tell()
+            break
+        else:
+            return lineas_anotacion, [], False
+        if os.fstat(archivo.fileno()).st_size <= inicio_datos:
+            return lineas_anotacion, encabezado, False
+        with mmap.mmap(archivo.fileno(), 0, access=mmap.ACCESS_READ) as datos:
+            anotaciones_intermedias = datos.find(b'\n#', inicio_datos - 1) != -1
+    return lineas_anotacion, encabezado, anotaciones_intermedias
+
+
+def _columna_tiempo(encabezado):
+    for nombre in COLUMNAS_TIEMPO:
+        if nombre in encabezado:
+            return nombre
+    raise ValueError(f"El CSV no tiene columna de tiempo ({' / '.join(COLUMNAS_TIEMPO)}).")
+
+
+def _limpiar(df, columna_tiempo):
+    """Normaliza nombres, descarta filas incompletas y pone el tiempo como índice."""
+    if columna_tiempo != 'time':
+        df = df.rename(columns={columna_tiempo: 'time'})
+    df = df.dropna(subset=['time', 'power', 'power_factor'])
+    if 'device_id' in df.columns:
+        df['device_id'] = df['device_id'].astype('category')
+    return df.set_index('time')
+
+
+# --- 3. Lectores ---
+
+def _leer_pyarrow(ruta, lineas_anotacion, encabezado):
+    columna_tiempo = _columna_tiempo(encabezado)
+    columnas = [c for c in encabezado if c in COLUMNAS_ANALISIS]
+    tipos = {c: pa.from_numpy_dtype(tipo) for c, tipo in TIPOS_COLUMNAS.items()}
+    tipos[columna_tiempo] = pa.timestamp('ns', tz='UTC')
+    if 'device_id' in columnas:
+        tipos['device_id'] = pa.string()
+    tabla = pacsv.read_csv(
+        ruta,
+        read_options=pacsv.ReadOptions(skip_rows=lineas_anotacion),
+        convert_options=pacsv.ConvertOptions(include_columns=columnas, column_types=tipos),
+    )
+    return _limpiar(tabla.to_pandas(), columna_tiempo)
+
+
+def _lector_c(ruta, tamano_bloque, tolerante):
+    """
+    Lector C de pandas por bloques. En modo estricto los tipos se fijan al
+    parsear; en modo tolerante se leen como texto y se convierten con
+    errors='coerce' (encabezados repetidos de exportaciones con varias tablas).
+    """
+    tipos = {c: 'object' for c in TIPOS_COLUMNAS} if tolerante else dict(TIPOS_COLUMNAS)
+    tipos.update({c: 'object' for c in COLUMNAS_TIEMPO})
+    tipos['device_id'] = 'object'
+    return pd.read_csv(
+        ruta, comment='#', engine='c', usecols=lambda c: c in COLUMNAS_ANALISIS,
+        dtype=tipos, chunksize=tamano_bloque,
+    )
+
+
+def _convertir_bloque(bloque, columna_tiempo, tolerante):
+    if tolerante:
+        for columna, tipo in TIPOS_COLUMNAS.items():
+            bloque[columna] = pd.to_numeric(bloque[columna], errors='coerce').astype(tipo)
+    bloque[columna_tiempo] = pd.to_datetime(bloque[columna_tiempo], format='ISO8601', utc=True, errors='coerce')
+    return _limpiar(bloque, columna_tiempo)
+
+
+def iterar_bloques(ruta, tamano_bloque=None):
+    """
+    Genera el CSV en DataFrames limpios de hasta 'tamano_bloque' filas, sin
+    cargar el archivo completo en memoria. Si un bloque no se puede parsear
+    con tipos estrictos, se reabre el archivo en modo tolerante y se continúa
+    desde ese mismo bloque.
+    """
+    tamano_bloque = tamano_bloque or ANALISIS_TAMANO_BLOQUE
+    _, encabezado, _ = _inspeccionar_csv(ruta)
+    columna_tiempo = _columna_tiempo(encabezado)
+
+    emitidos = 0
+    try:
+        for bloque in _lector_c(ruta, tamano_bloque, tolerante=False):
+            emitidos += 1
+            yield _convertir_bloque(bloque, columna_tiempo, tolerante=False)
+        return
+    except ValueError:
+        pass
+
+    for indice, bloque in enumerate(_lector_c(ruta, tamano_bloque, tolerante=True)):
+        if indice >= emitidos:
+            yield _convertir_bloque(bloque, columna_tiempo, tolerante=True)
+
+
+def leer_csv(ruta, motor=MOTOR_AUTO, tamano_bloque=None):
+    """Parsea el CSV completo (sin caché) y devuelve (DataFrame, motor_usado)."""
+    lineas_anotacion, encabezado, anotaciones_intermedias = _inspeccionar_csv(ruta)
+    usar_pyarrow = motor == MOTOR_PYARROW or (motor == MOTOR_AUTO and pa is not None)
+    if usar_pyarrow:
+        if pa is None:
+            raise ImportError("El motor 'pyarrow' requiere instalar pyarrow.")
+        if not anotaciones_intermedias:
+            try:
+                return _leer_pyarrow(ruta, lineas_anotacion, encabezado), MOTOR_PYARROW
+            except pa.ArrowInvalid as e:
+                print(f"ADVERTENCIA: PyArrow no pudo parsear el CSV ({e}). Usando el lector C.")
+
+    bloques = list(iterar_bloques(ruta, tamano_bloque))
+    if not bloques:
+        return pd.DataFrame(columns=list(TIPOS_COLUMNAS)), MOTOR_C
+    df = pd.concat(bloques)
+    if 'device_id' in df.columns:
+        df['device_id'] = df['device_id'].astype('category')
+    return df, MOTOR_C
+
+
+# --- 4. Caché ---
+
+def _formato_cache():
+    if pa is not None:
+        return 'feather'
+    if HAY_FASTPARQUET:
+        return 'parquet'
+    return None
+
+
+def _directorio_cache(ruta):
+    return ANALISIS_CACHE_DIR or os.path.join(os.path.dirname(os.path.abspath(ruta)), '.cache_consumo')
+
+
+def hash_archivo(ruta, directorio_cache=None):
+    """
+    Hash BLAKE2b del contenido del CSV. Se memoriza por (ruta, tamaño, mtime)
+    en 'indice.json' para no releer el archivo si no ha cambiado.
+    """
+    estado = os.stat(ruta)
+    llave = f"{os.path.abspath(ruta)}|{estado.st_size}|{estado.st_mtime_ns}"
+    ruta_indice = os.path.join(directorio_cache, 'indice.json') if directorio_cache else None
+
+    indice = {}
+    if ruta_indice and os.path.exists(ruta_indice):
+        try:
+            with open(ruta_indice) as f:
+                indice = json.load(f)
+        except (OSError, ValueError):
+            indice = {}
+        if llave in indice:
+            return indice[llave]
+
+    resumen = hashlib.blake2b(digest_size=16)
+    with open(ruta, 'rb') as archivo:
+        for trozo in iter(lambda: archivo.read(1 << 20), b''):
+            resumen.update(trozo)
+    firma = resumen.hexdigest()
+
+    if ruta_indice:
+        indice = {k: v for k, v in indice.items() if not k.startswith(f"{os.path.abspath(ruta)}|")}
+        indice[llave] = firma
+        def escribir(tmp):
+            with open(tmp, 'w') as f:
+                json.dump(indice, f)
+        _escribir_atomico(ruta_indice, escribir)
+    return firma
+
+
+def _escribir_atomico(ruta, escribir):
+    temporal = f"{ruta}.{os.getpid()}.tmp"
+    escribir(temporal)
+    os.replace(temporal, ruta)
+
+
+def _leer_cache(ruta_cache, formato):
+    if formato == 'feather':
+        return pd.read_feather(ruta_cache).set_index('time')
+    return pd.read_parquet(ruta_cache)
+
+
+def _escribir_cache(df, ruta_cache, formato):
+    if formato == 'feather':
+        _escribir_atomico(ruta_cache, lambda tmp: df.reset_index().to_feather(tmp))
+    else:
+        _escribir_atomico(ruta_cache, lambda tmp: df.to_parquet(tmp))
+
+
+def cargar_consumo(ruta, usar_cache=True, motor=MOTOR_AUTO, tamano_bloque=None):
+    """
+    Devuelve el DataFrame limpio de una exportación. Con 'usar_cache' busca
+    primero la versión ya parseada del mismo contenido y, si no existe, la
+    guarda tras parsear. Lanza FileNotFoundError si el CSV no existe.
+    """
+    if not os.path.exists(ruta):
+        raise FileNotFoundError(ruta)
+
+    formato = _formato_cache() if usar_cache else None
+    ruta_cache = None
+    if formato:
+        directorio = _directorio_cache(ruta)
+        os.makedirs(directorio, exist_ok=True)
+        firma = hash_archivo(ruta, directorio)
+        ruta_cache = os.path.join(directorio, f"{firma}.v{VERSION_CACHE}.{formato}")
+        if os.path.exists(ruta_cache):
+            try:
+                df = _leer_cache(ruta_cache, formato)
+                print(f"INFO: Datos cargados desde caché ({os.path.basename(ruta_cache)}).")
+                return df
+            except Exception as e:
+                print(f"ADVERTENCIA: Caché ilegible ({e}). Se vuelve a parsear el CSV.")
+
+    df, motor_usado = leer_csv(ruta, motor, tamano_bloque)
+    print(f"INFO: {len(df):,} filas válidas parseadas con el lector '{motor_usado}'.")
+
+    if ruta_cache:
+        try:
+            _escribir_cache(df, ruta_cache, formato)
+        except Exception as e:
+            print(f"ADVERTENCIA: No se pudo guardar la caché ({e}).")
+    return df
@@ -0,0 +1,186 @@
+"""
+CONTROL DE CARGA DEL RECEPTOR (módulo compartido)
+
+Protege a receptor_mqtt.py de un dispositivo que publica sin control (ej. un
+ESP32 en bucle) y de una caída de InfluxDB que haría crecer los buffers sin
+límite:
+- LimitadorDispositivos: token bucket por dispositivo y carril, medido en
+  muestras (un lote binario cuenta todas las suyas). Lo que excede la tasa
+  se descarta. El carril de backfill tiene su propio bucket, más amplio,
+  para que el vaciado legítimo de la SD no se confunda con abuso.
+- EspoolDisco: archivos de line protocol donde el receptor derrama lotes
+  cuando los buffers pasan su presupuesto; se reescriben a InfluxDB después,
+  con la prioridad del backfill.
+- nivel_descarte(): escalones de descarte según puntos en memoria:
+    0 normal, 1 derramar a disco, 2 además descartar datos de gracia,
+    3 además descartar datos activos.
+- ContadoresDescarte: cuántas muestras se limitaron o descartaron por
+  dispositivo y motivo, para reportarlas en las métricas.
+"""
+
+import os
+import json
+import time
+import threading
+from collections import defaultdict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- 1. Configuración ---
+
+# Token bucket por dispositivo (muestras/s y ráfaga); 0 desactiva el límite
+LIMITE_VIVO_MUESTRAS_S = float(os.environ.get("LIMITE_VIVO_MUESTRAS_S", 5))
+LIMITE_VIVO_RAFAGA = float(os.environ.get("LIMITE_VIVO_RAFAGA", 300))
+LIMITE_BACKFILL_MUESTRAS_S = float(os.environ.get("LIMITE_BACKFILL_MUESTRAS_S", 500))
+LIMITE_BACKFILL_RAFAGA = float(os.environ.get("LIMITE_BACKFILL_RAFAGA", 100_000))
+
+# Presupuesto de puntos en los buffers del receptor: arriba de MAX se derrama a
+# disco; arriba de MAX_DURO (o si el espool está lleno) se descarta
+RECEPTOR_MAX_PUNTOS = int(os.environ.get("RECEPTOR_MAX_PUNTOS", 200_000))
+RECEPTOR_MAX_PUNTOS_DURO = int(os.environ.get("RECEPTOR_MAX_PUNTOS_DURO", 2 * RECEPTOR_MAX_PUNTOS))
+
+ESPOOL_DIR = os.environ.get("ESPOOL_DIR", "espool_receptor")
+ESPOOL_MAX_MB = float(os.environ.get("ESPOOL_MAX_MB", 2048))
+
+# Encabezado de las horas tardías en los archivos del espool
+PREFIJO_HORAS = "# horas "
+
+# Motivos de ContadoresDescarte
+LIMITADA = 'limitadas'
+DESCARTADA_GRACIA = 'descartadas_gracia'
+DESCARTADA_ACTIVA = 'descartadas_activas'
+
+
+# --- 2. Token bucket por dispositivo ---
+
+class LimitadorDispositivos:
+    """
+    Un bucket por dispositivo: se llena a 'tasa' muestras/s hasta 'rafaga'.
+    Un mensaje pasa si hay fichas para él (o el bucket está lleno, para
+    lotes más grandes que la ráfaga) y las gasta todas, aunque quede en
+    negativo. Sin lock: lo usa solo el thread de mensajes MQTT.
+    """
+
+    def __init__(self, tasa, rafaga):
+        self.tasa = tasa
+        self.rafaga = rafaga
+        self.buckets = {}
+
+    def permitir(self, device_id, muestras=1):
+        if self.tasa <= 0:
+            return True
+        ahora = time.monotonic()
+        bucket = self.buckets.get(device_id)
+        if bucket is None:
+            bucket = self.buckets[device_id] = [self.rafaga, ahora]
+        else:
+            bucket[0] = min(self.rafaga, bucket[0] + (ahora - bucket[1]) * self.tasa)
+            bucket[1] = ahora
+        if bucket[0] >= min(muestras, self.rafaga):
+            bucket[0] -= muestras
+            return True
+        return False
+
+
+# --- 3. Contadores ---
+
+class ContadoresDescarte:
+    """{device_id: {motivo: muestras}} desde el último reporte (thread-safe)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.por_dispositivo = defaultdict(lambda: defaultdict(int))
+
+    def sumar(self, device_id, motivo, muestras=1):
+        with self.lock:
+            self.por_dispositivo[device_id][motivo] += muestras
+
+    def tomar(self):
+        with self.lock:
+            datos, self.por_dispositivo = self.por_dispositivo, defaultdict(lambda: defaultdict(int))
+        return {device_id: dict(motivos) for device_id, motivos in datos.items()}
+
+
+# --- 4. Espool en disco ---
+
+class EspoolDisco:
+    """
+    Lotes de line protocol en archivos '<ns>_<n>.lp' (orden de llegada).
+    guardar() escribe con fsync, así lo derramado es durable y sus mensajes
+    se pueden confirmar al broker. Las horas tardías del lote (device_id,
+    hora_unix) van en una primera línea de comentario '# horas [...]', para
+    marcarlas cuando el archivo llegue a InfluxDB.
+    """
+
+    def __init__(self, directorio=ESPOOL_DIR, max_mb=ESPOOL_MAX_MB):
+        self.directorio = directorio
+        self.max_bytes = max_mb * 1024 * 1024
+        self.lock = threading.Lock()
+        os.makedirs(directorio, exist_ok=True)
+        self.bytes = sum(os.path.getsize(os.path.join(directorio, f)) for f in self._archivos())
+        self.fallando = False
+
+    def _archivos(self):
+        return sorted(f for f in os.listdir(self.directorio) if f.endswith('.lp'))
+
+    def disponible(self):
+        return not self.fallando and self.bytes < self.max_bytes
+
+    def guardar(self, lineas, horas=()):
+        """Escribe un lote. Devuelve False si no se pudo (disco lleno, permisos...)."""
+        encabezado = [f"{PREFIJO_HORAS}{json.dumps(sorted(horas))}"] if horas else []
+        contenido = "\n".join(encabezado + list(lineas)).encode('utf-8')
+        ruta = os.path.join(self.directorio, f"{time.time_ns()}_{len(lineas)}.lp")
+        try:
+            with open(ruta + '.tmp', 'wb') as f:
+                f.write(contenido)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(ruta + '.tmp', ruta)
+        except OSError:
+            self.fallando = True
+            return False
+        with self.lock:
+            self.bytes += len(contenido)
+            self.fallando = False
+        return True
+
+    def siguiente(self):
+        """(ruta, líneas, horas tardías) del archivo más viejo, o (None, None, None)."""
+        archivos = self._archivos()
+        if not archivos:
+            return None, None, None
+        ruta = os.path.join(self.directorio, archivos[0])
+        with open(ruta, encoding='utf-8') as f:
+            lineas = f.read().split("\n")
+        horas = []
+        if lineas and lineas[0].startswith(PREFIJO_HORAS):
+            horas = [tuple(hora) for hora in json.loads(lineas.pop(0)[len(PREFIJO_HORAS):])]
+        return ruta, lineas, horas
+
+    def borrar(self, ruta):
+        tamano = os.path.getsize(ruta)
+        os.remove(ruta)
+        with self.lock:
+            self.bytes = max(0, self.bytes - tamano)
+            self.fallando = False
+
+    def apartar(self, ruta):
+        """Renombra un archivo que InfluxDB rechaza para no reintentarlo."""
+        tamano = os.path.getsize(ruta)
+        os.replace(ruta, ruta + '.rechazado')
+        with self.lock:
+            self.bytes = max(0, self.bytes - tamano)
+
+
+# --- 5. Escalones de descarte ---
+
+def nivel_descarte(puntos_en_memoria, espool_disponible):
+    """0 normal, 1 derramar a disco, 2 descartar gracia, 3 descartar también activos."""
+    if puntos_en_memoria <= RECEPTOR_MAX_PUNTOS:
+        return 0
+    if puntos_en_memoria > RECEPTOR_MAX_PUNTOS_DURO:
+        return 3
+    return 1 if espool_disponible else 2
@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+
+"""
+DETECTOR EN STREAMING DE CALIDAD DE ENERGÍA (v1)
+
+Servicio que complementa a vigilante_calidad.py:
+1. Escucha el mismo feed MQTT que receptor_mqtt ('lete/mediciones/+' y
+   los lotes binarios de 'lete/mediciones_lote/+').
+2. Mantiene, por dispositivo, ventanas móviles (ventana_movil.VentanaMovil)
+   de memoria fija con vrms, leakage y potencia, actualizadas en O(1).
+3. Evalúa de forma continua los picos/caídas de voltaje
+   (UMBRAL_VOLTAJE_ALTO / UMBRAL_VOLTAJE_BAJO) y la fuga de corriente
+   (cuantil 25 + modelo EWMA de 'fuga_stats'), alertando en segundos en
+   lugar de esperar al chequeo horario.
+4. Una vez por ciclo (1h por defecto) corre los chequeos horarios del
+   vigilante (verificar_voltaje / verificar_fuga_corriente, con su modelo
+   EWMA y strikes) sobre el resumen de las ventanas (resumir_ventanas_moviles),
+   sin consultar InfluxDB. No repite una alerta que la evaluación continua
+   ya envió dentro del enfriamiento (ni al revés).
+
+Con DETECCION_STREAMING=true, vigilante_calidad.py omite los chequeos de
+voltaje y fuga (ya no descarga la última hora de InfluxDB para ellos).
+"""
+
+# --- 1. LIBRERÍAS ---
+import os
+import sys
+import json
+import math
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+import paho.mqtt.client as mqtt
+from dotenv import load_dotenv
+
+# Reutilizamos umbrales, plantillas y envío de alertas del vigilante
+import vigilante_calidad as vc
+from ventana_movil import VentanaMovil
+from lote_mediciones import TOPIC_MEDICIONES_LOTE, PREFIJO_TOPIC_LOTE, decodificar_lote
+
+# --- 2. Carga de Configuración ---
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MQTT_BROKER_HOST = os.environ.get("MQTT_BROKER_HOST")
+MQTT_PORT = int(os.environ.get("MQTT_PORT", 1883))
+MQTT_USERNAME = os.environ.get("MQTT_USERNAME")
+MQTT_PASSWORD = os.environ.get("MQTT_PASSWORD")
+
+TOPIC_MEDICIONES = "lete/mediciones/+"
+
+# Ventana de voltaje: misma hora que usaba el chequeo horario
+VENTANA_VOLTAJE_S = int(os.environ.get("DETECTOR_VENTANA_VOLTAJE_S", 3600))
+# Ventana corta para la fuga (el cuantil 25 ignora picos de ruido)
+VENTANA_FUGA_S = int(os.environ.get("DETECTOR_VENTANA_FUGA_S", 300))
+# Tiempo que la fuga debe sostenerse antes de alertar
+CONFIRMACION_FUGA_S = int(os.environ.get("DETECTOR_CONFIRMACION_FUGA_S", 120))
+# Cada cuánto se actualiza el modelo EWMA de fuga (igual que el cron horario)
+CICLO_MODELO_FUGA_S = int(os.environ.get("DETECTOR_CICLO_MODELO_FUGA_S", 3600))
+# No re-alertar el mismo tipo de evento antes de este tiempo
+ENFRIAMIENTO_ALERTA_S = int(os.environ.get("DETECTOR_ENFRIAMIENTO_ALERTA_S", 3600))
+# Muestras con un retraso mayor son backlog (tarjeta SD), no tráfico en vivo
+MAX_RETRASO_S = int(os.environ.get("DETECTOR_MAX_RETRASO_S", 120))
+# Frecuencia máxima de evaluación por dispositivo
+EVALUACION_CADA_S = float(os.environ.get("DETECTOR_EVALUACION_CADA_S", 5))
+# Frecuencia de recarga de la lista de clientes activos
+RECARGA_CLIENTES_S = int(os.environ.get("DETECTOR_RECARGA_CLIENTES_S", 300))
+
+MIN_MUESTRAS_FUGA = 30 # ~1 minuto de datos antes de evaluar la fuga
+# Histograma de fuga para cuantiles: 0-5A con resolución de 0.01A
+RANGO_FUGA_A = (0.0, 5.0)
+BINS_FUGA = 500
+
+
+# --- 3. Ventanas por Dispositivo ---
+
+class EstadoDispositivo:
+    """Ventanas móviles y estado de alertas de un dispositivo."""
+
+    def __init__(self):
+        self.voltaje = VentanaMovil(
+            VENTANA_VOLTAJE_S,
+            umbrales_sobre=(vc.UMBRAL_VOLTAJE_ALTO,),
+            umbrales_bajo=(vc.UMBRAL_VOLTAJE_BAJO,)
+        )
+        self.fuga = VentanaMovil(VENTANA_FUGA_S, rango_histograma=RANGO_FUGA_A, bins_histograma=BINS_FUGA)
+        self.fuga_ciclo = VentanaMovil(CICLO_MODELO_FUGA_S, rango_histograma=RANGO_FUGA_A, bins_histograma=BINS_FUGA)
+        self.potencia = VentanaMovil(VENTANA_VOLTAJE_S)
+        self.ultima_evaluacion = 0.0
+        self.inicio_ciclo_fuga = None
+        self.fuga_anomala_desde = None
+        self.estado_voltaje = None
+        self.fuga_activa = None
+        self.ultima_alerta = {}
+
+
+# --- 4. Estado Global ---
+clientes_por_dispositivo = {}
+clientes_lock = threading.Lock()
+
+estados = {}
+estados_lock = threading.Lock()
+
+db_conn = None
+# Un solo worker: serializa el uso de la conexión y los envíos (con reintentos)
+ejecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="detector_alertas")
+
+
+def connect_db():
+    """Conecta (o reconecta) a la base de datos PostgreSQL."""
+    global db_conn
+    try:
+        if db_conn and not db_conn.closed:
+            db_conn.close()
+        db_conn = psycopg2.connect(
+            host=vc.DB_HOST, port=vc.DB_PORT, user=vc.DB_USER,
+            password=vc.DB_PASS, dbname=vc.DB_NAME, connect_timeout=10
+        )
+        logger.info("✅ Conexión con PostgreSQL exitosa.")
+        return True
+    except psycopg2.OperationalError as e:
+        logger.error(f"❌ Error al conectar con PostgreSQL: {e}")
+        return False
+
+
+def recargar_clientes():
+    """[EJECUTADO EN EL WORKER] Recarga la lista de clientes activos."""
+    global clientes_por_dispositivo
+    if not db_conn or db_conn.closed:
+        if not connect_db():
+            return
+    clientes = vc.obtener_clientes(db_conn)
+    nuevos = {c['device_id']: dict(c) for c in clientes}
+    with clientes_lock:
+        # Conservamos 'fuga_stats' en memoria (puede ser más reciente que la BD)
+        for device_id, cliente in nuevos.items():
+            anterior = clientes_por_dispositivo.get(device_id)
+            if anterior is not None and anterior['estadisticas_consumo']:
+                fuga_stats = anterior['estadisticas_consumo'].get('fuga_stats')
+                if fuga_stats is not None:
+                    estadisticas = cliente['estadisticas_consumo'] or {}
+                    estadisticas['fuga_stats'] = fuga_stats
+                    cliente['estadisticas_consumo'] = estadisticas
+        clientes_por_dispositivo = nuevos
+    logger.info(f"🔄 {len(nuevos)} clientes activos cargados para el detector.")
+
+
+# --- 5. Acciones (ejecutadas en el worker) ---
+
+def _notificar_cliente(cliente, template_sid, variables):
+    if vc.NOTIFICACIONES_OUTBOX:
+        # Mismo periodo horario que el vigilante: no se duplican entre ambos
+        if not db_conn or db_conn.closed:
+            connect_db()
+        vc.notificar(db_conn, cliente['device_id'], cliente['telefono_whatsapp'], cliente['telegram_chat_id'],
+                     template_sid, variables, vc.periodo_hora_actual())
+        return
+    mensaje_telegram = vc.formatear_mensaje_telegram(template_sid, variables)
+    try:
+        vc.enviar_alerta_whatsapp(cliente['telefono_whatsapp'], template_sid, variables)
+    except Exception as e:
+        logger.error(f"❌ Fallo definitivo de WhatsApp para {cliente['device_id']}: {e}")
+    try:
+        vc.enviar_alerta_telegram(cliente['telegram_chat_id'], mensaje_telegram)
+    except Exception as e:
+        logger.error(f"❌ Fallo definitivo de Telegram para {cliente['device_id']}: {e}")
+
+
+def _actualizar_estado(device_id, columna, valor):
+    if not db_conn or db_conn.closed:
+        if not connect_db():
+            return
+    vc.actualizar_estado_db(db_conn, device_id, columna, valor)
+
+
+def _chequeo_horario(estado, cliente, resumen, alertar_voltaje, alertar_fuga, ahora):
+    """Chequeos horarios del vigilante sobre el resumen de las ventanas."""
+    if not db_conn or db_conn.closed:
+        if not connect_db():
+            return
+    estado_voltaje = vc.verificar_voltaje(db_conn, resumen, cliente, alertar=alertar_voltaje)
+    if alertar_voltaje and estado_voltaje in ('alto', 'bajo'):
+        estado.ultima_alerta[f'voltaje_{estado_voltaje}'] = ahora
+    if vc.verificar_fuga_corriente(db_conn, resumen, cliente, alertar=alertar_fuga) and alertar_fuga:
+        estado.ultima_alerta['fuga'] = ahora
+    # La BD quedó con el estado del chequeo; la evaluación continua lo vuelve a escribir si difiere
+    estado.estado_voltaje = estado_voltaje
+    estado.fuga_activa = None
+    _guardar_fuga_stats(cliente['device_id'], dict(_obtener_stats_fuga(cliente)))
+
+
+def _guardar_fuga_stats(device_id, stats_fuga):
+    """Guarda solo la llave 'fuga_stats' (no pisa los bloques del vigilante)."""
+    if not db_conn or db_conn.closed:
+        if not connect_db():
+            return
+    sql = """
+        UPDATE clientes c
+        SET estadisticas_consumo = jsonb_set(
+            COALESCE(c.estadisticas_consumo, '{}'::jsonb), '{fuga_stats}', %s::jsonb
+        )
+        FROM dispositivos_lete d
+        WHERE c.id = d.cliente_id AND d.device_id = %s
+    """
+    try:
+        with db_conn.cursor() as cursor:
+            cursor.execute(sql, (json.dumps(stats_fuga), device_id))
+        db_conn.commit()
+    except psycopg2.Error as e:
+        logger.error(f"❌ ERROR al guardar fuga_stats para {device_id}: {e}")
+        db_conn.rollback()
+
+
+# --- 6. Lógica de Detección ---
+
+def _obtener_stats_fuga(cliente):
+    estadisticas = cliente['estadisticas_consumo'] if cliente['estadisticas_consumo'] is not None else {}
+    stats_fuga = estadisticas.setdefault('fuga_stats', {
+        'media': 0.1, 'varianza': (0.1 * 0.3)**2, 'n_muestras': 0, 'strikes': 0
+    })
+    cliente['estadisticas_consumo'] = estadisticas
+    return stats_fuga
+
+
+def _limite_fuga(stats_fuga):
+    """Límite de fuga con la misma lógica híbrida del vigilante (v2.6)."""
+    if stats_fuga['n_muestras'] < vc.PERIODO_APRENDIZAJE_MUESTRAS_FUGA:
+        return vc.UMBRAL_FUGA_CORRIENTE_MINIMO
+    desv_std = math.sqrt(stats_fuga['varianza']) if stats_fuga['varianza'] > 0 else 0
+    limite_ewma = stats_fuga['media'] + (vc.DESVIACIONES_ESTANDAR_PARA_ANOMALIA_FUGA * desv_std)
+    return max(limite_ewma, vc.UMBRAL_FUGA_CORRIENTE_MINIMO)
+
+
+def _puede_alertar(estado, tipo, ahora):
+    ultima = estado.ultima_alerta.get(tipo)
+    return ultima is None or (ahora - ultima) >= ENFRIAMIENTO_ALERTA_S
+
+
+def evaluar_voltaje(estado, cliente, ahora):
+    device_id = cliente['device_id']
+
+    picos_altos = estado.voltaje.contar_sobre(vc.UMBRAL_VOLTAJE_ALTO)
+    if picos_altos >= vc.CANTIDAD_EVENTOS_VOLTAJE_PARA_ALERTA:
+        nuevo_estado = 'alto'
+        if _puede_alertar(estado, 'voltaje_alto', ahora):
+            estado.ultima_alerta['voltaje_alto'] = ahora
+            logger.warning(f"⚡ {device_id}: {picos_altos} picos de alto voltaje en la ventana.")
+            variables = {"1": cliente['nombre'], "2": str(picos_altos)}
+            ejecutor.submit(_notificar_cliente, cliente, vc.TPL_PICOS_VOLTAJE, variables)
+    elif estado.voltaje.contar_bajo(vc.UMBRAL_VOLTAJE_BAJO) >= vc.CANTIDAD_EVENTOS_VOLTAJE_PARA_ALERTA:
+        nuevo_estado = 'bajo'
+        if _puede_alertar(estado, 'voltaje_bajo', ahora):
+            estado.ultima_alerta['voltaje_bajo'] = ahora
+            logger.warning(f"📉 {device_id}: voltaje bajo sostenido en la ventana.")
+            variables = {"1": cliente['nombre']}
+            ejecutor.submit(_notificar_cliente, cliente, vc.TPL_BAJO_VOLTAJE, variables)
+    else:
+        nuevo_estado = 'normal'
+
+    # Solo escribimos en la BD cuando el estado cambia
+    if nuevo_estado != estado.estado_voltaje:
+        estado.estado_voltaje = nuevo_estado
+        ejecutor.submit(_actualizar_estado, device_id, 'alerta_voltaje_estado', nuevo_estado)
+
+
+def evaluar_fuga(estado, cliente, ts, ahora):
+    if estado.fuga.n < MIN_MUESTRAS_FUGA:
+        return
+    device_id = cliente['device_id']
+    stats_fuga = _obtener_stats_fuga(cliente)
+    fuga_actual = estado.fuga.cuantil(0.25)
+    limite = _limite_fuga(stats_fuga)
+
+    if fuga_actual > limite:
+        if estado.fuga_anomala_desde is None:
+            estado.fuga_anomala_desde = ts
+            logger.info(f"       -> {device_id}: fuga anómala ({fuga_actual:.3f}A > {limite:.3f}A). Confirmando...")
+        sostenida = (ts - estado.fuga_anomala_desde) >= CONFIRMACION_FUGA_S
+        if sostenida and _puede_alertar(estado, 'fuga', ahora):
+            estado.ultima_alerta['fuga'] = ahora
+            logger.warning(f"⚠️ {device_id}: ¡ALERTA DE FUGA! Cuantil 25: {fuga_actual:.3f}A.")
+            ejecutor.submit(_notificar_cliente, cliente, vc.TPL_FUGA_CORRIENTE, {"1": cliente['nombre']})
+        if sostenida and estado.fuga_activa is not True:
+            estado.fuga_activa = True
+            ejecutor.submit(_actualizar_estado, device_id, 'alerta_fuga_activa', True)
+    else:
+        estado.fuga_anomala_desde = None
+        if estado.fuga_activa is not False:
+            estado.fuga_activa = False
+            ejecutor.submit(_actualizar_estado, device_id, 'alerta_fuga_activa', False)
+
+
+def chequeo_horario(estado, cliente, ts, ahora):
+    """
+    Cierra un ciclo: corre los chequeos horarios del vigilante (mismo modelo
+    EWMA, strikes y estados) sobre las ventanas de la última hora, sin consultar.
+    """
+    if estado.inicio_ciclo_fuga is None:
+        estado.inicio_ciclo_fuga = ts
+        return
+    if ts - estado.inicio_ciclo_fuga < CICLO_MODELO_FUGA_S or not estado.fuga_ciclo.n:
+        return
+    estado.inicio_ciclo_fuga = ts
+
+    resumen = vc.resumir_ventanas_moviles(estado.voltaje, estado.fuga_ciclo, estado.potencia)
+    alertar_voltaje = _puede_alertar(estado, 'voltaje_alto', ahora) and _puede_alertar(estado, 'voltaje_bajo', ahora)
+    ejecutor.submit(_chequeo_horario, estado, cliente, resumen, alertar_voltaje,
+                    _puede_alertar(estado, 'fuga', ahora), ahora)
+
+
+def procesar_muestra(device_id, payload_str):
+    try:
+        data = json.loads(payload_str)
+        ts = data.get('ts_unix')
+        if ts is None:
+            return
+        ts = float(ts)
+        vrms = float(data.get('vrms', 0))
+        leakage = float(data.get('leak', 0))
+        potencia = float(data.get('pwr', 0))
+    except (json.JSONDecodeError, TypeError, ValueError):
+        return
+    procesar_valores(device_id, ts, vrms, leakage, potencia)
+
+
+def procesar_lote(device_id, payload):
+    """Lote binario (lote_mediciones.py): solo las mediciones recientes entran a las ventanas."""
+    try:
+        registros = decodificar_lote(payload)
+    except ValueError:
+        return
+    recientes = registros[time.time() - registros['ts_unix'] <= MAX_RETRASO_S]
+    for ts, vrms, leakage, potencia in zip(recientes['ts_unix'].tolist(), recientes['vrms'].tolist(),
+                                           recientes['leak'].tolist(), recientes['pwr'].tolist()):
+        procesar_valores(device_id, float(ts), vrms, leakage, potencia)
+
+
+def procesar_valores(device_id, ts, vrms, leakage, potencia):
+    with clientes_lock:
+        cliente = clientes_por_dispositivo.get(device_id)
+    if cliente is None:
+        return # Cliente no activo: lo ignora (igual que el vigilante)
+
+    ahora = time.time()
+    if ahora - ts > MAX_RETRASO_S:
+        return # Backlog de la tarjeta SD: el vigilante horario lo cubre vía Influx
+
+    with estados_lock:
+        estado = estados.get(device_id)
+        if estado is None:
+            estado = estados[device_id] = EstadoDispositivo()
+
+    ultimo = estado.voltaje.ultimo_ts()
+    if ultimo is not None and ts <= ultimo:
+        return # Fuera de orden o duplicada
+
+    estado.voltaje.agregar(ts, vrms)
+    estado.fuga.agregar(ts, leakage)
+    estado.fuga_ciclo.agregar(ts, leakage)
+    estado.potencia.agregar(ts, potencia)
+
+    chequeo_horario(estado, cliente, ts, ahora)
+
+    if ahora - estado.ultima_evaluacion < EVALUACION_CADA_S:
+        return
+    estado.ultima_evaluacion = ahora
+    evaluar_voltaje(estado, cliente, ahora)
+    evaluar_fuga(estado, cliente, ts, ahora)
+
+
+# --- 7. Callbacks MQTT ---
+
+def on_connect(client, userdata, flags, rc):
+    if rc == 0:
+        logger.info(f"✅ Conectado al broker MQTT en {MQTT_BROKER_HOST}")
+        client.subscribe(TOPIC_MEDICIONES)
+        client.subscribe(TOPIC_MEDICIONES_LOTE)
+        logger.info(f"📡 Suscrito a: {TOPIC_MEDICIONES} y {TOPIC_MEDICIONES_LOTE}")
+    else:
+        logger.error(f"❌ Fallo al conectar al broker MQTT. Código: {rc}")
+
+
+def on_message(client, userdata, msg):
+    try:
+        topic_parts = msg.topic.split('/')
+        if len(topic_parts) != 3:
+            return
+        if msg.topic.startswith(PREFIJO_TOPIC_LOTE):
+            procesar_lote(topic_parts[2], msg.payload)
+        else:
+            procesar_muestra(topic_parts[2], msg.payload.decode('utf-8'))
+    except Exception:
+        logger.exception(f"❌ ERROR procesando topic {msg.topic}")
+
+
+# --- 8. Ejecución Principal ---
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        stream=sys.stdout
+    )
+
+    logger.info("=" * 60)
+    logger.info("INICIANDO DETECTOR EN STREAMING LETE - v1")
+    logger.info("=" * 60)
+
+    if not connect_db():
+        logger.critical("❌ CRÍTICO: No se pudo conectar a PostgreSQL. Abortando.")
+        return
+    ejecutor.submit(recargar_clientes).result()
+
+    client = mqtt.Client(
+        mqtt.CallbackAPIVersion.VERSION1,
+        client_id="detector_streaming_lete_v1"
+    )
+    if MQTT_USERNAME and MQTT_PASSWORD:
+        client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.reconnect_delay_set(min_delay=1, max_delay=120)
+
+    while True:
+        try:
+            logger.info(f"Conectando a MQTT en {MQTT_BROKER_HOST}:{MQTT_PORT}...")
+            client.connect(MQTT_BROKER_HOST, MQTT_PORT, 60)
+            break
+        except Exception as e:
+            logger.error(f"❌ Error de conexión MQTT: {e}. Reintentando en 5s...")
+            time.sleep(5)
+
+    logger.info(f"⚡ Voltaje: ventana {VENTANA_VOLTAJE_S}s. 💧 Fuga: ventana {VENTANA_FUGA_S}s, confirmación {CONFIRMACION_FUGA_S}s.")
+    client.loop_start()
+    try:
+        while True:
+            time.sleep(RECARGA_CLIENTES_S)
+            ejecutor.submit(recargar_clientes)
+    except KeyboardInterrupt:
+        logger.info("🛑 Detectado (Ctrl+C). Cerrando detector...")
+    finally:
+        client.loop_stop()
+        client.disconnect()
+        ejecutor.shutdown(wait=True)
+        if db_conn and not db_conn.closed:
+            db_conn.close()
+        logger.info("✅ Detector detenido correctamente.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,223 @@
+#!/usr/bin/env python3
+
+"""
+ENVIADOR DE NOTIFICACIONES (drena 'notificaciones_outbox') v1
+
+Servicio que envía los mensajes que alerta_diaria.py, vigilante_calidad.py
+y detector_streaming.py dejan en el outbox (NOTIFICACIONES_OUTBOX=true):
+1. Reclama lotes de intenciones pendientes con FOR UPDATE SKIP LOCKED
+   (se pueden correr varias instancias sin enviar dos veces lo mismo).
+2. Envía con concurrencia acotada y un límite de tasa por canal.
+3. Registra el estado de entrega: 'enviado' solo si el mensaje salió; los
+   errores y los envíos omitidos (ENVIAR_ALERTAS=false, destino o plantilla
+   vacíos, sin token) se reintentan con espera exponencial hasta
+   ENVIADOR_MAX_INTENTOS y después quedan 'fallido'.
+4. Recupera intenciones que quedaron en 'enviando' por una caída
+   (entrega al menos una vez).
+
+Uso: python enviador_notificaciones.py [--una-vez]
+"""
+
+# --- 1. LIBRERÍAS ---
+import os
+import sys
+import time
+import logging
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg2
+from dotenv import load_dotenv
+
+# Reutilizamos los clientes de Twilio/Telegram (y el interruptor ENVIAR_ALERTAS),
+# en su versión de un solo intento: los reintentos son los del outbox
+import vigilante_calidad as vc
+import outbox_notificaciones as outbox
+
+# --- 2. Carga de Configuración ---
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+ENVIADOR_CONCURRENCIA = int(os.environ.get("ENVIADOR_CONCURRENCIA", 8))
+ENVIADOR_LOTE = int(os.environ.get("ENVIADOR_LOTE", 100))
+ENVIADOR_MAX_INTENTOS = int(os.environ.get("ENVIADOR_MAX_INTENTOS", 5))
+# Espera base entre reintentos (se duplica en cada intento)
+ENVIADOR_ESPERA_REINTENTO_S = int(os.environ.get("ENVIADOR_ESPERA_REINTENTO_S", 60))
+# Segundos sin actualizar tras los que un 'enviando' se considera abandonado
+ENVIADOR_TIMEOUT_ENVIANDO_S = int(os.environ.get("ENVIADOR_TIMEOUT_ENVIANDO_S", 600))
+# Pausa cuando el outbox está vacío
+ENVIADOR_ESPERA_VACIO_S = float(os.environ.get("ENVIADOR_ESPERA_VACIO_S", 5))
+# Mensajes por segundo por canal
+TASA_POR_CANAL = {
+    outbox.CANAL_WHATSAPP: float(os.environ.get("ENVIADOR_TASA_WHATSAPP", 10)),
+    outbox.CANAL_TELEGRAM: float(os.environ.get("ENVIADOR_TASA_TELEGRAM", 25)),
+}
+
+
+# --- 3. Límite de Tasa ---
+
+class LimitadorTasa:
+    """Cubeta de fichas: permite 'tasa' envíos por segundo con ráfagas de hasta 'tasa'."""
+
+    def __init__(self, tasa):
+        self.tasa = tasa
+        self.fichas = tasa
+        self.ultimo = time.monotonic()
+        self._lock = threading.Lock()
+
+    def esperar(self):
+        while True:
+            with self._lock:
+                ahora = time.monotonic()
+                self.fichas = min(self.tasa, self.fichas + (ahora - self.ultimo) * self.tasa)
+                self.ultimo = ahora
+                if self.fichas >= 1:
+                    self.fichas -= 1
+                    return
+                faltante = (1 - self.fichas) / self.tasa
+            time.sleep(faltante)
+
+
+limitadores = {canal: LimitadorTasa(tasa) for canal, tasa in TASA_POR_CANAL.items()}
+
+
+# --- 4. Outbox ---
+
+def connect_db():
+    conn = psycopg2.connect(
+        host=vc.DB_HOST, port=vc.DB_PORT, user=vc.DB_USER,
+        password=vc.DB_PASS, dbname=vc.DB_NAME, connect_timeout=10
+    )
+    outbox.asegurar_esquema_outbox(conn)
+    conn.commit()
+    return conn
+
+
+def reclamar_lote(conn):
+    """Marca como 'enviando' un lote de intenciones listas y las devuelve."""
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            UPDATE notificaciones_outbox
+            SET estado = %s, intentos = intentos + 1, actualizado = NOW()
+            WHERE id IN (
+                SELECT id FROM notificaciones_outbox
+                WHERE (estado = %s AND proximo_intento <= NOW())
+                   OR (estado = %s AND actualizado < NOW() - make_interval(secs => %s))
+                ORDER BY id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, canal, destino, template_sid, variables, texto, intentos
+        """, (outbox.ESTADO_ENVIANDO, outbox.ESTADO_PENDIENTE, outbox.ESTADO_ENVIANDO,
+              ENVIADOR_TIMEOUT_ENVIANDO_S, ENVIADOR_LOTE))
+        filas = cursor.fetchall()
+    conn.commit()
+    return filas
+
+
+def enviar_intencion(fila):
+    """
+    [EJECUTADO EN EL POOL] Envía una intención. Devuelve (id, error o None);
+    un envío omitido por el remitente cuenta como error (no se marca 'enviado').
+    """
+    id_outbox, canal, destino, template_sid, variables, texto, _ = fila
+    limitadores[canal].esperar()
+    try:
+        if canal == outbox.CANAL_WHATSAPP:
+            entregado, motivo = vc.enviar_whatsapp_una_vez(destino, template_sid, variables)
+        else:
+            entregado, motivo = vc.enviar_telegram_una_vez(
+                destino, texto or vc.formatear_mensaje_telegram(template_sid, variables))
+        return id_outbox, None if entregado else f"omitido: {motivo}"
+    except Exception as e:
+        return id_outbox, str(e)[:500]
+
+
+def registrar_resultados(conn, filas, resultados):
+    """Guarda en una transacción el estado de entrega del lote."""
+    intentos_por_id = {fila[0]: fila[6] for fila in filas}
+    enviados = [id_outbox for id_outbox, error in resultados if error is None]
+    fallos = [(id_outbox, error) for id_outbox, error in resultados if error is not None]
+    with conn.cursor() as cursor:
+        if enviados:
+            cursor.execute("""
+                UPDATE notificaciones_outbox
+                SET estado = %s, enviado_en = NOW(), actualizado = NOW(), ultimo_error = NULL
+                WHERE id = ANY(%s)
+            """, (outbox.ESTADO_ENVIADO, enviados))
+        for id_outbox, error in fallos:
+            intentos = intentos_por_id[id_outbox]
+            estado = outbox.ESTADO_FALLIDO if intentos >= ENVIADOR_MAX_INTENTOS else outbox.ESTADO_PENDIENTE
+            espera_s = ENVIADOR_ESPERA_REINTENTO_S * 2 ** (intentos - 1)
+            cursor.execute("""
+                UPDATE notificaciones_outbox
+                SET estado = %s, ultimo_error = %s, actualizado = NOW(),
+                    proximo_intento = NOW() + make_interval(secs => %s)
+                WHERE id = %s
+            """, (estado, error, espera_s, id_outbox))
+    conn.commit()
+    return len(enviados), len(fallos)
+
+
+def drenar(conn, pool):
+    """Procesa un lote. Devuelve el número de intenciones reclamadas."""
+    filas = reclamar_lote(conn)
+    if not filas:
+        return 0
+    inicio = time.perf_counter()
+    resultados = list(pool.map(enviar_intencion, filas))
+    enviados, fallidos = registrar_resultados(conn, filas, resultados)
+    logger.info(f"📨 Lote de {len(filas)}: {enviados} enviados, {fallidos} con error "
+                f"({time.perf_counter() - inicio:.2f}s).")
+    return len(filas)
+
+
+# --- 5. Ejecución Principal ---
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format='%(asctime)s - %(levelname)s - %(name)s - %(message)s',
+        stream=sys.stdout
+    )
+    parser = argparse.ArgumentParser(description="Envía las notificaciones pendientes del outbox.")
+    parser.add_argument('--una-vez', action='store_true', help="Drena el outbox y termina (modo cron).")
+    args = parser.parse_args()
+
+    logger.info("=" * 60)
+    logger.info(f"INICIANDO ENVIADOR DE NOTIFICACIONES - v1 (concurrencia {ENVIADOR_CONCURRENCIA})")
+    logger.info("=" * 60)
+
+    conn = None
+    pool = ThreadPoolExecutor(max_workers=ENVIADOR_CONCURRENCIA, thread_name_prefix="enviador")
+    try:
+        while True:
+            try:
+                if conn is None or conn.closed:
+                    conn = connect_db()
+                    logger.info("✅ Conexión con PostgreSQL exitosa.")
+                procesadas = drenar(conn, pool)
+            except psycopg2.Error as e:
+                logger.error(f"❌ ERROR PostgreSQL en el enviador: {e}. Reintentando en 5s...")
+                if conn and not conn.closed:
+                    conn.close()
+                conn = None
+                time.sleep(5)
+                continue
+            if not procesadas:
+                if args.una_vez:
+                    break
+                time.sleep(ENVIADOR_ESPERA_VACIO_S)
+    except KeyboardInterrupt:
+        logger.info("🛑 Detectado (Ctrl+C). Cerrando enviador...")
+    finally:
+        pool.shutdown(wait=True)
+        if conn and not conn.closed:
+            conn.close()
+        logger.info("✅ Enviador detenido correctamente.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,215 @@
+"""
+DETECCIÓN DE EVENTOS DE ELECTRODOMÉSTICOS (módulo compartido)
+
+Detecta encendidos y apagados en una serie de potencia y los clasifica:
+1. Los saltos positivos (o negativos) consecutivos se funden en una sola
+   rampa: un aparato que sube en 2-3 muestras cuenta como UN evento.
+2. El tamaño del escalón se estima con la mediana de MUESTRAS_ESTABLES
+   muestras antes y después de la rampa (el pico de arranque de un motor no
+   infla el escalón).
+3. Todos los eventos se clasifican de una vez con searchsorted contra las
+   bandas de watts de analizar_consumo.py.
+4. Cada apagado se empareja con el encendido abierto de escalón parecido
+   para estimar duración y energía del aparato.
+
+Lo usan analizar_consumo.py (reporte, también por bloques) y
+vigilante_calidad.py (resumen de la última hora). Solo requiere numpy/pandas.
+"""
+
+import numpy as np
+import pandas as pd
+
+# --- 1. Configuración ---
+
+UMBRAL_EVENTO_W = 300          # Escalón mínimo para considerar un encendido/apagado
+RUIDO_W = 20                   # Saltos menores no continúan una rampa
+MUESTRAS_ESTABLES = 3          # Muestras para la mediana antes/después de la rampa
+MAX_HUECO_S = 60               # Un salto a través de un hueco mayor no es evento
+TOLERANCIA_EMPAREJADO = 0.3    # |apagado - encendido| <= 30% del encendido
+MAX_DURACION_S = 12 * 3600     # Encendidos más largos quedan sin emparejar
+
+NS_POR_S = 1_000_000_000
+
+# Bandas de watts (límite inferior exclusivo) y su descripción
+BANDAS_W = np.array([100, 300, 800, 1500, 2500])
+CATEGORIAS = (
+    'carga_pequena', 'refrigerador_ventilador', 'motor_grande',
+    'microondas_cafetera', 'horno_induccion_clima', 'regadera_varios',
+)
+DESCRIPCIONES = (
+    "Carga pequeña (TV, computadora).",
+    "Probablemente el compresor del refrigerador o un ventilador.",
+    "Sugiere un motor grande (lavadora, bomba de agua, licuadora).",
+    "Común en microondas, cafeteras, tostadores, planchas o secadoras de pelo.",
+    "Típico de un horno eléctrico, parrilla de inducción o aire acondicionado grande.",
+    "Podría ser una regadera eléctrica, o varios aparatos potentes al mismo tiempo.",
+)
+
+
+# --- 2. Clasificación ---
+
+def clasificar(watts):
+    """Índice de categoría (0-5) de cada valor; 'watts' escalar o arreglo."""
+    return np.searchsorted(BANDAS_W, np.round(watts), side='left')
+
+
+# --- 3. Detección ---
+
+def _ventana_mediana(potencia, centros, desplazamientos):
+    """Mediana de potencia[centros + desplazamientos], ignorando lo que cae fuera."""
+    indices = centros[:, None] + desplazamientos[None, :]
+    fuera = (indices < 0) | (indices >= len(potencia))
+    valores = np.where(fuera, np.nan, potencia[np.clip(indices, 0, len(potencia) - 1)])
+    return np.nanmedian(valores, axis=1)
+
+
+def _rampas(tiempos, potencia, signo, cierre):
+    """
+    Rampas de un signo en el búfer. Devuelve (antes, despues, completas):
+    índices de la muestra previa y final de cada rampa, y cuáles ya se pueden
+    evaluar (rampa cerrada y MUESTRAS_ESTABLES muestras después).
+    """
+    n = len(potencia)
+    diferencias = np.diff(potencia) * signo
+    validas = np.diff(tiempos) <= MAX_HUECO_S * NS_POR_S
+    marca = np.concatenate([[False], (diferencias > RUIDO_W) & validas, [False]])
+    cambios = np.flatnonzero(marca[1:] != marca[:-1])
+    antes, despues = cambios[0::2], cambios[1::2]
+    if cierre:
+        completas = np.ones(len(antes), dtype=bool)
+    else:
+        completas = (despues < n - 1) & (despues + MUESTRAS_ESTABLES <= n - 1)
+    return antes, despues, completas
+
+
+class DetectorEventos:
+    """
+    Detector por bloques: agregar() recibe tramos consecutivos de la serie y
+    arrastra la cola no resuelta al siguiente; finalizar() cierra la serie.
+    Procesar la serie completa en un bloque o en muchos da los mismos eventos.
+    """
+
+    def __init__(self, umbral_w=UMBRAL_EVENTO_W):
+        self.umbral_w = umbral_w
+        self.cola_tiempos = np.empty(0, dtype=np.int64)
+        self.cola_potencia = np.empty(0)
+        # Tiempo final de la última rampa ya evaluada, por signo
+        self.ultima_evaluada = {1: None, -1: None}
+        # Encendidos aún sin apagado: [índice en self.eventos, escalón, inicio_ns]
+        self.abiertos = []
+        self.eventos = []
+        self.finalizado = False
+
+    def agregar(self, tiempos_ns, potencia):
+        tiempos = np.concatenate([self.cola_tiempos, np.asarray(tiempos_ns, dtype=np.int64)])
+        potencia = np.concatenate([self.cola_potencia, np.asarray(potencia, dtype=np.float64)])
+        self._procesar(tiempos, potencia, cierre=False)
+        return self
+
+    def finalizar(self):
+        if not self.finalizado:
+            self._procesar(self.cola_tiempos, self.cola_potencia, cierre=True)
+            self.abiertos = []
+            self.finalizado = True
+        return self
+
+    def _procesar(self, tiempos, potencia, cierre):
+        n = len(potencia)
+        if n < 2:
+            self.cola_tiempos, self.cola_potencia = tiempos, potencia
+            return
+
+        desplazamientos_antes = np.arange(-MUESTRAS_ESTABLES + 1, 1)
+        desplazamientos_despues = np.arange(MUESTRAS_ESTABLES)
+        inicio_cola = max(n - MUESTRAS_ESTABLES, 0)
+        nuevos = []
+        for signo in (1, -1):
+            antes, despues, completas = _rampas(tiempos, potencia, signo, cierre)
+            if len(antes) and not completas.all():
+                inicio_cola = min(inicio_cola, int(antes[~completas][0]) - MUESTRAS_ESTABLES + 1)
+            # Las rampas ya evaluadas en un búfer anterior se reconocen por su final
+            ultima = self.ultima_evaluada[signo]
+            if ultima is not None:
+                completas &= tiempos[despues] > ultima
+            antes, despues = antes[completas], despues[completas]
+            if not len(antes):
+                continue
+            self.ultima_evaluada[signo] = int(tiempos[despues[-1]])
+
+            salto = (potencia[despues] - potencia[antes]) * signo
+            escalon = (_ventana_mediana(potencia, despues, desplazamientos_despues)
+                       - _ventana_mediana(potencia, antes, desplazamientos_antes)) * signo
+            es_evento = (salto > self.umbral_w) & (escalon > self.umbral_w)
+            for i in np.flatnonzero(es_evento).tolist():
+                nuevos.append((int(tiempos[antes[i] + 1]), signo, float(escalon[i]),
+                               float(salto[i]), int(despues[i] - antes[i])))
+
+        for inicio_ns, signo, escalon, salto, muestras in sorted(nuevos):
+            if signo > 0:
+                self.abiertos.append([len(self.eventos), escalon, inicio_ns])
+                self.eventos.append({'inicio_ns': inicio_ns, 'escalon_w': escalon, 'salto_w': salto,
+                                     'muestras_rampa': muestras, 'fin_ns': None})
+            else:
+                self._emparejar(inicio_ns, escalon)
+
+        inicio_cola = max(inicio_cola, 0)
+        self.cola_tiempos, self.cola_potencia = tiempos[inicio_cola:], potencia[inicio_cola:]
+
+    def _emparejar(self, apagado_ns, caida_w):
+        """Cierra el encendido abierto de escalón más parecido (el más reciente si empatan)."""
+        limite = apagado_ns - MAX_DURACION_S * NS_POR_S
+        self.abiertos = [a for a in self.abiertos if a[2] >= limite]
+        mejor = None
+        for posicion, (_, escalon, _) in enumerate(self.abiertos):
+            diferencia = abs(escalon - caida_w)
+            if diferencia <= TOLERANCIA_EMPAREJADO * escalon and (mejor is None or diferencia <= mejor[0]):
+                mejor = (diferencia, posicion)
+        if mejor is not None:
+            indice, _, _ = self.abiertos.pop(mejor[1])
+            self.eventos[indice]['fin_ns'] = apagado_ns
+
+    def tabla(self):
+        """
+        DataFrame de encendidos: inicio (UTC), escalon_w, salto_w,
+        muestras_rampa, categoria (0-5), duracion_s y energia_kwh (NaN si no
+        se encontró su apagado).
+        """
+        if not self.eventos:
+            return pd.DataFrame({
+                'inicio': pd.DatetimeIndex([], tz='UTC'), 'escalon_w': [], 'salto_w': [],
+                'muestras_rampa': [], 'categoria': [], 'duracion_s': [], 'energia_kwh': []})
+        crudo = pd.DataFrame(self.eventos)
+        escalon = crudo['escalon_w'].to_numpy()
+        duracion_s = (crudo['fin_ns'].astype('float64') - crudo['inicio_ns']).to_numpy() / NS_POR_S
+        return pd.DataFrame({
+            'inicio': pd.to_datetime(crudo['inicio_ns'], utc=True),
+            'escalon_w': escalon,
+            'salto_w': crudo['salto_w'].to_numpy(),
+            'muestras_rampa': crudo['muestras_rampa'].to_numpy(),
+            'categoria': clasificar(escalon),
+            'duracion_s': duracion_s,
+            'energia_kwh': escalon * duracion_s / 3600 / 1000,
+        })
+
+
+def detectar_eventos(tiempos, potencia, umbral_w=UMBRAL_EVENTO_W):
+    """
+    Encendidos de una serie completa. 'tiempos' es un DatetimeIndex / Series
+    de fechas (o enteros en ns) en orden; devuelve DetectorEventos.tabla().
+    """
+    if isinstance(tiempos, pd.Series):
+        tiempos = pd.DatetimeIndex(tiempos)
+    if isinstance(tiempos, pd.DatetimeIndex):
+        tiempos = tiempos.as_unit('ns').asi8
+    return DetectorEventos(umbral_w).agregar(tiempos, potencia).finalizar().tabla()
+
+
+def resumir_eventos(eventos):
+    """Encendidos y energía emparejada por categoría: {categoria: {'eventos': n, 'energia_kwh': x}}."""
+    resumen = {}
+    for codigo, grupo in eventos.groupby('categoria'):
+        resumen[CATEGORIAS[int(codigo)]] = {
+            'eventos': int(len(grupo)),
+            'energia_kwh': float(grupo['energia_kwh'].sum()),
+        }
+    return resumen
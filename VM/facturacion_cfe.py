@@ -0,0 +1,206 @@
+"""
+FACTURACIÓN CFE (módulo compartido)
+
+Reúne en un solo lugar lo que alerta_diaria.py y vigilante_calidad.py
+calculaban por separado:
+- Tablas de tarifas (escalones de precio y umbrales de aviso de escalón).
+- Calendario de cortes bimestrales, cacheado por (dia_de_corte, ciclo, fecha).
+  Solo existen 31 x 2 combinaciones por día, así que cada combinación se
+  calcula una vez por fecha y proceso.
+- Costo estimado del recibo, escalar y vectorizado (NumPy) para proyectar
+  toda la flotilla en una sola llamada.
+"""
+
+import calendar
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+
+import numpy as np
+
+IVA = 1.16
+
+# --- Estructura de Tarifas CFE (escalones de precio por kWh del bimestre) ---
+TARIFAS_CFE = {
+    '01': [
+        {'hasta_kwh': 150, 'precio': 1.08},
+        {'hasta_kwh': 280, 'precio': 1.32},
+        {'hasta_kwh': float('inf'), 'precio': 3.85}
+    ],
+    '01A': [
+        {'hasta_kwh': 150, 'precio': 1.08},
+        {'hasta_kwh': 300, 'precio': 1.32},
+        {'hasta_kwh': float('inf'), 'precio': 3.85}
+    ],
+    'PDBT': [
+        {'hasta_kwh': float('inf'), 'precio': 5.60}
+    ],
+    'DAC': [
+        {'hasta_kwh': float('inf'), 'precio': 7.80}
+    ]
+}
+
+# --- Umbrales para el aviso de "brinco de escalón" (vigilante) ---
+
+# kWh de aviso que difieren de los escalones de precio, por tarifa y escalón.
+# 01A avisa en 200/400 kWh (no en 150/300): son los límites que ven hoy los
+# clientes; cambiarlos es una decisión de negocio aparte.
+LIMITES_AVISO_ESCALON = {
+    '01A': {'escalon1': 200, 'escalon2': 400},
+}
+
+
+def _construir_umbrales():
+    """
+    Un umbral por cada cambio de escalón de TARIFAS_CFE (las tarifas de precio
+    único no tienen aviso), con el precio del escalón siguiente. El límite es
+    el del escalón, salvo que LIMITES_AVISO_ESCALON lo fije explícitamente.
+    """
+    umbrales = {}
+    for codigo, escalones in TARIFAS_CFE.items():
+        if len(escalones) < 2:
+            continue
+        limites = LIMITES_AVISO_ESCALON.get(codigo, {})
+        umbrales[codigo] = [
+            {'limite': limites.get(f"escalon{i}", actual['hasta_kwh']),
+             'precio_siguiente': siguiente['precio'], 'bandera': f"escalon{i}"}
+            for i, (actual, siguiente) in enumerate(zip(escalones, escalones[1:]), start=1)
+        ]
+    return umbrales
+
+
+TARIFAS_CFE_UMBRALES = _construir_umbrales()
+
+
+def _construir_matrices_tarifas():
+    """Precalcula las tablas de escalones como matrices (tarifas x escalones)."""
+    codigos = list(TARIFAS_CFE)
+    num_escalones = max(len(escalones) for escalones in TARIFAS_CFE.values())
+    # Los escalones de relleno tienen ancho 0 y precio 0: no suman costo.
+    inicios = np.zeros((len(codigos), num_escalones))
+    limites = np.zeros((len(codigos), num_escalones))
+    precios = np.zeros((len(codigos), num_escalones))
+    for i, codigo in enumerate(codigos):
+        limite_anterior = 0.0
+        for j, escalon in enumerate(TARIFAS_CFE[codigo]):
+            inicios[i, j] = limite_anterior
+            limites[i, j] = escalon['hasta_kwh']
+            precios[i, j] = escalon['precio']
+            limite_anterior = escalon['hasta_kwh']
+    indices = {codigo: i for i, codigo in enumerate(codigos)}
+    return indices, inicios, limites - inicios, precios
+
+
+_INDICE_TARIFA, _INICIO_ESCALON, _ANCHO_ESCALON, _PRECIO_ESCALON = _construir_matrices_tarifas()
+
+
+# --- Costo Estimado ---
+
+def calcular_costo_estimado(kwh_consumidos, tipo_tarifa):
+    """Calcula el costo aproximado del recibo de CFE usando la estructura de tarifas."""
+    if tipo_tarifa not in TARIFAS_CFE:
+        print(f"⚠️  Advertencia: Tarifa '{tipo_tarifa}' no reconocida. No se puede calcular el costo.")
+        return 0.0
+    costo_sin_iva = 0.0
+    kwh_restantes = kwh_consumidos
+    limite_anterior = 0
+    for escalon in TARIFAS_CFE[tipo_tarifa]:
+        limite_actual = escalon['hasta_kwh']
+        kwh_en_este_escalon = min(kwh_restantes, limite_actual - limite_anterior)
+        costo_sin_iva += kwh_en_este_escalon * escalon['precio']
+        kwh_restantes -= kwh_en_este_escalon
+        if kwh_restantes <= 0: break
+        limite_anterior = limite_actual
+    return costo_sin_iva * IVA
+
+
+def calcular_costo_estimado_vectorizado(kwh_consumidos, tipos_tarifa):
+    """
+    Versión vectorizada de calcular_costo_estimado().
+    'kwh_consumidos' y 'tipos_tarifa' son secuencias del mismo largo
+    (o 'tipos_tarifa' un solo código). Tarifas desconocidas cuestan 0.0.
+    Devuelve un arreglo NumPy con el costo (con IVA) de cada elemento.
+    """
+    kwh = np.asarray(kwh_consumidos, dtype=np.float64)
+    if isinstance(tipos_tarifa, str):
+        indices = np.full(kwh.shape, _INDICE_TARIFA.get(tipos_tarifa, -1))
+    else:
+        codigos, inversa = np.unique(np.asarray(tipos_tarifa, dtype=str), return_inverse=True)
+        indices = np.array([_INDICE_TARIFA.get(c, -1) for c in codigos], dtype=np.int64)[inversa]
+    indices = indices.reshape(kwh.shape)
+
+    desconocida = indices < 0
+    indices = np.where(desconocida, 0, indices)
+    kwh_por_escalon = np.clip(
+        kwh[..., None] - _INICIO_ESCALON[indices], 0.0, _ANCHO_ESCALON[indices]
+    )
+    costo = (kwh_por_escalon * _PRECIO_ESCALON[indices]).sum(axis=-1) * IVA
+    return np.where(desconocida, 0.0, costo)
+
+
+# --- Calendario de Cortes ---
+
+def _sumar_meses(fecha, meses, dia_de_corte):
+    mes = fecha.month + meses
+    ano = fecha.year
+    while mes > 12:
+        mes -= 12
+        ano += 1
+    while mes <= 0:
+        mes += 12
+        ano -= 1
+    dia = min(dia_de_corte, calendar.monthrange(ano, mes)[1])
+    return date(ano, mes, dia)
+
+
+@lru_cache(maxsize=4096)
+def _fechas_corte_cacheadas(dia_de_corte, ciclo_bimestral, hoy):
+    candidatos_pasados = []
+    for i in range(12):
+        mes_candidato = hoy.month - i
+        ano_candidato = hoy.year
+        if mes_candidato <= 0:
+            mes_candidato += 12
+            ano_candidato -= 1
+        es_mes_par = (mes_candidato % 2 == 0)
+        if (ciclo_bimestral == 'par' and es_mes_par) or (ciclo_bimestral == 'impar' and not es_mes_par):
+            try:
+                dia = min(dia_de_corte, calendar.monthrange(ano_candidato, mes_candidato)[1])
+                fecha_candidata = date(ano_candidato, mes_candidato, dia)
+                if fecha_candidata <= hoy:
+                    candidatos_pasados.append(fecha_candidata)
+            except ValueError: continue
+    if not candidatos_pasados: return None, None
+    ultima_fecha_de_corte = max(candidatos_pasados)
+    proxima_fecha_de_corte = _sumar_meses(ultima_fecha_de_corte, 2, dia_de_corte)
+    return ultima_fecha_de_corte, proxima_fecha_de_corte
+
+
+def calcular_fechas_corte(hoy, dia_de_corte, ciclo_bimestral):
+    """
+    Calcula la fecha de corte más reciente (inicio del periodo actual) y la próxima.
+    'hoy' puede ser un datetime (aware) o un date. Devuelve (None, None) si no aplica.
+    """
+    if isinstance(hoy, datetime):
+        hoy = hoy.date()
+    if dia_de_corte is None:
+        return None, None
+    return _fechas_corte_cacheadas(int(dia_de_corte), ciclo_bimestral, hoy)
+
+
+def fecha_corte_anterior(fecha_corte, dia_de_corte):
+    """Fecha de corte del bimestre previo a 'fecha_corte' (para el cierre de ciclo)."""
+    return _sumar_meses(fecha_corte, -2, dia_de_corte)
+
+
+def precalcular_calendario(hoy, dias=1):
+    """
+    Llena la caché con las 31 x 2 combinaciones de corte para 'dias' fechas
+    a partir de 'hoy'. Útil al inicio de una corrida de toda la flotilla.
+    """
+    if isinstance(hoy, datetime):
+        hoy = hoy.date()
+    for desplazamiento in range(dias):
+        fecha = hoy + timedelta(days=desplazamiento)
+        for dia_de_corte in range(1, 32):
+            for ciclo in ('par', 'impar'):
+                _fechas_corte_cacheadas(dia_de_corte, ciclo, fecha)
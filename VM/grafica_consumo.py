@@ -0,0 +1,127 @@
+"""
+GRÁFICA DE CONSUMO (módulo compartido)
+
+Dibuja la gráfica de analizar_consumo.py (promedio por hora, consumo base y
+picos absolutos) para uno o miles de reportes:
+- La figura, los ejes, la leyenda y el formato se arman una sola vez
+  (PlantillaGrafica); para cada dispositivo solo se reemplazan los datos.
+- La serie se diezma conservando el mínimo y el máximo de cada columna de
+  píxeles antes de dibujar (la forma visible no cambia).
+- El formato de salida (png, svg o webp) se toma de la extensión.
+
+matplotlib solo se importa aquí, así que calcular el reporte sin gráfica
+no lo carga.
+"""
+
+import os
+
+import numpy as np
+from matplotlib.figure import Figure
+import matplotlib.dates as mdates
+
+# --- 1. Configuración ---
+TAMANO_FIGURA = (15, 8)
+DPI = 150
+FORMATOS = ('png', 'svg', 'webp')
+# Puntos máximos de la serie: dos (mínimo y máximo) por columna de píxeles
+MAX_PUNTOS_SERIE = 2 * TAMANO_FIGURA[0] * DPI
+
+
+# --- 2. Diezmado ---
+
+def decimar_min_max(x, y, max_puntos=MAX_PUNTOS_SERIE):
+    """
+    Reduce (x, y) a lo más 'max_puntos' puntos: divide la serie en
+    max_puntos / 2 tramos y de cada uno conserva el mínimo y el máximo en su
+    orden original. Los tramos sin datos (NaN) siguen cortando la línea.
+    """
+    n = len(y)
+    if n <= max_puntos:
+        return x, y
+    tramos = max_puntos // 2
+    ancho = -(-n // tramos)
+    relleno = np.full(tramos * ancho, np.nan)
+    relleno[:n] = y
+    matriz = relleno.reshape(tramos, ancho)
+    i_min = np.where(np.isnan(matriz), np.inf, matriz).argmin(axis=1)
+    i_max = np.where(np.isnan(matriz), -np.inf, matriz).argmax(axis=1)
+    pares = np.sort(np.stack([i_min, i_max], axis=1), axis=1)
+    indices = np.minimum((pares + (np.arange(tramos) * ancho)[:, None]).ravel(), n - 1)
+    return x[indices], y[indices]
+
+
+def _a_numeros_de_fecha(indice):
+    """DatetimeIndex (con o sin zona) a los números de fecha de matplotlib, en UTC."""
+    if indice.tz is not None:
+        indice = indice.tz_convert('UTC').tz_localize(None)
+    return mdates.date2num(indice.to_numpy())
+
+
+# --- 3. Plantilla ---
+
+class PlantillaGrafica:
+    """
+    Figura preparada una vez. dibujar() solo actualiza la línea, la base,
+    los picos, los límites y el texto de la leyenda, y guarda el archivo.
+    Con 'interactiva' la figura se crea con pyplot para poder mostrarla.
+    """
+
+    def __init__(self, interactiva=False):
+        if interactiva:
+            import matplotlib.pyplot as plt
+            self.figura = plt.figure(figsize=TAMANO_FIGURA)
+        else:
+            self.figura = Figure(figsize=TAMANO_FIGURA)
+        ax = self.ax = self.figura.add_subplot()
+
+        self.linea, = ax.plot([], [], color='blue', label='Consumo Promedio por Hora (W)', zorder=2)
+        self.base = ax.axhline(y=0, color='red', linestyle='--', label='Consumo Base (Fantasma)', zorder=3)
+        self.picos = ax.scatter([], [], color='orange', s=100, zorder=4, label='Picos Máximos Absolutos')
+
+        ax.set_title('Análisis de Consumo Eléctrico - 7 Días', fontsize=16)
+        ax.set_ylabel('Potencia (Watts)', fontsize=12)
+        ax.set_xlabel('Fecha y Hora', fontsize=12)
+        ax.grid(True, linestyle='--', alpha=0.6)
+        self.leyenda = ax.legend(loc='upper left')
+        ax.xaxis.set_major_locator(mdates.AutoDateLocator())
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d %H:%M'))
+        ax.tick_params(axis='x', labelrotation=30)
+        # Márgenes fijos en lugar de tight_layout() en cada gráfica
+        self.figura.subplots_adjust(left=0.06, right=0.98, top=0.94, bottom=0.16)
+
+    def dibujar(self, serie_horaria, consumo_base_w, top_picos_absolutos, ruta, formato=None):
+        x, y = decimar_min_max(_a_numeros_de_fecha(serie_horaria.index),
+                               serie_horaria.to_numpy(dtype=np.float64))
+        x_picos = _a_numeros_de_fecha(top_picos_absolutos.index)
+        y_picos = top_picos_absolutos.to_numpy(dtype=np.float64)
+
+        self.linea.set_data(x, y)
+        self.base.set_ydata([consumo_base_w, consumo_base_w])
+        self.picos.set_offsets(np.column_stack([x_picos, y_picos]))
+        self.leyenda.get_texts()[1].set_text(f'Consumo Base (Fantasma): {consumo_base_w:.0f} W')
+
+        todas_x = np.concatenate([x, x_picos])
+        todas_y = np.concatenate([y[~np.isnan(y)], y_picos, [consumo_base_w]])
+        x_min, x_max = todas_x.min(), todas_x.max()
+        y_min, y_max = todas_y.min(), todas_y.max()
+        margen_x = (x_max - x_min) * 0.05 or 1 / 24
+        margen_y = (y_max - y_min) * 0.05 or 1.0
+        self.ax.set_xlim(x_min - margen_x, x_max + margen_x)
+        self.ax.set_ylim(y_min - margen_y, y_max + margen_y)
+
+        formato = formato or os.path.splitext(ruta)[1].lstrip('.').lower() or 'png'
+        if formato not in FORMATOS:
+            raise ValueError(f"Formato de gráfica no soportado: {formato} (usar {', '.join(FORMATOS)}).")
+        self.figura.savefig(ruta, dpi=DPI, format=formato)
+
+
+_plantilla = None
+
+
+def dibujar_grafica(metricas, ruta, formato=None):
+    """Dibuja con la plantilla del proceso (se crea en la primera llamada)."""
+    global _plantilla
+    if _plantilla is None:
+        _plantilla = PlantillaGrafica()
+    _plantilla.dibujar(metricas['serie_horaria'], metricas['consumo_base_w'],
+                       metricas['top_picos_absolutos'], ruta, formato)
@@ -0,0 +1,160 @@
+"""
+INTEGRACIÓN DE ENERGÍA EN LA INGESTA (módulo compartido)
+
+Con ENERGIA_EN_RECEPTOR=true, receptor_mqtt.py integra la potencia de cada
+dispositivo mientras llegan las muestras, en lugar de que rollup_energia.py
+vuelva a leer los datos crudos de cada hora con integral() de Flux:
+- Por dispositivo y hora abierta guarda las muestras (ts_unix, potencia)
+  ordenadas en arreglos compactos (8 bytes por muestra); las que llegan
+  fuera de orden se insertan en su lugar y una repetida reemplaza a la anterior.
+- kWh por la regla del trapecio entre muestras consecutivas de la hora; un
+  hueco mayor a ENERGIA_MAX_HUECO_S (dispositivo sin reportar) no se integra.
+- Las horas modificadas se escriben como 'energia_kwh_hora' (mismo esquema
+  que el rollup) cada ENERGIA_FLUSH_S segundos. Una hora se cierra
+  ENERGIA_CIERRE_S segundos después de terminar: se escribe por última vez
+  y sale de memoria.
+- Lo que no puede integrar (horas ya cerradas o la hora en que arrancó el
+  receptor, que no vio completa) lo devuelve al receptor, que la marca en
+  'horas_recalculo_pendiente' para que rollup_energia.py la recalcule desde
+  los datos crudos y ajuste el acumulado del periodo con la diferencia.
+
+ENERGIA_CIERRE_S + ENERGIA_FLUSH_S debe ser menor que ROLLUP_RETRASO_S, para
+que cada hora esté escrita antes de que el rollup la dé por consolidada.
+"""
+
+import os
+import time
+import threading
+from array import array
+from bisect import bisect_left
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- 1. Configuración ---
+
+ENERGIA_EN_RECEPTOR = os.environ.get("ENERGIA_EN_RECEPTOR", "false").lower() == "true"
+# Dos muestras más separadas que esto no se integran entre sí
+ENERGIA_MAX_HUECO_S = int(os.environ.get("ENERGIA_MAX_HUECO_S", 300))
+# Segundos después del fin de la hora antes de cerrarla
+ENERGIA_CIERRE_S = int(os.environ.get("ENERGIA_CIERRE_S", 120))
+# Segundos entre escrituras de las horas modificadas
+ENERGIA_FLUSH_S = float(os.environ.get("ENERGIA_FLUSH_S", 30))
+
+SEGUNDOS_POR_HORA = 3600
+
+
+def _inicio_de_hora(ts_unix):
+    return int(ts_unix) // SEGUNDOS_POR_HORA * SEGUNDOS_POR_HORA
+
+
+# --- 2. Hora de un dispositivo ---
+
+class HoraEnergia:
+    """Muestras ordenadas de una hora de un dispositivo."""
+
+    __slots__ = ('ts', 'potencia', 'sucia')
+
+    def __init__(self):
+        self.ts = array('I')
+        self.potencia = array('f')
+        self.sucia = False
+
+    def insertar(self, ts_unix, potencia):
+        ts_unix = int(ts_unix)
+        if not self.ts or ts_unix > self.ts[-1]:
+            self.ts.append(ts_unix)
+            self.potencia.append(potencia)
+        else:
+            i = bisect_left(self.ts, ts_unix)
+            if i < len(self.ts) and self.ts[i] == ts_unix:
+                self.potencia[i] = potencia
+            else:
+                self.ts.insert(i, ts_unix)
+                self.potencia.insert(i, potencia)
+        self.sucia = True
+
+    def kwh(self):
+        if len(self.ts) < 2:
+            return 0.0
+        ts = np.frombuffer(self.ts, dtype=np.uint32).astype(np.float64)
+        potencia = np.frombuffer(self.potencia, dtype=np.float32).astype(np.float64)
+        dt = np.diff(ts)
+        trapecios = dt * (potencia[1:] + potencia[:-1]) / 2
+        return float(trapecios[dt <= ENERGIA_MAX_HUECO_S].sum() / 3_600_000)
+
+
+# --- 3. Integrador ---
+
+class IntegradorEnergia:
+    """
+    Horas abiertas de todos los dispositivos (thread-safe). Solo integra
+    horas que empiezan después de 'inicio' (el arranque del receptor).
+    """
+
+    def __init__(self, inicio=None):
+        inicio = time.time() if inicio is None else inicio
+        self.hora_minima = -(-int(inicio) // SEGUNDOS_POR_HORA) * SEGUNDOS_POR_HORA
+        self.horas = {}
+        self.lock = threading.Lock()
+
+    def _cerrada(self, hora, ahora):
+        return ahora >= hora + SEGUNDOS_POR_HORA + ENERGIA_CIERRE_S
+
+    def _agregar(self, device_id, ts_unix, potencia, ahora):
+        hora = _inicio_de_hora(ts_unix)
+        if hora < self.hora_minima or self._cerrada(hora, ahora):
+            return False
+        estado = self.horas.get((device_id, hora))
+        if estado is None:
+            estado = self.horas[(device_id, hora)] = HoraEnergia()
+        estado.insertar(ts_unix, potencia)
+        return True
+
+    def agregar(self, device_id, ts_unix, potencia):
+        """Integra una muestra. False si su hora no la cubre el integrador."""
+        with self.lock:
+            return self._agregar(device_id, ts_unix, potencia, time.time())
+
+    def agregar_lote(self, device_id, ts_unix, potencia):
+        """Integra un lote de muestras. Devuelve las horas (unix) que no cubre."""
+        ahora = time.time()
+        no_cubiertas = set()
+        with self.lock:
+            for ts, valor in zip(np.asarray(ts_unix).tolist(), np.asarray(potencia, dtype=np.float64).tolist()):
+                if not self._agregar(device_id, ts, valor, ahora):
+                    no_cubiertas.add(_inicio_de_hora(ts))
+        return no_cubiertas
+
+    def pendientes(self, ahora=None):
+        """
+        {(device_id, hora_unix): (kwh, muestras)} de las horas modificadas
+        desde la última llamada y de las ya cerradas (hasta confirmar()).
+        """
+        ahora = time.time() if ahora is None else ahora
+        filas = {}
+        with self.lock:
+            for llave, estado in self.horas.items():
+                if estado.sucia or self._cerrada(llave[1], ahora):
+                    filas[llave] = (estado.kwh(), len(estado.ts))
+                    estado.sucia = False
+        return filas
+
+    def confirmar(self, llaves, ahora=None):
+        """Tras escribir 'llaves' con éxito, libera las horas cerradas."""
+        ahora = time.time() if ahora is None else ahora
+        with self.lock:
+            for llave in llaves:
+                estado = self.horas.get(llave)
+                if estado is not None and not estado.sucia and self._cerrada(llave[1], ahora):
+                    del self.horas[llave]
+
+    def reintentar(self, llaves):
+        """Vuelve a marcar como modificadas las horas de una escritura fallida."""
+        with self.lock:
+            for llave in llaves:
+                estado = self.horas.get(llave)
+                if estado is not None:
+                    estado.sucia = True
@@ -0,0 +1,117 @@
+"""
+LOTES BINARIOS DE MEDICIONES (módulo compartido)
+
+Formato compacto para que el ESP32 envíe muchas mediciones en un solo
+publish MQTT (ej. al vaciar el backlog de la tarjeta SD) en lugar de un JSON
+de ~200 bytes por línea del .dat:
+
+  Topic:   lete/mediciones_lote/<device_id>
+  Payload: encabezado de 6 bytes + N registros de 40 bytes (little-endian)
+    encabezado: b'LM', versión (uint8 = 1), tamaño de registro (uint8 = 40),
+                N (uint16)
+    registro:   el struct MeasurementData del firmware tal cual (memcpy):
+                uint32 sequence_number, uint32 timestamp, float32 vrms,
+                irms_phase, irms_neutral, power, leakage, temp_cpu, va,
+                power_factor
+
+Los registros se decodifican de una vez con numpy (sin json.loads por
+muestra) y se convierten a line protocol para InfluxDB con los mismos
+decimales que el JSON del firmware, así un dato vale lo mismo por
+cualquiera de los dos topics. Lo usan receptor_mqtt.py y detector_streaming.py.
+"""
+
+import json
+import struct
+
+import numpy as np
+
+# --- 1. Formato ---
+
+TOPIC_MEDICIONES_LOTE = "lete/mediciones_lote/+"
+PREFIJO_TOPIC_LOTE = "lete/mediciones_lote/"
+
+MAGIA = b'LM'
+VERSION = 1
+ENCABEZADO = struct.Struct('<2sBBH')
+
+DTYPE_MEDICION = np.dtype([
+    ('seq', '<u4'), ('ts_unix', '<u4'),
+    ('vrms', '<f4'), ('irms_p', '<f4'), ('irms_n', '<f4'), ('pwr', '<f4'),
+    ('leak', '<f4'), ('temp', '<f4'), ('va', '<f4'), ('pf', '<f4'),
+])
+MAX_REGISTROS = 0xFFFF
+
+# Campo del JSON del firmware -> (campo en InfluxDB, decimales del snprintf)
+CAMPOS_INFLUX = (
+    ('vrms', 'vrms', 2), ('irms_p', 'irms_phase', 3), ('irms_n', 'irms_neutral', 3),
+    ('pwr', 'power', 2), ('va', 'va', 2), ('pf', 'power_factor', 2),
+    ('leak', 'leakage', 3), ('temp', 'temp_cpu', 1),
+)
+
+
+# --- 2. Codificación / Decodificación ---
+
+def codificar_lote(registros):
+    """Payload binario de un arreglo con DTYPE_MEDICION (lo que haría el firmware)."""
+    registros = np.asarray(registros, dtype=DTYPE_MEDICION)
+    if len(registros) > MAX_REGISTROS:
+        raise ValueError(f"Un lote admite a lo más {MAX_REGISTROS} registros.")
+    return ENCABEZADO.pack(MAGIA, VERSION, DTYPE_MEDICION.itemsize, len(registros)) + registros.tobytes()
+
+
+def decodificar_lote(payload):
+    """
+    Arreglo estructurado (DTYPE_MEDICION) de un payload binario, sin copiar
+    los datos. Lanza ValueError si el encabezado o la longitud no cuadran.
+    """
+    if len(payload) < ENCABEZADO.size:
+        raise ValueError(f"Lote demasiado corto ({len(payload)} bytes).")
+    magia, version, tamano_registro, n = ENCABEZADO.unpack_from(payload)
+    if magia != MAGIA or version != VERSION or tamano_registro != DTYPE_MEDICION.itemsize:
+        raise ValueError(f"Encabezado de lote no soportado ({magia!r}, v{version}, {tamano_registro} bytes).")
+    esperado = ENCABEZADO.size + n * tamano_registro
+    if len(payload) != esperado:
+        raise ValueError(f"Lote de {len(payload)} bytes; se esperaban {esperado} para {n} registros.")
+    return np.frombuffer(payload, dtype=DTYPE_MEDICION, count=n, offset=ENCABEZADO.size)
+
+
+# --- 3. Conversión ---
+
+def _escapar_tag(valor):
+    return str(valor).replace(',', r'\,').replace('=', r'\=').replace(' ', r'\ ')
+
+
+def a_line_protocol(device_id, registros):
+    """
+    Líneas de InfluxDB (measurement 'energia', timestamps en ns) de un lote
+    decodificado; equivalen a los Point que arma el receptor desde el JSON.
+    """
+    plantilla = (f"energia,device_id={_escapar_tag(device_id)} "
+                 + ",".join(f"{nombre}=%r" for _, nombre, _ in CAMPOS_INFLUX)
+                 + ",sequence=%di %d")
+    columnas = [np.round(registros[campo].astype(np.float64), decimales).tolist()
+                for campo, _, decimales in CAMPOS_INFLUX]
+    ts_ns = (registros['ts_unix'].astype(np.int64) * 1_000_000_000).tolist()
+    return [plantilla % fila for fila in zip(*columnas, registros['seq'].tolist(), ts_ns)]
+
+
+def registros_desde_json(mediciones):
+    """
+    Arreglo DTYPE_MEDICION de mediciones JSON ya decodificadas (llaves del
+    firmware; un campo ausente vale 0, como en el receptor).
+    """
+    registros = np.zeros(len(mediciones), dtype=DTYPE_MEDICION)
+    for campo in DTYPE_MEDICION.names:
+        registros[campo] = [datos.get(campo) or 0 for datos in mediciones]
+    return registros
+
+
+def a_payloads_json(registros):
+    """(ts_unix, payload JSON) por registro, con las llaves del firmware (búfer de gracia)."""
+    columnas = {campo: np.round(registros[campo].astype(np.float64), decimales).tolist()
+                for campo, _, decimales in CAMPOS_INFLUX}
+    salida = []
+    for i, (seq, ts) in enumerate(zip(registros['seq'].tolist(), registros['ts_unix'].tolist())):
+        datos = {'ts_unix': ts, **{campo: valores[i] for campo, valores in columnas.items()}, 'seq': seq}
+        salida.append((ts, json.dumps(datos, separators=(',', ':'))))
+    return salida
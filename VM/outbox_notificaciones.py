@@ -0,0 +1,103 @@
+"""
+OUTBOX DE NOTIFICACIONES (módulo compartido)
+
+En lugar de enviar WhatsApp/Telegram en línea y después marcar la bandera
+correspondiente (con riesgo de mensajes duplicados si el script cae entre
+ambos pasos), los detectores insertan "intenciones de mensaje" en la tabla
+'notificaciones_outbox' dentro de la MISMA transacción que sus banderas.
+
+Cada intención lleva una clave de idempotencia (dispositivo, plantilla,
+periodo, canal): insertar dos veces la misma intención no tiene efecto.
+enviador_notificaciones.py drena la tabla con concurrencia y límites de
+tasa, y registra el estado de entrega (pendiente / enviando / enviado / fallido).
+
+Se activa con NOTIFICACIONES_OUTBOX=true en alerta_diaria.py,
+vigilante_calidad.py y detector_streaming.py.
+"""
+
+import os
+import json
+
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+
+load_dotenv()
+
+NOTIFICACIONES_OUTBOX = os.environ.get("NOTIFICACIONES_OUTBOX", "false").lower() == "true"
+
+CANAL_WHATSAPP = 'whatsapp'
+CANAL_TELEGRAM = 'telegram'
+
+ESTADO_PENDIENTE = 'pendiente'
+ESTADO_ENVIANDO = 'enviando'
+ESTADO_ENVIADO = 'enviado'
+ESTADO_FALLIDO = 'fallido'
+
+
+def asegurar_esquema_outbox(conn):
+    """Crea la tabla del outbox si no existe. No hace commit."""
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS notificaciones_outbox (
+                id BIGSERIAL PRIMARY KEY,
+                clave_idempotencia TEXT NOT NULL UNIQUE,
+                device_id VARCHAR(20),
+                canal VARCHAR(10) NOT NULL,
+                destino TEXT NOT NULL,
+                template_sid TEXT NOT NULL,
+                variables JSONB NOT NULL DEFAULT '{}'::jsonb,
+                texto TEXT,
+                estado VARCHAR(10) NOT NULL DEFAULT 'pendiente',
+                intentos INTEGER NOT NULL DEFAULT 0,
+                ultimo_error TEXT,
+                proximo_intento TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                creado TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                actualizado TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                enviado_en TIMESTAMPTZ
+            )
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_notificaciones_outbox_pendientes
+            ON notificaciones_outbox (proximo_intento) WHERE estado IN ('pendiente', 'enviando')
+        """)
+
+
+def clave_idempotencia(device_id, template_sid, periodo, canal):
+    return f"{device_id}|{template_sid}|{periodo}|{canal}"
+
+
+def intenciones(device_id, template_sid, variables, periodo, telefono=None, telegram_chat_id=None, texto_telegram=None):
+    """
+    Intenciones de mensaje para los canales con destino configurado.
+    'periodo' delimita la idempotencia (ej. fecha del reporte, fecha de corte,
+    hora de la alerta). Devuelve una lista de tuplas para encolar_notificaciones().
+    """
+    filas = []
+    if not template_sid:
+        return filas
+    if telefono:
+        filas.append((clave_idempotencia(device_id, template_sid, periodo, CANAL_WHATSAPP), device_id,
+                      CANAL_WHATSAPP, str(telefono), template_sid, json.dumps(variables), None))
+    if telegram_chat_id:
+        filas.append((clave_idempotencia(device_id, template_sid, periodo, CANAL_TELEGRAM), device_id,
+                      CANAL_TELEGRAM, str(telegram_chat_id), template_sid, json.dumps(variables), texto_telegram))
+    return filas
+
+
+def encolar_notificaciones(conn, filas):
+    """
+    Inserta en bloque las intenciones (las repetidas se ignoran).
+    No hace commit: el llamador confirma junto con sus banderas.
+    Devuelve cuántas intenciones nuevas se insertaron.
+    """
+    if not filas:
+        return 0
+    with conn.cursor() as cursor:
+        insertadas = execute_values(cursor, """
+            INSERT INTO notificaciones_outbox
+                (clave_idempotencia, device_id, canal, destino, template_sid, variables, texto)
+            VALUES %s
+            ON CONFLICT (clave_idempotencia) DO NOTHING
+            RETURNING id
+        """, filas, fetch=True)
+    return len(insertadas)
@@ -0,0 +1,282 @@
+"""
+PERFIL DE CARGA POR DISPOSITIVO (módulo compartido)
+
+Perfil compacto de 24x7 franjas (hora de la semana, en UTC) con sumas
+combinables de tamaño fijo, en lugar de recorrer los datos crudos:
+- n_muestras / suma_potencia: promedio de potencia por franja (ponderado
+  por muestra, como el reporte de analizar_consumo.py).
+- n_horas / suma_media / suma_media2: media y varianza de los promedios
+  horarios de cada franja (lo que comparan los chequeos de anomalía).
+- n_fp / suma_fp: factor de potencia de lecturas con consumo (> 20 W).
+El consumo base sale de las franjas de 02:00 a 04:00; con muestras crudas
+incluye además la muestra de las 04:00:00 exactas (como el reporte original,
+between_time('02:00', '04:00')). Esa muestra se lleva aparte y no se
+guarda: los perfiles de horas agregadas cubren [02:00, 04:00).
+
+rollup_energia.py lo actualiza con las horas recién cerradas y lo guarda en
+'perfil_carga' (arreglos float8[]); vigilante_calidad.py lo usa para el
+límite de anomalía de consumo y analizar_consumo.py para el perfil horario,
+el consumo base y el factor de potencia.
+"""
+
+import os
+from datetime import timedelta, timezone
+
+import numpy as np
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- 1. Configuración ---
+
+# Las horas viejas pesan la mitad tras esta cantidad de semanas (0 = sin olvido)
+PERFIL_VIDA_MEDIA_SEMANAS = float(os.environ.get("PERFIL_VIDA_MEDIA_SEMANAS", 8))
+# Días a consolidar para un perfil nuevo
+PERFIL_DIAS_INICIALES = int(os.environ.get("PERFIL_DIAS_INICIALES", 28))
+# Horas por consulta a InfluxDB
+PERFIL_HORAS_POR_LOTE = int(os.environ.get("PERFIL_HORAS_POR_LOTE", 24))
+
+FRANJAS = 24 * 7
+HORAS_MADRUGADA = (2, 3)
+# Fin (incluido) de la madrugada para las muestras crudas: 04:00:00
+FIN_MADRUGADA_NS = 4 * 3_600_000_000_000
+UMBRAL_CONSUMO_FP_W = 20
+
+NS_POR_HORA = 3_600_000_000_000
+NS_POR_DIA = 24 * NS_POR_HORA
+CAMPOS = ('n_muestras', 'suma_potencia', 'n_horas', 'suma_media', 'suma_media2', 'n_fp', 'suma_fp')
+
+
+def franja(ns):
+    """Hora de la semana (0 = lunes 00:00 UTC) de tiempos en ns desde epoch (1970-01-01 fue jueves)."""
+    return ((ns // NS_POR_DIA + 3) % 7) * 24 + (ns % NS_POR_DIA) // NS_POR_HORA
+
+
+# --- 2. Perfil ---
+
+class PerfilCarga:
+    """Sumas por franja; todas las operaciones son O(168) salvo agregar_muestras()."""
+
+    def __init__(self, arreglos=None, hasta=None):
+        for campo in CAMPOS:
+            valores = arreglos.get(campo) if arreglos else None
+            setattr(self, campo, np.array(valores, dtype=np.float64) if valores is not None else np.zeros(FRANJAS))
+        self.hasta = hasta
+        # Muestras de las 04:00:00 exactas (solo en memoria, ver consumo_base_w)
+        self.n_borde_madrugada = 0.0
+        self.suma_borde_madrugada = 0.0
+
+    def agregar_muestras(self, ns, potencia, factor_potencia):
+        """Suma muestras crudas (solo el nivel por muestra; sin promedios horarios)."""
+        f = franja(ns)
+        self.n_muestras += np.bincount(f, minlength=FRANJAS)
+        self.suma_potencia += np.bincount(f, weights=potencia, minlength=FRANJAS)
+        con_consumo = potencia > UMBRAL_CONSUMO_FP_W
+        self.n_fp += np.bincount(f[con_consumo], minlength=FRANJAS)
+        self.suma_fp += np.bincount(f[con_consumo], weights=factor_potencia[con_consumo], minlength=FRANJAS)
+        borde = ns % NS_POR_DIA == FIN_MADRUGADA_NS
+        self.n_borde_madrugada += float(np.count_nonzero(borde))
+        self.suma_borde_madrugada += float(potencia[borde].sum())
+        return self
+
+    def agregar_horas(self, horas_ns, muestras, medias, n_fp, suma_fp):
+        """Suma horas ya agregadas (promedio y muestras de cada hora cerrada)."""
+        f = franja(np.asarray(horas_ns, dtype=np.int64))
+        medias = np.asarray(medias, dtype=np.float64)
+        muestras = np.asarray(muestras, dtype=np.float64)
+        self.n_muestras += np.bincount(f, weights=muestras, minlength=FRANJAS)
+        self.suma_potencia += np.bincount(f, weights=medias * muestras, minlength=FRANJAS)
+        self.n_horas += np.bincount(f, minlength=FRANJAS)
+        self.suma_media += np.bincount(f, weights=medias, minlength=FRANJAS)
+        self.suma_media2 += np.bincount(f, weights=medias ** 2, minlength=FRANJAS)
+        self.n_fp += np.bincount(f, weights=np.asarray(n_fp, dtype=np.float64), minlength=FRANJAS)
+        self.suma_fp += np.bincount(f, weights=np.asarray(suma_fp, dtype=np.float64), minlength=FRANJAS)
+        return self
+
+    def olvidar(self, horas_transcurridas):
+        """Atenúa lo acumulado para que el perfil siga los cambios de hábitos."""
+        if PERFIL_VIDA_MEDIA_SEMANAS <= 0 or horas_transcurridas <= 0:
+            return self
+        factor = 0.5 ** (horas_transcurridas / (FRANJAS * PERFIL_VIDA_MEDIA_SEMANAS))
+        for campo in CAMPOS:
+            setattr(self, campo, getattr(self, campo) * factor)
+        self.n_borde_madrugada *= factor
+        self.suma_borde_madrugada *= factor
+        return self
+
+    def combinar(self, otro):
+        for campo in CAMPOS:
+            setattr(self, campo, getattr(self, campo) + getattr(otro, campo))
+        self.n_borde_madrugada += otro.n_borde_madrugada
+        self.suma_borde_madrugada += otro.suma_borde_madrugada
+        return self
+
+    @property
+    def vacio(self):
+        return not self.n_muestras.any()
+
+    def promedio_por_hora_del_dia(self):
+        """Promedio de potencia por hora del día (0-23, UTC); NaN en horas sin datos."""
+        muestras = self.n_muestras.reshape(7, 24).sum(axis=0)
+        suma = self.suma_potencia.reshape(7, 24).sum(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(muestras > 0, suma / muestras, np.nan)
+
+    def consumo_base_w(self):
+        """
+        Promedio de 02:00 a 04:00 (UTC, ambos incluidos con muestras crudas;
+        [02:00, 04:00) en perfiles de horas agregadas), o None si no hay datos de madrugada.
+        """
+        horas = np.arange(FRANJAS) % 24
+        madrugada = np.isin(horas, HORAS_MADRUGADA)
+        muestras = self.n_muestras[madrugada].sum() + self.n_borde_madrugada
+        suma = self.suma_potencia[madrugada].sum() + self.suma_borde_madrugada
+        return suma / muestras if muestras > 0 else None
+
+    def consumo_promedio_w(self):
+        total = self.n_muestras.sum()
+        return self.suma_potencia.sum() / total if total > 0 else None
+
+    def factor_potencia_promedio(self):
+        total = self.n_fp.sum()
+        return self.suma_fp.sum() / total if total > 0 else np.nan
+
+    def media_desviacion(self, numero_franja):
+        """(media, desviación estándar, horas) de los promedios horarios de una franja."""
+        n = self.n_horas[numero_franja]
+        if n <= 0:
+            return None, None, 0.0
+        media = self.suma_media[numero_franja] / n
+        varianza = max(self.suma_media2[numero_franja] / n - media ** 2, 0.0)
+        return media, float(np.sqrt(varianza)), float(n)
+
+
+# --- 3. Almacenamiento (PostgreSQL) ---
+
+def asegurar_esquema_perfiles(conn):
+    """Crea la tabla de perfiles si no existe. No hace commit."""
+    columnas = ",\n".join(f"{campo} DOUBLE PRECISION[] NOT NULL" for campo in CAMPOS)
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS perfil_carga (
+                device_id VARCHAR(20) PRIMARY KEY,
+                {columnas},
+                hasta TIMESTAMPTZ,
+                actualizado TIMESTAMPTZ DEFAULT NOW()
+            )
+        """)
+
+
+def cargar_perfiles(conn, device_ids=None, bloquear=False):
+    """{device_id: PerfilCarga} de la tabla (todos, o solo 'device_ids')."""
+    consulta = f"SELECT device_id, {', '.join(CAMPOS)}, hasta FROM perfil_carga"
+    parametros = ()
+    if device_ids is not None:
+        consulta += " WHERE device_id = ANY(%s)"
+        parametros = (list(device_ids),)
+    if bloquear:
+        consulta += " FOR UPDATE"
+    with conn.cursor() as cursor:
+        cursor.execute(consulta, parametros)
+        filas = cursor.fetchall()
+    return {
+        fila[0]: PerfilCarga(dict(zip(CAMPOS, fila[1:1 + len(CAMPOS)])), hasta=fila[-1])
+        for fila in filas
+    }
+
+
+def guardar_perfil(conn, device_id, perfil):
+    """Inserta o reemplaza el perfil. No hace commit."""
+    valores = [getattr(perfil, campo).tolist() for campo in CAMPOS]
+    with conn.cursor() as cursor:
+        cursor.execute(f"""
+            INSERT INTO perfil_carga (device_id, {', '.join(CAMPOS)}, hasta, actualizado)
+            VALUES (%s, {', '.join(['%s'] * len(CAMPOS))}, %s, NOW())
+            ON CONFLICT (device_id) DO UPDATE SET
+                {', '.join(f'{campo} = EXCLUDED.{campo}' for campo in CAMPOS)},
+                hasta = EXCLUDED.hasta, actualizado = NOW()
+        """, (device_id, *valores, perfil.hasta))
+
+
+# --- 4. Actualización incremental (desde InfluxDB) ---
+
+def consultar_horas_perfil(query_api, bucket, inicio, fin):
+    """
+    Agregados por dispositivo y hora en [inicio, fin): promedio y muestras
+    de potencia, y suma/conteo del factor de potencia con consumo.
+    Devuelve {device_id: {hora_utc: [muestras, media, n_fp, suma_fp]}}.
+    """
+    flux_query = f"""
+    datos = from(bucket: "{bucket}")
+      |> range(start: {inicio.isoformat()}, stop: {fin.isoformat()})
+      |> filter(fn: (r) => r._measurement == "energia")
+      |> filter(fn: (r) => r._field == "power" or r._field == "power_factor")
+
+    potencia = datos |> filter(fn: (r) => r._field == "power")
+    potencia
+      |> aggregateWindow(every: 1h, fn: mean, timeSrc: "_start", createEmpty: false)
+      |> yield(name: "media")
+    potencia
+      |> aggregateWindow(every: 1h, fn: count, timeSrc: "_start", createEmpty: false)
+      |> yield(name: "muestras")
+
+    fp = datos
+      |> pivot(rowKey: ["_time"], columnKey: ["_field"], valueColumn: "_value")
+      |> filter(fn: (r) => exists r.power and exists r.power_factor and r.power > {float(UMBRAL_CONSUMO_FP_W)})
+      |> map(fn: (r) => ({{ r with _value: r.power_factor }}))
+    fp
+      |> aggregateWindow(every: 1h, fn: sum, timeSrc: "_start", createEmpty: false)
+      |> yield(name: "suma_fp")
+    fp
+      |> aggregateWindow(every: 1h, fn: count, timeSrc: "_start", createEmpty: false)
+      |> yield(name: "n_fp")
+    """
+    posicion = {'muestras': 0, 'media': 1, 'n_fp': 2, 'suma_fp': 3}
+    horas = {}
+    for table in query_api.query(query=flux_query):
+        for record in table.records:
+            resultado = record.values.get('result')
+            if resultado not in posicion:
+                continue
+            fila = horas.setdefault(record.values.get('device_id'), {}).setdefault(record.get_time(), [0, 0.0, 0, 0.0])
+            fila[posicion[resultado]] = float(record.get_value())
+    return horas
+
+
+def actualizar_perfiles(conn, query_api, bucket, hasta):
+    """
+    Agrega a cada perfil las horas cerradas desde su 'hasta' hasta 'hasta'
+    (watermark del rollup), en lotes de PERFIL_HORAS_POR_LOTE horas.
+    Confirma cada lote. Devuelve el número de horas-dispositivo agregadas.
+    """
+    asegurar_esquema_perfiles(conn)
+    conn.commit()
+    with conn.cursor() as cursor:
+        cursor.execute("SELECT MIN(hasta) FROM perfil_carga")
+        minimo = cursor.fetchone()[0]
+    desde = minimo.astimezone(timezone.utc) if minimo else hasta - timedelta(days=PERFIL_DIAS_INICIALES)
+
+    total = 0
+    while desde < hasta:
+        fin_lote = min(desde + timedelta(hours=PERFIL_HORAS_POR_LOTE), hasta)
+        horas = consultar_horas_perfil(query_api, bucket, desde, fin_lote)
+        perfiles = cargar_perfiles(conn, bloquear=True)
+        for device_id, por_hora in horas.items():
+            perfil = perfiles.get(device_id) or PerfilCarga()
+            inicio_perfil = perfil.hasta.astimezone(timezone.utc) if perfil.hasta else desde
+            nuevas = sorted(h for h in por_hora if h >= inicio_perfil)
+            if not nuevas:
+                continue
+            perfil.olvidar((fin_lote - inicio_perfil).total_seconds() / 3600)
+            filas = np.array([por_hora[h] for h in nuevas])
+            horas_ns = np.array([int(h.timestamp()) * 1_000_000_000 for h in nuevas], dtype=np.int64)
+            perfil.agregar_horas(horas_ns, filas[:, 0], filas[:, 1], filas[:, 2], filas[:, 3])
+            perfil.hasta = fin_lote
+            guardar_perfil(conn, device_id, perfil)
+            total += len(nuevas)
+        # Los perfiles sin datos en el lote también avanzan (dispositivo desconectado)
+        with conn.cursor() as cursor:
+            cursor.execute("UPDATE perfil_carga SET hasta = %s WHERE hasta < %s", (fin_lote, fin_lote))
+        conn.commit()
+        desde = fin_lote
+    return total
@@ -0,0 +1,134 @@
+"""
+REGISTRO DE PRESENCIA DE DISPOSITIVOS (módulo compartido)
+
+receptor_mqtt.py ve cada mensaje de medición; en lugar de que
+vigilante_calidad.py consulte InfluxDB por cliente solo para saber si un
+dispositivo ya reportó y cuándo fue la última vez, el receptor lleva en
+memoria, por dispositivo:
+- primera_vista / ultima_vista: hora del servidor al recibir sus mensajes.
+- ultima_medicion: mayor timestamp (RTC del dispositivo) recibido.
+- ultimo_seq: número de secuencia de esa medición.
+- mensajes: mediciones recibidas.
+y lo vuelca a la tabla 'presencia_dispositivos' con un solo upsert cada
+PRESENCIA_FLUSH_S segundos. El vigilante lee toda la flota con un SELECT.
+"""
+
+import os
+import time
+import threading
+from datetime import datetime, timezone
+
+from dotenv import load_dotenv
+from psycopg2.extras import execute_values
+
+load_dotenv()
+
+# Segundos entre volcados del registro a PostgreSQL
+PRESENCIA_FLUSH_S = float(os.environ.get("PRESENCIA_FLUSH_S", 5))
+
+
+def asegurar_esquema_presencia(conn):
+    """Crea la tabla de presencia si no existe. No hace commit."""
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS presencia_dispositivos (
+                device_id VARCHAR(20) PRIMARY KEY,
+                primera_vista TIMESTAMPTZ NOT NULL,
+                ultima_vista TIMESTAMPTZ NOT NULL,
+                ultima_medicion TIMESTAMPTZ,
+                ultimo_seq BIGINT,
+                mensajes BIGINT NOT NULL DEFAULT 0
+            )
+        """)
+
+
+class RegistroPresencia:
+    """Presencia acumulada en memoria desde el último volcado (thread-safe)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # device_id -> [primera_vista, ultima_vista, ultima_medicion_unix, ultimo_seq, mensajes]
+        self.pendientes = {}
+
+    def registrar(self, device_id, ts_unix=None, seq=None, mensajes=1):
+        ahora = time.time()
+        with self.lock:
+            fila = self.pendientes.get(device_id)
+            if fila is None:
+                self.pendientes[device_id] = [ahora, ahora, ts_unix, seq, mensajes]
+                return
+            fila[1] = ahora
+            fila[4] += mensajes
+            if ts_unix is not None and (fila[2] is None or ts_unix >= fila[2]):
+                fila[2], fila[3] = ts_unix, seq
+
+    def _devolver(self, filas):
+        """Reincorpora filas de un volcado fallido sin perder lo registrado mientras tanto."""
+        with self.lock:
+            for device_id, (primera, ultima, ts_unix, seq, mensajes) in filas.items():
+                fila = self.pendientes.get(device_id)
+                if fila is None:
+                    self.pendientes[device_id] = [primera, ultima, ts_unix, seq, mensajes]
+                    continue
+                fila[0], fila[1] = min(fila[0], primera), max(fila[1], ultima)
+                fila[4] += mensajes
+                if ts_unix is not None and (fila[2] is None or ts_unix > fila[2]):
+                    fila[2], fila[3] = ts_unix, seq
+
+    def volcar(self, conn):
+        """
+        Upsert de todo lo pendiente en una sentencia y commit. Devuelve el
+        número de dispositivos; si falla, conserva las filas y relanza.
+        """
+        with self.lock:
+            filas, self.pendientes = self.pendientes, {}
+        if not filas:
+            return 0
+
+        def fecha(ts):
+            return datetime.fromtimestamp(ts, tz=timezone.utc) if ts is not None else None
+
+        valores = [(device_id, fecha(primera), fecha(ultima), fecha(ts_unix), seq, mensajes)
+                   for device_id, (primera, ultima, ts_unix, seq, mensajes) in filas.items()]
+        try:
+            with conn.cursor() as cursor:
+                execute_values(cursor, """
+                    INSERT INTO presencia_dispositivos
+                        (device_id, primera_vista, ultima_vista, ultima_medicion, ultimo_seq, mensajes)
+                    VALUES %s
+                    ON CONFLICT (device_id) DO UPDATE SET
+                        primera_vista = LEAST(presencia_dispositivos.primera_vista, EXCLUDED.primera_vista),
+                        ultima_vista = GREATEST(presencia_dispositivos.ultima_vista, EXCLUDED.ultima_vista),
+                        ultimo_seq = CASE
+                            WHEN presencia_dispositivos.ultima_medicion IS NULL
+                              OR EXCLUDED.ultima_medicion >= presencia_dispositivos.ultima_medicion
+                            THEN COALESCE(EXCLUDED.ultimo_seq, presencia_dispositivos.ultimo_seq)
+                            ELSE presencia_dispositivos.ultimo_seq END,
+                        ultima_medicion = GREATEST(presencia_dispositivos.ultima_medicion, EXCLUDED.ultima_medicion),
+                        mensajes = presencia_dispositivos.mensajes + EXCLUDED.mensajes
+                """, valores)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            self._devolver(filas)
+            raise
+        return len(filas)
+
+
+def consultar_presencia(conn, device_ids=None):
+    """{device_id: {'primera_vista', 'ultima_vista', 'ultima_medicion', 'ultimo_seq', 'mensajes'}}."""
+    consulta = """
+        SELECT device_id, primera_vista, ultima_vista, ultima_medicion, ultimo_seq, mensajes
+        FROM presencia_dispositivos
+    """
+    parametros = ()
+    if device_ids is not None:
+        consulta += " WHERE device_id = ANY(%s)"
+        parametros = (list(device_ids),)
+    with conn.cursor() as cursor:
+        cursor.execute(consulta, parametros)
+        filas = cursor.fetchall()
+    return {
+        fila[0]: dict(zip(('primera_vista', 'ultima_vista', 'ultima_medicion', 'ultimo_seq', 'mensajes'), fila[1:]))
+        for fila in filas
+    }
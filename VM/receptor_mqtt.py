@@ -8,12 +8,66 @@ Este script actúa como un servicio intermediario que:
 2. Maneja los reportes de arranque ('boot_time') y los guarda en PostgreSQL.
 3. Verifica el estado de suscripción del cliente (con caché).
 4. Si está 'active', envía a InfluxDB (batching).
-5. Si está en 'grace_period', guarda en una tabla 'mediciones_pendientes' en PostgreSQL.
+5. Si está en 'grace_period', guarda en PostgreSQL en chunks binarios por
+   dispositivo, en la tabla particionada 'mediciones_gracia' (bufer_gracia.py).
 6. Si está 'expired', descarta el dato.
 7. Si la suscripción se reactiva, reenvía los datos pendientes a InfluxDB.
 8. Si la suscripción expira (post-gracia), purga los datos pendientes.
+   (Ambos como trabajos en cola, ver punto 18.)
 9. [NUEVO] Mueve lotes "venenosos" (que Influx rechaza) a un archivo .log 
    en lugar de re-encolarlos, evitando bloqueos ("Poison Pill").
+10. Acepta lotes binarios de muchas mediciones por mensaje en
+   'lete/mediciones_lote/<device_id>' (formato en lote_mediciones.py),
+   decodificados de una vez con numpy; el topic JSON sigue igual.
+11. Lleva en memoria la presencia de cada dispositivo (primera/última vez
+   visto, última medición y secuencia) y la vuelca en bloque a
+   'presencia_dispositivos' cada PRESENCIA_FLUSH_S segundos.
+12. Con ENERGIA_EN_RECEPTOR=true, integra la potencia de cada dispositivo al
+   recibirla (integrador_energia.py) y escribe los kWh de las horas abiertas
+   como 'energia_kwh_hora' cada ENERGIA_FLUSH_S segundos; lo que no cubre lo
+   marca para que rollup_energia.py lo recalcule.
+13. Con INFLUX_BUCKET_REDUCIDO configurado, acumula agregados por ventana
+   (1 y 15 min: vrms mín/máx/promedio, potencia promedio, fuga máxima, FP
+   promedio y muestras; agregados_mediciones.py) y los escribe a ese bucket
+   al cerrarse cada ventana, para las consultas de rango largo.
+14. Con MQTT_SESION_PERSISTENTE=true, entrega "al menos una vez": sesión
+   persistente (clean_session=False, client id fijo), suscripciones QoS 1 y
+   ack manual. Una medición activa se confirma al broker solo cuando su lote
+   quedó escrito en InfluxDB (o en el archivo de cuarentena); las de gracia,
+   al insertarse en PostgreSQL. Si el receptor cae, el broker conserva y
+   reenvía lo no confirmado. En mosquitto.conf: persistence true,
+   upgrade_outgoing_qos true (el firmware publica con QoS 0),
+   max_inflight_messages (ventana de mensajes sin ack; conviene
+   >= BATCH_SIZE + BACKFILL_MAX_ACKS)
+   y max_queued_messages (lo que se guarda mientras el receptor no está).
+15. Separa las mediciones en dos carriles hacia InfluxDB: 'vivo' (datos
+   recientes) y 'backfill' (más viejos que BACKLOG_UMBRAL_SECONDS, ej. el
+   vaciado de la SD al reconectar), cada uno con su buffer, tamaño de lote
+   y cadencia. El vivo tiene prioridad estricta; el backfill se escribe en
+   su propio thread, solo cuando el vivo no tiene lote pendiente y a lo más
+   BACKFILL_MAX_PUNTOS_S puntos/s. Cada mensaje se confirma en cuanto todos
+   sus puntos quedan escritos (aunque el carril no se haya vaciado) y el
+   backfill retiene a lo más BACKFILL_MAX_ACKS mensajes sin confirmar (lo
+   demás se derrama al espool), para no llenar la ventana de mensajes en
+   vuelo del broker y frenar al vivo. El retraso del carril vivo se registra
+   como 'receptor_carriles' en INFLUX_BUCKET_NEW cada METRICAS_S segundos.
+16. Control de carga (control_carga.py): token bucket por dispositivo y
+   carril (lo que excede se descarta) y presupuesto de puntos en memoria
+   con descarte escalonado: derramar lotes a un espool en disco, luego
+   descartar datos de gracia y, al final, datos activos. Los descartes por
+   dispositivo se registran como 'receptor_descartes' con las métricas.
+17. Búfer de gracia (bufer_gracia.py): las mediciones de gracia se juntan
+   por dispositivo hasta GRACIA_CHUNK_MUESTRAS o GRACIA_FLUSH_S y se guardan
+   como un chunk binario (sus mensajes se confirman al broker entonces). La
+   tabla se particiona por día de recepción: expirar es un DROP de las
+   particiones más viejas que GRACE_PERIOD_DAYS, y reenviar o purgar un
+   dispositivo toca sus chunks, no cada medición.
+18. Reenvíos y purgas (trabajos_receptor.py): cada transición encola un
+   trabajo persistente en 'trabajos_receptor' (sin duplicados pendientes
+   por dispositivo) que ejecuta un pool de TRABAJOS_WORKERS threads, con
+   el reenvío antes que la purga y reintentos con espera exponencial. La
+   profundidad de la cola y la duración de los trabajos se registran como
+   'receptor_trabajos' con las métricas.
 """
 
 # --- 1. LIBRERÍAS ---
@@ -26,10 +80,26 @@ import logging
 import sys
 import threading
 import subprocess
+import numpy as np
 from dotenv import load_dotenv
 from datetime import datetime, timezone, timedelta
 from collections import deque
-from psycopg2.extras import execute_values 
+
+from presencia_dispositivos import PRESENCIA_FLUSH_S, RegistroPresencia, asegurar_esquema_presencia
+from integrador_energia import ENERGIA_EN_RECEPTOR, ENERGIA_FLUSH_S, IntegradorEnergia
+from consumo_energia import INFLUX_BUCKET_ROLLUP, MEDICION_KWH_HORA, RegistroHorasTardias, marcar_horas_tardias
+from agregados_mediciones import INFLUX_BUCKET_REDUCIDO, AGREGADOS_FLUSH_S, AgregadorVentanas, medicion_ventana
+from control_carga import (LIMITE_VIVO_MUESTRAS_S, LIMITE_VIVO_RAFAGA, LIMITE_BACKFILL_MUESTRAS_S,
+                           LIMITE_BACKFILL_RAFAGA, RECEPTOR_MAX_PUNTOS, LIMITADA, DESCARTADA_GRACIA,
+                           DESCARTADA_ACTIVA, LimitadorDispositivos, ContadoresDescarte, EspoolDisco,
+                           nivel_descarte)
+from lote_mediciones import (TOPIC_MEDICIONES_LOTE, PREFIJO_TOPIC_LOTE, decodificar_lote,
+                             a_line_protocol, registros_desde_json)
+from bufer_gracia import (AcumuladorGracia, asegurar_esquema_gracia, guardar_chunks, leer_pendientes,
+                          borrar_pendientes, expirar_particiones)
+from trabajos_receptor import (TRABAJOS_WORKERS, TRABAJOS_ESPERA_VACIO_S, TIPO_REENVIO, TIPO_PURGA,
+                               MetricasTrabajos, asegurar_esquema_trabajos, encolar_trabajo, reclamar_trabajo,
+                               terminar_trabajo, fallar_trabajo, profundidad_cola, limpiar_terminados)
 
 # Librerías para InfluxDB
 from influxdb_client import InfluxDBClient, Point, WritePrecision
@@ -62,6 +132,10 @@ MQTT_BROKER_HOST = os.environ.get("MQTT_BROKER_HOST")
 MQTT_PORT = int(os.environ.get("MQTT_PORT", 1883))
 MQTT_USERNAME = os.environ.get("MQTT_USERNAME")
 MQTT_PASSWORD = os.environ.get("MQTT_PASSWORD")
+MQTT_CLIENT_ID = os.environ.get("MQTT_CLIENT_ID", "receptor_servidor_lete_v5")
+# Entrega "al menos una vez" (sesión persistente + QoS 1 + ack tras escritura durable)
+MQTT_SESION_PERSISTENTE = os.environ.get("MQTT_SESION_PERSISTENTE", "false").lower() == "true"
+MQTT_QOS = 1 if MQTT_SESION_PERSISTENTE else 0
 
 # Configuración de InfluxDB
 INFLUX_URL = os.environ.get("INFLUX_URL")
@@ -77,25 +151,210 @@ TOPIC_MEDICIONES = "lete/mediciones/+"
 BATCH_SIZE = int(os.environ.get("BATCH_SIZE", 50))
 BATCH_TIMEOUT = int(os.environ.get("BATCH_TIMEOUT", 10))
 MAX_RETRY_ATTEMPTS = int(os.environ.get("MAX_RETRY_ATTEMPTS", 3))
+# Carril de backfill: lotes más grandes, cadencia propia y tope de puntos/s
+BACKFILL_BATCH_SIZE = int(os.environ.get("BACKFILL_BATCH_SIZE", 5000))
+BACKFILL_BATCH_TIMEOUT = int(os.environ.get("BACKFILL_BATCH_TIMEOUT", 30))
+BACKFILL_MAX_PUNTOS_S = float(os.environ.get("BACKFILL_MAX_PUNTOS_S", 2000))
+# Mensajes QoS 1 sin confirmar que puede retener el backfill (ventana en vuelo del broker)
+BACKFILL_MAX_ACKS = int(os.environ.get("BACKFILL_MAX_ACKS", 50))
+# Segundos entre registros de métricas de los carriles
+METRICAS_S = float(os.environ.get("METRICAS_S", 60))
 
 # --- Configuración de Lógica de Suscripción ---
 CACHE_TTL_SECONDS = int(os.environ.get("CACHE_TTL_SECONDS", 1000)) # 5 minutos
 GRACE_PERIOD_DAYS = int(os.environ.get("GRACE_PERIOD_DAYS", 30))
 
+# Antigüedad a partir de la cual una medición se considera "tardía" (backlog de SD).
+# Sus horas se marcan para que rollup_energia.py las recalcule.
+BACKLOG_UMBRAL_SECONDS = int(os.environ.get("BACKLOG_UMBRAL_SECONDS", 300))
+
+# Mediciones por escritura a InfluxDB al reenviar el búfer de gracia
+RESEND_BATCH_SIZE = int(os.environ.get("RESEND_BATCH_SIZE", 10000))
+
 # --- 3. Clientes y Conexiones Globales ---
 db_conn = None
 influx_client = None
 influx_write_api = None
 
-# Buffer para batching (thread-safe)
-measurement_buffer = deque()
-buffer_lock = threading.Lock()
-last_flush_time = time.time()
+# Buffers para batching (thread-safe): un carril por prioridad
+class CarrilEscritura:
+    """
+    Buffer de puntos hacia INFLUX_BUCKET_NEW con su tamaño de lote, timeout y
+    (opcional) máximo de puntos por flush, de puntos por segundo y de acks
+    retenidos. 'acks' guarda los mensajes QoS 1 (sesión, mid, qos) cuyas
+    mediciones están en el buffer, cada uno con la posición (en puntos
+    agregados desde el inicio) donde terminan sus puntos: tomar() libera los
+    de los mensajes que el lote termina de cubrir, aunque el carril no se
+    vacíe. Igual 'horas': las horas tardías (device_id, hora_unix) de esas
+    mediciones, que se marcan para recálculo solo cuando ya están en InfluxDB.
+    """
+
+    def __init__(self, nombre, batch_size, batch_timeout, max_lote=None, max_puntos_s=None, max_acks=None):
+        self.nombre = nombre
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.max_lote = max_lote
+        self.max_puntos_s = max_puntos_s
+        self.max_acks = max_acks
+        self.buffer = deque()
+        self.acks = deque()  # (fin, delivery)
+        self.horas = deque() # (fin, [(device_id, hora_unix), ...])
+        # Puntos agregados y tomados desde el inicio (posiciones de 'fin')
+        self.agregados = 0
+        self.tomados = 0
+        self.lock = threading.Lock()
+        self.last_flush_time = time.time()
+        self.siguiente_flush = 0.0
+        # Momento en que entró el punto más viejo del buffer (para el retraso)
+        self.encolado_desde = None
+        # Métricas desde el último registro
+        self.retraso_max = 0.0
+        self.retraso_suma = 0.0
+        self.lotes = 0
+        self.puntos = 0
+
+    def agregar(self, puntos, delivery=None, horas=None):
+        """Encola puntos (y el ack de su mensaje). Devuelve True si el ack quedó pendiente."""
+        with self.lock:
+            if not self.buffer:
+                self.encolado_desde = time.time()
+            self.buffer.extend(puntos)
+            self.agregados += len(puntos)
+            if delivery:
+                self.acks.append((self.agregados, delivery))
+            if horas:
+                self.horas.append((self.agregados, list(horas)))
+            return bool(delivery)
+
+    def tomar(self):
+        """
+        Saca el siguiente lote: (puntos, acks, horas, segundos en cola del más viejo).
+        Los acks y las horas son los de los mensajes cuyos puntos terminan en
+        este lote; los de un mensaje repartido salen con su último lote.
+        """
+        with self.lock:
+            if not self.buffer:
+                return [], [], set(), 0.0
+            ahora = time.time()
+            espera = ahora - (self.encolado_desde or ahora)
+            if self.max_lote is None or len(self.buffer) <= self.max_lote:
+                puntos = list(self.buffer)
+                self.buffer.clear()
+                self.encolado_desde = None
+            else:
+                puntos = [self.buffer.popleft() for _ in range(self.max_lote)]
+                self.encolado_desde = ahora
+            self.tomados += len(puntos)
+            acks = []
+            while self.acks and self.acks[0][0] <= self.tomados:
+                acks.append(self.acks.popleft()[1])
+            horas = set()
+            while self.horas and self.horas[0][0] <= self.tomados:
+                horas.update(self.horas.popleft()[1])
+            return puntos, acks, horas, espera
+
+    def devolver(self, puntos, acks, horas=()):
+        """
+        Re-encola un lote que no se pudo escribir (al frente, en orden). Sus
+        acks y horas se vuelven a liberar cuando ese lote completo se escriba.
+        """
+        with self.lock:
+            if not self.buffer:
+                self.encolado_desde = time.time()
+            self.buffer.extendleft(reversed(puntos))
+            self.tomados -= len(puntos)
+            fin = self.tomados + len(puntos)
+            self.acks.extendleft((fin, delivery) for delivery in reversed(acks))
+            if horas:
+                self.horas.appendleft((fin, list(horas)))
+
+    def acks_excedidos(self):
+        """True si el carril retiene más mensajes sin confirmar que 'max_acks'."""
+        with self.lock:
+            return self.max_acks is not None and len(self.acks) > self.max_acks
+
+    def registrar_escritura(self, n_puntos, espera):
+        with self.lock:
+            self.last_flush_time = time.time()
+            if self.max_puntos_s:
+                self.siguiente_flush = self.last_flush_time + n_puntos / self.max_puntos_s
+            self.retraso_max = max(self.retraso_max, espera)
+            self.retraso_suma += espera
+            self.lotes += 1
+            self.puntos += n_puntos
+
+    def motivo_flush(self):
+        """Razón para hacer flush ahora (tamaño o timeout), o None."""
+        with self.lock:
+            buffer_size = len(self.buffer)
+            if buffer_size == 0 or time.time() < self.siguiente_flush:
+                return None
+            if buffer_size >= self.batch_size:
+                return f"tamaño ({buffer_size}/{self.batch_size})"
+            if self.max_acks is not None and len(self.acks) > self.max_acks:
+                return f"acks pendientes ({len(self.acks)}/{self.max_acks})"
+            if (time.time() - self.last_flush_time) >= self.batch_timeout:
+                return f"timeout ({int(time.time() - self.last_flush_time)}s)"
+        return None
+
+    def metricas(self):
+        """Métricas acumuladas desde la última llamada (y las reinicia)."""
+        with self.lock:
+            pendientes = len(self.buffer)
+            espera_actual = time.time() - self.encolado_desde if self.encolado_desde else 0.0
+            campos = {
+                f"{self.nombre}_retraso_max_s": max(self.retraso_max, espera_actual),
+                f"{self.nombre}_retraso_prom_s": self.retraso_suma / self.lotes if self.lotes else 0.0,
+                f"{self.nombre}_lotes": self.lotes,
+                f"{self.nombre}_puntos": self.puntos,
+                f"{self.nombre}_pendientes": pendientes,
+            }
+            self.retraso_max = self.retraso_suma = 0.0
+            self.lotes = self.puntos = 0
+        return campos
+
+carril_vivo = CarrilEscritura("vivo", BATCH_SIZE, BATCH_TIMEOUT)
+carril_backfill = CarrilEscritura("backfill", BACKFILL_BATCH_SIZE, BACKFILL_BATCH_TIMEOUT,
+                                  max_lote=BACKFILL_BATCH_SIZE, max_puntos_s=BACKFILL_MAX_PUNTOS_S,
+                                  max_acks=BACKFILL_MAX_ACKS)
+
+# Control de carga: límites por dispositivo, contadores y espool (se crea en main)
+limitador_vivo = LimitadorDispositivos(LIMITE_VIVO_MUESTRAS_S, LIMITE_VIVO_RAFAGA)
+limitador_backfill = LimitadorDispositivos(LIMITE_BACKFILL_MUESTRAS_S, LIMITE_BACKFILL_RAFAGA)
+contadores_descarte = ContadoresDescarte()
+espool = None
+
+# Mediciones en periodo de gracia esperando su chunk en PostgreSQL. El lock
+# cubre de listos()/tomar() al commit, así un reenvío no lee la tabla con
+# un chunk de su dispositivo a medio guardar.
+acumulador_gracia = AcumuladorGracia()
+grace_save_lock = threading.Lock()
+
+# Pool de trabajos de reenvío/purga: aviso de trabajo nuevo y métricas
+trabajos_disponibles = threading.Event()
+metricas_trabajos = MetricasTrabajos(METRICAS_S)
+
+# Sesión MQTT actual: los acks pendientes de una conexión anterior se omiten
+mqtt_client = None
+mqtt_session = 0
 
 # Caché de estados de suscripción (thread-safe)
 device_status_cache = {}
 cache_lock = threading.Lock()
 
+# Horas con datos tardíos ya escritos a Influx, por marcar para recálculo
+# (se vuelcan a PostgreSQL con la presencia)
+registro_horas = RegistroHorasTardias()
+
+# Presencia de dispositivos (se vuelca a PostgreSQL en su propio thread)
+registro_presencia = RegistroPresencia()
+
+# kWh por hora integrados al recibir (None si ENERGIA_EN_RECEPTOR=false)
+integrador_energia = IntegradorEnergia() if ENERGIA_EN_RECEPTOR else None
+
+# Agregados de 1 y 15 min (None si no hay INFLUX_BUCKET_REDUCIDO)
+agregador_ventanas = AgregadorVentanas() if INFLUX_BUCKET_REDUCIDO else None
+
 
 def connect_db():
     """Conecta (o reconecta) a la base de datos PostgreSQL."""
@@ -153,26 +412,26 @@ def setup_database_schema():
                 )
             """)
             
-            # 2. Tabla de mediciones pendientes (para período de gracia)
+            # 2. Mediciones del período de gracia (chunks particionados por día)
+            asegurar_esquema_gracia(db_conn)
+
+            # 3. Horas con datos tardíos (las recalcula rollup_energia.py)
             cursor.execute("""
-                CREATE TABLE IF NOT EXISTS mediciones_pendientes (
-                    id BIGSERIAL PRIMARY KEY,
+                CREATE TABLE IF NOT EXISTS horas_recalculo_pendiente (
                     device_id VARCHAR(20) NOT NULL,
-                    ts_unix BIGINT NOT NULL,
-                    payload_json TEXT NOT NULL,
-                    created_at TIMESTAMPTZ DEFAULT NOW()
+                    hora TIMESTAMPTZ NOT NULL,
+                    registrado TIMESTAMPTZ DEFAULT NOW(),
+                    PRIMARY KEY (device_id, hora)
                 )
             """)
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_mediciones_pendientes_device_id 
-                ON mediciones_pendientes (device_id);
-            """)
-            cursor.execute("""
-                CREATE INDEX IF NOT EXISTS idx_mediciones_pendientes_ts_unix
-                ON mediciones_pendientes (ts_unix);
-            """)
 
-            logger.info("✅ Esquema de PostgreSQL verificado (boot_sessions y mediciones_pendientes).")
+            # 4. Presencia de dispositivos (la lee vigilante_calidad.py)
+            asegurar_esquema_presencia(db_conn)
+
+            # 5. Cola de trabajos de reenvío/purga
+            asegurar_esquema_trabajos(db_conn)
+
+            logger.info("✅ Esquema de PostgreSQL verificado (boot_sessions, mediciones_gracia, horas_recalculo_pendiente, presencia_dispositivos y trabajos_receptor).")
             return True
     except psycopg2.Error as e:
         logger.error(f"❌ ERROR al configurar el esquema: {e}")
@@ -224,7 +483,8 @@ def quarantine_failed_batch(points_to_send, original_exception, context_message)
     """
     try:
         # Convertir puntos a line protocol para loggear fácilmente
-        failed_data = "\n".join([p.to_line_protocol() for p in points_to_send])
+        # (los lotes binarios ya vienen como líneas de texto)
+        failed_data = "\n".join([p if isinstance(p, str) else p.to_line_protocol() for p in points_to_send])
         
         # Usar un nombre de archivo único
         fail_filename = f"failed_batch_{int(time.time())}.log"
@@ -244,21 +504,17 @@ def quarantine_failed_batch(points_to_send, original_exception, context_message)
     return False
 
 # --- [MODIFICADO] Lógica de InfluxDB con Anti-Bloqueo ---
-def flush_buffer_to_influx():
+def flush_buffer_to_influx(carril=carril_vivo):
     """
-    Envía todas las mediciones acumuladas a InfluxDB en un solo batch.
+    Envía las mediciones acumuladas de un carril a InfluxDB en un solo batch
+    (todo el carril vivo; a lo más BACKFILL_BATCH_SIZE del backfill).
     [v5] Incluye lógica anti-bloqueo ("Poison Pill").
     """
-    global last_flush_time
-    
-    with buffer_lock:
-        if len(measurement_buffer) == 0:
-            return True
-        
-        points_to_send = list(measurement_buffer)
-        measurement_buffer.clear()
+    points_to_send, acks_to_send, horas_to_mark, espera = carril.tomar()
+    if not points_to_send:
+        return True
     
-    logger.info(f"📤 Enviando batch de {len(points_to_send)} mediciones a InfluxDB...")
+    logger.info(f"📤 Enviando batch de {len(points_to_send)} mediciones a InfluxDB (carril {carril.nombre})...")
     
     for attempt in range(MAX_RETRY_ATTEMPTS):
         try:
@@ -269,7 +525,9 @@ def flush_buffer_to_influx():
                 record=points_to_send
             )
             logger.info(f"✅ Batch enviado exitosamente ({len(points_to_send)} puntos)")
-            last_flush_time = time.time()
+            carril.registrar_escritura(len(points_to_send), espera)
+            ack_messages(acks_to_send)
+            registro_horas.marcar(horas_to_mark)
             return True # <-- ÉXITO
             
         except InfluxDBError as e:
@@ -289,20 +547,23 @@ def flush_buffer_to_influx():
                             record=points_to_send
                         )
                         logger.info(f"✅ Batch enviado tras reconexión")
-                        last_flush_time = time.time()
+                        carril.registrar_escritura(len(points_to_send), espera)
+                        ack_messages(acks_to_send)
+                        registro_horas.marcar(horas_to_mark)
                         return True # <-- ÉXITO (tras reconexión)
                     
                     except Exception as e2:
                         # 5. [ANTI-BLOQUEO] Influx está UP, pero RECHAZÓ el lote.
                         # Esta es la "Poison Pill".
                         logger.critical(f"❌ CRÍTICO: Fallo final al enviar batch (post-reconexión): {e2}")
-                        return quarantine_failed_batch(points_to_send, e2, "Fallo_Post_Reconexion")
+                        resultado = quarantine_failed_batch(points_to_send, e2, "Fallo_Post_Reconexion")
+                        ack_messages(acks_to_send)
+                        return resultado
                 else:
                     # 6. [RE-ENCOLAR] Influx está DOWN. No es Poison Pill.
                     # Re-encolar es lo correcto.
                     logger.critical("❌ CRÍTICO: No se pudo reconectar a Influx. Re-encolando lote.")
-                    with buffer_lock:
-                        measurement_buffer.extendleft(reversed(points_to_send))
+                    carril.devolver(points_to_send, acks_to_send, horas_to_mark)
                     return False
 
         except Exception as e:
@@ -314,31 +575,48 @@ def flush_buffer_to_influx():
                 # 8. [ANTI-BLOQUEO] Fallo inesperado persistente.
                 # Podría ser una "Poison Pill" (ej. bug de parseo).
                 logger.critical(f"❌ CRÍTICO: Fallo inesperado final al enviar batch: {e}")
-                return quarantine_failed_batch(points_to_send, e, "Fallo_Inesperado_Persistente")
+                resultado = quarantine_failed_batch(points_to_send, e, "Fallo_Inesperado_Persistente")
+                ack_messages(acks_to_send)
+                return resultado
     
     # 9. (Si el bucle termina) Fallo, re-encolar por seguridad.
     logger.error("El bucle de flush terminó inesperadamente. Re-encolando por seguridad.")
-    with buffer_lock:
-        measurement_buffer.extendleft(reversed(points_to_send))
+    carril.devolver(points_to_send, acks_to_send, horas_to_mark)
     return False
 
-def check_and_flush_buffer():
-    """Verifica si el buffer debe ser enviado (por tamaño o timeout)."""
-    global last_flush_time
-    
-    should_flush = False
-    with buffer_lock:
-        buffer_size = len(measurement_buffer)
-        if buffer_size >= BATCH_SIZE:
-            should_flush = True
-            reason = f"tamaño ({buffer_size}/{BATCH_SIZE})"
-        elif buffer_size > 0 and (time.time() - last_flush_time) >= BATCH_TIMEOUT:
-            should_flush = True
-            reason = f"timeout ({int(time.time() - last_flush_time)}s)"
-    
-    if should_flush:
-        logger.info(f"🔔 Flush disparado por {reason}")
-        flush_buffer_to_influx()
+def ack_messages(acks):
+    """
+    Confirma al broker mensajes QoS 1 ya escritos de forma durable. Los de
+    una conexión anterior se omiten: el broker ya los reenvió en la sesión
+    nueva (la reescritura en Influx es idempotente) y su mid pudo reutilizarse.
+    """
+    for session, mid, qos in acks:
+        if session == mqtt_session:
+            mqtt_client.ack(mid, qos)
+
+def check_and_flush_buffer(carril=carril_vivo):
+    """Verifica si el buffer de un carril debe ser enviado (por tamaño o timeout)."""
+    reason = carril.motivo_flush()
+    if reason:
+        logger.info(f"🔔 Flush ({carril.nombre}) disparado por {reason}")
+        flush_buffer_to_influx(carril)
+
+def select_lane(ts_unix):
+    """Carril de una medición (o del lote, por su muestra más vieja) según su antigüedad."""
+    return carril_backfill if time.time() - ts_unix > BACKLOG_UMBRAL_SECONDS else carril_vivo
+
+def admit_samples(device_id, carril, muestras=1):
+    """Token bucket del dispositivo en el carril; lo que excede se cuenta y se descarta."""
+    limitador = limitador_vivo if carril is carril_vivo else limitador_backfill
+    if limitador.permitir(device_id, muestras):
+        return True
+    contadores_descarte.sumar(device_id, LIMITADA, muestras)
+    return False
+
+def shedding_level():
+    """Escalón de descarte actual (control_carga.nivel_descarte)."""
+    return nivel_descarte(len(carril_vivo.buffer) + len(carril_backfill.buffer) + acumulador_gracia.muestras(),
+                          espool is not None and espool.disponible())
 
 # --- 6. Handlers de MQTT ---
 
@@ -376,15 +654,27 @@ def handle_boot_time(payload_str):
         logger.exception("❌ ERROR inesperado en handle_boot_time")
 
 
-def handle_medicion(payload_str, device_id):
+def handle_medicion(payload_str, device_id, delivery=None):
     """
     Procesa una medición.
     Verifica el estado de la suscripción y decide si:
     1. Envía a InfluxDB (Active)
     2. Guarda en PostgreSQL (Grace Period)
     3. Descarta (Expired)
+    Devuelve True si el ack de 'delivery' quedó pendiente del flush a Influx.
     """
+    deferred = False
     try:
+        try:
+            data = json.loads(payload_str)
+        except json.JSONDecodeError:
+            logger.error(f"❌ ERROR: Medición no es JSON válido: {payload_str}")
+            return
+        registro_presencia.registrar(device_id, data.get('ts_unix'), data.get('seq'))
+        ts_unix = data.get('ts_unix')
+        if not admit_samples(device_id, select_lane(ts_unix) if ts_unix else carril_vivo):
+            return deferred
+
         # 1. Obtener el estado de la suscripción (usando caché)
         status = get_device_subscription_status(device_id)
 
@@ -393,26 +683,35 @@ def handle_medicion(payload_str, device_id):
             # ---------------------------------
             # ESTADO: ACTIVO -> Enviar a Influx
             # ---------------------------------
-            point, _ = parse_payload_to_point(payload_str, device_id)
-            if point:
-                with buffer_lock:
-                    measurement_buffer.append(point)
-                check_and_flush_buffer()
+            point, ts_unix = data_to_point(data, device_id, payload_str)
+            if point and shedding_level() >= 3:
+                contadores_descarte.sumar(device_id, DESCARTADA_ACTIVA)
+            elif point:
+                if integrador_energia is not None:
+                    tardia = not integrador_energia.agregar(device_id, ts_unix, float(data.get('pwr', 0)))
+                else:
+                    tardia = time.time() - ts_unix > BACKLOG_UMBRAL_SECONDS
+                # La hora se marca para recálculo cuando el punto ya esté en Influx
+                horas = [(device_id, int(ts_unix) // 3600 * 3600)] if tardia else None
+                carril = select_lane(ts_unix)
+                deferred = carril.agregar([point], delivery, horas)
+                if carril is carril_vivo:
+                    check_and_flush_buffer()
+                if agregador_ventanas is not None:
+                    aggregate_measurement(device_id, data)
             
         elif status == 'grace_period':
             # ---------------------------------
             # ESTADO: PERÍODO DE GRACIA -> Guardar localmente
             # ---------------------------------
+            if shedding_level() >= 2:
+                contadores_descarte.sumar(device_id, DESCARTADA_GRACIA)
+                return deferred
             logger.info(f"Suscripción en gracia para {device_id}. Guardando en búfer local.")
-            try:
-                data = json.loads(payload_str)
-                ts_unix = data.get('ts_unix')
-                if ts_unix:
-                    save_to_local_buffer(device_id, ts_unix, payload_str)
-                else:
-                    logger.warning(f"⚠️ Medición en gracia sin ts_unix: {payload_str}")
-            except json.JSONDecodeError:
-                logger.error(f"❌ ERROR: Medición (en gracia) no es JSON válido: {payload_str}")
+            if ts_unix:
+                deferred = acumulador_gracia.agregar(device_id, registros_desde_json([data]), delivery)
+            else:
+                logger.warning(f"⚠️ Medición en gracia sin ts_unix: {payload_str}")
 
         elif status == 'expired' or status == 'unknown':
             # ---------------------------------
@@ -423,8 +722,81 @@ def handle_medicion(payload_str, device_id):
 
     except Exception:
         logger.exception(f"❌ ERROR inesperado en handle_medicion para {device_id}")
+    return deferred
+
+def handle_lote_mediciones(payload, device_id, delivery=None):
+    """
+    Procesa un lote binario (lote_mediciones.py) con la misma lógica de
+    suscripción que handle_medicion, pero una sola vez por lote: las
+    mediciones se decodifican juntas y entran al buffer como line protocol.
+    Devuelve True si el ack de 'delivery' quedó pendiente del flush a Influx.
+    """
+    deferred = False
+    try:
+        registros = decodificar_lote(payload)
+    except ValueError as e:
+        logger.error(f"❌ ERROR: Lote binario inválido de {device_id}: {e}")
+        return deferred
+    if len(registros) == 0:
+        return deferred
+    ultima = int(registros['ts_unix'].argmax())
+    registro_presencia.registrar(device_id, int(registros['ts_unix'][ultima]), int(registros['seq'][ultima]),
+                                 mensajes=len(registros))
+    ts_unix = registros['ts_unix'].astype(np.int64)
+    carril = select_lane(int(ts_unix.min()))
+    if not admit_samples(device_id, carril, len(registros)):
+        return deferred
 
-# --- 7. Lógica de Suscripción y Búfer Local ---
+    try:
+        status = get_device_subscription_status(device_id)
+
+        if status == 'active' and shedding_level() >= 3:
+            contadores_descarte.sumar(device_id, DESCARTADA_ACTIVA, len(registros))
+
+        elif status == 'active':
+            if integrador_energia is not None:
+                # Misma potencia que se escribe a Influx (2 decimales)
+                potencia = np.round(registros['pwr'].astype(np.float64), 2)
+                horas_tardias = integrador_energia.agregar_lote(device_id, ts_unix, potencia)
+            else:
+                tardias = ts_unix[time.time() - ts_unix > BACKLOG_UMBRAL_SECONDS]
+                horas_tardias = np.unique(tardias // 3600 * 3600).tolist()
+            lineas = a_line_protocol(device_id, registros)
+            deferred = carril.agregar(lineas, delivery, [(device_id, int(hora)) for hora in horas_tardias])
+            if carril is carril_vivo:
+                check_and_flush_buffer()
+            if agregador_ventanas is not None:
+                aggregate_records(device_id, registros)
+
+        elif status == 'grace_period' and shedding_level() >= 2:
+            contadores_descarte.sumar(device_id, DESCARTADA_GRACIA, len(registros))
+
+        elif status == 'grace_period':
+            logger.info(f"Suscripción en gracia para {device_id}. Guardando lote de {len(registros)} en búfer local.")
+            deferred = acumulador_gracia.agregar(device_id, registros, delivery)
+
+        elif status == 'expired' or status == 'unknown':
+            logger.info(f"Suscripción expirada/desconocida para {device_id}. Descartando lote de {len(registros)}.")
+
+    except Exception:
+        logger.exception(f"❌ ERROR inesperado en handle_lote_mediciones para {device_id}")
+    return deferred
+
+def aggregate_measurement(device_id, data):
+    """Suma una medición JSON (ya validada por data_to_point) a sus ventanas."""
+    agregador_ventanas.agregar(
+        device_id, data['ts_unix'],
+        float(data.get('vrms', 0)), float(data.get('pwr', 0)),
+        float(data.get('leak', 0)), float(data.get('pf', 0))
+    )
+
+def aggregate_records(device_id, registros):
+    """Suma registros DTYPE_MEDICION a sus ventanas (con los decimales que van a Influx)."""
+    agregador_ventanas.agregar_lote(
+        device_id, registros['ts_unix'].astype(np.int64),
+        *(np.round(registros[campo].astype(np.float64), decimales)
+          for campo, decimales in (('vrms', 2), ('pwr', 2), ('leak', 3), ('pf', 2)))
+    )
 
 def get_device_subscription_status(device_id):
     """
@@ -486,16 +858,17 @@ def get_device_subscription_status(device_id):
         return 'unknown'
 
     # 3. Lógica de Transición de Estado (Reenviar o Purgar)
+    trabajo = None
     with cache_lock:
         old_status = device_status_cache.get(device_id, {}).get('status')
         
         if old_status == 'grace_period' and new_status == 'active':
-            logger.info(f"🎉 ¡Suscripción reactivada para {device_id}! Iniciando reenvío de datos pendientes...")
-            threading.Thread(target=resend_local_buffer, args=(device_id,), daemon=True).start()
+            logger.info(f"🎉 ¡Suscripción reactivada para {device_id}! Encolando reenvío de datos pendientes...")
+            trabajo = TIPO_REENVIO
 
         elif old_status == 'grace_period' and new_status == 'expired':
-            logger.warning(f"🗑️ Período de gracia terminado para {device_id}. Purgando datos pendientes...")
-            threading.Thread(target=delete_local_buffer, args=(device_id,), daemon=True).start()
+            logger.warning(f"🗑️ Período de gracia terminado para {device_id}. Encolando purga de datos pendientes...")
+            trabajo = TIPO_PURGA
     
         # 4. Actualizar caché
         device_status_cache[device_id] = {
@@ -503,6 +876,9 @@ def get_device_subscription_status(device_id):
             'cached_until': now + CACHE_TTL_SECONDS
         }
     
+    if trabajo is not None:
+        schedule_job(device_id, trabajo)
+
     logger.info(f"Estado actualizado para {device_id}: {new_status} (Cacheado por {CACHE_TTL_SECONDS}s)")
     return new_status
 
@@ -514,6 +890,14 @@ def parse_payload_to_point(payload_str, device_id):
     """
     try:
         data = json.loads(payload_str)
+    except json.JSONDecodeError:
+        logger.error(f"❌ ERROR: Medición (en parse) no es JSON válido: {payload_str}")
+        return None, None
+    return data_to_point(data, device_id, payload_str)
+
+def data_to_point(data, device_id, payload_str=None):
+    """Como parse_payload_to_point, pero con el JSON ya decodificado."""
+    try:
         ts_unix = data.get('ts_unix')
 
         if ts_unix is None:
@@ -537,148 +921,209 @@ def parse_payload_to_point(payload_str, device_id):
         
         return point, ts_unix
     
-    except json.JSONDecodeError:
-        logger.error(f"❌ ERROR: Medición (en parse) no es JSON válido: {payload_str}")
-        return None, None
     except Exception:
-        logger.exception("❌ ERROR inesperado en parse_payload_to_point")
+        logger.exception("❌ ERROR inesperado en data_to_point")
         return None, None
 
-def save_to_local_buffer(device_id, ts_unix, payload_str):
-    """Guarda una medición en la tabla 'mediciones_pendientes'."""
-    sql = """
-        INSERT INTO mediciones_pendientes (device_id, ts_unix, payload_json)
-        VALUES (%s, %s, %s)
+def save_grace_chunks(conn, forzar=False):
     """
-    try:
-        with db_conn.cursor() as cursor:
-            cursor.execute(sql, (device_id, ts_unix, payload_str))
-    except psycopg2.Error as e:
-        logger.error(f"❌ ERROR PostgreSQL en save_to_local_buffer: {e}")
-        connect_db() # Reconectar
-    except Exception:
-        logger.exception("❌ ERROR inesperado en save_to_local_buffer")
-
-def resend_local_buffer(device_id):
+    Guarda en PostgreSQL los chunks de gracia listos (todos con 'forzar'),
+    hace commit y confirma sus mensajes. Si falla, los re-encola y relanza.
+    """
+    with grace_save_lock:
+        chunks = acumulador_gracia.listos(forzar)
+        if not chunks:
+            return 0
+        try:
+            muestras = guardar_chunks(conn, [(device_id, registros) for device_id, registros, _ in chunks])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            acumulador_gracia.devolver(chunks)
+            raise
+    for _, _, acks in chunks:
+        ack_messages(acks)
+    return muestras
+
+def take_grace_chunk(conn, device_id, guardar=True):
+    """
+    Saca de memoria el chunk de gracia pendiente de un dispositivo y lo
+    guarda en PostgreSQL (reenvío) o lo descarta (purga). En ambos casos
+    confirma sus mensajes. Devuelve las muestras tomadas.
     """
-    [EJECUTADO EN UN THREAD]
+    with grace_save_lock:
+        registros, acks = acumulador_gracia.tomar(device_id)
+        if registros is not None and guardar:
+            try:
+                guardar_chunks(conn, [(device_id, registros)])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                acumulador_gracia.devolver([(device_id, registros, acks)])
+                raise
+    ack_messages(acks)
+    return 0 if registros is None else len(registros)
+
+def resend_local_buffer(conn, device_id):
+    """
+    [TRABAJO 'reenvio' DEL POOL]
     Lee todas las mediciones pendientes de un device_id desde PostgreSQL,
-    las envía a InfluxDB y luego las borra de PostgreSQL.
+    las envía a InfluxDB y luego las borra de PostgreSQL. Devuelve cuántas
+    se reenviaron; si algo falla, revierte y relanza (la cola reintenta).
     """
-    logger.info(f"[Resend Thread {device_id}] Iniciando.")
-    local_db_conn = None
-    try:
-        local_db_conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS,
-            connect_timeout=10
-        )
-        
-        points_to_resend = []
-        ids_to_delete = []
-
-        with local_db_conn.cursor() as cursor:
-            cursor.execute(
-                "SELECT id, payload_json FROM mediciones_pendientes WHERE device_id = %s ORDER BY ts_unix", 
-                (device_id,)
-            )
-            rows = cursor.fetchall()
-        
-        if not rows:
-            logger.info(f"[Resend Thread {device_id}] No hay datos pendientes para reenviar.")
-            return
-
-        logger.info(f"[Resend Thread {device_id}] Procesando {len(rows)} mediciones pendientes...")
-
-        for row in rows:
-            id_db, payload_str = row
-            point, _ = parse_payload_to_point(payload_str, device_id)
-            if point:
-                points_to_resend.append(point)
-                ids_to_delete.append(id_db)
-            else:
-                logger.warning(f"[Resend Thread {device_id}] Omitiendo punto inválido ID: {id_db}")
-
-        if not points_to_resend:
-            logger.info(f"[Resend Thread {device_id}] No hay puntos válidos para reenviar.")
-            return
-
-        logger.info(f"[Resend Thread {device_id}] Enviando {len(points_to_resend)} puntos a InfluxDB...")
-        # NOTA: Este reenvío es "todo o nada". Si falla, se reintentará
-        # la próxima vez que el cliente pase de 'gracia' a 'activo'.
-        # Para producción más robusta, se podría implementar batching aquí también.
+    # Lo que aún estaba en memoria se guarda antes de leer, para que entre en este reenvío
+    take_grace_chunk(conn, device_id)
+    registros, marca = leer_pendientes(conn, device_id)
+    conn.rollback() # No dejar la transacción abierta mientras se escribe a Influx
+    if len(registros) == 0:
+        logger.info(f"[Reenvío {device_id}] No hay datos pendientes para reenviar.")
+        return 0
+
+    logger.info(f"[Reenvío {device_id}] Enviando {len(registros)} mediciones pendientes a InfluxDB...")
+    # NOTA: Este reenvío es "todo o nada": si un lote falla no se borra
+    # nada y el trabajo se reintenta (reescribir los lotes ya enviados es
+    # idempotente).
+    for inicio in range(0, len(registros), RESEND_BATCH_SIZE):
         influx_write_api.write(
             bucket=INFLUX_BUCKET_NEW, 
             org=INFLUX_ORG, 
-            record=points_to_resend
+            record=a_line_protocol(device_id, registros[inicio:inicio + RESEND_BATCH_SIZE])
         )
-        logger.info(f"[Resend Thread {device_id}] ✅ Reenvío a InfluxDB exitoso.")
-
-        with local_db_conn.cursor() as cursor:
-            execute_values(
-                cursor, 
-                "DELETE FROM mediciones_pendientes WHERE id IN %s", 
-                [(id,) for id in ids_to_delete]
-            )
-        local_db_conn.commit()
-        logger.info(f"[Resend Thread {device_id}] ✅ {len(ids_to_delete)} registros borrados del búfer local.")
+    logger.info(f"[Reenvío {device_id}] ✅ Reenvío a InfluxDB exitoso.")
 
+    late_hours = np.unique(registros['ts_unix'].astype(np.int64) // 3600 * 3600).tolist()
+    try:
+        borradas = borrar_pendientes(conn, device_id, marca)
+        # Las horas reenviadas ya pudieron consolidarse sin estos datos
+        marcar_horas_tardias(conn, [(device_id, hora) for hora in late_hours])
+        conn.commit()
     except Exception:
-        logger.exception(f"❌ ERROR CRÍTICO en [Resend Thread {device_id}]")
-        if local_db_conn:
-            local_db_conn.rollback() # Revertir borrado si Influx falló
-    finally:
-        if local_db_conn:
-            local_db_conn.close()
-            logger.info(f"[Resend Thread {device_id}] Conexión de BD local cerrada.")
-
-def delete_local_buffer(device_id):
+        conn.rollback()
+        raise
+    # Solo tras el commit: un reintento del trabajo volvería a sumar estas muestras
+    if agregador_ventanas is not None:
+        aggregate_records(device_id, registros)
+    logger.info(f"[Reenvío {device_id}] ✅ {borradas} chunks borrados del búfer local.")
+    return len(registros)
+
+def delete_local_buffer(conn, device_id):
     """
-    [EJECUTADO EN UN THREAD]
-    Borra TODAS las mediciones pendientes para un device_id.
+    [TRABAJO 'purga' DEL POOL]
+    Borra TODAS las mediciones pendientes para un device_id. Devuelve
+    cuántos chunks/filas se borraron.
     """
-    logger.info(f"[Purge Thread {device_id}] Iniciando purga.")
-    local_db_conn = None
+    descartadas = take_grace_chunk(conn, device_id, guardar=False)
+    if descartadas:
+        logger.info(f"[Purga {device_id}] {descartadas} mediciones en memoria descartadas.")
     try:
-        local_db_conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            dbname=DB_NAME,
-            user=DB_USER,
-            password=DB_PASS,
-            connect_timeout=10
-        )
-        local_db_conn.autocommit = True
-        
-        with local_db_conn.cursor() as cursor:
-            cursor.execute(
-                "DELETE FROM mediciones_pendientes WHERE device_id = %s", 
-                (device_id,)
-            )
-            count = cursor.rowcount
-        
-        logger.info(f"[Purge Thread {device_id}] ✅ Purga completada. {count} registros eliminados.")
-
+        count = borrar_pendientes(conn, device_id)
+        conn.commit()
     except Exception:
-        logger.exception(f"❌ ERROR CRÍTICO en [Purge Thread {device_id}]")
-    finally:
-        if local_db_conn:
+        conn.rollback()
+        raise
+    logger.info(f"[Purga {device_id}] ✅ Purga completada. {count} chunks eliminados.")
+    return count
+
+def schedule_job(device_id, tipo):
+    """Encola un trabajo de reenvío/purga (deduplicado) y despierta a los workers."""
+    try:
+        nuevo = encolar_trabajo(db_conn, device_id, tipo)
+    except psycopg2.Error as e:
+        logger.error(f"❌ ERROR PostgreSQL al encolar '{tipo}' de {device_id}: {e}")
+        connect_db() # Reconectar
+        return
+    if nuevo:
+        trabajos_disponibles.set()
+    else:
+        logger.info(f"'{tipo}' de {device_id} ya estaba en cola; se omite el duplicado.")
+
+# Ejecutor de cada tipo de trabajo: función(conn, device_id) -> resultado
+EJECUTORES_TRABAJO = {
+    TIPO_REENVIO: resend_local_buffer,
+    TIPO_PURGA: delete_local_buffer,
+}
+
+def job_worker_thread(numero):
+    """
+    Worker del pool de trabajos (TRABAJOS_WORKERS en total), con su propia
+    conexión: reclama el siguiente trabajo listo, lo ejecuta y registra
+    el resultado o programa el reintento.
+    """
+    local_db_conn = None
+    while True:
+        try:
+            if local_db_conn is None or local_db_conn.closed:
+                local_db_conn = psycopg2.connect(
+                    host=DB_HOST, port=DB_PORT, dbname=DB_NAME,
+                    user=DB_USER, password=DB_PASS, connect_timeout=10
+                )
+            if metricas_trabajos.toca_profundidad():
+                metricas_trabajos.fijar_profundidad(profundidad_cola(local_db_conn))
+                limpiar_terminados(local_db_conn)
+                local_db_conn.commit()
+            trabajo = reclamar_trabajo(local_db_conn)
+        except psycopg2.Error as e:
+            logger.error(f"❌ ERROR PostgreSQL en el worker de trabajos {numero} (se reintentará): {e}")
+            if local_db_conn is not None and not local_db_conn.closed:
+                local_db_conn.close()
+            local_db_conn = None
+            time.sleep(5)
+            continue
+        if trabajo is None:
+            trabajos_disponibles.wait(TRABAJOS_ESPERA_VACIO_S)
+            trabajos_disponibles.clear()
+            continue
+
+        id_trabajo, device_id, tipo, intentos = trabajo
+        logger.info(f"⚙️ [Worker {numero}] '{tipo}' de {device_id} (intento {intentos}).")
+        inicio = time.perf_counter()
+        try:
+            resultado = EJECUTORES_TRABAJO[tipo](local_db_conn, device_id)
+        except Exception as e:
+            duracion = time.perf_counter() - inicio
+            logger.exception(f"❌ ERROR en '{tipo}' de {device_id}")
+            metricas_trabajos.registrar(tipo, duracion, ok=False)
+            try:
+                if local_db_conn.closed:
+                    local_db_conn = psycopg2.connect(
+                        host=DB_HOST, port=DB_PORT, dbname=DB_NAME,
+                        user=DB_USER, password=DB_PASS, connect_timeout=10
+                    )
+                else:
+                    local_db_conn.rollback()
+                estado = fallar_trabajo(local_db_conn, id_trabajo, intentos, e, duracion)
+                logger.warning(f"⚠️ '{tipo}' de {device_id} quedó '{estado}' tras {intentos} intento(s).")
+            except psycopg2.Error as e_db:
+                # Sin registrar: se reclama otra vez al vencer TRABAJOS_TIMEOUT_S
+                logger.error(f"❌ No se pudo registrar el fallo del trabajo {id_trabajo}: {e_db}")
+                local_db_conn.close()
+            continue
+        duracion = time.perf_counter() - inicio
+        metricas_trabajos.registrar(tipo, duracion)
+        try:
+            terminar_trabajo(local_db_conn, id_trabajo, duracion, resultado)
+        except psycopg2.Error as e:
+            logger.error(f"❌ No se pudo marcar como hecho el trabajo {id_trabajo}: {e}")
             local_db_conn.close()
+        logger.info(f"✅ [Worker {numero}] '{tipo}' de {device_id} terminado en {duracion:.2f}s.")
 
 
 # --- 8. Lógica de Conexión MQTT ---
 
 def on_connect(client, userdata, flags, rc):
     """Callback que se ejecuta cuando nos conectamos al broker."""
+    global mqtt_session
     if rc == 0:
-        logger.info(f"✅ Conectado al broker MQTT en {MQTT_BROKER_HOST}")
-        client.subscribe(TOPIC_BOOT)
-        client.subscribe(TOPIC_MEDICIONES)
+        mqtt_session += 1
+        logger.info(f"✅ Conectado al broker MQTT en {MQTT_BROKER_HOST}"
+                    + (f" (sesión persistente, retomada: {bool(flags.get('session present'))})"
+                       if MQTT_SESION_PERSISTENTE else ""))
+        client.subscribe(TOPIC_BOOT, qos=MQTT_QOS)
+        client.subscribe(TOPIC_MEDICIONES, qos=MQTT_QOS)
+        client.subscribe(TOPIC_MEDICIONES_LOTE, qos=MQTT_QOS)
         logger.info(f"📡 Suscrito a: {TOPIC_BOOT}")
         logger.info(f"📡 Suscrito a: {TOPIC_MEDICIONES}")
+        logger.info(f"📡 Suscrito a: {TOPIC_MEDICIONES_LOTE}")
     else:
         logger.error(f"❌ Fallo al conectar al broker MQTT. Código: {rc}")
 
@@ -689,8 +1134,23 @@ def on_disconnect(client, userdata, rc):
         logger.info("🔄 Intentando reconectar...")
 
 def on_message(client, userdata, msg):
-    """Callback que se ejecuta cuando llega un mensaje."""
+    """
+    Callback que se ejecuta cuando llega un mensaje. Con ack manual, lo que
+    no queda pendiente del flush a Influx (boot, gracia, descartes, errores)
+    se confirma aquí mismo.
+    """
+    delivery = (mqtt_session, msg.mid, msg.qos) if MQTT_SESION_PERSISTENTE and msg.qos > 0 else None
+    deferred = False
     try:
+        # Los lotes son binarios: se enrutan antes de decodificar como texto
+        if msg.topic.startswith(PREFIJO_TOPIC_LOTE):
+            device_id = msg.topic[len(PREFIJO_TOPIC_LOTE):]
+            if device_id and '/' not in device_id:
+                deferred = handle_lote_mediciones(msg.payload, device_id, delivery)
+            else:
+                logger.warning(f"⚠️ Topic malformado: {msg.topic}")
+            return
+
         payload_str = msg.payload.decode('utf-8')
         
         if msg.topic == TOPIC_BOOT:
@@ -700,12 +1160,15 @@ def on_message(client, userdata, msg):
             topic_parts = msg.topic.split('/')
             if len(topic_parts) == 3:
                 device_id = topic_parts[2]
-                handle_medicion(payload_str, device_id)
+                deferred = handle_medicion(payload_str, device_id, delivery)
             else:
                 logger.warning(f"⚠️ Topic malformado: {msg.topic}")
                 
     except Exception:
         logger.exception(f"❌ ERROR fatal en on_message procesando topic {msg.topic}")
+    finally:
+        if delivery and not deferred:
+            ack_messages([delivery])
 
 
 # --- 9. Thread de Flush Periódico ---
@@ -713,7 +1176,7 @@ def on_message(client, userdata, msg):
 def periodic_flush_thread():
     """Thread que fuerza el flush del buffer de Influx periódicamente."""
     while True:
-        time_since_last_flush = time.time() - last_flush_time
+        time_since_last_flush = time.time() - carril_vivo.last_flush_time
         
         if (time_since_last_flush > BATCH_TIMEOUT / 2):
             time.sleep(1) 
@@ -721,6 +1184,239 @@ def periodic_flush_thread():
         else:
             time.sleep(BATCH_TIMEOUT / 2)
 
+def spill_to_disk():
+    """
+    Derrama lotes al espool (primero del backfill) mientras los buffers pasen
+    RECEPTOR_MAX_PUNTOS o el backfill retenga más de BACKFILL_MAX_ACKS mensajes
+    sin confirmar. Lo derramado ya es durable: sus mensajes se confirman.
+    """
+    derramados = 0
+    while espool.disponible():
+        if carril_backfill.acks_excedidos():
+            carril = carril_backfill
+        elif len(carril_vivo.buffer) + len(carril_backfill.buffer) > RECEPTOR_MAX_PUNTOS:
+            carril = carril_backfill if carril_backfill.buffer else carril_vivo
+        else:
+            break
+        puntos, acks, horas, _ = carril.tomar()
+        if not puntos:
+            break
+        if not espool.guardar([p if isinstance(p, str) else p.to_line_protocol() for p in puntos], horas):
+            carril.devolver(puntos, acks, horas)
+            logger.error(f"❌ No se pudo escribir al espool '{espool.directorio}'. Se descartarán datos de gracia.")
+            break
+        ack_messages(acks)
+        derramados += len(puntos)
+    if derramados:
+        logger.warning(f"💾 {derramados} puntos derramados al espool ({espool.bytes / 1e6:.1f} MB en disco).")
+
+def drain_spool():
+    """
+    Escribe a InfluxDB el archivo más viejo del espool y lo borra. Devuelve
+    True si escribió algo. Un archivo que InfluxDB rechaza (400) se aparta.
+    """
+    ruta, lineas, horas = espool.siguiente()
+    if ruta is None:
+        return False
+    try:
+        influx_write_api.write(bucket=INFLUX_BUCKET_NEW, org=INFLUX_ORG, record=lineas)
+    except InfluxDBError as e:
+        if e.response is not None and e.response.status == 400:
+            espool.apartar(ruta)
+            logger.critical(f"☣️ InfluxDB rechazó '{ruta}' ({e}). Apartado como .rechazado.")
+            return True
+        raise
+    espool.borrar(ruta)
+    registro_horas.marcar(horas)
+    carril_backfill.registrar_escritura(len(lineas), 0.0)
+    logger.info(f"✅ {len(lineas)} puntos del espool escritos a InfluxDB.")
+    return True
+
+def backfill_flush_thread():
+    """
+    Thread del carril de backfill: escribe solo cuando el carril vivo no
+    tiene un lote listo (prioridad estricta) y respeta BACKFILL_MAX_PUNTOS_S.
+    También derrama al espool si se pasa el presupuesto de memoria o el tope
+    de acks del backfill y, con los buffers en calma, vuelve a escribir lo derramado.
+    """
+    while True:
+        try:
+            nivel = shedding_level()
+            if nivel >= 1 or carril_backfill.acks_excedidos():
+                spill_to_disk()
+            vivo_libre = carril_vivo.motivo_flush() is None
+            if vivo_libre and carril_backfill.motivo_flush():
+                flush_buffer_to_influx(carril_backfill)
+            elif (vivo_libre and nivel == 0 and not carril_backfill.buffer
+                  and time.time() >= carril_backfill.siguiente_flush and drain_spool()):
+                continue
+            else:
+                time.sleep(0.5)
+        except Exception:
+            logger.exception("❌ ERROR en el carril de backfill (se reintentará)")
+            time.sleep(5)
+
+def metrics_thread():
+    """Registra cada METRICAS_S segundos el retraso y volumen de los carriles."""
+    while True:
+        time.sleep(METRICAS_S)
+        campos = {**carril_vivo.metricas(), **carril_backfill.metricas()}
+        logger.info(f"📈 Carril vivo: retraso máx {campos['vivo_retraso_max_s']:.1f}s, "
+                    f"{campos['vivo_pendientes']} pendientes | backfill: {campos['backfill_puntos']} escritos, "
+                    f"{campos['backfill_pendientes']} pendientes")
+        punto = Point("receptor_carriles").tag("receptor", MQTT_CLIENT_ID)
+        for campo, valor in campos.items():
+            punto = punto.field(campo, valor)
+        puntos = [punto]
+        descartes = contadores_descarte.tomar()
+        if descartes:
+            peores = sorted(descartes.items(), key=lambda item: -sum(item[1].values()))[:5]
+            logger.warning("🚫 Muestras limitadas/descartadas: "
+                           + ", ".join(f"{device_id} {motivos}" for device_id, motivos in peores)
+                           + (f" (+{len(descartes) - 5} dispositivos)" if len(descartes) > 5 else ""))
+            for device_id, motivos in descartes.items():
+                punto = Point("receptor_descartes").tag("device_id", device_id)
+                for motivo, muestras in motivos.items():
+                    punto = punto.field(motivo, muestras)
+                puntos.append(punto)
+        trabajos = metricas_trabajos.tomar()
+        if trabajos:
+            logger.info(f"🧰 Trabajos: {trabajos}")
+            punto = Point("receptor_trabajos").tag("receptor", MQTT_CLIENT_ID)
+            for campo, valor in trabajos.items():
+                punto = punto.field(campo, valor)
+            puntos.append(punto)
+        try:
+            influx_write_api.write(bucket=INFLUX_BUCKET_NEW, org=INFLUX_ORG, record=puntos)
+        except Exception as e:
+            logger.warning(f"⚠️ No se pudieron escribir las métricas de carriles: {e}")
+
+def grace_flush_thread():
+    """
+    Thread que guarda los chunks de gracia listos (cada segundo) y, cada
+    hora, borra las particiones recibidas antes del periodo de gracia.
+    Usa su propia conexión.
+    """
+    local_db_conn = None
+    ultima_expiracion = 0.0
+    while True:
+        time.sleep(1)
+        try:
+            if local_db_conn is None or local_db_conn.closed:
+                local_db_conn = psycopg2.connect(
+                    host=DB_HOST, port=DB_PORT, dbname=DB_NAME,
+                    user=DB_USER, password=DB_PASS, connect_timeout=10
+                )
+            save_grace_chunks(local_db_conn)
+            if time.time() - ultima_expiracion >= 3600:
+                borradas = expirar_particiones(local_db_conn, GRACE_PERIOD_DAYS + 1)
+                local_db_conn.commit()
+                ultima_expiracion = time.time()
+                if borradas:
+                    logger.info(f"🗑️ Particiones de gracia expiradas: {', '.join(borradas)}")
+        except psycopg2.Error as e:
+            logger.error(f"❌ ERROR PostgreSQL al guardar chunks de gracia (se reintentará): {e}")
+            if local_db_conn is not None and not local_db_conn.closed:
+                local_db_conn.close()
+            local_db_conn = None
+            time.sleep(5)
+        except Exception:
+            logger.exception("❌ ERROR inesperado al guardar chunks de gracia")
+
+def presence_flush_thread():
+    """
+    Thread que vuelca el registro de presencia y las horas tardías ya
+    escritas a PostgreSQL cada PRESENCIA_FLUSH_S segundos, con su propia
+    conexión.
+    """
+    local_db_conn = None
+    while True:
+        time.sleep(PRESENCIA_FLUSH_S)
+        try:
+            if local_db_conn is None or local_db_conn.closed:
+                local_db_conn = psycopg2.connect(
+                    host=DB_HOST, port=DB_PORT, dbname=DB_NAME,
+                    user=DB_USER, password=DB_PASS, connect_timeout=10
+                )
+            registro_presencia.volcar(local_db_conn)
+            registro_horas.volcar(local_db_conn)
+        except psycopg2.Error as e:
+            logger.error(f"❌ ERROR PostgreSQL al volcar presencia/horas tardías (se reintentará): {e}")
+            if local_db_conn is not None and not local_db_conn.closed:
+                local_db_conn.close()
+            local_db_conn = None
+        except Exception:
+            logger.exception("❌ ERROR inesperado al volcar presencia")
+
+def write_energy_hours():
+    """
+    Escribe los kWh de las horas modificadas en el bucket de rollup (mismo
+    esquema que rollup_energia.py). Si falla, quedan pendientes para la
+    siguiente vuelta. Devuelve el número de filas escritas.
+    """
+    filas = integrador_energia.pendientes()
+    if not filas:
+        return 0
+    puntos = [
+        Point(MEDICION_KWH_HORA)
+            .tag("device_id", device_id)
+            .field("kwh", kwh)
+            .field("muestras", muestras)
+            .time(hora_unix, WritePrecision.S)
+        for (device_id, hora_unix), (kwh, muestras) in filas.items()
+    ]
+    try:
+        influx_write_api.write(bucket=INFLUX_BUCKET_ROLLUP, org=INFLUX_ORG, record=puntos)
+    except Exception:
+        integrador_energia.reintentar(filas)
+        raise
+    integrador_energia.confirmar(filas)
+    return len(puntos)
+
+def energy_flush_thread():
+    """Thread que escribe los kWh por hora integrados cada ENERGIA_FLUSH_S segundos."""
+    while True:
+        time.sleep(ENERGIA_FLUSH_S)
+        try:
+            write_energy_hours()
+        except InfluxDBError as e:
+            logger.error(f"❌ ERROR InfluxDB al escribir energia_kwh_hora (se reintentará): {e}")
+        except Exception:
+            logger.exception("❌ ERROR inesperado al escribir energia_kwh_hora")
+
+def write_closed_windows():
+    """
+    Escribe las ventanas cerradas de agregados en INFLUX_BUCKET_REDUCIDO.
+    Si falla, quedan pendientes para la siguiente vuelta. Devuelve el número
+    de ventanas escritas.
+    """
+    filas = agregador_ventanas.cerradas()
+    if not filas:
+        return 0
+    puntos = []
+    for ancho, device_id, inicio, campos in filas:
+        punto = Point(medicion_ventana(ancho)).tag("device_id", device_id)
+        for campo, valor in campos.items():
+            punto = punto.field(campo, valor)
+        puntos.append(punto.time(inicio, WritePrecision.S))
+    try:
+        influx_write_api.write(bucket=INFLUX_BUCKET_REDUCIDO, org=INFLUX_ORG, record=puntos)
+    except Exception:
+        agregador_ventanas.reintentar(filas)
+        raise
+    return len(puntos)
+
+def window_flush_thread():
+    """Thread que escribe las ventanas de agregados cerradas cada AGREGADOS_FLUSH_S segundos."""
+    while True:
+        time.sleep(AGREGADOS_FLUSH_S)
+        try:
+            write_closed_windows()
+        except InfluxDBError as e:
+            logger.error(f"❌ ERROR InfluxDB al escribir agregados por ventana (se reintentará): {e}")
+        except Exception:
+            logger.exception("❌ ERROR inesperado al escribir agregados por ventana")
+
 # --- 10. Ejecución Principal ---
 
 def main():
@@ -750,15 +1446,53 @@ def main():
         return
 
     # 3. Iniciar thread de flush periódico
+    global espool
+    espool = EspoolDisco()
+    if espool.bytes:
+        logger.info(f"💾 Espool con {espool.bytes / 1e6:.1f} MB pendientes de reescribir a InfluxDB.")
     flush_thread = threading.Thread(target=periodic_flush_thread, daemon=True)
     flush_thread.start()
     logger.info("✅ Thread de flush periódico (Influx) iniciado")
 
+    backfill_thread = threading.Thread(target=backfill_flush_thread, daemon=True)
+    backfill_thread.start()
+    logger.info(f"✅ Carril de backfill iniciado (lotes de {BACKFILL_BATCH_SIZE}, máx {BACKFILL_MAX_PUNTOS_S:g} puntos/s)")
+
+    threading.Thread(target=metrics_thread, daemon=True).start()
+
+    threading.Thread(target=grace_flush_thread, daemon=True).start()
+    logger.info("✅ Thread del búfer de gracia (chunks en PostgreSQL) iniciado")
+
+    for numero in range(TRABAJOS_WORKERS):
+        threading.Thread(target=job_worker_thread, args=(numero,), daemon=True).start()
+    logger.info(f"✅ Pool de trabajos de reenvío/purga iniciado ({TRABAJOS_WORKERS} workers)")
+
+    presence_thread = threading.Thread(target=presence_flush_thread, daemon=True)
+    presence_thread.start()
+    logger.info(f"✅ Thread de presencia de dispositivos iniciado (cada {PRESENCIA_FLUSH_S:g}s)")
+
+    if integrador_energia is not None:
+        if not INFLUX_BUCKET_ROLLUP:
+            logger.critical("❌ CRÍTICO: ENERGIA_EN_RECEPTOR requiere INFLUX_BUCKET_ROLLUP. Abortando.")
+            return
+        energy_thread = threading.Thread(target=energy_flush_thread, daemon=True)
+        energy_thread.start()
+        logger.info(f"✅ Thread de energía por hora iniciado (cada {ENERGIA_FLUSH_S:g}s)")
+
+    if agregador_ventanas is not None:
+        window_thread = threading.Thread(target=window_flush_thread, daemon=True)
+        window_thread.start()
+        logger.info(f"✅ Thread de agregados por ventana iniciado ({INFLUX_BUCKET_REDUCIDO})")
+
     # 4. Configurar cliente MQTT
+    global mqtt_client
     client = mqtt.Client(
         mqtt.CallbackAPIVersion.VERSION1, 
-        client_id="receptor_servidor_lete_v5" # Nuevo Client ID
+        client_id=MQTT_CLIENT_ID,
+        clean_session=not MQTT_SESION_PERSISTENTE,
+        manual_ack=MQTT_SESION_PERSISTENTE
     )
+    mqtt_client = client
     
     if MQTT_USERNAME and MQTT_PASSWORD:
         client.username_pw_set(MQTT_USERNAME, MQTT_PASSWORD)
@@ -785,6 +1519,8 @@ def main():
     logger.info(f"📊 Batching (Influx): {BATCH_SIZE} mediciones o {BATCH_TIMEOUT}s")
     logger.info(f"💡 Lógica de Suscripción: TTL de caché de {CACHE_TTL_SECONDS}s, Gracia de {GRACE_PERIOD_DAYS} días.")
     logger.info(f"☣️ Protección Anti-Bloqueo (Poison Pill) ACTIVADA.")
+    if MQTT_SESION_PERSISTENTE:
+        logger.info(f"📬 Entrega al menos una vez: sesión persistente '{MQTT_CLIENT_ID}', QoS 1, ack tras escritura.")
     logger.info("=" * 60 + "\n")
     
     try:
@@ -793,6 +1529,25 @@ def main():
         logger.info("\n\n🛑 Detectado (Ctrl+C). Cerrando sistema...")
         logger.info("📤 Enviando últimas mediciones pendientes (Influx)...")
         flush_buffer_to_influx()
+        while carril_backfill.buffer and flush_buffer_to_influx(carril_backfill):
+            pass
+        try:
+            save_grace_chunks(db_conn, forzar=True)
+        except Exception as e:
+            logger.error(f"❌ No se pudieron guardar las mediciones de gracia pendientes: {e}")
+        try:
+            registro_presencia.volcar(db_conn)
+        except Exception as e:
+            logger.error(f"❌ No se pudo volcar la presencia de dispositivos: {e}")
+        try:
+            registro_horas.volcar(db_conn)
+        except Exception as e:
+            logger.error(f"❌ No se pudieron marcar las horas tardías pendientes: {e}")
+        if integrador_energia is not None:
+            try:
+                write_energy_hours()
+            except Exception as e:
+                logger.error(f"❌ No se pudieron escribir los kWh por hora: {e}")
     except Exception:
         logger.exception("❌ ERROR CRÍTICO INESPERADO EN EL BUCLE PRINCIPAL")
     finally:
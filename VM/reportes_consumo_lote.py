@@ -0,0 +1,203 @@
+#!/usr/bin/env python3
+"""
+REPORTES DE CONSUMO EN LOTE (analizar_consumo.py para muchos clientes)
+
+Genera el reporte de analizar_consumo.py para muchas exportaciones:
+1. Una exportación por dispositivo (varios CSV), o exportaciones con varios
+   dispositivos que se separan por la columna 'device_id' (--multidispositivo).
+2. Cada dispositivo se analiza en un pool de procesos; cada proceso dibuja
+   sus gráficas sin ventanas reutilizando una sola figura (grafica_consumo.py).
+3. Por dispositivo escribe <device_id>.txt (el reporte impreso),
+   <device_id>.json (las métricas) y la gráfica (<device_id>.png, .svg o
+   .webp; --formato-grafica ninguno la omite).
+4. Imprime el tiempo de cada dispositivo por fase y el total del lote.
+
+Uso: python reportes_consumo_lote.py export1.csv [export2.csv ...] --salida reportes/
+     [--workers 4] [--multidispositivo] [--dias 7] [--sin-cache] [--formato-grafica png]
+"""
+
+# --- 1. LIBRERÍAS ---
+import os
+import io
+import re
+import sys
+import json
+import time
+import argparse
+import contextlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import pandas as pd
+
+import analizar_consumo as ac
+from cargador_consumo import cargar_consumo
+
+# --- 2. Configuración ---
+REPORTES_WORKERS = int(os.environ.get("REPORTES_WORKERS", os.cpu_count() or 1))
+SIN_GRAFICA = 'ninguno'
+
+
+# --- 3. Tareas ---
+
+def _nombre_archivo(device_id):
+    return re.sub(r'[^A-Za-z0-9_.-]', '_', str(device_id))
+
+
+def _ultimos_dias(df, dias):
+    if not dias or df.empty:
+        return df
+    return df[df.index >= df.index.max() - pd.Timedelta(days=dias)]
+
+
+def metricas_a_json(m):
+    """Versión serializable de las métricas (sin la serie horaria de la gráfica)."""
+    return {
+        'muestras': int(m['muestras']),
+        'consumo_promedio_w': float(m['consumo_promedio_w']),
+        'consumo_maximo_w': float(m['consumo_maximo_w']),
+        'fecha_consumo_maximo': m['fecha_consumo_maximo'].isoformat(),
+        'hora_pico_promedio': m['hora_pico_promedio'],
+        'hora_valle_promedio': m['hora_valle_promedio'],
+        'consumo_base_w': float(m['consumo_base_w']),
+        'costo_fantasma_mes': float(m['costo_fantasma_mes']),
+        'factor_potencia_promedio': float(m['factor_potencia_promedio']),
+        'eventos_encendido': [
+            {'fecha': e['fecha'].isoformat(), 'watts': float(e['escalon_w']),
+             'clasificacion': ac.clasificar_pico(e['escalon_w']),
+             'duracion_s': None if np.isnan(e['duracion_s']) else float(e['duracion_s']),
+             'energia_kwh': None if np.isnan(e['energia_kwh']) else float(e['energia_kwh'])}
+            for e in m['eventos_encendido']
+        ],
+        'total_encendidos': int(m['total_encendidos']),
+        'resumen_eventos': m['resumen_eventos'],
+        'picos_absolutos': [
+            {'fecha': timestamp.isoformat(), 'watts': float(watts)}
+            for timestamp, watts in m['top_picos_absolutos'].items()
+        ],
+    }
+
+
+def generar_reporte(device_id, datos, salida, dias=None, usar_cache=True, formato_grafica='png'):
+    """
+    [EJECUTADO EN EL POOL] Analiza un dispositivo y escribe sus archivos.
+    'datos' es la ruta de su exportación o un DataFrame ya separado.
+    Devuelve un diccionario con los tiempos por fase (o el error).
+    """
+    tiempos = {'device_id': device_id, 'error': None}
+    inicio = time.perf_counter()
+    try:
+        if isinstance(datos, str):
+            with contextlib.redirect_stdout(io.StringIO()):
+                datos = cargar_consumo(datos, usar_cache=usar_cache)
+        df = _ultimos_dias(datos, dias)
+        tiempos['carga'] = time.perf_counter() - inicio
+        if df.empty:
+            raise ValueError("sin datos válidos")
+        tiempos['muestras'] = len(df)
+
+        marca = time.perf_counter()
+        metricas = ac.calcular_metricas(df)
+        tiempos['metricas'] = time.perf_counter() - marca
+
+        marca = time.perf_counter()
+        base = os.path.join(salida, _nombre_archivo(device_id))
+        texto = io.StringIO()
+        with contextlib.redirect_stdout(texto):
+            ac.imprimir_reporte(metricas)
+        with open(f"{base}.txt", 'w', encoding='utf-8') as f:
+            f.write(texto.getvalue())
+        with open(f"{base}.json", 'w', encoding='utf-8') as f:
+            json.dump({'device_id': device_id, **metricas_a_json(metricas)}, f, ensure_ascii=False, indent=2)
+        tiempos['reporte'] = time.perf_counter() - marca
+
+        marca = time.perf_counter()
+        if formato_grafica != SIN_GRAFICA:
+            with contextlib.redirect_stdout(io.StringIO()):
+                ac.generar_grafica(metricas, f"{base}.{formato_grafica}")
+        tiempos['grafica'] = time.perf_counter() - marca
+    except Exception as e:
+        tiempos['error'] = str(e)
+    tiempos['total'] = time.perf_counter() - inicio
+    return tiempos
+
+
+def preparar_tareas(rutas, multidispositivo=False, usar_cache=True):
+    """
+    Lista de (device_id, datos). Con 'multidispositivo' cada exportación se
+    carga una vez aquí y se separa por 'device_id'; si no, cada worker carga
+    su propio archivo (el device_id es el nombre del archivo).
+    """
+    tareas = []
+    for ruta in rutas:
+        if not multidispositivo:
+            tareas.append((os.path.splitext(os.path.basename(ruta))[0], ruta))
+            continue
+        df = cargar_consumo(ruta, usar_cache=usar_cache)
+        if 'device_id' not in df.columns:
+            print(f"ADVERTENCIA: {ruta} no tiene columna 'device_id'. Se trata como un solo dispositivo.")
+            tareas.append((os.path.splitext(os.path.basename(ruta))[0], df))
+            continue
+        for device_id, datos in df.groupby('device_id', observed=True):
+            tareas.append((str(device_id), datos.drop(columns='device_id')))
+    return tareas
+
+
+def procesar_lote(tareas, salida, workers=REPORTES_WORKERS, dias=None, usar_cache=True,
+                  formato_grafica='png', mostrar_progreso=True):
+    """Ejecuta generar_reporte() en un pool de procesos. Devuelve (resultados, segundos)."""
+    os.makedirs(salida, exist_ok=True)
+    inicio = time.perf_counter()
+    resultados = []
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futuros = [pool.submit(generar_reporte, device_id, datos, salida, dias, usar_cache, formato_grafica)
+                   for device_id, datos in tareas]
+        for futuro in as_completed(futuros):
+            resultado = futuro.result()
+            resultados.append(resultado)
+            if mostrar_progreso:
+                _imprimir_fila(resultado)
+    return resultados, time.perf_counter() - inicio
+
+
+def _imprimir_fila(r):
+    if r['error']:
+        print(f"  ❌ {r['device_id']:<16} error: {r['error']}")
+        return
+    print(f"  ✅ {r['device_id']:<16} {r['muestras']:>9,} {r['carga']:8.2f} {r['metricas']:9.2f} "
+          f"{r['reporte']:8.2f} {r['grafica']:8.2f} {r['total']:8.2f}")
+
+
+# --- 4. Ejecución Principal ---
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('exportaciones', nargs='+')
+    parser.add_argument('--salida', default='reportes_consumo')
+    parser.add_argument('--workers', type=int, default=REPORTES_WORKERS)
+    parser.add_argument('--multidispositivo', action='store_true',
+                        help="Separa cada exportación por la columna 'device_id'.")
+    parser.add_argument('--dias', type=int, default=None, help="Analiza solo los últimos N días de cada dispositivo.")
+    parser.add_argument('--sin-cache', action='store_true')
+    parser.add_argument('--formato-grafica', choices=['png', 'svg', 'webp', SIN_GRAFICA], default='png')
+    args = parser.parse_args()
+
+    print("=" * 60)
+    print(f"--- REPORTES DE CONSUMO EN LOTE ({args.workers} procesos) ---")
+    tareas = preparar_tareas(args.exportaciones, args.multidispositivo, usar_cache=not args.sin_cache)
+    print(f"{len(tareas)} dispositivos -> {os.path.abspath(args.salida)}\n")
+    print(f"     {'device_id':<16} {'muestras':>9} {'carga':>8} {'métricas':>9} {'reporte':>8} {'gráfica':>8} {'total':>8}")
+
+    resultados, segundos = procesar_lote(tareas, args.salida, args.workers, args.dias,
+                                         not args.sin_cache, args.formato_grafica)
+
+    errores = sum(1 for r in resultados if r['error'])
+    suma = sum(r['total'] for r in resultados)
+    print(f"\n--- Lote completado en {segundos:.2f}s: {len(resultados) - errores} reportes, {errores} con error "
+          f"(suma por dispositivo {suma:.2f}s, paralelismo efectivo {suma / segundos if segundos else 0:.1f}x) ---")
+    print("=" * 60)
+    return 1 if errores else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -------------------------------------------------------------------
+# Job de Acumulados Horarios de Energía (rollup) v2
+# - Integra la potencia cruda (INFLUX_BUCKET_NEW) hora por hora y guarda
+#   los kWh de cada dispositivo como 'energia_kwh_hora' en INFLUX_BUCKET_ROLLUP.
+# - Avanza con un watermark ('rollup_estado'): cada corrida solo procesa
+#   las horas cerradas desde la última ejecución.
+# - consumo_energia.py suma estas filas en lugar de integrar ~60 días de
+#   datos crudos en cada consulta de periodo.
+# - Recalcula las horas ya consolidadas que recibieron datos tardíos
+#   (marcadas por receptor_mqtt.py en 'horas_recalculo_pendiente') y
+#   corrige 'acumulado_periodo' con la diferencia, sin rehacer el periodo.
+# - Actualiza los perfiles de carga por dispositivo (perfil_carga.py)
+#   con las mismas horas cerradas.
+# - Con ENERGIA_EN_RECEPTOR=true, receptor_mqtt.py ya escribe las horas al
+#   cerrarlas (integrador_energia.py): aquí solo se avanza el watermark y se
+#   recalculan las horas que el receptor marcó como no cubiertas.
+# - Pensado para cron (ej. cada 10 minutos).
+# -------------------------------------------------------------------
+
+# --- 1. Importaciones ---
+import os
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+import psycopg2
+from dotenv import load_dotenv
+from influxdb_client import Point, WritePrecision
+from influxdb_client.client.write_api import SYNCHRONOUS
+
+import consumo_energia as ce
+import perfil_carga as pc
+from integrador_energia import ENERGIA_EN_RECEPTOR
+
+# --- 2. Configuración ---
+load_dotenv()
+
+# Margen para considerar "cerrada" una hora (datos que llegan con retraso)
+ROLLUP_RETRASO_S = int(os.environ.get("ROLLUP_RETRASO_S", 300))
+# Días a consolidar en la primera ejecución (un bimestre + holgura)
+ROLLUP_DIAS_INICIALES = int(os.environ.get("ROLLUP_DIAS_INICIALES", 62))
+# Horas por consulta a InfluxDB
+ROLLUP_HORAS_POR_LOTE = int(os.environ.get("ROLLUP_HORAS_POR_LOTE", 24))
+# Máximo de horas tardías a recalcular por corrida (el resto queda para la siguiente)
+ROLLUP_MAX_HORAS_RECALCULO = int(os.environ.get("ROLLUP_MAX_HORAS_RECALCULO", 500))
+
+DB_HOST = os.environ.get("DB_HOST")
+DB_USER = os.environ.get("DB_USER")
+DB_PASS = os.environ.get("DB_PASS")
+DB_NAME = os.environ.get("DB_NAME")
+DB_PORT = os.environ.get("DB_PORT", "5432")
+
+
+# --- 3. Funciones ---
+
+def consultar_kwh_por_hora(query_api, inicio, fin, device_id=None):
+    """
+    Integra la potencia cruda por ventanas de 1 hora en [inicio, fin).
+    Devuelve {(device_id, hora_utc): (kwh, muestras)}.
+    """
+    filtro_dispositivo = f'|> filter(fn: (r) => r.device_id == "{device_id}")' if device_id else ''
+    flux_query = f"""
+    datos = from(bucket: "{ce.INFLUX_BUCKET}")
+      |> range(start: {inicio.isoformat()}, stop: {fin.isoformat()})
+      |> filter(fn: (r) => r._measurement == "energia")
+      |> filter(fn: (r) => r._field == "power")
+      {filtro_dispositivo}
+
+    datos
+      |> aggregateWindow(every: 1h, fn: (column, tables=<-) => tables |> integral(unit: 1s, column: column), timeSrc: "_start", createEmpty: false)
+      |> map(fn: (r) => ({{ r with _value: r._value / 3600000.0 }}))
+      |> yield(name: "kwh")
+
+    datos
+      |> aggregateWindow(every: 1h, fn: count, timeSrc: "_start", createEmpty: false)
+      |> yield(name: "muestras")
+    """
+    resultado = {}
+    muestras = {}
+    for table in query_api.query(query=flux_query):
+        for record in table.records:
+            llave = (record.values.get('device_id'), record.get_time())
+            if record.values.get('result') == 'muestras':
+                muestras[llave] = int(record.get_value())
+            else:
+                resultado[llave] = float(record.get_value())
+    return {llave: (kwh, muestras.get(llave, 0)) for llave, kwh in resultado.items()}
+
+
+def escribir_horas(write_api, horas):
+    """Escribe (o sobreescribe) las filas horarias en el bucket de rollup."""
+    puntos = [
+        Point(ce.MEDICION_KWH_HORA)
+            .tag("device_id", device_id)
+            .field("kwh", kwh)
+            .field("muestras", muestras)
+            .time(hora, WritePrecision.S)
+        for (device_id, hora), (kwh, muestras) in horas.items()
+    ]
+    if puntos:
+        write_api.write(bucket=ce.INFLUX_BUCKET_ROLLUP, org=ce.INFLUX_ORG, record=puntos)
+    return len(puntos)
+
+
+def escribir_watermark(write_api, watermark):
+    punto = Point(ce.MEDICION_ROLLUP_ESTADO) \
+        .field("watermark_unix", int(watermark.timestamp())) \
+        .time(datetime.now(timezone.utc), WritePrecision.S)
+    write_api.write(bucket=ce.INFLUX_BUCKET_ROLLUP, org=ce.INFLUX_ORG, record=punto)
+
+
+def leer_horas_rollup(query_api, device_id, inicio, fin):
+    """kWh horarios ya consolidados de un dispositivo en [inicio, fin): {hora_utc: kwh}."""
+    flux_query = f"""
+    from(bucket: "{ce.INFLUX_BUCKET_ROLLUP}")
+      |> range(start: {inicio.isoformat()}, stop: {fin.isoformat()})
+      |> filter(fn: (r) => r._measurement == "{ce.MEDICION_KWH_HORA}")
+      |> filter(fn: (r) => r._field == "kwh")
+      |> filter(fn: (r) => r.device_id == "{device_id}")
+    """
+    horas = {}
+    for table in query_api.query(query=flux_query):
+        for record in table.records:
+            horas[record.get_time()] = float(record.get_value())
+    return horas
+
+
+def _tramos_contiguos(horas):
+    """Agrupa horas ordenadas en tramos consecutivos [(inicio, fin_exclusivo), ...]."""
+    tramos = []
+    for hora in sorted(horas):
+        if tramos and tramos[-1][1] == hora:
+            tramos[-1][1] = hora + timedelta(hours=1)
+        else:
+            tramos.append([hora, hora + timedelta(hours=1)])
+    return tramos
+
+
+def recalcular_horas_tardias(conn, query_api, write_api, watermark):
+    """
+    Recalcula las horas consolidadas (< watermark) que recibieron datos tardíos,
+    reescribe sus filas horarias y aplica la diferencia al acumulado del periodo.
+    Las horas aún no consolidadas solo se descartan de la lista (el rollup normal
+    las procesará); con ENERGIA_EN_RECEPTOR se conservan hasta cerrarse, porque
+    son horas que el receptor no integró. Devuelve el número de horas recalculadas.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "SELECT device_id, hora, registrado FROM horas_recalculo_pendiente ORDER BY hora LIMIT %s",
+            (ROLLUP_MAX_HORAS_RECALCULO,)
+        )
+        pendientes = cursor.fetchall()
+    if not pendientes:
+        return 0
+
+    # hora -> 'registrado' leído: una marca renovada después (datos que
+    # llegaron mientras se recalculaba) no se borra
+    por_dispositivo = defaultdict(dict)
+    for device_id, hora, registrado in pendientes:
+        por_dispositivo[device_id][hora.astimezone(timezone.utc)] = registrado
+
+    recalculadas = 0
+    for device_id, horas in por_dispositivo.items():
+        horas_cerradas = {h for h in horas if h < watermark}
+        deltas = {}
+        for inicio, fin in _tramos_contiguos(horas_cerradas):
+            nuevas = consultar_kwh_por_hora(query_api, inicio, fin, device_id)
+            anteriores = leer_horas_rollup(query_api, device_id, inicio, fin)
+            escribir_horas(write_api, nuevas)
+            for (_, hora), (kwh, _) in nuevas.items():
+                deltas[hora] = kwh - anteriores.get(hora, 0.0)
+        delta_total = ce.ajustar_acumulado(conn, device_id, deltas) if deltas else 0.0
+        horas_borrar = sorted(horas_cerradas if ENERGIA_EN_RECEPTOR else horas)
+        with conn.cursor() as cursor:
+            cursor.execute(
+                """
+                DELETE FROM horas_recalculo_pendiente h
+                USING unnest(%s::timestamptz[], %s::timestamptz[]) AS leidas(hora, registrado)
+                WHERE h.device_id = %s AND h.hora = leidas.hora AND (h.registrado <= leidas.registrado OR h.registrado IS NULL)
+                """,
+                (horas_borrar, [horas[h] for h in horas_borrar], device_id)
+            )
+        conn.commit()
+        recalculadas += len(horas_cerradas)
+        if horas_cerradas:
+            print(f"🔁 {device_id}: {len(horas_cerradas)} horas tardías recalculadas (ajuste {delta_total:+.3f} kWh).")
+    return recalculadas
+
+
+# --- 4. Ejecución Principal ---
+def main():
+    print("=" * 50)
+    print(f"--- Iniciando ROLLUP de energía v2 ({datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')} UTC) ---")
+
+    if not ce.INFLUX_BUCKET_ROLLUP:
+        print("❌ INFLUX_BUCKET_ROLLUP no está configurado en .env. Abortando.")
+        return
+
+    client = ce.obtener_cliente_influx()
+    query_api = client.query_api()
+    write_api = client.write_api(write_options=SYNCHRONOUS)
+
+    ahora = datetime.now(timezone.utc)
+    hasta = (ahora - timedelta(seconds=ROLLUP_RETRASO_S)).replace(minute=0, second=0, microsecond=0)
+    watermark = ce.obtener_watermark_rollup(usar_cache=False)
+    integrar = True
+    if watermark is None:
+        watermark = (hasta - timedelta(days=ROLLUP_DIAS_INICIALES))
+        print(f"INFO: Primera ejecución. Consolidando desde {watermark.isoformat()}.")
+    elif ENERGIA_EN_RECEPTOR:
+        integrar = False
+
+    total_filas = 0
+    conn = None
+    try:
+        if not integrar and watermark < hasta:
+            # receptor_mqtt.py ya escribió estas horas al cerrarlas
+            escribir_watermark(write_api, hasta)
+            print(f"✅ {watermark.isoformat()} -> {hasta.isoformat()}: horas integradas por el receptor.")
+            watermark = hasta
+        while watermark < hasta:
+            fin_lote = min(watermark + timedelta(hours=ROLLUP_HORAS_POR_LOTE), hasta)
+            horas = consultar_kwh_por_hora(query_api, watermark, fin_lote)
+            total_filas += escribir_horas(write_api, horas)
+            escribir_watermark(write_api, fin_lote)
+            print(f"✅ {watermark.isoformat()} -> {fin_lote.isoformat()}: {len(horas)} filas horarias.")
+            watermark = fin_lote
+
+        conn = psycopg2.connect(host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASS, dbname=DB_NAME)
+        ce.asegurar_esquema_acumulados(conn)
+        recalculadas = recalcular_horas_tardias(conn, query_api, write_api, watermark)
+        if recalculadas:
+            print(f"✅ {recalculadas} horas con datos tardíos recalculadas.")
+
+        # Perfiles de carga (vigilante_calidad.py, analizar_consumo.py): mismas horas cerradas
+        try:
+            horas_perfil = pc.actualizar_perfiles(conn, query_api, ce.INFLUX_BUCKET, watermark)
+            print(f"✅ Perfiles de carga actualizados ({horas_perfil} horas-dispositivo).")
+        except Exception as e:
+            conn.rollback()
+            print(f"⚠️  No se pudieron actualizar los perfiles de carga (se reintentará): {e}")
+    except Exception as e:
+        print(f"❌ ERROR durante el rollup (se reanudará desde {watermark.isoformat()}): {e}")
+    finally:
+        if conn: conn.close()
+        ce.cerrar_cliente_influx()
+
+    print(f"\n--- ROLLUP completado. {total_filas} filas escritas. Watermark: {watermark.isoformat()} ---")
+    print("=" * 50)
+
+
+if __name__ == "__main__":
+    main()
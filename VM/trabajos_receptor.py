@@ -0,0 +1,232 @@
+"""
+COLA DE TRABAJOS DEL RECEPTOR (módulo compartido)
+
+Cuando una suscripción pasa de gracia a activa (reenvío del búfer de gracia)
+o de gracia a expirada (purga), receptor_mqtt.py ya no abre un thread y una
+conexión por transición: encola un trabajo en 'trabajos_receptor' y un pool
+fijo de TRABAJOS_WORKERS threads (cada uno con su conexión) los ejecuta.
+- Dedupe: un dispositivo tiene a lo más un trabajo pendiente de cada tipo;
+  repetir el disparo no agrega otro.
+- Orden: los de un mismo dispositivo corren de uno en uno y en el orden en
+  que se encolaron; entre dispositivos va primero el reenvío (prioridad 0)
+  que la purga (1).
+- Reintentos con espera exponencial hasta TRABAJOS_MAX_INTENTOS y después
+  'fallido'. Un 'ejecutando' sin actualizar en TRABAJOS_TIMEOUT_S (caída del
+  receptor) se vuelve a reclamar.
+- El estado vive en PostgreSQL, así que sobrevive a reinicios; la duración
+  de cada trabajo queda en la fila y en MetricasTrabajos.
+"""
+
+import os
+import time
+import threading
+from collections import defaultdict
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# --- 1. Configuración ---
+
+TRABAJOS_WORKERS = int(os.environ.get("TRABAJOS_WORKERS", 2))
+TRABAJOS_MAX_INTENTOS = int(os.environ.get("TRABAJOS_MAX_INTENTOS", 6))
+# Espera base entre reintentos (se duplica en cada intento)
+TRABAJOS_ESPERA_REINTENTO_S = int(os.environ.get("TRABAJOS_ESPERA_REINTENTO_S", 30))
+# Segundos sin actualizar tras los que un 'ejecutando' se considera abandonado
+TRABAJOS_TIMEOUT_S = int(os.environ.get("TRABAJOS_TIMEOUT_S", 1800))
+# Pausa de un worker cuando no hay trabajos listos (un encolado lo despierta antes)
+TRABAJOS_ESPERA_VACIO_S = float(os.environ.get("TRABAJOS_ESPERA_VACIO_S", 5))
+# Días que se conservan los trabajos terminados
+TRABAJOS_RETENCION_DIAS = int(os.environ.get("TRABAJOS_RETENCION_DIAS", 7))
+
+TIPO_REENVIO = 'reenvio'
+TIPO_PURGA = 'purga'
+PRIORIDAD = {TIPO_REENVIO: 0, TIPO_PURGA: 1}
+
+ESTADO_PENDIENTE = 'pendiente'
+ESTADO_EJECUTANDO = 'ejecutando'
+ESTADO_HECHO = 'hecho'
+ESTADO_FALLIDO = 'fallido'
+
+
+# --- 2. Esquema ---
+
+def asegurar_esquema_trabajos(conn):
+    """Crea la tabla de trabajos y sus índices si no existen. No hace commit."""
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS trabajos_receptor (
+                id BIGSERIAL PRIMARY KEY,
+                device_id VARCHAR(20) NOT NULL,
+                tipo VARCHAR(10) NOT NULL,
+                prioridad SMALLINT NOT NULL,
+                estado VARCHAR(10) NOT NULL DEFAULT 'pendiente',
+                intentos INTEGER NOT NULL DEFAULT 0,
+                ultimo_error TEXT,
+                resultado BIGINT,
+                duracion_s REAL,
+                proximo_intento TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                creado TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                actualizado TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+                terminado TIMESTAMPTZ
+            )
+        """)
+        cursor.execute("""
+            CREATE UNIQUE INDEX IF NOT EXISTS idx_trabajos_receptor_dedupe
+            ON trabajos_receptor (device_id, tipo) WHERE estado = 'pendiente'
+        """)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_trabajos_receptor_activos
+            ON trabajos_receptor (prioridad, id) WHERE estado IN ('pendiente', 'ejecutando')
+        """)
+
+
+# --- 3. Cola ---
+
+def encolar_trabajo(conn, device_id, tipo):
+    """Encola un trabajo (si ya hay uno pendiente igual no hace nada). Devuelve True si es nuevo. No hace commit."""
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            INSERT INTO trabajos_receptor (device_id, tipo, prioridad) VALUES (%s, %s, %s)
+            ON CONFLICT (device_id, tipo) WHERE estado = 'pendiente' DO NOTHING
+            RETURNING id
+        """, (device_id, tipo, PRIORIDAD[tipo]))
+        return cursor.fetchone() is not None
+
+
+def reclamar_trabajo(conn):
+    """
+    Marca como 'ejecutando' el siguiente trabajo listo y lo devuelve como
+    (id, device_id, tipo, intentos), o None. Hace commit.
+    """
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            UPDATE trabajos_receptor
+            SET estado = %s, intentos = intentos + 1, actualizado = NOW()
+            WHERE id = (
+                SELECT t.id FROM trabajos_receptor t
+                WHERE (t.estado = %s AND t.proximo_intento <= NOW()
+                       AND NOT EXISTS (
+                           SELECT 1 FROM trabajos_receptor o
+                           WHERE o.device_id = t.device_id AND o.id <> t.id
+                             AND (o.estado = %s OR (o.estado = %s AND o.id < t.id))
+                       ))
+                   OR (t.estado = %s AND t.actualizado < NOW() - make_interval(secs => %s))
+                ORDER BY t.prioridad, t.id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, device_id, tipo, intentos
+        """, (ESTADO_EJECUTANDO, ESTADO_PENDIENTE, ESTADO_EJECUTANDO, ESTADO_PENDIENTE,
+              ESTADO_EJECUTANDO, TRABAJOS_TIMEOUT_S))
+        trabajo = cursor.fetchone()
+    conn.commit()
+    return trabajo
+
+
+def terminar_trabajo(conn, id_trabajo, duracion_s, resultado=None):
+    """Marca un trabajo como 'hecho'. Hace commit."""
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            UPDATE trabajos_receptor
+            SET estado = %s, resultado = %s, duracion_s = %s, ultimo_error = NULL,
+                actualizado = NOW(), terminado = NOW()
+            WHERE id = %s
+        """, (ESTADO_HECHO, resultado, duracion_s, id_trabajo))
+    conn.commit()
+
+
+def fallar_trabajo(conn, id_trabajo, intentos, error, duracion_s):
+    """
+    Programa el reintento de un trabajo fallido (o lo marca 'fallido' al
+    agotar TRABAJOS_MAX_INTENTOS). Devuelve el estado nuevo. Hace commit.
+    """
+    estado = ESTADO_FALLIDO if intentos >= TRABAJOS_MAX_INTENTOS else ESTADO_PENDIENTE
+    espera_s = TRABAJOS_ESPERA_REINTENTO_S * 2 ** (intentos - 1)
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            UPDATE trabajos_receptor
+            SET estado = %s, ultimo_error = %s, duracion_s = %s, actualizado = NOW(),
+                proximo_intento = NOW() + make_interval(secs => %s),
+                terminado = CASE WHEN %s = 'fallido' THEN NOW() END
+            WHERE id = %s
+        """, (estado, str(error)[:500], duracion_s, espera_s, estado, id_trabajo))
+    conn.commit()
+    return estado
+
+
+def profundidad_cola(conn):
+    """{'pendientes_<tipo>': n, 'ejecutando': n} de los trabajos activos. No hace commit."""
+    profundidad = {f"pendientes_{tipo}": 0 for tipo in PRIORIDAD}
+    profundidad['ejecutando'] = 0
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            SELECT tipo, estado, COUNT(*) FROM trabajos_receptor
+            WHERE estado IN ('pendiente', 'ejecutando')
+            GROUP BY tipo, estado
+        """)
+        for tipo, estado, n in cursor.fetchall():
+            if estado == ESTADO_EJECUTANDO:
+                profundidad['ejecutando'] += n
+            else:
+                profundidad[f"pendientes_{tipo}"] = n
+    return profundidad
+
+
+def limpiar_terminados(conn, dias=TRABAJOS_RETENCION_DIAS):
+    """Borra los trabajos terminados hace más de 'dias'. Devuelve cuántos. No hace commit."""
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            DELETE FROM trabajos_receptor
+            WHERE estado IN ('hecho', 'fallido') AND terminado < NOW() - make_interval(days => %s)
+        """, (dias,))
+        return cursor.rowcount
+
+
+# --- 4. Métricas ---
+
+class MetricasTrabajos:
+    """
+    Duración de los trabajos ejecutados desde el último reporte (por tipo) y
+    la última profundidad de cola leída por un worker (thread-safe).
+    """
+
+    def __init__(self, intervalo_profundidad_s=60):
+        self.lock = threading.Lock()
+        self.intervalo_profundidad_s = intervalo_profundidad_s
+        self.ultima_profundidad = 0.0
+        self.profundidad = {}
+        self.duraciones = defaultdict(list)
+        self.fallos = defaultdict(int)
+
+    def registrar(self, tipo, duracion_s, ok=True):
+        with self.lock:
+            self.duraciones[tipo].append(duracion_s)
+            if not ok:
+                self.fallos[tipo] += 1
+
+    def toca_profundidad(self):
+        """True una vez por intervalo: el worker que lo recibe lee la profundidad."""
+        ahora = time.monotonic()
+        with self.lock:
+            if ahora - self.ultima_profundidad < self.intervalo_profundidad_s:
+                return False
+            self.ultima_profundidad = ahora
+            return True
+
+    def fijar_profundidad(self, profundidad):
+        with self.lock:
+            self.profundidad = dict(profundidad)
+
+    def tomar(self):
+        """Campos para el reporte: profundidad y, por tipo, ejecutados/fallidos/duración media y máxima."""
+        with self.lock:
+            duraciones, self.duraciones = self.duraciones, defaultdict(list)
+            fallos, self.fallos = self.fallos, defaultdict(int)
+            campos = dict(self.profundidad)
+        for tipo, valores in duraciones.items():
+            campos[f"{tipo}_ejecutados"] = len(valores)
+            campos[f"{tipo}_fallidos"] = fallos.get(tipo, 0)
+            campos[f"{tipo}_duracion_media_s"] = sum(valores) / len(valores)
+            campos[f"{tipo}_duracion_max_s"] = max(valores)
+        return campos
@@ -0,0 +1,203 @@
+"""
+VENTANA MÓVIL DE ESTADÍSTICAS INCREMENTALES (por dispositivo)
+
+Estructura reutilizable para mantener una ventana de tiempo sobre una
+variable (vrms, leakage, power, ...) con memoria fija y conocida:
+
+- Buffers circulares NumPy de 'capacidad' muestras (ts + valor = 16 bytes c/u)
+  más un histograma de 'bins_histograma' contadores (8 bytes c/u).
+- agregar(): O(1) amortizado. Actualiza suma, suma de cuadrados, conteos
+  sobre/bajo umbral, histograma y las colas monótonas de mínimo/máximo.
+- Consultas: conteos, media, varianza, mínimo y máximo en O(1);
+  cuantiles aproximados en O(bins) (constante) con resolución de
+  (rango / bins); cuantil exacto disponible en O(n) para verificación.
+
+Ejemplo (ventana de 1 hora de vrms a 2s):
+    v = VentanaMovil(3600, umbrales_sobre=(139.7,), umbrales_bajo=(114.3,))
+    v.agregar(ts_unix, vrms)
+    v.contar_sobre(139.7), v.media(), v.cuantil(0.25)
+"""
+
+from collections import deque
+
+import numpy as np
+
+PERIODO_MUESTREO_S = 2 # El firmware reporta cada 2 segundos
+
+
+class VentanaMovil:
+    """Ventana de tiempo con estadísticas incrementales sobre una variable."""
+
+    def __init__(self, ventana_s, capacidad=None, umbrales_sobre=(), umbrales_bajo=(),
+                 rango_histograma=(0.0, 1.0), bins_histograma=0):
+        self.ventana_s = ventana_s
+        if capacidad is None:
+            # Holgura del 25% sobre el número nominal de muestras
+            capacidad = int(ventana_s / PERIODO_MUESTREO_S * 1.25) + 1
+        self.capacidad = capacidad
+
+        self._ts = np.zeros(capacidad, dtype=np.float64)
+        self._valores = np.zeros(capacidad, dtype=np.float64)
+        self._inicio = 0
+        self.n = 0
+        # Número de secuencia global de la muestra más antigua (para min/max)
+        self._seq_inicio = 0
+
+        self._suma = 0.0
+        self._suma_cuadrados = 0.0
+        self._expulsiones = 0
+
+        self._sobre = {float(u): 0 for u in umbrales_sobre}
+        self._bajo = {float(u): 0 for u in umbrales_bajo}
+
+        # Colas monótonas de (seq, valor)
+        self._cola_min = deque()
+        self._cola_max = deque()
+
+        self._bins = bins_histograma
+        if bins_histograma:
+            self._hist_min, self._hist_max = rango_histograma
+            self._ancho_bin = (self._hist_max - self._hist_min) / bins_histograma
+            self._histograma = np.zeros(bins_histograma, dtype=np.int64)
+        else:
+            self._histograma = None
+
+    def memoria_bytes(self):
+        """Memoria de los arreglos NumPy de esta ventana."""
+        total = self._ts.nbytes + self._valores.nbytes
+        if self._histograma is not None:
+            total += self._histograma.nbytes
+        return total
+
+    # --- Actualización ---
+
+    def _bin(self, valor):
+        indice = int((valor - self._hist_min) / self._ancho_bin)
+        return min(max(indice, 0), self._bins - 1)
+
+    def _expulsar(self):
+        valor = float(self._valores[self._inicio])
+        self._suma -= valor
+        self._suma_cuadrados -= valor * valor
+        for umbral in self._sobre:
+            if valor > umbral:
+                self._sobre[umbral] -= 1
+        for umbral in self._bajo:
+            if valor < umbral:
+                self._bajo[umbral] -= 1
+        if self._histograma is not None:
+            self._histograma[self._bin(valor)] -= 1
+
+        if self._cola_min and self._cola_min[0][0] == self._seq_inicio:
+            self._cola_min.popleft()
+        if self._cola_max and self._cola_max[0][0] == self._seq_inicio:
+            self._cola_max.popleft()
+
+        self._inicio = (self._inicio + 1) % self.capacidad
+        self._seq_inicio += 1
+        self.n -= 1
+
+        # Recalcular sumas de vez en cuando para evitar deriva numérica
+        self._expulsiones += 1
+        if self._expulsiones >= self.capacidad:
+            self._expulsiones = 0
+            valores = self.valores()
+            self._suma = float(valores.sum())
+            self._suma_cuadrados = float(np.dot(valores, valores))
+
+    def agregar(self, ts, valor):
+        """Añade una muestra (en orden de tiempo) y expulsa las que salen de la ventana."""
+        valor = float(valor)
+        if self.n == self.capacidad:
+            self._expulsar()
+
+        pos = (self._inicio + self.n) % self.capacidad
+        seq = self._seq_inicio + self.n
+        self._ts[pos] = ts
+        self._valores[pos] = valor
+        self.n += 1
+
+        self._suma += valor
+        self._suma_cuadrados += valor * valor
+        for umbral in self._sobre:
+            if valor > umbral:
+                self._sobre[umbral] += 1
+        for umbral in self._bajo:
+            if valor < umbral:
+                self._bajo[umbral] += 1
+        if self._histograma is not None:
+            self._histograma[self._bin(valor)] += 1
+
+        while self._cola_min and self._cola_min[-1][1] >= valor:
+            self._cola_min.pop()
+        self._cola_min.append((seq, valor))
+        while self._cola_max and self._cola_max[-1][1] <= valor:
+            self._cola_max.pop()
+        self._cola_max.append((seq, valor))
+
+        limite = ts - self.ventana_s
+        while self.n and self._ts[self._inicio] <= limite:
+            self._expulsar()
+
+    # --- Consultas ---
+
+    def ultimo_ts(self):
+        if not self.n:
+            return None
+        return float(self._ts[(self._inicio + self.n - 1) % self.capacidad])
+
+    def contar_sobre(self, umbral):
+        return self._sobre[float(umbral)]
+
+    def contar_bajo(self, umbral):
+        return self._bajo[float(umbral)]
+
+    def media(self):
+        return self._suma / self.n if self.n else None
+
+    def varianza(self, ddof=1):
+        """Varianza de la ventana (ddof=1 como pandas)."""
+        if self.n <= ddof:
+            return None
+        media = self._suma / self.n
+        varianza = (self._suma_cuadrados - self.n * media * media) / (self.n - ddof)
+        return max(varianza, 0.0)
+
+    def minimo(self):
+        return self._cola_min[0][1] if self._cola_min else None
+
+    def maximo(self):
+        return self._cola_max[0][1] if self._cola_max else None
+
+    def cuantil(self, q):
+        """
+        Cuantil aproximado a partir del histograma (interpolación dentro del bin).
+        Requiere haber creado la ventana con 'bins_histograma'.
+        """
+        if not self.n:
+            return None
+        if self._histograma is None:
+            return self.cuantil_exacto(q)
+        rango = q * (self.n - 1)
+        acumulado = np.cumsum(self._histograma)
+        indice = int(np.searchsorted(acumulado, rango, side='right'))
+        indice = min(indice, self._bins - 1)
+        previos = acumulado[indice - 1] if indice > 0 else 0
+        en_bin = self._histograma[indice]
+        fraccion = (rango - previos + 0.5) / en_bin if en_bin else 0.5
+        valor = self._hist_min + (indice + min(max(fraccion, 0.0), 1.0)) * self._ancho_bin
+        # El cuantil nunca sale del rango real observado
+        return min(max(valor, self.minimo()), self.maximo())
+
+    def cuantil_exacto(self, q):
+        """Cuantil exacto (O(n)), mismo método lineal que pandas."""
+        if not self.n:
+            return None
+        return float(np.quantile(self.valores(), q))
+
+    def valores(self):
+        """Valores vigentes de la ventana (en orden de llegada)."""
+        fin = self._inicio + self.n
+        if fin <= self.capacidad:
+            return self._valores[self._inicio:fin]
+        return np.concatenate((self._valores[self._inicio:], self._valores[:fin - self.capacidad]))
@@ -20,19 +20,30 @@ import requests
 import pandas as pd
 import os
 import json
-from datetime import date, datetime, timedelta
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
 import pytz
 from tenacity import retry, stop_after_attempt, wait_exponential
-import calendar
 import math
 from influxdb_client import InfluxDBClient
 
+from consumo_energia import asegurar_esquema_acumulados, obtener_consumo_periodo
+from outbox_notificaciones import NOTIFICACIONES_OUTBOX, asegurar_esquema_outbox, encolar_notificaciones, intenciones
+from facturacion_cfe import TARIFAS_CFE_UMBRALES, calcular_fechas_corte
+from eventos_consumo import DESCRIPCIONES, clasificar, detectar_eventos
+from perfil_carga import cargar_perfiles, franja
+from presencia_dispositivos import consultar_presencia
+
 # --- 2. Carga de Variables de Entorno ---
 load_dotenv()
 
 # --- 3. Configuración General ---
 ENVIAR_ALERTAS = True # Interruptor general para ambas plataformas
+# Si detector_streaming.py está corriendo, él se encarga de voltaje y fuga
+DETECCION_STREAMING = os.environ.get("DETECCION_STREAMING", "false").lower() == "true"
+# Calcula el resumen de la última hora dentro de InfluxDB (una fila por dispositivo
+# para toda la flota) en lugar de descargar las muestras crudas de cada cliente
+RESUMEN_EN_INFLUX = os.environ.get("RESUMEN_EN_INFLUX", "false").lower() == "true"
 
 DB_HOST = os.environ.get("DB_HOST")
 DB_USER = os.environ.get("DB_USER")
@@ -83,16 +94,15 @@ UMBRAL_FUGA_CORRIENTE_MINIMO = 0.5 # Umbral mínimo absoluto para CUALQUIER aler
 NUM_STRIKES_PARA_ALERTA_CONSUMO = 2
 DESVIACIONES_ESTANDAR_PARA_ANOMALIA_CONSUMO = 2.0
 PERIODO_APRENDIZAJE_MUESTRAS_CONSUMO = 20
+# Horas mínimas de una franja del perfil de carga para usarla como límite
+PERFIL_MIN_HORAS_FRANJA = int(os.environ.get("PERFIL_MIN_HORAS_FRANJA", 3))
 
 # Configuración para Detección de Anomalías (Fuga de Corriente Global)
 NUM_STRIKES_PARA_ALERTA_FUGA = 2 # Requiere 2 strikes consecutivos para alertar
 DESVIACIONES_ESTANDAR_PARA_ANOMALIA_FUGA = 4.0 # Más alto (4.0) para ignorar picos de ruido
 PERIODO_APRENDIZAJE_MUESTRAS_FUGA = 50 # Un periodo más largo (aprox 2 días) para establecer una línea base
 
-TARIFAS_CFE_UMBRALES = {
-    '01':  [{'limite': 150, 'precio_siguiente': 1.32, 'bandera': 'escalon1'}, {'limite': 280, 'precio_siguiente': 3.85, 'bandera': 'escalon2'}],
-    '01A': [{'limite': 200, 'precio_siguiente': 1.32, 'bandera': 'escalon1'}, {'limite': 400, 'precio_siguiente': 3.85, 'bandera': 'escalon2'}]
-}
+# Umbrales de escalón y calendario de cortes: ver facturacion_cfe.py
 
 # --- 4. Funciones ---
 
@@ -126,20 +136,23 @@ def obtener_clientes(conn):
         print(f"❌ ERROR al obtener clientes: {e}")
         return []
 
-@retry(wait=wait_exponential(multiplier=1, min=4, max=10), stop=stop_after_attempt(3))
-def enviar_alerta_whatsapp(telefono_destino, content_sid, content_variables):
-    """Envía un mensaje de WhatsApp o lo simula en pantalla según el interruptor."""
+def enviar_whatsapp_una_vez(telefono_destino, content_sid, content_variables):
+    """
+    Un solo intento de envío de WhatsApp (sin reintentos; el outbox tiene los suyos).
+    Devuelve (True, None) si se entregó o (False, motivo) si se omitió
+    (simulación, destino o plantilla vacíos). Los errores de red se lanzan.
+    """
     if not ENVIAR_ALERTAS:
         print("\n--- SIMULACIÓN DE ALERTA WHATSAPP (Envío desactivado) ---")
         print(f"    -> Destinatario: {telefono_destino}")
         print(f"    -> Plantilla (SID): {content_sid}")
         print(f"    -> Variables: {json.dumps(content_variables)}")
         print("---------------------------------------------------------")
-        return
+        return False, "envío desactivado (ENVIAR_ALERTAS=false)"
 
     if not telefono_destino or not content_sid:
         print(f"⚠️  Teléfono ({telefono_destino}) o Content SID ({content_sid}) vacío. No se envía alerta.")
-        return
+        return False, "teléfono o Content SID vacío"
     payload = {
         "ContentSid": content_sid,
         "ContentVariables": json.dumps(content_variables),
@@ -157,26 +170,35 @@ def enviar_alerta_whatsapp(telefono_destino, content_sid, content_variables):
     except requests.exceptions.RequestException as e:
         print(f"❌ ERROR de conexión al enviar alerta de WhatsApp: {e}")
         raise
+    return True, None
+
+@retry(wait=wait_exponential(multiplier=1, min=4, max=10), stop=stop_after_attempt(3))
+def enviar_alerta_whatsapp(telefono_destino, content_sid, content_variables):
+    """Envía un mensaje de WhatsApp o lo simula en pantalla según el interruptor. Devuelve True si se entregó."""
+    return enviar_whatsapp_una_vez(telefono_destino, content_sid, content_variables)[0]
 
 # --- ¡NUEVAS FUNCIONES DE TELEGRAM! ---
 
-@retry(wait=wait_exponential(multiplier=1, min=4, max=10), stop=stop_after_attempt(3))
-def enviar_alerta_telegram(chat_id, message_text):
-    """Envía un mensaje de Telegram o lo simula en pantalla."""
+def enviar_telegram_una_vez(chat_id, message_text):
+    """
+    Un solo intento de envío de Telegram (sin reintentos; el outbox tiene los suyos).
+    Devuelve (True, None) si se entregó o (False, motivo) si se omitió
+    (simulación, destino o mensaje vacíos, sin TELEGRAM_BOT_TOKEN). Los errores de red se lanzan.
+    """
     if not ENVIAR_ALERTAS:
         print("\n--- SIMULACIÓN DE ALERTA TELEGRAM (Envío desactivado) ---")
         print(f"    -> Destinatario (Chat ID): {chat_id}")
         print(f"    -> Mensaje: {message_text}")
         print("---------------------------------------------------------")
-        return
+        return False, "envío desactivado (ENVIAR_ALERTAS=false)"
 
     if not chat_id or not message_text:
         print(f"⚠️  Chat ID ({chat_id}) o Mensaje ({message_text}) vacío. No se envía alerta de Telegram.")
-        return
+        return False, "chat ID o mensaje vacío"
     
     if not TELEGRAM_BOT_TOKEN:
         print("⚠️ ⚠️  ADVERTENCIA: TELEGRAM_BOT_TOKEN no está configurado en .env. No se puede enviar alerta.")
-        return
+        return False, "TELEGRAM_BOT_TOKEN no configurado"
 
     url = f"https://api.telegram.org/bot{TELEGRAM_BOT_TOKEN}/sendMessage"
     payload = {
@@ -198,7 +220,13 @@ def enviar_alerta_telegram(chat_id, message_text):
             response.raise_for_status()
     except requests.exceptions.RequestException as e:
         print(f"❌ ERROR de conexión al enviar alerta de Telegram: {e}")
-        raise # Re-lanza para que tenacity pueda reintentar
+        raise # Re-lanza para que tenacity (o el outbox) pueda reintentar
+    return True, None
+
+@retry(wait=wait_exponential(multiplier=1, min=4, max=10), stop=stop_after_attempt(3))
+def enviar_alerta_telegram(chat_id, message_text):
+    """Envía un mensaje de Telegram o lo simula en pantalla. Devuelve True si se entregó."""
+    return enviar_telegram_una_vez(chat_id, message_text)[0]
 
 def formatear_mensaje_telegram(template_sid, variables):
     """
@@ -253,6 +281,32 @@ def formatear_mensaje_telegram(template_sid, variables):
 
 # --- Fin de Funciones de Telegram ---
 
+def periodo_hora_actual():
+    """Periodo de idempotencia para alertas que pueden repetirse cada hora."""
+    return datetime.now(ZONA_HORARIA_LOCAL).strftime('%Y-%m-%dT%H')
+
+def notificar(conn, device_id, telefono, telegram_chat_id, template_sid, variables, periodo, confirmar=True):
+    """
+    Envía la alerta por WhatsApp y Telegram o, con NOTIFICACIONES_OUTBOX, la deja
+    en 'notificaciones_outbox' (idempotente por dispositivo/plantilla/periodo/canal)
+    para enviador_notificaciones.py. Con confirmar=False el commit lo hace el
+    llamador junto con su bandera.
+    """
+    mensaje_telegram = formatear_mensaje_telegram(template_sid, variables)
+    if NOTIFICACIONES_OUTBOX:
+        try:
+            nuevas = encolar_notificaciones(conn, intenciones(
+                device_id, template_sid, variables, periodo, telefono, telegram_chat_id, mensaje_telegram
+            ))
+            if confirmar: conn.commit()
+            print(f"📨 {nuevas} notificación(es) nuevas en el outbox ({periodo}).")
+        except Exception as e:
+            conn.rollback()
+            print(f"❌ ERROR al encolar notificación para {device_id}: {e}")
+        return
+    enviar_alerta_whatsapp(telefono, template_sid, variables)
+    enviar_alerta_telegram(telegram_chat_id, mensaje_telegram)
+
 def marcar_notificacion_enviada(conn, device_id, tipo_bandera):
     """Actualiza una bandera de notificación en la base de datos."""
     banderas_permitidas = ['notificacion_escalon1_enviada', 'notificacion_escalon2_enviada']
@@ -276,14 +330,20 @@ def marcar_notificacion_enviada(conn, device_id, tipo_bandera):
         print(f"❌ ERROR al actualizar bandera de notificación para {device_id}: {e}")
 
 def actualizar_estadisticas(conn, device_id, estadisticas_actuales):
-    """Actualiza la columna JSONB de estadísticas para un cliente."""
+    """
+    Actualiza la columna JSONB de estadísticas para un cliente.
+    Hace merge de llaves (||) para no pisar lo que escribe detector_streaming.
+    """
     print(f"Actualizando estadísticas para {device_id}...")
+    if DETECCION_STREAMING:
+        # 'fuga_stats' es propiedad del detector en streaming
+        estadisticas_actuales = {k: v for k, v in estadisticas_actuales.items() if k != 'fuga_stats'}
     try:
         cursor = conn.cursor()
         # --- ¡CONSULTA MODIFICADA CON UPDATE...FROM...WHERE! ---
         sql = """
             UPDATE clientes c
-            SET estadisticas_consumo = %s
+            SET estadisticas_consumo = COALESCE(c.estadisticas_consumo, '{}'::jsonb) || %s::jsonb
             FROM dispositivos_lete d
             WHERE c.id = d.cliente_id AND d.device_id = %s
         """
@@ -323,65 +383,12 @@ def get_bloque_horario(hora):
     if 18 <= hora < 21: return "tarde"
     return "noche" # 21 a 23
 
-def calcular_fechas_corte(hoy_aware, dia_de_corte, ciclo_bimestral):
-    """Calcula la fecha de corte más reciente (el inicio del periodo actual)."""
-    hoy = hoy_aware.date()
-    candidatos_pasados = []
-    for i in range(12):
-        mes_candidato = hoy.month - i
-        ano_candidato = hoy.year
-        if mes_candidato <= 0:
-            mes_candidato += 12
-            ano_candidato -= 1
-        es_mes_par = (mes_candidato % 2 == 0)
-        if (ciclo_bimestral == 'par' and es_mes_par) or (ciclo_bimestral == 'impar' and not es_mes_par):
-            try:
-                dia = min(dia_de_corte, calendar.monthrange(ano_candidato, mes_candidato)[1])
-                fecha_candidata = date(ano_candidato, mes_candidato, dia)
-                if fecha_candidata <= hoy:
-                    candidatos_pasados.append(fecha_candidata)
-            except ValueError: continue
-    return max(candidatos_pasados) if candidatos_pasados else None
-
-def obtener_consumo_desde_influxdb(device_id, fecha_inicio_aware, fecha_fin_aware):
-    """
-    Obtiene el consumo total de un dispositivo (en kWh) desde InfluxDB 
-    para un rango de tiempo específico.
-    """
-    start_time = fecha_inicio_aware.isoformat()
-    stop_time = fecha_fin_aware.isoformat()
-
-    flux_query = f"""
-    from(bucket: "{INFLUX_BUCKET}")
-      |> range(start: {start_time}, stop: {stop_time})
-      |> filter(fn: (r) => r._measurement == "energia")
-      |> filter(fn: (r) => r._field == "power")
-      |> filter(fn: (r) => r.device_id == "{device_id}")
-      |> integral(unit: 1s)
-      |> map(fn: (r) => ({{ _value: r._value / 3600000.0 }}))
-      |> sum()
-    """
-    try:
-        with InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG, timeout=10_000) as client:
-            query_api = client.query_api()
-            tables = query_api.query(query=flux_query)
-            if tables and tables[0].records:
-                total_kwh = tables[0].records[0].get_value()
-                return total_kwh, None
-            else:
-                return None, None
-    except Exception as e:
-        print(f"❌ ERROR al consultar InfluxDB (kwh) para {device_id}: {e}")
-        return None, None
-
-def obtener_datos_influx_dataframe(device_id, minutos_atras):
-    """Obtiene un DataFrame de Pandas con los datos de InfluxDB de los últimos X minutos."""
-
-    ahora = datetime.now(ZONA_HORARIA_LOCAL)
-    tiempo_limite = ahora - timedelta(minutes=minutos_atras)
-    start_time = tiempo_limite.isoformat()
+# (el consumo en kWh vive en consumo_energia.py: acumulados horarios y acumulado del periodo)
 
-    flux_query = f"""
+def flux_datos_crudos(device_id, minutos_atras):
+    """Consulta de las muestras crudas (vrms, leakage, power) de un dispositivo."""
+    start_time = (datetime.now(ZONA_HORARIA_LOCAL) - timedelta(minutes=minutos_atras)).isoformat()
+    return f"""
     from(bucket: "{INFLUX_BUCKET}")
       |> range(start: {start_time})
       |> filter(fn: (r) => r._measurement == "energia")
@@ -391,6 +398,11 @@ def obtener_datos_influx_dataframe(device_id, minutos_atras):
       |> keep(columns: ["_time", "vrms", "leakage", "power"])
     """
 
+def obtener_datos_influx_dataframe(device_id, minutos_atras):
+    """Obtiene un DataFrame de Pandas con los datos de InfluxDB de los últimos X minutos."""
+
+    flux_query = flux_datos_crudos(device_id, minutos_atras)
+
     try:
         with InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG, timeout=10_000) as client:
             df = client.query_api().query_data_frame(query=flux_query)
@@ -406,21 +418,160 @@ def obtener_datos_influx_dataframe(device_id, minutos_atras):
         print(f"❌ ERROR al consultar InfluxDB (DataFrame) para {device_id}: {e}")
         return None
 
+def resumir_encendidos(df):
+    """Encendidos de aparatos en el DataFrame crudo (eventos_consumo.py)."""
+    if df is None or df.empty:
+        return {'encendidos': 0, 'mayor_encendido_w': 0.0}
+    eventos = detectar_eventos(df['timestamp_servidor'], df['power'].to_numpy(dtype=float))
+    return {
+        'encendidos': len(eventos),
+        'mayor_encendido_w': float(eventos['escalon_w'].max()) if len(eventos) else 0.0,
+    }
+
+def resumir_dataframe(df):
+    """
+    Reduce el DataFrame de la última hora a las métricas que usan los chequeos.
+    Devuelve None si no hay datos (mismo significado que df=None).
+    """
+    if df is None or df.empty:
+        return None
+    return {
+        'picos_altos': int((df['vrms'] > UMBRAL_VOLTAJE_ALTO).sum()),
+        'picos_bajos': int((df['vrms'] < UMBRAL_VOLTAJE_BAJO).sum()),
+        'fuga_p25': df['leakage'].quantile(0.25),
+        'potencia_media': df['power'].mean(),
+        'ultima_medicion': df['timestamp_servidor'].max(),
+        # Encendidos de aparatos en la hora (eventos_consumo.py)
+        **resumir_encendidos(df),
+    }
+
+def flux_cuantil_lineal(nombre, flujo, q):
+    """
+    Fragmento Flux que calcula el cuantil 'q' por device_id con la misma
+    interpolación lineal que pandas (Series.quantile): con los valores
+    ordenados x[0..n-1] y h = q*(n-1), x[piso(h)] + (h - piso(h))*(x[piso(h)+1] - x[piso(h)]).
+    (quantile() de Flux no garantiza ese método.) 'flujo' es una expresión con
+    columnas device_id y _value; el resultado sale con yield(name: nombre).
+    La consulta que lo use debe empezar con import "math".
+    """
+    return f"""
+    {nombre}_ordenado = {flujo}
+      |> group(columns: ["device_id"])
+      |> sort(columns: ["_value"])
+      |> map(fn: (r) => ({{device_id: r.device_id, _value: float(v: r._value), i: 1}}))
+      |> cumulativeSum(columns: ["i"])
+    {nombre}_posicion = {nombre}_ordenado
+      |> count(column: "i")
+      |> map(fn: (r) => ({{device_id: r.device_id, h: {float(q)} * float(v: r.i - 1)}}))
+    join(tables: {{v: {nombre}_ordenado, p: {nombre}_posicion}}, on: ["device_id"])
+      |> map(fn: (r) => ({{device_id: r.device_id, _value: r._value, k: float(v: r.i - 1), piso: math.floor(x: r.h), h: r.h}}))
+      |> filter(fn: (r) => r.k == r.piso or r.k == r.piso + 1.0)
+      |> map(fn: (r) => ({{device_id: r.device_id, _value: r._value * (if r.k == r.piso then 1.0 - (r.h - r.piso) else r.h - r.piso)}}))
+      |> group(columns: ["device_id"])
+      |> sum()
+      |> yield(name: "{nombre}")
+    """
+
+def flux_resumen_flota(minutos_atras):
+    """Consulta que agrega dentro de InfluxDB el resumen de todos los dispositivos."""
+    start_time = (datetime.now(ZONA_HORARIA_LOCAL) - timedelta(minutes=minutos_atras)).isoformat()
+    return f"""
+    import "math"
+
+    datos = from(bucket: "{INFLUX_BUCKET}")
+      |> range(start: {start_time})
+      |> filter(fn: (r) => r._measurement == "energia")
+      |> filter(fn: (r) => r._field == "vrms" or r._field == "leakage" or r._field == "power")
+      |> group(columns: ["device_id", "_field"])
+
+    vrms = datos |> filter(fn: (r) => r._field == "vrms")
+    vrms |> filter(fn: (r) => r._value > {float(UMBRAL_VOLTAJE_ALTO)}) |> count() |> yield(name: "picos_altos")
+    vrms |> filter(fn: (r) => r._value < {float(UMBRAL_VOLTAJE_BAJO)}) |> count() |> yield(name: "picos_bajos")
+    {flux_cuantil_lineal("fuga_p25", 'datos |> filter(fn: (r) => r._field == "leakage")', 0.25)}
+    datos |> filter(fn: (r) => r._field == "power") |> mean() |> yield(name: "potencia_media")
+    datos |> last() |> yield(name: "ultima_medicion")
+    """
+
+def obtener_resumenes_influx(minutos_atras):
+    """
+    Mismo resumen que resumir_dataframe(), calculado dentro de InfluxDB para
+    todos los dispositivos en una sola consulta: conteos sobre flujos
+    filtrados, p25 con la interpolación lineal de pandas (flux_cuantil_lineal),
+    mean y last.
+    Devuelve {device_id: resumen} (sin 'encendidos', que necesitan la serie
+    cruda) o None si la consulta falla.
+    """
+    flux_query = flux_resumen_flota(minutos_atras)
+
+    try:
+        with InfluxDBClient(url=INFLUX_URL, token=INFLUX_TOKEN, org=INFLUX_ORG, timeout=30_000) as client:
+            tablas = client.query_api().query(query=flux_query)
+    except Exception as e:
+        print(f"❌ ERROR al consultar el resumen agregado en InfluxDB: {e}")
+        return None
+
+    resumenes = {}
+    for table in tablas:
+        for record in table.records:
+            device_id = record.values.get('device_id')
+            resumen = resumenes.setdefault(device_id, {
+                'picos_altos': 0, 'picos_bajos': 0,
+                'fuga_p25': float('nan'), 'potencia_media': float('nan'),
+                'ultima_medicion': None,
+            })
+            nombre = record.values.get('result')
+            if nombre == 'ultima_medicion':
+                momento = pd.Timestamp(record.get_time()).tz_convert(ZONA_HORARIA_LOCAL)
+                if resumen['ultima_medicion'] is None or momento > resumen['ultima_medicion']:
+                    resumen['ultima_medicion'] = momento
+            elif nombre in ('picos_altos', 'picos_bajos'):
+                resumen[nombre] = int(record.get_value())
+            elif nombre in ('fuga_p25', 'potencia_media'):
+                resumen[nombre] = float(record.get_value())
+    return resumenes
+
+def resumir_ventanas_moviles(ventana_vrms, ventana_fuga, ventana_potencia):
+    """
+    Mismo resumen que resumir_dataframe(), pero leído de ventanas móviles
+    (ventana_movil.VentanaMovil) ya mantenidas en memoria: no hace ninguna consulta.
+    Lo usa detector_streaming.py para correr los chequeos horarios.
+    'ventana_vrms' debe tener UMBRAL_VOLTAJE_ALTO/BAJO como umbrales. El p25 es
+    el exacto (mismo método que pandas) para que las decisiones no cambien.
+    """
+    if not ventana_vrms.n:
+        return None
+    return {
+        'picos_altos': ventana_vrms.contar_sobre(UMBRAL_VOLTAJE_ALTO),
+        'picos_bajos': ventana_vrms.contar_bajo(UMBRAL_VOLTAJE_BAJO),
+        'fuga_p25': ventana_fuga.cuantil_exacto(0.25),
+        'potencia_media': ventana_potencia.media(),
+        'ultima_medicion': datetime.fromtimestamp(ventana_vrms.ultimo_ts(), tz=ZONA_HORARIA_LOCAL),
+    }
+
 # --- Funciones de Verificación de Alertas (MODIFICADAS) ---
 
 # --- ¡FUNCIÓN MODIFICADA! ---
-def verificar_primera_medicion(conn, cliente):
-    """Verifica si es la primera medición y envía felicitación."""
+def verificar_primera_medicion(conn, cliente, presencias=None):
+    """
+    Verifica si es la primera medición y envía felicitación.
+    'presencias' es el registro del receptor (presencia_dispositivos.py) para
+    toda la flota; si no está disponible se consulta InfluxDB.
+    """
     if cliente['primera_medicion_recibida']:
         return False # Ya se procesó, no hacer nada.
     
     print(f"-> {cliente['nombre']}: Verificando primera medición...")
     
-    # Consultamos InfluxDB. Si hay CUALQUIER dato reciente, es la primera vez.
-    # Usamos 60 minutos para coincidir con la frecuencia del script
-    df_check = obtener_datos_influx_dataframe(cliente['device_id'], 60) 
+    if presencias is not None:
+        # El receptor ya vio al menos una medición de este dispositivo
+        hay_datos = cliente['device_id'] in presencias
+    else:
+        # Consultamos InfluxDB. Si hay CUALQUIER dato reciente, es la primera vez.
+        # Usamos 60 minutos para coincidir con la frecuencia del script
+        df_check = obtener_datos_influx_dataframe(cliente['device_id'], 60) 
+        hay_datos = df_check is not None and not df_check.empty
     
-    if df_check is not None and not df_check.empty:
+    if hay_datos:
         print(f"🎉 ¡PRIMERA MEDICIÓN RECIBIDA para {cliente['nombre']}!")
         
         # 1. Enviar felicitación
@@ -429,10 +580,9 @@ def verificar_primera_medicion(conn, cliente):
         else:
             variables = {"1": cliente['nombre']}
             
-            # Enviar a ambos canales
-            mensaje_telegram = formatear_mensaje_telegram(TPL_FELICITACION_CONEXION, variables)
-            enviar_alerta_whatsapp(cliente['telefono_whatsapp'], TPL_FELICITACION_CONEXION, variables)
-            enviar_alerta_telegram(cliente['telegram_chat_id'], mensaje_telegram)
+            # Enviar a ambos canales (con outbox, se confirma junto con la bandera)
+            notificar(conn, cliente['device_id'], cliente['telefono_whatsapp'], cliente['telegram_chat_id'],
+                      TPL_FELICITACION_CONEXION, variables, 'primera_medicion', confirmar=False)
         
         # 2. Actualizar la bandera en la BD
         try:
@@ -455,7 +605,12 @@ def verificar_primera_medicion(conn, cliente):
         return False
 
 # --- ¡FUNCIÓN MODIFICADA! ---
-def verificar_dispositivo_offline(df, cliente):
+def verificar_dispositivo_offline(conn, resumen, cliente, presencias=None):
+    """
+    Alerta al admin si el dispositivo no reporta hace más de 60 minutos. Con
+    'presencias' (registro del receptor) la última medición sale de ahí;
+    si no, del resumen de la última hora.
+    """
     # --- ¡NUEVA GUARDIA! ---
     if not cliente['primera_medicion_recibida']:
         print("-> Dispositivo aún no reporta su primera medición. Omitiendo chequeo offline.")
@@ -464,64 +619,75 @@ def verificar_dispositivo_offline(df, cliente):
 
     print("-> Verificando estado de conexión...")
     variables = {"1": cliente['nombre']}
-    mensaje_telegram = formatear_mensaje_telegram(TPL_DISPOSITIVO_OFFLINE, variables)
         
-    if df is None:
-        enviar_alerta_whatsapp(ADMIN_WHATSAPP_NUMBER, TPL_DISPOSITIVO_OFFLINE, variables)
-        enviar_alerta_telegram(ADMIN_TELEGRAM_CHAT_ID, mensaje_telegram)
+    if presencias is not None:
+        presencia = presencias.get(cliente['device_id'])
+        ultima_medicion = presencia['ultima_medicion'] if presencia else None
+    else:
+        ultima_medicion = resumen['ultima_medicion'] if resumen is not None else None
+
+    if ultima_medicion is None:
+        notificar(conn, cliente['device_id'], ADMIN_WHATSAPP_NUMBER, ADMIN_TELEGRAM_CHAT_ID,
+                  TPL_DISPOSITIVO_OFFLINE, variables, periodo_hora_actual())
         return
 
-    ultima_medicion = df['timestamp_servidor'].max()
     minutos_desde_ultima_medicion = (datetime.now(ZONA_HORARIA_LOCAL) - ultima_medicion).total_seconds() / 60
     
     if minutos_desde_ultima_medicion > 60:
-        enviar_alerta_whatsapp(ADMIN_WHATSAPP_NUMBER, TPL_DISPOSITIVO_OFFLINE, variables)
-        enviar_alerta_telegram(ADMIN_TELEGRAM_CHAT_ID, mensaje_telegram)
+        notificar(conn, cliente['device_id'], ADMIN_WHATSAPP_NUMBER, ADMIN_TELEGRAM_CHAT_ID,
+                  TPL_DISPOSITIVO_OFFLINE, variables, periodo_hora_actual())
         
-def verificar_voltaje(conn, df, cliente): # <-- Añadido 'conn'
-    if df is None: 
+def verificar_voltaje(conn, resumen, cliente, alertar=True): # <-- Añadido 'conn'
+    """
+    Actualiza 'alerta_voltaje_estado' y alerta si hubo picos o caídas.
+    Con alertar=False solo actualiza el estado. Devuelve el estado ('alto', 'bajo', 'normal').
+    """
+    if resumen is None: 
         # Si no hay datos, no podemos asumir que es 'normal', mantenemos el estado anterior
         return
     print("-> Verificando voltaje...")
     
     device_id = cliente['device_id'] # Obtenemos el device_id para actualizar
     
-    picos_altos = df[df['vrms'] > UMBRAL_VOLTAJE_ALTO].shape[0]
+    picos_altos = resumen['picos_altos']
     if picos_altos >= CANTIDAD_EVENTOS_VOLTAJE_PARA_ALERTA:
         variables = {"1": cliente['nombre'], "2": str(picos_altos)}
         
-        mensaje_telegram = formatear_mensaje_telegram(TPL_PICOS_VOLTAJE, variables)
-        enviar_alerta_whatsapp(cliente['telefono_whatsapp'], TPL_PICOS_VOLTAJE, variables)
-        enviar_alerta_telegram(cliente['telegram_chat_id'], mensaje_telegram)
+        if alertar:
+            notificar(conn, device_id, cliente['telefono_whatsapp'], cliente['telegram_chat_id'],
+                      TPL_PICOS_VOLTAJE, variables, periodo_hora_actual())
         
         # --- ¡MEJORA AÑADIDA! ---
         actualizar_estado_db(conn, device_id, 'alerta_voltaje_estado', 'alto')
-        return # Salimos para no sobrescribir el estado 'alto' con 'normal'
+        return 'alto' # Salimos para no sobrescribir el estado 'alto' con 'normal'
 
-    picos_bajos = df[df['vrms'] < UMBRAL_VOLTAJE_BAJO].shape[0]
+    picos_bajos = resumen['picos_bajos']
     if picos_bajos >= CANTIDAD_EVENTOS_VOLTAJE_PARA_ALERTA:
         variables = {"1": cliente['nombre']}
         
-        mensaje_telegram = formatear_mensaje_telegram(TPL_BAJO_VOLTAJE, variables)
-        enviar_alerta_whatsapp(cliente['telefono_whatsapp'], TPL_BAJO_VOLTAJE, variables)
-        enviar_alerta_telegram(cliente['telegram_chat_id'], mensaje_telegram)
+        if alertar:
+            notificar(conn, device_id, cliente['telefono_whatsapp'], cliente['telegram_chat_id'],
+                      TPL_BAJO_VOLTAJE, variables, periodo_hora_actual())
         
         # --- ¡MEJORA AÑADIDA! ---
         actualizar_estado_db(conn, device_id, 'alerta_voltaje_estado', 'bajo')
-        return # Salimos para no sobrescribir el estado 'bajo' con 'normal'
+        return 'bajo' # Salimos para no sobrescribir el estado 'bajo' con 'normal'
 
     # --- ¡MEJORA AÑADIDA! ---
     # Si no hubo picos ni caídas, marcamos el estado como 'normal'
     actualizar_estado_db(conn, device_id, 'alerta_voltaje_estado', 'normal')
+    return 'normal'
 
-def verificar_fuga_corriente(conn, df, cliente): # <-- Añadido 'conn'
+def verificar_fuga_corriente(conn, resumen, cliente, alertar=True): # <-- Añadido 'conn'
     """
     Verifica la fuga de corriente usando una LÓGICA HÍBRIDA.
     1. Durante el aprendizaje: Compara la media actual vs UMBRAL FIJO (0.5A)
     2. Post-aprendizaje: Compara la media actual vs LÍNEA BASE EWMA
     ¡MODIFICADO! Ahora escribe el estado (True/False) en la columna 'alerta_fuga_activa'.
+    Con alertar=False no envía el mensaje (el modelo y el estado sí se actualizan).
+    Devuelve True si se alcanzaron los strikes de alerta.
     """
-    if df is None: return
+    if resumen is None: return False
     print("-> Verificando fuga de corriente (Lógica Híbrida v2.6)...")
     
     device_id = cliente['device_id'] # Obtenemos el device_id
@@ -533,9 +699,7 @@ def verificar_fuga_corriente(conn, df, cliente): # <-- Añadido 'conn'
     })
 
     # 2. Calcular datos actuales... (Todo tu código existente)
-    fuga_actual_media = df['leakage'].quantile(0.25) # <--- Esta línea es tuya, pero ¿estás seguro de .quantile(0.25)? 'mean()' devuelve un solo número, 'quantile()' fallaría. 
-                                                          # Asumiré que tu lógica es `df['leakage'].quantile(0.25)` o solo `df['leakage'].mean()`
-                                                          # Por ahora, la dejaré como está.
+    fuga_actual_media = resumen['fuga_p25'] # Cuantil 25 de 'leakage' en la ventana
 
     # 3. Comparar con el modelo estadístico... (Todo tu código existente)
     media_hist = stats_fuga['media']
@@ -544,6 +708,7 @@ def verificar_fuga_corriente(conn, df, cliente): # <-- Añadido 'conn'
     limite_superior_ewma = media_hist + (DESVIACIONES_ESTANDAR_PARA_ANOMALIA_FUGA * desv_std)
     
     es_anomalia = False
+    alerta = False
     
     if stats_fuga['n_muestras'] < PERIODO_APRENDIZAJE_MUESTRAS_FUGA:
         # --- MODO APRENDIZAJE ---
@@ -564,12 +729,13 @@ def verificar_fuga_corriente(conn, df, cliente): # <-- Añadido 'conn'
         print(f"       -> ¡ANOMALÍA DE FUGA! Media actual: {fuga_actual_media:.3f}A. Strike #{stats_fuga['strikes']}.")
         
         if stats_fuga['strikes'] >= NUM_STRIKES_PARA_ALERTA_FUGA:
-            print("       -> ¡ALERTA DE FUGA ENVIADA!")
+            alerta = True
             variables = {"1": cliente['nombre']}
             
-            mensaje_telegram = formatear_mensaje_telegram(TPL_FUGA_CORRIENTE, variables)
-            enviar_alerta_whatsapp(cliente['telefono_whatsapp'], TPL_FUGA_CORRIENTE, variables)
-            enviar_alerta_telegram(cliente['telegram_chat_id'], mensaje_telegram)
+            if alertar:
+                print("       -> ¡ALERTA DE FUGA ENVIADA!")
+                notificar(conn, device_id, cliente['telefono_whatsapp'], cliente['telegram_chat_id'],
+                          TPL_FUGA_CORRIENTE, variables, periodo_hora_actual())
             
             # --- ¡MEJORA AÑADIDA! ---
             # Le decimos a la DB que la fuga está ACTIVA
@@ -598,15 +764,20 @@ def verificar_fuga_corriente(conn, df, cliente): # <-- Añadido 'conn'
     # 6. ACTUALIZAR EL OBJETO 'cliente' EN MEMORIA... (Todo tu código existente)
     estadisticas['fuga_stats'] = stats_fuga
     cliente['estadisticas_consumo'] = estadisticas
+    return alerta
 
-def verificar_anomalia_consumo(conn, df, cliente):
-    """Compara el consumo actual con el perfil estadístico del cliente."""
-    if df is None: return
+def verificar_anomalia_consumo(conn, resumen, cliente, perfil=None):
+    """
+    Compara el consumo actual con el perfil estadístico del cliente. Si hay
+    un perfil de carga (perfil_carga.py) con suficientes horas en la franja
+    de la última hora, el límite sale de esa franja; si no, del EWMA por bloque.
+    """
+    if resumen is None: return
     print("-> Verificando anomalías de consumo...")
 
     ahora = datetime.now(ZONA_HORARIA_LOCAL)
     bloque_actual = get_bloque_horario(ahora.hour)
-    consumo_actual = df['power'].mean()
+    consumo_actual = resumen['potencia_media']
 
     estadisticas = cliente['estadisticas_consumo'] if cliente['estadisticas_consumo'] is not None else {}
     
@@ -623,9 +794,23 @@ def verificar_anomalia_consumo(conn, df, cliente):
     varianza = stats_bloque['varianza']
     desv_std = math.sqrt(varianza) if varianza > 0 else 0
     limite_superior = media + (DESVIACIONES_ESTANDAR_PARA_ANOMALIA_CONSUMO * desv_std)
-    
+
+    # Franja (hora de la semana, UTC) a la mitad de la ventana de la última hora
+    media_franja, desv_franja, horas_franja = (None, None, 0.0)
+    if perfil is not None:
+        mitad_ventana = ahora - timedelta(minutes=30)
+        media_franja, desv_franja, horas_franja = perfil.media_desviacion(
+            franja(int(mitad_ventana.timestamp()) * 1_000_000_000))
+
     es_anomalia = False
-    if stats_bloque['n_muestras'] < PERIODO_APRENDIZAJE_MUESTRAS_CONSUMO:
+    if horas_franja >= PERFIL_MIN_HORAS_FRANJA:
+        α = 0.1
+        media = media_franja
+        limite_superior = media_franja + DESVIACIONES_ESTANDAR_PARA_ANOMALIA_CONSUMO * max(desv_franja, 0.1 * media_franja)
+        print(f"    -> Límite desde el perfil de carga ({horas_franja:.0f} horas en la franja).")
+        if consumo_actual > limite_superior:
+            es_anomalia = True
+    elif stats_bloque['n_muestras'] < PERIODO_APRENDIZAJE_MUESTRAS_CONSUMO:
         print(f"    -> En periodo de aprendizaje para '{bloque_actual}' ({stats_bloque['n_muestras'] + 1} muestras).")
         α = 0.2
         if consumo_actual > (media * 3): # Alerta solo para anomalías extremas
@@ -638,14 +823,20 @@ def verificar_anomalia_consumo(conn, df, cliente):
     if es_anomalia:
         stats_bloque['strikes'] += 1
         print(f"    -> ¡ANOMALÍA! Consumo: {consumo_actual:.0f}W, Límite: {limite_superior:.0f}W. Strike #{stats_bloque['strikes']}.")
+        if 'encendidos' not in resumen:
+            # Resumen agregado en InfluxDB: solo aquí hace falta la serie cruda
+            resumen.update(resumir_encendidos(obtener_datos_influx_dataframe(cliente['device_id'], 60)))
+        if resumen.get('encendidos'):
+            mayor = resumen['mayor_encendido_w']
+            print(f"       -> {resumen['encendidos']} encendidos en la última hora; el mayor de +{mayor:.0f}W "
+                  f"({DESCRIPCIONES[clasificar(mayor)]})")
         if stats_bloque['strikes'] >= NUM_STRIKES_PARA_ALERTA_CONSUMO:
             porcentaje = ((consumo_actual / media - 1) * 100) if media > 0 else 0
             hora_legible = ahora.strftime('%I:%M %p')
             variables = {"1": cliente['nombre'], "2": hora_legible, "3": f"{porcentaje:.0f}"}
             
-            mensaje_telegram = formatear_mensaje_telegram(TPL_CONSUMO_FANTASMA, variables)
-            enviar_alerta_whatsapp(cliente['telefono_whatsapp'], TPL_CONSUMO_FANTASMA, variables)
-            enviar_alerta_telegram(cliente['telegram_chat_id'], mensaje_telegram)
+            notificar(conn, cliente['device_id'], cliente['telefono_whatsapp'], cliente['telegram_chat_id'],
+                      TPL_CONSUMO_FANTASMA, variables, periodo_hora_actual())
             
             stats_bloque['strikes'] = 0
     else:
@@ -675,7 +866,7 @@ def verificar_brinco_escalon(conn, cliente):
     print("-> Verificando brinco de escalón de tarifa...")
     if cliente['tipo_tarifa'] not in TARIFAS_CFE_UMBRALES: return
 
-    ultima_corte = calcular_fechas_corte(datetime.now(ZONA_HORARIA_LOCAL), cliente['dia_de_corte'], cliente['ciclo_bimestral'])
+    ultima_corte, _ = calcular_fechas_corte(datetime.now(ZONA_HORARIA_LOCAL), cliente['dia_de_corte'], cliente['ciclo_bimestral'])
     if not ultima_corte: 
         print("    -> No se pudo calcular la última fecha de corte. Omitiendo brinco de escalón.")
         return
@@ -703,7 +894,8 @@ def verificar_brinco_escalon(conn, cliente):
     inicio_periodo_aware = ZONA_HORARIA_LOCAL.localize(datetime.combine(fecha_inicio_medicion, datetime.min.time()))
     fin_periodo_aware = datetime.now(ZONA_HORARIA_LOCAL)
     
-    kwh_medidos_influx, _ = obtener_consumo_desde_influxdb(device_id, inicio_periodo_aware, fin_periodo_aware)
+    # Acumulado incremental: solo integra lo nuevo desde la corrida anterior
+    kwh_medidos_influx, _ = obtener_consumo_periodo(conn, device_id, inicio_periodo_aware, fin_periodo_aware)
     if kwh_medidos_influx is None: kwh_medidos_influx = 0.0
 
     # 3. Aplicar la lógica del "Primer Periodo" (Solo si hay datos de lectura inicial)
@@ -742,9 +934,9 @@ def verificar_brinco_escalon(conn, cliente):
         if kwh_acumulados > umbral['limite'] and not cliente[bandera_notificacion]:
             variables = {"1": cliente['nombre'], "2": f"{umbral['precio_siguiente']:.2f}"}
             
-            mensaje_telegram = formatear_mensaje_telegram(TPL_BRINCO_ESCALON, variables)
-            enviar_alerta_whatsapp(cliente['telefono_whatsapp'], TPL_BRINCO_ESCALON, variables)
-            enviar_alerta_telegram(cliente['telegram_chat_id'], mensaje_telegram)
+            # Un aviso por escalón y periodo (con outbox, se confirma junto con la bandera)
+            notificar(conn, device_id, cliente['telefono_whatsapp'], cliente['telegram_chat_id'],
+                      TPL_BRINCO_ESCALON, variables, f"{ultima_corte.isoformat()}|{umbral['bandera']}", confirmar=False)
             
             marcar_notificacion_enviada(conn, device_id, bandera_notificacion)
             break    
@@ -765,35 +957,72 @@ def main():
         print(f"❌ ERROR de conexión con la Base de Datos. Abortando. Detalles: {e}")
         return
 
+    try:
+        asegurar_esquema_acumulados(conn)
+        if NOTIFICACIONES_OUTBOX:
+            asegurar_esquema_outbox(conn)
+            conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"⚠️  No se pudo verificar la tabla de acumulados (se usará la consulta completa): {e}")
+
+    try:
+        perfiles = cargar_perfiles(conn)
+    except Exception as e:
+        conn.rollback()
+        perfiles = {}
+        print(f"⚠️  No se pudieron cargar los perfiles de carga (se usará el EWMA por bloque): {e}")
+
     clientes = obtener_clientes(conn)
     if not clientes:
         print("No hay clientes para procesar. Terminando script.")
         if conn: conn.close()
         return
 
+    # Presencia de toda la flota en un SELECT (la mantiene receptor_mqtt.py)
+    try:
+        presencias = consultar_presencia(conn, [cliente['device_id'] for cliente in clientes])
+        # Tabla vacía: el receptor aún no la mantiene, se sigue usando InfluxDB
+        presencias = presencias or None
+    except Exception as e:
+        conn.rollback()
+        presencias = None
+        print(f"⚠️  No se pudo leer la presencia de dispositivos (se consultará InfluxDB): {e}")
+
+    resumenes = obtener_resumenes_influx(60) if RESUMEN_EN_INFLUX else None
+    if resumenes is not None:
+        print(f"✅ Resumen de la última hora agregado en InfluxDB ({len(resumenes)} dispositivos con datos).")
+
     for cliente in clientes:
         print(f"\n--- Verificando alertas para: {cliente['nombre']} ({cliente['device_id']}) ---")
 
         # --- ¡NUEVA LÓGICA DE PRIMERA MEDICIÓN! ---
-        fue_la_primera_medicion = verificar_primera_medicion(conn, cliente)
+        fue_la_primera_medicion = verificar_primera_medicion(conn, cliente, presencias)
         if fue_la_primera_medicion:
             continue # Saltar el resto de chequeos en esta primera ejecución
         # --- FIN DE LÓGICA ---
 
-        df_ultima_hora = obtener_datos_influx_dataframe(cliente['device_id'], 60)
+        if resumenes is not None:
+            resumen_ultima_hora = resumenes.get(cliente['device_id'])
+        else:
+            df_ultima_hora = obtener_datos_influx_dataframe(cliente['device_id'], 60)
+            resumen_ultima_hora = resumir_dataframe(df_ultima_hora)
+
+        verificar_dispositivo_offline(conn, resumen_ultima_hora, cliente, presencias)
 
-        verificar_dispositivo_offline(df_ultima_hora, cliente)
-        verificar_voltaje(conn, df_ultima_hora, cliente)
-        
-        # --- ¡MODIFICACIÓN IMPORTANTE DEL FLUJO! ---
-        # 1. 'verificar_fuga_corriente' ahora se ejecuta PRIMERO.
-        #    Modifica el dict 'cliente['estadisticas_consumo']' en memoria.
-        verificar_fuga_corriente(conn, df_ultima_hora, cliente)
+        # Con DETECCION_STREAMING, voltaje y fuga se evalúan en detector_streaming.py
+        if not DETECCION_STREAMING:
+            verificar_voltaje(conn, resumen_ultima_hora, cliente)
+
+            # --- ¡MODIFICACIÓN IMPORTANTE DEL FLUJO! ---
+            # 1. 'verificar_fuga_corriente' ahora se ejecuta PRIMERO.
+            #    Modifica el dict 'cliente['estadisticas_consumo']' en memoria.
+            verificar_fuga_corriente(conn, resumen_ultima_hora, cliente)
         
         # 2. 'verificar_anomalia_consumo' se ejecuta DESPUÉS.
         #    Lee el dict modificado, añade sus propios cambios,
         #    y guarda TODO (fuga + consumo) en la BD.
-        verificar_anomalia_consumo(conn, df_ultima_hora, cliente)
+        verificar_anomalia_consumo(conn, resumen_ultima_hora, cliente, perfiles.get(cliente['device_id']))
         # --- Fin de la modificación del flujo ---
         
         verificar_brinco_escalon(conn, cliente)